@@ -0,0 +1,636 @@
+"""Benchmarks of interfile ingest - header conversion, listmode decoding, scan creation,
+PET_RAW uploads and concurrent ingestion - against the in-process fake XNAT server (see
+tests/fake_xnat.py), so they run anywhere in seconds to minutes.
+
+Results are written to JSON, with the commit and environment they were run on, so they can
+be compared across commits. Run from the python directory:
+
+    python -m benchmarks.run_benchmarks --output benchmark_results.json
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import numpy as np
+import xnat
+
+from tests.fake_xnat import FakeXNATServer
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.batch_ingest import Acquisition, ingest_acquisitions
+from xnat_interfile.header_cache import HeaderCache, cached_read_listmode_header_2_xnat
+from xnat_interfile.interfile_2_xnat import read_listmode_header_2_xnat
+from xnat_interfile.interfile_header import read_interfile_header
+from xnat_interfile.label_index import LabelIndex, label_exists, subjects_uri
+from xnat_interfile.listmode_stats import listmode_event_stats
+from xnat_interfile.metrics import MetricsRecorder
+from xnat_interfile.populate_datatype_fields import (
+    add_experiment,
+    add_scan,
+    create_scan,
+    create_subject,
+    put_scan,
+    verify_project_exists,
+)
+
+logger = logging.getLogger(__name__)
+
+PROJECT = "benchmark_project"
+
+# Random prompts following each 1 ms time tag in the synthetic listmode data (~100 kcps)
+EVENTS_PER_MS = 99
+
+# A representative (Siemens mMR) listmode header, so header parsing is timed on a
+# realistic number of keys
+MMR_HEADER = """!INTERFILE:=
+%comment:=SMS-MI header
+!originating system:=2008
+%SMS-MI header name space:=sinogram subheader
+%SMS-MI version number:=3.4
+!GENERAL DATA:=
+%sinogram header file:={name}.s.hdr
+!name of data file:={name}.l
+!GENERAL IMAGE DATA:=
+%study date (yyyy:mm:dd):=2017:08:09
+%study time (hh:mm:ss GMT+00:00):=10:24:31
+isotope name:=F-18
+isotope gamma halflife (sec):=6586.2
+isotope branching factor:=0.9686
+radiopharmaceutical:=Fluorodeoxyglucose
+%tracer injection date (yyyy:mm:dd):=2017:08:09
+%tracer injection time (hh:mm:ss GMT+00:00):=10:20:00
+relative time of tracer injection (sec):=271
+tracer activity at time of injection (Bq):=4.3e+07
+injected volume (ml):=0
+patient orientation:=HFS
+patient rotation:=supine
+imagedata byte order:=LITTLEENDIAN
+%patient orientation:=HFS
+!PET data type:=emission
+%LM event and tag words format (bits):=32
+%SMS-MI header name space:=listmode
+%LM event and tag words format:=32-bit
+%timing tagwords interval (msec):=1
+%scanner type:=mMR
+%energy window lower level[1]:=430
+%energy window upper level[1]:=610
+%number of energy windows:=1
+%axial compression:=11
+%maximum ring difference:=60
+number of rings:=64
+%number of TOF time bins:=1
+segment table:={{127,115,115,93,93,71,71,49,49,27,27}}
+%total listmode word counts:={n_words}
+%DATA MATRIX DESCRIPTION:=
+number of time frames:=1
+%number of horizontal bed offsets:=1
+number of time windows:=1
+!image duration (sec)[1]:={duration}
+image relative start time (sec)[1]:=0
+%image duration from timing tags (msec):={duration_ms}
+%GIM loss fraction:=1
+%PDR loss fraction:=1
+%DETECTOR SPECIFIC:=
+%crystal ring diameter (cm):=65.6
+%crystal layer depth (cm):=2
+%transaxial crystal pitch (mm):=4.0
+%axial crystal pitch (mm):=4.0
+%total number of blocks per ring:=56
+%total number of crystals per block (transaxial):=8
+%total number of crystals per block (axial):=8
+!END OF INTERFILE:=
+"""
+
+
+@dataclass
+class BenchmarkConfig:
+    """Sizes of the benchmarks - the defaults take a few minutes on a typical node"""
+
+    # size (MB) of the synthetic listmode data of each upload / decoding benchmark
+    data_size_mb: float = 64.0
+    # size (MB) of the listmode data of each acquisition in the concurrency benchmark
+    ingest_data_size_mb: float = 4.0
+    # number of headers converted in the header benchmarks
+    n_headers: int = 1000
+    # number of scans / labels in the scan creation and label lookup benchmarks
+    n_objects: int = 100
+    # number of acquisitions ingested in the concurrency benchmark, and the largest
+    # number of upload workers (it is run with 1, 2, 4 ... max_workers)
+    n_acquisitions: int = 16
+    max_workers: int = 8
+    # latency (s) added to every request to the fake server
+    latency: float = 0.002
+    repeats: int = 3
+
+
+@dataclass
+class BenchmarkResult:
+    """Timings (s) of each repeat of a benchmark, which processed n_items (headers,
+    requests, acquisitions ...) and n_bytes of data each repeat"""
+
+    name: str
+    seconds: list[float]
+    n_items: int
+    n_bytes: int = 0
+    params: dict[str, Any] = field(default_factory=dict)
+    extra: dict[str, Any] = field(default_factory=dict)
+
+    def to_json(self) -> dict[str, Any]:
+        median = statistics.median(self.seconds)
+        result = asdict(self)
+        result["median_seconds"] = median
+        result["min_seconds"] = min(self.seconds)
+        result["items_per_second"] = self.n_items / median if median > 0 else None
+        result["megabytes_per_second"] = (
+            self.n_bytes / median / 1e6 if self.n_bytes and median > 0 else None
+        )
+        return result
+
+
+def _time(
+    run: Callable[[int], Any],
+    repeats: int,
+    setup: Optional[Callable[[int], Any]] = None,
+) -> list[float]:
+    """Time run(repeat) for each repeat, calling setup(repeat) (untimed) first"""
+
+    seconds = []
+    for repeat in range(repeats):
+        if setup is not None:
+            setup(repeat)
+        start = time.perf_counter()
+        run(repeat)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def _write_acquisition(header_path: Path, data_size_mb: float, seed: int = 0) -> Path:
+    n_ms = max(1, int(data_size_mb * 1e6 / (4 * (EVENTS_PER_MS + 1))))
+    name = header_path.name.removesuffix(".l.hdr")
+    return write_listmode_acquisition(
+        header_path,
+        n_ms=n_ms,
+        events_per_ms=EVENTS_PER_MS,
+        seed=seed,
+        header_text=MMR_HEADER.format(
+            name=name,
+            n_words=n_ms * (EVENTS_PER_MS + 1),
+            duration=n_ms / 1000,
+            duration_ms=n_ms,
+        ),
+    )
+
+
+def _data_size(header_path: Path) -> int:
+    return header_path.with_name(header_path.name.removesuffix(".hdr")).stat().st_size
+
+
+def _new_experiment(session: xnat.XNATSession, name: str) -> Any:
+    project = verify_project_exists(session, PROJECT)
+    subject = create_subject(session, project, f"subject_{name}")
+    return add_experiment(subject, f"experiment_{name}")
+
+
+def bench_headers(config: BenchmarkConfig, work_dir: Path) -> list[BenchmarkResult]:
+    """Parse and convert many headers - each header is small, so this is dominated by
+    per-file overhead"""
+
+    header_dir = work_dir / "headers"
+    header_paths = [
+        _write_acquisition(header_dir / f"scan{index}.l.hdr", 0.0)
+        for index in range(config.n_headers)
+    ]
+    n_bytes = sum(path.stat().st_size for path in header_paths)
+    params = {"n_headers": config.n_headers}
+
+    def read_all(read: Callable[[Path], Any]) -> Callable[[int], None]:
+        def run(repeat: int) -> None:
+            for path in header_paths:
+                read(path)
+
+        return run
+
+    results = [
+        BenchmarkResult(
+            "header_parse",
+            _time(read_all(read_interfile_header), config.repeats),
+            config.n_headers,
+            n_bytes,
+            params,
+        ),
+        BenchmarkResult(
+            "header_2_xnat_native",
+            _time(read_all(read_listmode_header_2_xnat), config.repeats),
+            config.n_headers,
+            n_bytes,
+            params,
+        ),
+    ]
+
+    if importlib.util.find_spec("stir") is not None:
+        results.append(
+            BenchmarkResult(
+                "header_2_xnat_stir",
+                _time(
+                    read_all(
+                        lambda path: read_listmode_header_2_xnat(path, backend="stir")
+                    ),
+                    config.repeats,
+                ),
+                config.n_headers,
+                n_bytes,
+                params,
+            )
+        )
+    else:
+        logger.info("stir not installed - skipping header_2_xnat_stir")
+
+    with HeaderCache(work_dir / "header_cache.sqlite") as header_cache:
+        for path in header_paths:
+            cached_read_listmode_header_2_xnat(path, header_cache=header_cache)
+        results.append(
+            BenchmarkResult(
+                "header_2_xnat_cached",
+                _time(
+                    read_all(
+                        lambda path: cached_read_listmode_header_2_xnat(
+                            path, header_cache=header_cache
+                        )
+                    ),
+                    config.repeats,
+                ),
+                config.n_headers,
+                n_bytes,
+                params,
+            )
+        )
+    return results
+
+
+def bench_event_stats(config: BenchmarkConfig, work_dir: Path) -> list[BenchmarkResult]:
+    header_path = _write_acquisition(work_dir / "stats.l.hdr", config.data_size_mb)
+    data_path = header_path.with_name("stats.l")
+    n_bytes = data_path.stat().st_size
+
+    seconds = _time(lambda repeat: listmode_event_stats(data_path), config.repeats)
+    return [
+        BenchmarkResult(
+            "listmode_event_stats",
+            seconds,
+            n_bytes // 4,
+            n_bytes,
+            {"data_size_mb": config.data_size_mb},
+        )
+    ]
+
+
+def bench_label_lookup(
+    config: BenchmarkConfig, work_dir: Path
+) -> list[BenchmarkResult]:
+    """Check whether n_objects subject labels exist (half of them do) - listing the
+    project's subjects for each label, a HEAD request for each label, or a single listing
+    shared through a LabelIndex"""
+
+    params = {"n_labels": config.n_objects, "latency": config.latency}
+    with FakeXNATServer((PROJECT,), latency=config.latency) as server:
+        with server.connect() as session:
+            parent_uri = subjects_uri(PROJECT)
+            project = verify_project_exists(session, PROJECT)
+            labels = [f"subject{index}" for index in range(config.n_objects)]
+            for label in labels[::2]:
+                session.classes.SubjectData(parent=project, label=label)
+
+            def listing(repeat: int) -> None:
+                for label in labels:
+                    LabelIndex(session).contains(parent_uri, label)
+
+            def head(repeat: int) -> None:
+                for label in labels:
+                    label_exists(session, parent_uri, label)
+
+            def shared_index(repeat: int) -> None:
+                label_index = LabelIndex(session)
+                for label in labels:
+                    label_index.contains(parent_uri, label)
+
+            return [
+                BenchmarkResult(
+                    f"label_lookup_{name}",
+                    _time(lookup, config.repeats),
+                    config.n_objects,
+                    0,
+                    params,
+                )
+                for name, lookup in [
+                    ("listing", listing),
+                    ("head", head),
+                    ("shared_index", shared_index),
+                ]
+            ]
+
+
+def bench_scan_put(config: BenchmarkConfig, work_dir: Path) -> list[BenchmarkResult]:
+    """Create n_objects scans with the header fields in one experiment - create_scan
+    (which lists the experiment's scans before and after) vs put_scan"""
+
+    header_path = _write_acquisition(work_dir / "scan_put.l.hdr", 0.0)
+    xnat_hdr = read_listmode_header_2_xnat(header_path)
+    params = {"n_scans": config.n_objects, "latency": config.latency}
+
+    results = []
+    for name, create in [("scan_create", create_scan), ("scan_put", put_scan)]:
+        with FakeXNATServer((PROJECT,), latency=config.latency) as server:
+            with server.connect() as session:
+                experiments: dict[int, Any] = {}
+
+                # the loop variables are bound as defaults, not looked up when called
+                def setup(
+                    repeat: int,
+                    name: str = name,
+                    session: xnat.XNATSession = session,
+                    experiments: dict[int, Any] = experiments,
+                ) -> None:
+                    experiments[repeat] = _new_experiment(session, f"{name}{repeat}")
+
+                def run(
+                    repeat: int,
+                    create: Callable[..., Any] = create,
+                    experiments: dict[int, Any] = experiments,
+                ) -> None:
+                    for index in range(config.n_objects):
+                        create(experiments[repeat], xnat_hdr, f"scan{index}")
+
+                n_requests = server.request_count()
+                seconds = _time(run, config.repeats, setup)
+                n_requests = server.request_count() - n_requests
+        results.append(
+            BenchmarkResult(
+                name,
+                seconds,
+                config.n_objects,
+                0,
+                params,
+                # includes the (untimed) experiment creation
+                {"requests_per_repeat": n_requests / config.repeats},
+            )
+        )
+    return results
+
+
+def bench_upload(config: BenchmarkConfig, work_dir: Path) -> list[BenchmarkResult]:
+    """Create a scan and upload its PET_RAW files - one request per file, or a single
+    (archive) request"""
+
+    header_path = _write_acquisition(work_dir / "upload.l.hdr", config.data_size_mb)
+    xnat_hdr = read_listmode_header_2_xnat(header_path)
+    n_bytes = header_path.stat().st_size + _data_size(header_path)
+    params = {"data_size_mb": config.data_size_mb, "latency": config.latency}
+
+    results = []
+    for name, archive in [("upload_pet_raw", False), ("upload_pet_raw_archive", True)]:
+        with FakeXNATServer((PROJECT,), latency=config.latency) as server:
+            with server.connect() as session:
+                experiments: dict[int, Any] = {}
+
+                def setup(
+                    repeat: int,
+                    name: str = name,
+                    session: xnat.XNATSession = session,
+                    experiments: dict[int, Any] = experiments,
+                ) -> None:
+                    experiments[repeat] = _new_experiment(session, f"{name}{repeat}")
+
+                def run(
+                    repeat: int,
+                    archive: bool = archive,
+                    experiments: dict[int, Any] = experiments,
+                ) -> None:
+                    add_scan(
+                        experiments[repeat],
+                        xnat_hdr,
+                        "scan",
+                        header_path,
+                        progress=None,
+                        archive=archive,
+                    )
+
+                n_requests = server.request_count()
+                seconds = _time(run, config.repeats, setup)
+                n_requests = server.request_count() - n_requests
+        results.append(
+            BenchmarkResult(
+                name,
+                seconds,
+                1,
+                n_bytes,
+                params,
+                {"requests_per_repeat": n_requests / config.repeats},
+            )
+        )
+    return results
+
+
+def _worker_counts(max_workers: int) -> list[int]:
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    if max_workers > 1:
+        counts.append(max_workers)
+    return counts
+
+
+def bench_concurrent_ingest(
+    config: BenchmarkConfig, work_dir: Path
+) -> list[BenchmarkResult]:
+    """Ingest n_acquisitions (header extraction, object creation and upload) with 1, 2,
+    4 ... max_workers upload workers"""
+
+    header_paths = [
+        _write_acquisition(
+            work_dir / "ingest" / f"scan{index}.l.hdr",
+            config.ingest_data_size_mb,
+            seed=index,
+        )
+        for index in range(config.n_acquisitions)
+    ]
+    n_bytes = sum(path.stat().st_size + _data_size(path) for path in header_paths)
+
+    results = []
+    for n_workers in _worker_counts(config.max_workers):
+        with FakeXNATServer((PROJECT,), latency=config.latency) as server:
+            with server.connect() as session:
+                metrics = MetricsRecorder()
+
+                def run(
+                    repeat: int,
+                    n_workers: int = n_workers,
+                    session: xnat.XNATSession = session,
+                    metrics: MetricsRecorder = metrics,
+                ) -> None:
+                    acquisitions = [
+                        Acquisition(
+                            path,
+                            PROJECT,
+                            f"subject{repeat}_{index}",
+                            "experiment",
+                            "scan",
+                        )
+                        for index, path in enumerate(header_paths)
+                    ]
+                    failed = [
+                        result
+                        for result in ingest_acquisitions(
+                            session,
+                            acquisitions,
+                            max_header_workers=min(n_workers, os.cpu_count() or 1),
+                            max_upload_workers=n_workers,
+                            progress=lambda result, n_completed, n_total: None,
+                            metrics=metrics,
+                        )
+                        if not result.ok
+                    ]
+                    if failed:
+                        raise RuntimeError(f"Ingest failed: {failed[0].error}")
+
+                seconds = _time(run, config.repeats)
+        results.append(
+            BenchmarkResult(
+                "concurrent_ingest",
+                seconds,
+                config.n_acquisitions,
+                n_bytes,
+                {
+                    "n_workers": n_workers,
+                    "n_acquisitions": config.n_acquisitions,
+                    "data_size_mb": config.ingest_data_size_mb,
+                    "latency": config.latency,
+                },
+                {
+                    "acquisitions_per_hour": config.n_acquisitions
+                    / statistics.median(seconds)
+                    * 3600,
+                    "stages": metrics.summary(),
+                },
+            )
+        )
+    return results
+
+
+BENCHMARKS = {
+    "headers": bench_headers,
+    "event_stats": bench_event_stats,
+    "label_lookup": bench_label_lookup,
+    "scan_put": bench_scan_put,
+    "upload": bench_upload,
+    "concurrent_ingest": bench_concurrent_ingest,
+}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment_info() -> dict[str, Any]:
+    """The commit and environment benchmarks are run in, to record with the results"""
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "xnat": xnat.__version__,
+    }
+
+
+def run_benchmarks(
+    config: BenchmarkConfig,
+    output_path: Path,
+    names: Optional[list[str]] = None,
+    work_dir: Optional[Path] = None,
+) -> dict[str, Any]:
+    """Run the named benchmarks (all, by default), writing the results as JSON to
+    output_path. Synthetic data is written to work_dir (a temporary directory by
+    default)."""
+
+    names = names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(
+            f"Unknown benchmarks {sorted(unknown)} - must be in {list(BENCHMARKS)}"
+        )
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        for name in names:
+            logger.info(f"Running {name} benchmark")
+            benchmark_dir = Path(temp_dir) / name
+            benchmark_dir.mkdir()
+            for result in BENCHMARKS[name](config, benchmark_dir):
+                result_json = result.to_json()
+                logger.info(
+                    f"{result.name} {result.params}: median "
+                    f"{result_json['median_seconds']:.3f}s, "
+                    f"{result_json['items_per_second']:.1f} items/s"
+                )
+                results.append(result_json)
+
+    report = {
+        "environment": environment_info(),
+        "config": asdict(config),
+        "results": results,
+    }
+    output_path.write_text(json.dumps(report, indent=2))
+    logger.info(f"Wrote benchmark results to {output_path}")
+    return report
+
+
+def main() -> None:
+    defaults = BenchmarkConfig()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=list(BENCHMARKS),
+        help="benchmarks to run (default all)",
+    )
+    parser.add_argument("--work-dir", type=Path, help="where to write synthetic data")
+    for name, value in asdict(defaults).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=type(value), default=value
+        )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    config = BenchmarkConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+    run_benchmarks(config, args.output, args.benchmarks, args.work_dir)
+
+
+if __name__ == "__main__":
+    main()
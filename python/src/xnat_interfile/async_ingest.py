@@ -0,0 +1,679 @@
+import asyncio
+import logging
+import time
+from contextlib import AbstractAsyncContextManager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+import httpx
+from xnat.exceptions import XNATResponseError
+
+from xnat_interfile.batch_ingest import (
+    INGEST_ERRORS,
+    Acquisition,
+    IngestResult,
+    ProgressCallback,
+    _timed_read_header,
+    log_progress,
+)
+from xnat_interfile.header_cache import HeaderCache, cached_read_listmode_header_2_xnat
+from xnat_interfile.interfile_header import interfile_data_path
+from xnat_interfile.label_index import experiments_uri, subjects_uri
+from xnat_interfile.metrics import MetricsRecorder, timed_stage
+from xnat_interfile.retry import (
+    DEFAULT_RETRY_POLICY,
+    RetryPolicy,
+    retry_after_seconds,
+)
+from xnat_interfile.upload import (
+    DEFAULT_CHUNK_SIZE,
+    FileChunkStream,
+    UploadProgressCallback,
+    ZipStream,
+    log_upload_progress,
+)
+
+logger = logging.getLogger(__name__)
+
+# Default limits on the requests sent to the server at once - in total, and of those, the
+# number of file uploads
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_MAX_UPLOADS = 2
+
+# Timeout (s) for connecting, and for each read / write of a request. Uploads have no
+# overall timeout, as large listmode files can take a long time to send.
+DEFAULT_TIMEOUT = 60.0
+
+
+class AsyncXNATClient:
+    """Async client for the XNAT REST requests made during ingest, sending them over a
+    single pool of keep-alive connections (an httpx.AsyncClient).
+
+    At most max_connections requests are in flight to the server at once - the per-host
+    limit - and at most max_uploads of those are file uploads, so metadata requests (e.g.
+    creating subjects and scans) for other acquisitions still get through while large
+    files are streaming. Requests over the limits wait for a free slot.
+
+    Use as an async context manager. If user is given, the client logs in once (with
+    basic auth) and re-uses the session cookie for all requests. Requests failing with a
+    transient error are retried according to retry (see request).
+    """
+
+    def __init__(
+        self,
+        server_url: str,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_uploads: int = DEFAULT_MAX_UPLOADS,
+        timeout: float = DEFAULT_TIMEOUT,
+        verify: bool = True,
+        retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    ):
+        if max_connections <= 0:
+            raise ValueError(f"max_connections must be positive, got {max_connections}")
+        if not 0 < max_uploads <= max_connections:
+            raise ValueError(
+                f"max_uploads must be between 1 and max_connections "
+                f"({max_connections}), got {max_uploads}"
+            )
+
+        self.server_url = server_url.rstrip("/")
+        self.user = user
+        self.password = password
+        self.max_connections = max_connections
+        self.max_uploads = max_uploads
+        self.timeout = timeout
+        self.verify = verify
+        self.retry = retry
+        self._client: Optional[httpx.AsyncClient] = None
+        self._request_slots = asyncio.Semaphore(max_connections)
+        self._upload_slots = asyncio.Semaphore(max_uploads)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self) -> None:
+        self._client = httpx.AsyncClient(
+            base_url=self.server_url,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            timeout=httpx.Timeout(self.timeout),
+            verify=self.verify,
+        )
+        if self.user is not None:
+            response = await self.request(
+                "GET", "/data/JSESSION", auth=(self.user, self.password or "")
+            )
+            self._client.cookies.set("JSESSIONID", response.text.strip())
+            logger.info(f"Logged in to {self.server_url} as {self.user}")
+
+    async def close(self) -> None:
+        if self._client is None:
+            return
+        if self.user is not None:
+            await self.request("DELETE", "/data/JSESSION", accepted_status=(200, 401))
+        await self._client.aclose()
+        self._client = None
+
+    async def request(
+        self,
+        method: str,
+        uri: str,
+        query: Optional[dict[str, Any]] = None,
+        accepted_status: Iterable[int] = (200,),
+        upload: bool = False,
+        content: Optional[Callable[[], AsyncIterator[bytes]]] = None,
+        retry_query: Optional[dict[str, Any]] = None,
+        retry_accepted_status: Iterable[int] = (),
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """Send a request, waiting for a free slot first (an upload slot too, if upload
+        is True). content, if given, is called to get a fresh request body for each
+        attempt. Raises XNATResponseError (as xnat-py does) if the status of the response
+        isn't in accepted_status.
+
+        Transient errors (see RetryPolicy) are retried with the client's retry policy,
+        waiting outside the slots. retry_query is added to the query, and
+        retry_accepted_status to accepted_status, on attempts after the first - so the
+        request can be repeated safely if an earlier attempt reached the server (e.g.
+        overwriting a partially uploaded file)."""
+
+        if self._client is None:
+            raise RuntimeError("AsyncXNATClient is not open - use it with 'async with'")
+
+        retry = self.retry
+        accepted_status = list(accepted_status)
+        upload_slot: AbstractAsyncContextManager[Any] = (
+            self._upload_slots if upload else nullcontext()
+        )
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt == 2:
+                query = {**(query or {}), **(retry_query or {})}
+                accepted_status += list(retry_accepted_status)
+            if content is not None:
+                kwargs["content"] = content()
+
+            retry_after = None
+            error: Exception
+            try:
+                async with upload_slot, self._request_slots:
+                    response = await self._client.request(
+                        method, uri, params=query, **kwargs
+                    )
+            except httpx.TransportError as transport_error:
+                error = transport_error
+                reason = repr(error)
+            else:
+                if response.status_code in accepted_status:
+                    if retry is not None:
+                        retry.record(transient_failure=False)
+                    return response
+                error = XNATResponseError(
+                    f"Invalid status for response from {self.server_url} for url {uri} "
+                    f"(status {response.status_code}, accepted status: "
+                    f"{accepted_status}):\n{response.text}",
+                    response=response,
+                )
+                if retry is None or response.status_code not in retry.retry_status:
+                    raise error
+                reason = f"status {response.status_code}"
+                retry_after = retry_after_seconds(response.headers)
+
+            if retry is None:
+                raise error
+            retry.record(transient_failure=True)
+            if attempt == retry.max_attempts:
+                raise error
+
+            delay = retry.delay(attempt, retry_after)
+            logger.warning(
+                f"{method} {uri} failed ({reason}) - retrying in {delay:.1f}s "
+                f"(attempt {attempt + 1} of {retry.max_attempts})"
+            )
+            await asyncio.sleep(delay)
+
+    async def label_exists(self, parent_uri: str, label: str) -> bool:
+        """Async label_exists - check for an object under parent_uri with a HEAD request"""
+
+        response = await self.request(
+            "HEAD", f"{parent_uri}/{label}", accepted_status=(200, 404)
+        )
+        return response.status_code == 200
+
+    async def put(
+        self, uri: str, query: Optional[dict[str, Any]] = None, **kwargs: Any
+    ) -> httpx.Response:
+        return await self.request("PUT", uri, query=query, **kwargs)
+
+
+async def _aiter_chunks(stream: Iterable[bytes]) -> AsyncIterator[bytes]:
+    """Iterate over an upload stream (e.g. FileChunkStream) without blocking the event
+    loop - each chunk is read from disk in a worker thread."""
+
+    chunks = iter(stream)
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+async def verify_project_exists_async(
+    client: AsyncXNATClient,
+    project_name: str,
+    metrics: Optional[MetricsRecorder] = None,
+) -> str:
+    """Async verify_project_exists - returns the project's uri"""
+
+    project_uri = f"/data/projects/{project_name}"
+    with timed_stage(metrics, "project", project_name):
+        response = await client.request("HEAD", project_uri, accepted_status=(200, 404))
+    if response.status_code == 404:
+        logger.error(f"Project {project_name} not available on server")
+        raise NameError(f"Project {project_name} not available on server.")
+    logger.info(f"Project {project_name} exists")
+    return project_uri
+
+
+async def create_subject_async(
+    client: AsyncXNATClient,
+    project_name: str,
+    subject_name: str,
+    metrics: Optional[MetricsRecorder] = None,
+) -> str:
+    """Async create_subject - returns the new subject's uri"""
+
+    parent_uri = subjects_uri(project_name)
+    with timed_stage(metrics, "subject", subject_name):
+        if await client.label_exists(parent_uri, subject_name):
+            logger.error(f"Subject {subject_name} already exists")
+            raise NameError(f"Subject {subject_name} already exists.")
+        await client.put(
+            f"{parent_uri}/{subject_name}", query={"xsiType": "xnat:subjectData"}
+        )
+
+    logger.info(f"Created subject: {subject_name}")
+    return f"{parent_uri}/{subject_name}"
+
+
+async def add_experiment_async(
+    client: AsyncXNATClient,
+    project_name: str,
+    subject_name: str,
+    experiment_name: str,
+    metrics: Optional[MetricsRecorder] = None,
+) -> str:
+    """Async add_experiment - returns the new experiment's uri"""
+
+    parent_uri = experiments_uri(project_name, subject_name)
+    with timed_stage(metrics, "experiment", experiment_name):
+        if await client.label_exists(parent_uri, experiment_name):
+            logger.error(f"Experiment {experiment_name} already exists")
+            raise NameError(f"Experiment {experiment_name} already exists.")
+        await client.put(
+            f"{parent_uri}/{experiment_name}",
+            query={"xsiType": "xnat:petSessionData"},
+        )
+
+    logger.info(f"Created experiment: {experiment_name}")
+    return f"{parent_uri}/{experiment_name}"
+
+
+async def put_scan_async(
+    client: AsyncXNATClient, experiment_uri: str, xnat_hdr: dict, scan_name: str
+) -> str:
+    """Async put_scan - a HEAD to check the scan doesn't exist, and the PUT creating it
+    with all the header info in xnat_hdr. Returns the new scan's uri."""
+
+    scans_uri = f"{experiment_uri}/scans"
+    if await client.label_exists(scans_uri, scan_name):
+        logger.error(f"XNAT scan {scan_name} already exists")
+        raise NameError(f"XNAT scan {scan_name} already exists")
+
+    logger.info(f"Creating interfile scan {scan_name} with header data")
+    await client.put(f"{scans_uri}/{scan_name}", query=xnat_hdr)
+    logger.info(f"Successfully created interfile scan: {scan_name}")
+    return f"{scans_uri}/{scan_name}"
+
+
+async def upload_resource_file_async(
+    client: AsyncXNATClient,
+    resource_uri: str,
+    file_path: Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = None,
+) -> None:
+    """Async upload_resource_file - stream a file from disk to an XNAT resource"""
+
+    stream = FileChunkStream(file_path, chunk_size=chunk_size, progress=progress)
+
+    start_time = time.perf_counter()
+    await client.put(
+        f"{resource_uri}/files/{file_path.name}",
+        content=lambda: _aiter_chunks(stream),
+        retry_query={"overwrite": "true"},
+        headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(len(stream)),
+        },
+        upload=True,
+    )
+    elapsed = time.perf_counter() - start_time
+
+    logger.info(
+        f"Uploaded {file_path.name} ({len(stream)} bytes in {elapsed:.1f}s, "
+        f"{len(stream) / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+    )
+
+
+async def upload_resource_archive_async(
+    client: AsyncXNATClient,
+    resource_uri: str,
+    file_paths: list[Path],
+    archive_name: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = None,
+) -> None:
+    """Async upload_resource_archive - stream files to an XNAT resource as a single zip
+    archive, extracted on the server"""
+
+    stream = ZipStream(
+        [(file_path, file_path.name) for file_path in file_paths],
+        chunk_size=chunk_size,
+        progress=progress,
+    )
+
+    start_time = time.perf_counter()
+    await client.put(
+        f"{resource_uri}/files/{archive_name}",
+        query={"extract": "true"},
+        content=lambda: _aiter_chunks(stream),
+        retry_query={"overwrite": "true"},
+        headers={"Content-Type": "application/zip"},
+        upload=True,
+    )
+    elapsed = time.perf_counter() - start_time
+
+    logger.info(
+        f"Uploaded {len(file_paths)} files as {archive_name} ({stream.total_bytes} bytes "
+        f"in {elapsed:.1f}s, {stream.total_bytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+    )
+
+
+async def add_scan_async(
+    client: AsyncXNATClient,
+    experiment_uri: str,
+    xnat_hdr: dict,
+    scan_name: str,
+    interfile_file_path: Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = log_upload_progress,
+    archive: bool = False,
+    metrics: Optional[MetricsRecorder] = None,
+) -> str:
+    """Async add_scan - create the scan with the xnat_hdr info, and upload the header and
+    data file to its PET_RAW resource (one file at a time, or in a single zip archive
+    if archive is True). Returns the new scan's uri."""
+
+    file_paths = [interfile_file_path, interfile_data_path(interfile_file_path)]
+
+    with timed_stage(metrics, "scan_put", scan_name):
+        scan_uri = await put_scan_async(client, experiment_uri, xnat_hdr, scan_name)
+    resource_uri = f"{scan_uri}/resources/PET_RAW"
+
+    if archive:
+        with timed_stage(metrics, "upload", f"{scan_name}.zip") as upload_stage:
+            await upload_resource_archive_async(
+                client,
+                resource_uri,
+                file_paths,
+                f"{scan_name}.zip",
+                chunk_size=chunk_size,
+                progress=progress,
+            )
+            upload_stage.n_bytes = sum(path.stat().st_size for path in file_paths)
+        logger.info(f"Successfully created scan {scan_name} and uploaded archive")
+        return scan_uri
+
+    with timed_stage(metrics, "resource", "PET_RAW"):
+        # a retry may find the resource created by an attempt whose response was lost
+        await client.put(resource_uri, retry_accepted_status=(409,))
+    for file_path in file_paths:
+        with timed_stage(metrics, "upload", file_path.name) as upload_stage:
+            await upload_resource_file_async(
+                client,
+                resource_uri,
+                file_path,
+                chunk_size=chunk_size,
+                progress=progress,
+            )
+            upload_stage.n_bytes = file_path.stat().st_size
+    logger.info(f"Successfully created scan {scan_name} and uploaded interfile files")
+    return scan_uri
+
+
+def _check_acquisition_files(interfile_listmode_file_path: Path) -> None:
+    if not interfile_listmode_file_path.exists():
+        raise FileNotFoundError(
+            f"Interfile file not found: {interfile_listmode_file_path}"
+        )
+    if not interfile_data_path(interfile_listmode_file_path).exists():
+        raise FileNotFoundError(
+            f"Interfile data file not found: "
+            f"{interfile_data_path(interfile_listmode_file_path)}"
+        )
+
+
+async def upload_interfile_data_async(
+    client: AsyncXNATClient,
+    interfile_listmode_file_path: Path,
+    project_name: str,
+    subject_name: str,
+    experiment_name: str,
+    scan_name: str,
+    header_backend: str = "native",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = log_upload_progress,
+    archive: bool = False,
+    event_stats: bool = False,
+    header_cache: Optional[HeaderCache] = None,
+    metrics: Optional[MetricsRecorder] = None,
+) -> str:
+    """Async upload_interfile_data - upload an interfile listmode acquisition to a new
+    subject / experiment / scan in an existing XNAT project, and return the scan's uri.
+
+    Like upload_interfile_data, a NameError is raised if the project doesn't exist, or
+    the subject, experiment or scan already does. The header is read in a worker thread
+    while the subject and experiment are created. Journals and hash indexes aren't
+    supported - use upload_interfile_data to resume interrupted uploads."""
+
+    logger.info(f"Interfile file path: {interfile_listmode_file_path}")
+    _check_acquisition_files(interfile_listmode_file_path)
+
+    async def read_header() -> dict[str, Any]:
+        with timed_stage(metrics, "header", interfile_listmode_file_path.name):
+            return await asyncio.to_thread(
+                cached_read_listmode_header_2_xnat,
+                interfile_listmode_file_path,
+                backend=header_backend,
+                event_stats=event_stats,
+                header_cache=header_cache,
+            )
+
+    async def create_experiment() -> str:
+        await verify_project_exists_async(client, project_name, metrics)
+        await create_subject_async(client, project_name, subject_name, metrics)
+        return await add_experiment_async(
+            client, project_name, subject_name, experiment_name, metrics
+        )
+
+    header_task = asyncio.create_task(read_header())
+    try:
+        experiment_uri = await create_experiment()
+        xnat_hdr = await header_task
+    finally:
+        if not header_task.done():
+            header_task.cancel()
+
+    return await add_scan_async(
+        client,
+        experiment_uri,
+        xnat_hdr,
+        scan_name,
+        interfile_listmode_file_path,
+        chunk_size=chunk_size,
+        progress=progress,
+        archive=archive,
+        metrics=metrics,
+    )
+
+
+class _AsyncBatchUploader:
+    """Async _BatchUploader - subjects and experiments are created the first time they
+    are seen (or re-used if they already exist on the server), and re-used by later
+    scans. Scans that already exist raise NameError."""
+
+    def __init__(
+        self,
+        client: AsyncXNATClient,
+        archive: bool = False,
+        metrics: Optional[MetricsRecorder] = None,
+    ):
+        self.client = client
+        self.archive = archive
+        self.metrics = metrics
+        self._object_locks: dict[tuple[str, ...], asyncio.Lock] = {}
+        self._objects: dict[tuple[str, ...], str] = {}
+
+    async def _get_or_create(
+        self, key: tuple[str, ...], create: Callable[[], Awaitable[str]]
+    ) -> str:
+        # no lock needed to set up the object lock - there's no await in between
+        object_lock = self._object_locks.setdefault(key, asyncio.Lock())
+        async with object_lock:
+            if key not in self._objects:
+                self._objects[key] = await create()
+            return self._objects[key]
+
+    async def _subject(self, acquisition: Acquisition) -> str:
+        async def create() -> str:
+            await verify_project_exists_async(
+                self.client, acquisition.project_name, self.metrics
+            )
+            parent_uri = subjects_uri(acquisition.project_name)
+            if await self.client.label_exists(parent_uri, acquisition.subject_name):
+                return f"{parent_uri}/{acquisition.subject_name}"
+            return await create_subject_async(
+                self.client,
+                acquisition.project_name,
+                acquisition.subject_name,
+                self.metrics,
+            )
+
+        key = (acquisition.project_name, acquisition.subject_name)
+        return await self._get_or_create(key, create)
+
+    async def _experiment(self, acquisition: Acquisition) -> str:
+        async def create() -> str:
+            await self._subject(acquisition)
+            parent_uri = experiments_uri(
+                acquisition.project_name, acquisition.subject_name
+            )
+            if await self.client.label_exists(parent_uri, acquisition.experiment_name):
+                return f"{parent_uri}/{acquisition.experiment_name}"
+            return await add_experiment_async(
+                self.client,
+                acquisition.project_name,
+                acquisition.subject_name,
+                acquisition.experiment_name,
+                self.metrics,
+            )
+
+        key = (
+            acquisition.project_name,
+            acquisition.subject_name,
+            acquisition.experiment_name,
+        )
+        return await self._get_or_create(key, create)
+
+    async def upload(
+        self, acquisition: Acquisition, xnat_hdr: dict[str, Any]
+    ) -> IngestResult:
+        experiment_uri = await self._experiment(acquisition)
+        scan_uri = await add_scan_async(
+            self.client,
+            experiment_uri,
+            xnat_hdr,
+            acquisition.scan_name,
+            acquisition.header_path,
+            archive=self.archive,
+            metrics=self.metrics,
+        )
+        return IngestResult(acquisition, scan=scan_uri)
+
+
+async def ingest_acquisitions_async(
+    client: AsyncXNATClient,
+    acquisitions: list[Acquisition],
+    max_header_workers: Optional[int] = None,
+    max_pending: Optional[int] = None,
+    header_backend: str = "native",
+    progress: ProgressCallback = log_progress,
+    archive: bool = False,
+    event_stats: bool = False,
+    header_cache: Optional[HeaderCache] = None,
+    metrics: Optional[MetricsRecorder] = None,
+) -> list[IngestResult]:
+    """Async ingest_acquisitions - ingest a batch of acquisitions over client's connection
+    pool. Headers are extracted in a pool of max_header_workers processes, and each
+    acquisition is uploaded as soon as its header is ready, so the metadata requests of
+    many acquisitions overlap with the file uploads of others (within the client's
+    limits). The results of the scans are their uris.
+
+    At most max_pending acquisitions (default: twice the client's max_connections) are in
+    progress at once - the next header isn't read until an upload completes, so header
+    extraction can't run ahead of the server.
+
+    A failure of one acquisition doesn't stop the batch - each outcome is passed to progress
+    as it completes, and all results are returned in the order of acquisitions.
+    """
+    if max_pending is None:
+        max_pending = 2 * client.max_connections
+    if max_pending <= 0:
+        raise ValueError(f"max_pending must be positive, got {max_pending}")
+
+    results: dict[Acquisition, IngestResult] = {}
+    n_total = len(acquisitions)
+    uploader = _AsyncBatchUploader(client, archive, metrics)
+    pending_slots = asyncio.Semaphore(max_pending)
+    loop = asyncio.get_running_loop()
+
+    def finish(result: IngestResult) -> None:
+        results[result.acquisition] = result
+        progress(result, len(results), n_total)
+
+    async def read_header(
+        acquisition: Acquisition, header_pool: ProcessPoolExecutor
+    ) -> dict[str, Any]:
+        if header_cache is not None:
+            cached_hdr = header_cache.get(
+                acquisition.header_path, header_backend, event_stats
+            )
+            if cached_hdr is not None:
+                return cached_hdr
+
+        xnat_hdr, header_timing = await loop.run_in_executor(
+            header_pool,
+            _timed_read_header,
+            acquisition.header_path,
+            header_backend,
+            event_stats,
+        )
+        if metrics is not None:
+            metrics.record(header_timing)
+        if header_cache is not None:
+            header_cache.put(
+                acquisition.header_path, xnat_hdr, header_backend, event_stats
+            )
+        return xnat_hdr
+
+    async def ingest(
+        acquisition: Acquisition, header_pool: ProcessPoolExecutor
+    ) -> None:
+        try:
+            xnat_hdr = await read_header(acquisition, header_pool)
+            result = await uploader.upload(acquisition, xnat_hdr)
+        except (*INGEST_ERRORS, httpx.HTTPError) as error:
+            logger.debug(f"Ingest failed for {acquisition.header_path}")
+            result = IngestResult(acquisition, error=error)
+        except Exception as error:
+            # a bug rather than a bad acquisition - the rest of the batch still runs
+            logger.exception(f"Unexpected error ingesting {acquisition.header_path}")
+            result = IngestResult(acquisition, error=error)
+        finally:
+            pending_slots.release()
+        finish(result)
+
+    with ProcessPoolExecutor(max_workers=max_header_workers) as header_pool:
+        async with asyncio.TaskGroup() as tasks:
+            for acquisition in acquisitions:
+                # backpressure - wait for an acquisition to finish before starting more
+                await pending_slots.acquire()
+                tasks.create_task(ingest(acquisition, header_pool))
+
+    if metrics is not None:
+        metrics.log_summary()
+    return [results[acquisition] for acquisition in acquisitions]
@@ -0,0 +1,487 @@
+import logging
+import re
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import xnat
+from xnat.exceptions import XNATError
+
+from xnat_interfile.hash_index import HashIndex
+from xnat_interfile.header_cache import HeaderCache
+from xnat_interfile.ingest_journal import DONE_STAGE, IngestJournal, acquisition_key
+from xnat_interfile.interfile_2_xnat import (
+    LISTMODE_SCAN_TYPE,
+    read_interfile_header_2_xnat,
+)
+from xnat_interfile.interfile_header import DATA_FILE_SUFFIXES, interfile_data_path
+from xnat_interfile.label_index import LabelIndex, experiments_uri, subjects_uri
+from xnat_interfile.metrics import MetricsRecorder, StageTiming
+from xnat_interfile.populate_datatype_fields import (
+    add_experiment,
+    add_scan,
+    create_subject,
+    find_archived_scan,
+    request_header_extraction,
+    verify_project_exists,
+)
+from xnat_interfile.retry import (
+    DEFAULT_RETRY_POLICY,
+    AdaptiveConcurrencyLimit,
+    RetryPolicy,
+)
+from xnat_interfile.upload import ChecksumError
+
+logger = logging.getLogger(__name__)
+
+# Default layout of a directory tree of acquisitions: <subject>/<experiment>/<scan>.l.hdr
+# (or <scan>.hs for projection data, <scan>.hv for images)
+DEFAULT_ACQUISITION_PATTERN = (
+    r"(?P<subject>[^/]+)/(?P<experiment>[^/]+)/(?P<scan>[^/]+?)\.(?:l\.hdr|hs|hv)"
+)
+
+# Errors expected to fail the ingest of an acquisition: missing or invalid files (OSError,
+# ValueError), objects that already exist (NameError), and XNAT, network (requests'
+# errors are OSErrors) and checksum failures
+INGEST_ERRORS = (OSError, ValueError, NameError, XNATError, ChecksumError)
+
+
+@dataclass(frozen=True)
+class Acquisition:
+    """An acquisition (a header and data file pair - .l.hdr / .l listmode data, .hs / .s
+    projection data or .hv / .v image) and where it belongs in XNAT."""
+
+    header_path: Path
+    project_name: str
+    subject_name: str
+    experiment_name: str
+    scan_name: str
+
+    @property
+    def key(self) -> str:
+        return acquisition_key(
+            self.project_name, self.subject_name, self.experiment_name, self.scan_name
+        )
+
+    @property
+    def data_path(self) -> Path:
+        return interfile_data_path(self.header_path)
+
+
+@dataclass
+class IngestResult:
+    """Outcome of ingesting a single acquisition - error is None on success. skipped is
+    True if the acquisition was already ingested according to the journal, or its data
+    was already archived according to the hash index."""
+
+    acquisition: Acquisition
+    scan: Any = None
+    error: Optional[BaseException] = None
+    skipped: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+ProgressCallback = Callable[[IngestResult, int, int], None]
+
+
+def log_progress(result: IngestResult, n_completed: int, n_total: int) -> None:
+    """Default progress callback - log the outcome of each acquisition."""
+
+    if result.skipped:
+        logger.info(
+            f"[{n_completed}/{n_total}] Skipped {result.acquisition.header_path} "
+            f"- already ingested"
+        )
+    elif result.ok:
+        logger.info(
+            f"[{n_completed}/{n_total}] Ingested {result.acquisition.header_path}"
+        )
+    else:
+        logger.error(
+            f"[{n_completed}/{n_total}] Failed to ingest "
+            f"{result.acquisition.header_path}: {result.error!r}"
+        )
+
+
+def find_acquisitions(
+    root_dir: Path,
+    project_name: str,
+    pattern: str = DEFAULT_ACQUISITION_PATTERN,
+) -> list[Acquisition]:
+    """Find all acquisitions (.l.hdr, .hs and .hv headers with a matching data file, see
+    DATA_FILE_SUFFIXES) under root_dir.
+
+    pattern is a regular expression matched against the path of each header relative to
+    root_dir (with '/' separators). It must define the named groups 'subject', 'experiment'
+    and 'scan', and may define 'project' to override project_name. Headers that don't
+    match the pattern, or have no data file, are skipped with a warning.
+    """
+    regex = re.compile(pattern)
+    acquisitions = []
+
+    header_paths = [
+        header_path
+        for suffix in DATA_FILE_SUFFIXES
+        for header_path in root_dir.rglob(f"*{suffix}")
+    ]
+    for header_path in sorted(header_paths):
+        acquisition = match_acquisition(root_dir, header_path, project_name, regex)
+        if acquisition is None:
+            continue
+        if not acquisition.data_path.exists():
+            relative_path = header_path.relative_to(root_dir).as_posix()
+            logger.warning(f"Skipping {relative_path} - no data file")
+            continue
+
+        acquisitions.append(acquisition)
+
+    return acquisitions
+
+
+def match_acquisition(
+    root_dir: Path,
+    header_path: Path,
+    project_name: str,
+    regex: re.Pattern[str],
+) -> Optional[Acquisition]:
+    """The acquisition of a header under root_dir, from its path relative to root_dir
+    (see find_acquisitions) - or None, with a warning, if it doesn't match regex"""
+
+    relative_path = header_path.relative_to(root_dir).as_posix()
+    match = regex.fullmatch(relative_path)
+    if match is None:
+        logger.warning(f"Skipping {relative_path} - doesn't match {regex.pattern}")
+        return None
+
+    groups = match.groupdict()
+    return Acquisition(
+        header_path=header_path,
+        project_name=groups.get("project") or project_name,
+        subject_name=groups["subject"],
+        experiment_name=groups["experiment"],
+        scan_name=groups["scan"],
+    )
+
+
+def _timed_read_header(
+    header_path: Path, backend: str, event_stats: bool
+) -> tuple[dict[str, Any], StageTiming]:
+    """read_interfile_header_2_xnat, also returning how long it took - run in the header
+    worker processes, so the time doesn't include waiting in the pool's queue"""
+
+    start_time = time.time()
+    start = time.perf_counter()
+    xnat_hdr = read_interfile_header_2_xnat(header_path, backend, event_stats)
+    timing = StageTiming(
+        stage="header",
+        seconds=time.perf_counter() - start,
+        start_time=start_time,
+        name=header_path.name,
+    )
+    return xnat_hdr, timing
+
+
+class _BatchUploader:
+    """Uploads acquisitions from several threads sharing one XNAT session. Subjects and
+    experiments are created the first time they are seen, and re-used by later scans. If
+    the retry policy has a concurrency_limit, each upload waits for a slot in it."""
+
+    def __init__(
+        self,
+        xnat_session: xnat.XNATSession,
+        journal: Optional[IngestJournal] = None,
+        hash_index: Optional[HashIndex] = None,
+        archive: bool = False,
+        metrics: Optional[MetricsRecorder] = None,
+        retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+        compression: Optional[str] = None,
+        extract_header_on_server: bool = False,
+        part_size: Optional[int] = None,
+    ):
+        self.xnat_session = xnat_session
+        self.journal = journal
+        self.hash_index = hash_index
+        self.archive = archive
+        self.metrics = metrics
+        self.retry = retry
+        self.compression = compression
+        self.extract_header_on_server = extract_header_on_server
+        self.part_size = part_size
+        self.label_index = LabelIndex(xnat_session)
+        self._lock = threading.Lock()
+        self._object_locks: dict[tuple[str, ...], threading.Lock] = {}
+        self._objects: dict[tuple[str, ...], Any] = {}
+
+    def _get_or_create(self, key: tuple[str, ...], create: Callable[[], Any]) -> Any:
+        with self._lock:
+            object_lock = self._object_locks.setdefault(key, threading.Lock())
+
+        with object_lock:
+            if key not in self._objects:
+                self._objects[key] = create()
+            return self._objects[key]
+
+    def _subject(self, acquisition: Acquisition) -> Any:
+        def create() -> Any:
+            project = verify_project_exists(
+                self.xnat_session, acquisition.project_name, self.metrics
+            )
+            parent_uri = subjects_uri(project.id)
+            if self.label_index.contains(parent_uri, acquisition.subject_name):
+                return self.xnat_session.create_object(
+                    f"{parent_uri}/{acquisition.subject_name}"
+                )
+            return create_subject(
+                self.xnat_session,
+                project,
+                acquisition.subject_name,
+                self.label_index,
+                self.metrics,
+            )
+
+        key = (acquisition.project_name, acquisition.subject_name)
+        return self._get_or_create(key, create)
+
+    def _experiment(self, acquisition: Acquisition) -> Any:
+        def create() -> Any:
+            subject = self._subject(acquisition)
+            parent_uri = experiments_uri(subject.project, subject.label)
+            if self.label_index.contains(parent_uri, acquisition.experiment_name):
+                return self.xnat_session.create_object(
+                    f"{parent_uri}/{acquisition.experiment_name}"
+                )
+            return add_experiment(
+                subject, acquisition.experiment_name, self.label_index, self.metrics
+            )
+
+        key = (
+            acquisition.project_name,
+            acquisition.subject_name,
+            acquisition.experiment_name,
+        )
+        return self._get_or_create(key, create)
+
+    def upload(
+        self, acquisition: Acquisition, xnat_hdr: dict[str, Any]
+    ) -> IngestResult:
+        concurrency_limit: AbstractContextManager[Any] = nullcontext()
+        if self.retry is not None and self.retry.concurrency_limit is not None:
+            concurrency_limit = self.retry.concurrency_limit
+        with concurrency_limit:
+            return self._upload(acquisition, xnat_hdr)
+
+    def _upload(
+        self, acquisition: Acquisition, xnat_hdr: dict[str, Any]
+    ) -> IngestResult:
+        if self.hash_index is not None:
+            archived_scan = find_archived_scan(
+                self.xnat_session, acquisition.header_path, self.hash_index
+            )
+            if archived_scan is not None:
+                return IngestResult(acquisition, scan=archived_scan, skipped=True)
+
+        acquisition_journal = None
+        if self.journal is not None:
+            acquisition_journal = self.journal.for_acquisition(acquisition.key)
+
+        experiment = self._experiment(acquisition)
+        scan = add_scan(
+            experiment,
+            xnat_hdr,
+            acquisition.scan_name,
+            acquisition.header_path,
+            journal=acquisition_journal,
+            hash_index=self.hash_index,
+            archive=self.archive,
+            metrics=self.metrics,
+            retry=self.retry,
+            compression=self.compression,
+            part_size=self.part_size,
+        )
+        # the plugin only extracts listmode headers - others were read on the client
+        if (
+            self.extract_header_on_server
+            and xnat_hdr.get("scans", LISTMODE_SCAN_TYPE) == LISTMODE_SCAN_TYPE
+        ):
+            request_header_extraction(
+                self.xnat_session,
+                acquisition.project_name,
+                acquisition.experiment_name,
+                acquisition.scan_name,
+                self.retry,
+            )
+        if acquisition_journal is not None:
+            acquisition_journal.complete(DONE_STAGE)
+        return IngestResult(acquisition, scan=scan)
+
+
+def ingest_acquisitions(
+    xnat_session: xnat.XNATSession,
+    acquisitions: list[Acquisition],
+    max_header_workers: Optional[int] = None,
+    max_upload_workers: int = 4,
+    header_backend: str = "native",
+    progress: ProgressCallback = log_progress,
+    journal: Optional[IngestJournal] = None,
+    hash_index: Optional[HashIndex] = None,
+    archive: bool = False,
+    event_stats: bool = False,
+    header_cache: Optional[HeaderCache] = None,
+    metrics: Optional[MetricsRecorder] = None,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    adaptive_concurrency: bool = True,
+    compression: Optional[str] = None,
+    part_size: Optional[int] = None,
+) -> list[IngestResult]:
+    """Ingest a batch of acquisitions. Headers are extracted in a pool of
+    max_header_workers processes, and each is queued for upload as soon as its header is
+    ready, in a pool of max_upload_workers threads sharing xnat_session.
+
+    A failure of one acquisition doesn't stop the batch - each outcome is passed to progress
+    as it completes, and all results are returned in the order of acquisitions.
+
+    If a journal is given, acquisitions it records as fully ingested are skipped, and
+    partially ingested acquisitions resume from the first incomplete stage. If a
+    hash_index is given, acquisitions whose listmode data is already archived are skipped,
+    and the checksums of uploaded files are verified (see upload_interfile_data). If
+    archive is True, each scan's files are uploaded in a single request (see add_scan).
+    If event_stats is True, event statistics are decoded from the listmode data in the
+    header worker processes, and stored with the header fields - which reads all of each
+    data file, so is off by default. With the 'server'
+    header_backend, the interfile plugin fills the header fields of each scan once its
+    files are uploaded (see request_header_extraction). If a header_cache
+    is given, headers cached there are used without re-reading them.
+
+    If metrics are given, the time taken by each stage of each acquisition is recorded in
+    them, and a summary (p50 / p95 per stage) is logged once the batch is complete.
+
+    Transient server errors are retried according to retry (see upload_interfile_data).
+    If adaptive_concurrency is True (and retry isn't None), the number of acquisitions
+    uploading at once also adapts to the server's load - it is cut when requests fail
+    with a 5xx or timeout, and grows back (up to max_upload_workers) as they succeed (see
+    AdaptiveConcurrencyLimit). A struggling server then makes the batch slower, rather
+    than failing it.
+
+    If compression is given (e.g. 'zstd'), the listmode data of each acquisition is
+    compressed as it is uploaded (see add_scan). If part_size is given, it is uploaded in
+    parts of part_size bytes through the interfile plugin (see add_scan).
+    """
+    if retry is not None and adaptive_concurrency and retry.concurrency_limit is None:
+        retry = replace(
+            retry, concurrency_limit=AdaptiveConcurrencyLimit(max_upload_workers)
+        )
+
+    results: dict[Acquisition, IngestResult] = {}
+    n_total = len(acquisitions)
+    uploader = _BatchUploader(
+        xnat_session,
+        journal,
+        hash_index,
+        archive,
+        metrics,
+        retry,
+        compression,
+        extract_header_on_server=header_backend == "server",
+        part_size=part_size,
+    )
+
+    def finish(result: IngestResult) -> None:
+        results[result.acquisition] = result
+        progress(result, len(results), n_total)
+
+    with (
+        ProcessPoolExecutor(max_workers=max_header_workers) as header_pool,
+        ThreadPoolExecutor(max_workers=max_upload_workers) as upload_pool,
+    ):
+        pending: dict[Future[Any], tuple[str, Acquisition]] = {}
+        for acquisition in acquisitions:
+            if journal is not None and journal.is_done(acquisition.key):
+                finish(IngestResult(acquisition, skipped=True))
+                continue
+
+            xnat_hdr = None
+            if header_cache is not None:
+                xnat_hdr = header_cache.get(
+                    acquisition.header_path, header_backend, event_stats
+                )
+            if xnat_hdr is not None:
+                upload_future = upload_pool.submit(
+                    uploader.upload, acquisition, xnat_hdr
+                )
+                pending[upload_future] = ("upload", acquisition)
+                continue
+
+            header_future = header_pool.submit(
+                _timed_read_header,
+                acquisition.header_path,
+                header_backend,
+                event_stats,
+            )
+            pending[header_future] = ("header", acquisition)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, acquisition = pending.pop(future)
+                error = future.exception()
+
+                if error is not None:
+                    logger.debug(f"{stage} stage failed for {acquisition.header_path}")
+                    finish(IngestResult(acquisition, error=error))
+                elif stage == "header":
+                    xnat_hdr, header_timing = future.result()
+                    if metrics is not None:
+                        metrics.record(header_timing)
+                    if header_cache is not None:
+                        header_cache.put(
+                            acquisition.header_path,
+                            xnat_hdr,
+                            header_backend,
+                            event_stats,
+                        )
+                    upload_future = upload_pool.submit(
+                        uploader.upload, acquisition, xnat_hdr
+                    )
+                    pending[upload_future] = ("upload", acquisition)
+                else:
+                    finish(future.result())
+
+    if metrics is not None:
+        metrics.log_summary()
+    return [results[acquisition] for acquisition in acquisitions]
+
+
+def ingest_directory(
+    xnat_session: xnat.XNATSession,
+    root_dir: Path,
+    project_name: str,
+    pattern: str = DEFAULT_ACQUISITION_PATTERN,
+    **kwargs: Any,
+) -> list[IngestResult]:
+    """Find all acquisitions under root_dir (see find_acquisitions) and ingest them in
+    parallel (see ingest_acquisitions, which takes the remaining keyword arguments)."""
+
+    acquisitions = find_acquisitions(root_dir, project_name, pattern)
+    logger.info(f"Found {len(acquisitions)} acquisitions under {root_dir}")
+
+    results = ingest_acquisitions(xnat_session, acquisitions, **kwargs)
+
+    n_failed = sum(not result.ok for result in results)
+    logger.info(
+        f"Ingested {len(results) - n_failed} of {len(results)} acquisitions "
+        f"({n_failed} failed)"
+    )
+    return results
@@ -0,0 +1,281 @@
+import hashlib
+import logging
+import mmap
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Optional
+
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy, request_with_retry
+from xnat_interfile.upload import ChecksumError, UploadProgressCallback
+
+logger = logging.getLogger(__name__)
+
+# Default size of the parts a file is uploaded in - the server allows up to 10,000 parts,
+# so this covers files up to ~600 GiB
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+
+# Default number of parts sent at once
+DEFAULT_PART_WORKERS = 4
+
+
+def chunked_upload_uri(
+    project_name: str, experiment_name: str, scan_name: str, resource_label: str
+) -> str:
+    """xapi uri of the interfile plugin to start uploads in parts to a resource of a scan
+    (the experiment is given by label or ID)"""
+
+    return (
+        f"/xapi/interfile/projects/{project_name}/experiments/{experiment_name}"
+        f"/scans/{scan_name}/resources/{resource_label}/uploads"
+    )
+
+
+def chunked_upload_status(xnat_session: Any, upload_id: str) -> dict[str, Any]:
+    """Status of an upload in parts - its name, size, partSize and the missingParts that
+    haven't been received yet"""
+
+    return xnat_session.get_json(f"/xapi/interfile/uploads/{upload_id}")
+
+
+def abort_chunked_upload(xnat_session: Any, upload_id: str) -> None:
+    """Delete an upload in parts from the server, with any parts it received"""
+
+    xnat_session.delete(f"/xapi/interfile/uploads/{upload_id}")
+    logger.info(f"Aborted upload {upload_id}")
+
+
+def parts_md5(part_md5s: list[str]) -> str:
+    """The checksum the server checks on completion of an upload in parts: the MD5 of the
+    concatenated (binary) MD5s of the parts, then '-' and the number of parts"""
+
+    md5 = hashlib.md5(b"".join(bytes.fromhex(part_md5) for part_md5 in part_md5s))
+    return f"{md5.hexdigest()}-{len(part_md5s)}"
+
+
+def _start_upload(
+    xnat_session: Any,
+    uri: str,
+    remote_path: str,
+    size: int,
+    part_size: int,
+    retry: Optional[RetryPolicy],
+) -> dict[str, Any]:
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        return xnat_session.post(
+            uri,
+            json={"name": remote_path, "size": size, "partSize": part_size},
+            accepted_status=accepted_status,
+        )
+
+    # a retry may leave an (empty) upload started by an earlier attempt on the server
+    response = request_with_retry(
+        send, retry, f"Start of upload of {remote_path}", accepted_status=(201,)
+    )
+    return response.json()
+
+
+def _resumed_upload(
+    xnat_session: Any, upload_id: str, remote_path: str, size: int, part_size: int
+) -> dict[str, Any]:
+    status = chunked_upload_status(xnat_session, upload_id)
+    if (status["name"], status["size"], status["partSize"]) != (
+        remote_path,
+        size,
+        part_size,
+    ):
+        raise ValueError(
+            f"Upload {upload_id} is of {status['name']} ({status['size']} bytes in "
+            f"parts of {status['partSize']}), not {remote_path} ({size} bytes in parts "
+            f"of {part_size})"
+        )
+    logger.info(
+        f"Resuming upload {upload_id} of {remote_path} - "
+        f"{len(status['missingParts'])} of {status['numberOfParts']} parts to send"
+    )
+    return status
+
+
+def upload_resource_file_in_parts(
+    xnat_session: Any,
+    project_name: str,
+    experiment_name: str,
+    scan_name: str,
+    resource_label: str,
+    source: Path,
+    remote_path: Optional[str] = None,
+    part_size: int = DEFAULT_PART_SIZE,
+    max_workers: int = DEFAULT_PART_WORKERS,
+    progress: Optional[UploadProgressCallback] = None,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    upload_id: Optional[str] = None,
+) -> str:
+    """Upload a (very large) file to a resource of an interfile scan through the interfile
+    plugin's upload API, in parts of part_size bytes sent over max_workers connections at
+    once. The resource is created if it doesn't exist. Returns the MD5 of the file.
+
+    The parts are sent straight from a memory map of the file, with no copies, while its
+    MD5 is computed in another thread. Transient failures of each part are retried on
+    their own, according to retry. The server checks the MD5 of each part, and on
+    completion the MD5 of the part MD5s (see parts_md5), so it never reads the file back
+    - a mismatch raises ChecksumError.
+
+    If a part still fails, the upload is left on the server, and its ID logged - pass it
+    as upload_id to send only the parts the server hasn't received (or see
+    abort_chunked_upload)."""
+
+    remote_path = remote_path or source.name
+    size = source.stat().st_size
+    if upload_id is None:
+        status = _start_upload(
+            xnat_session,
+            chunked_upload_uri(
+                project_name, experiment_name, scan_name, resource_label
+            ),
+            remote_path,
+            size,
+            part_size,
+            retry,
+        )
+        upload_id = status["uploadId"]
+    else:
+        status = _resumed_upload(xnat_session, upload_id, remote_path, size, part_size)
+    parts = status["missingParts"]
+
+    start_time = time.perf_counter()
+    try:
+        md5, upload_parts_md5 = _send_parts(
+            xnat_session,
+            upload_id,
+            source,
+            size,
+            part_size,
+            parts,
+            max_workers,
+            progress,
+            retry,
+        )
+    except Exception:
+        logger.warning(
+            f"Upload {upload_id} of {remote_path} failed - pass upload_id="
+            f"'{upload_id}' to resume it"
+        )
+        raise
+
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        # a retry after the file was added (but the response lost) finds no upload
+        if attempt > 1:
+            accepted_status = accepted_status + [404]
+        return xnat_session.post(
+            f"/xapi/interfile/uploads/{upload_id}/complete",
+            query={"partsMd5": upload_parts_md5},
+            accepted_status=accepted_status + [400],
+        )
+
+    response = request_with_retry(send, retry, f"Completion of upload {upload_id}")
+    if response.status_code == 400:
+        raise ChecksumError(
+            f"Checksum of the parts of {remote_path} received by server doesn't match "
+            f"local file ({upload_parts_md5}):\n{response.text}"
+        )
+    elapsed = time.perf_counter() - start_time
+
+    logger.info(
+        f"Uploaded {remote_path} in {len(parts)} parts ({size} bytes in {elapsed:.1f}s, "
+        f"{size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+    )
+    return md5
+
+
+def _send_parts(
+    xnat_session: Any,
+    upload_id: str,
+    source: Path,
+    size: int,
+    part_size: int,
+    parts: list[int],
+    max_workers: int,
+    progress: Optional[UploadProgressCallback],
+    retry: Optional[RetryPolicy],
+) -> tuple[str, str]:
+    """Send the given parts of the file, returning the MD5 of the whole file and the MD5
+    of the MD5s of all its parts"""
+
+    if size == 0:
+        return hashlib.md5().hexdigest(), parts_md5([])
+
+    progress_lock = threading.Lock()
+    bytes_sent = 0
+    sent_md5s: dict[int, str] = {}
+    start_time = time.perf_counter()
+
+    def send_part(mapped: mmap.mmap, part: int) -> None:
+        nonlocal bytes_sent
+        start = (part - 1) * part_size
+        end = min(start + part_size, size)
+        # released before the map is closed, which fails while views of it exist
+        with memoryview(mapped) as whole, whole[start:end] as view:
+            part_md5 = hashlib.md5(view).hexdigest()
+
+            def send(attempt: int, accepted_status: list[int]) -> Any:
+                return xnat_session.put(
+                    f"/xapi/interfile/uploads/{upload_id}/parts/{part}",
+                    data=view,
+                    headers={"Content-Type": "application/octet-stream"},
+                    accepted_status=accepted_status,
+                )
+
+            response = request_with_retry(
+                send, retry, f"Upload of part {part} of {upload_id}"
+            )
+        server_md5 = response.json()["md5"]
+        if server_md5 != part_md5:
+            raise ChecksumError(
+                f"Checksum of part {part} of {upload_id} on server ({server_md5}) "
+                f"doesn't match local file ({part_md5})"
+            )
+        sent_md5s[part] = part_md5
+        if progress is not None:
+            with progress_lock:
+                bytes_sent += end - start
+                elapsed = time.perf_counter() - start_time
+                progress(bytes_sent, size, bytes_sent / max(elapsed, 1e-9))
+
+    failed = threading.Event()
+
+    sending = set(parts)
+
+    def file_md5(mapped: mmap.mmap) -> tuple[str, dict[int, str]]:
+        # also the MD5s of the parts received before a resume, which aren't sent
+        md5 = hashlib.md5()
+        received_md5s = {}
+        with memoryview(mapped) as whole:
+            for part, start in enumerate(range(0, size, part_size), start=1):
+                if failed.is_set():
+                    break
+                with whole[start : start + part_size] as view:
+                    md5.update(view)
+                    if part not in sending:
+                        received_md5s[part] = hashlib.md5(view).hexdigest()
+        return md5.hexdigest(), received_md5s
+
+    with (
+        open(source, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        # hashlib releases the GIL, so the file's MD5 is computed alongside the uploads
+        with ThreadPoolExecutor(max_workers=max_workers + 1) as pool:
+            md5_future = pool.submit(file_md5, mapped)
+            futures = [pool.submit(send_part, mapped, part) for part in parts]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                error = future.exception()
+                if error is not None:
+                    failed.set()
+                    for pending in futures:
+                        pending.cancel()
+                    raise error
+            md5, part_md5s = md5_future.result()
+    part_md5s.update(sent_md5s)
+    return md5, parts_md5([part_md5s[part] for part in sorted(part_md5s)])
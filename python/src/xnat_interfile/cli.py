@@ -0,0 +1,405 @@
+"""Command line interface to ingest interfile acquisitions into XNAT, verify them
+against the archive and export the metadata of archived scans.
+
+Each subcommand only imports the modules it needs when it runs - xnat (and stir, for the
+stir header backend) take far longer to import than a dry run takes to convert a header,
+so `--help` and `dry-run` never import them. Server credentials are read from the
+XNAT_USER / XNAT_PASSWORD environment variables (or prompted for), or from ~/.netrc if no
+user is given.
+"""
+
+import argparse
+import getpass
+import json
+import logging
+import os
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+from xnat_interfile.interfile_2_xnat import LISTMODE_SCAN_TYPE, SCAN_TYPES
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def _connect(args: argparse.Namespace) -> Any:
+    import xnat
+
+    password = os.environ.get("XNAT_PASSWORD")
+    if args.user is not None and password is None:
+        password = getpass.getpass(f"Password for {args.user} on {args.server}: ")
+    return xnat.connect(args.server, user=args.user, password=password)
+
+
+def _find_acquisitions(args: argparse.Namespace) -> list[Any]:
+    """Acquisitions under the directory args.path, or the single header args.path in the
+    subject / experiment / scan given by the options"""
+
+    from xnat_interfile.batch_ingest import (
+        DEFAULT_ACQUISITION_PATTERN,
+        Acquisition,
+        find_acquisitions,
+    )
+
+    labels = (args.subject, args.experiment, args.scan)
+    if args.path.is_dir():
+        if any(label is not None for label in labels):
+            args.subparser.error(
+                "--subject, --experiment and --scan only apply to a single header"
+            )
+        acquisitions = find_acquisitions(
+            args.path, args.project, args.pattern or DEFAULT_ACQUISITION_PATTERN
+        )
+        logger.info(f"Found {len(acquisitions)} acquisitions under {args.path}")
+        return acquisitions
+
+    if any(label is None for label in labels):
+        args.subparser.error(
+            "--subject, --experiment and --scan are needed to ingest a single header"
+        )
+    return [Acquisition(args.path, args.project, *labels)]
+
+
+def _ingest(args: argparse.Namespace) -> int:
+    from xnat_interfile.batch_ingest import ingest_acquisitions
+    from xnat_interfile.hash_index import HashIndex
+    from xnat_interfile.header_cache import HeaderCache
+    from xnat_interfile.ingest_journal import IngestJournal
+
+    acquisitions = _find_acquisitions(args)
+    with ExitStack() as stack:
+        journal = (
+            stack.enter_context(IngestJournal(args.journal)) if args.journal else None
+        )
+        hash_index = (
+            stack.enter_context(HashIndex(args.hash_index)) if args.hash_index else None
+        )
+        header_cache = (
+            stack.enter_context(HeaderCache(args.header_cache))
+            if args.header_cache
+            else None
+        )
+        session = stack.enter_context(_connect(args))
+        results = ingest_acquisitions(
+            session,
+            acquisitions,
+            max_upload_workers=args.workers,
+            header_backend=args.backend,
+            journal=journal,
+            hash_index=hash_index,
+            archive=args.archive,
+            event_stats=args.event_stats,
+            header_cache=header_cache,
+            compression=args.compression,
+            part_size=args.part_size * 1024 * 1024 if args.part_size else None,
+        )
+
+    n_failed = sum(not result.ok for result in results)
+    logger.info(
+        f"Ingested {len(results) - n_failed} of {len(results)} acquisitions "
+        f"({n_failed} failed)"
+    )
+    return 1 if n_failed else 0
+
+
+def _verify_acquisition(session: Any, acquisition: Any) -> tuple[str, list[str]]:
+    """Status of an ingested acquisition ('ok', 'missing' or 'mismatch') and the names of
+    the files that are missing from, or differ from, the scan's PET_RAW resource"""
+
+    from xnat.exceptions import XNATResponseError
+
+    from xnat_interfile.hash_index import file_md5
+    from xnat_interfile.label_index import experiments_uri
+    from xnat_interfile.upload import resource_file_digests
+
+    resource_uri = (
+        f"{experiments_uri(acquisition.project_name, acquisition.subject_name)}"
+        f"/{acquisition.experiment_name}/scans/{acquisition.scan_name}"
+        f"/resources/PET_RAW"
+    )
+    file_paths = [acquisition.header_path, acquisition.data_path]
+    try:
+        server_md5s = resource_file_digests(session, resource_uri)
+    except XNATResponseError:
+        return "missing", [file_path.name for file_path in file_paths]
+
+    missing = [
+        file_path.name for file_path in file_paths if file_path.name not in server_md5s
+    ]
+    if missing:
+        return "missing", missing
+
+    mismatched = []
+    for file_path in file_paths:
+        server_md5 = server_md5s[file_path.name]
+        if server_md5 is None:
+            logger.warning(f"No checksum available on server for {file_path.name}")
+        elif server_md5 != file_md5(file_path):
+            mismatched.append(file_path.name)
+    return ("mismatch", mismatched) if mismatched else ("ok", [])
+
+
+def _verify(args: argparse.Namespace) -> int:
+    from xnat_interfile.ingest_journal import acquisition_key
+
+    acquisitions = _find_acquisitions(args)
+    n_failed = 0
+    with _connect(args) as session:
+        for acquisition in acquisitions:
+            status, file_names = _verify_acquisition(session, acquisition)
+            key = acquisition_key(
+                acquisition.project_name,
+                acquisition.subject_name,
+                acquisition.experiment_name,
+                acquisition.scan_name,
+            )
+            print("\t".join([status, key, *file_names]), flush=True)
+            n_failed += status != "ok"
+
+    logger.info(
+        f"Verified {len(acquisitions) - n_failed} of {len(acquisitions)} acquisitions "
+        f"({n_failed} missing or mismatched)"
+    )
+    return 1 if n_failed else 0
+
+
+def _export(args: argparse.Namespace) -> int:
+    from xnat_interfile.metadata_export import export_scan_metadata_csv
+
+    with _connect(args) as session:
+        n_rows = export_scan_metadata_csv(
+            session, args.project, args.output, xsi_type=args.scan_type
+        )
+    logger.info(f"Wrote metadata of {n_rows} scans to {args.output}")
+    return 0
+
+
+def _dry_run(args: argparse.Namespace) -> int:
+    from xnat_interfile.header_cache import (
+        HeaderCache,
+        cached_read_listmode_header_2_xnat,
+    )
+    from xnat_interfile.interfile_header import DATA_FILE_SUFFIXES
+
+    frame_schedule = None
+    if args.frames is not None:
+        from xnat_interfile.listmode_stats import parse_frame_schedule
+
+        frame_schedule = parse_frame_schedule(args.frames)
+
+    header_paths = []
+    for path in args.paths:
+        if not path.is_dir():
+            header_paths.append(path)
+            continue
+        header_paths.extend(
+            sorted(
+                header_path
+                for suffix in DATA_FILE_SUFFIXES
+                for header_path in path.rglob(f"*{suffix}")
+            )
+        )
+
+    n_failed = 0
+    with ExitStack() as stack:
+        header_cache = (
+            stack.enter_context(HeaderCache(args.header_cache))
+            if args.header_cache
+            else None
+        )
+        for header_path in header_paths:
+            try:
+                xnat_hdr = cached_read_listmode_header_2_xnat(
+                    header_path,
+                    backend=args.backend,
+                    event_stats=args.event_stats,
+                    header_cache=header_cache,
+                    frame_schedule=frame_schedule,
+                )
+            except (OSError, ValueError) as error:
+                logger.error(f"Failed to convert {header_path}: {error!r}")
+                n_failed += 1
+                continue
+            except Exception:
+                logger.exception(f"Unexpected error converting {header_path}")
+                n_failed += 1
+                continue
+            print(
+                json.dumps({"header": str(header_path), "fields": xnat_hdr}),
+                flush=True,
+            )
+    return 1 if n_failed else 0
+
+
+def _add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    server = os.environ.get("XNAT_SERVER")
+    parser.add_argument(
+        "--server",
+        default=server,
+        required=server is None,
+        help="XNAT server URL (default $XNAT_SERVER)",
+    )
+    parser.add_argument(
+        "--user",
+        default=os.environ.get("XNAT_USER"),
+        help="XNAT user (default $XNAT_USER, or from ~/.netrc)",
+    )
+    parser.add_argument("--project", required=True, help="XNAT project")
+
+
+def _add_acquisition_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "path",
+        type=Path,
+        help="directory of acquisitions (see --pattern), or a single header (.l.hdr, "
+        ".hs or .hv)",
+    )
+    parser.add_argument(
+        "--pattern",
+        help="regular expression matching the paths of headers relative to the "
+        "directory, with subject, experiment and scan groups (default "
+        "<subject>/<experiment>/<scan>.l.hdr, .hs or .hv)",
+    )
+    for label in ("subject", "experiment", "scan"):
+        parser.add_argument(f"--{label}", help=f"{label} of a single header")
+
+
+def _add_header_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--backend",
+        choices=("native", "stir", "server"),
+        default="native",
+        help="how headers are read (stir needs stir to be installed, server leaves them "
+        "to the interfile plugin on XNAT)",
+    )
+    parser.add_argument(
+        "--header-cache", type=Path, help="cache of converted headers (SQLite)"
+    )
+    parser.add_argument(
+        "--event-stats",
+        action="store_true",
+        help="include event statistics decoded from the listmode data (or the "
+        "minimum, maximum and sum of projection data and images) - this reads all "
+        "of each data file",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="xnat-interfile", description=__doc__.split("\n\n")[0]
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", action="store_true")
+    verbosity.add_argument("-q", "--quiet", action="store_true")
+    parser.add_argument("--log-file", type=Path, help="also write the log to a file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser(
+        "ingest", help="upload acquisitions to new scans in XNAT"
+    )
+    _add_acquisition_arguments(ingest)
+    _add_server_arguments(ingest)
+    _add_header_arguments(ingest)
+    ingest.add_argument(
+        "--workers", type=int, default=4, help="maximum number of parallel uploads"
+    )
+    ingest.add_argument(
+        "--archive",
+        action="store_true",
+        help="upload the header and data of each scan in a single zip archive",
+    )
+    ingest.add_argument(
+        "--compression",
+        choices=("zstd",),
+        help="compress the data files as they are uploaded (needs zstandard)",
+    )
+    ingest.add_argument(
+        "--part-size",
+        type=int,
+        metavar="MIB",
+        help="upload the data files in parts of this many MiB, several at once, "
+        "through the interfile plugin's upload API",
+    )
+    ingest.add_argument(
+        "--journal",
+        type=Path,
+        help="journal of ingested acquisitions (SQLite), to resume interrupted runs",
+    )
+    ingest.add_argument(
+        "--hash-index",
+        type=Path,
+        help="index of archived file checksums (SQLite), to skip duplicate data",
+    )
+    ingest.set_defaults(handler=_ingest, subparser=ingest)
+
+    verify = subparsers.add_parser(
+        "verify",
+        help="check the files of ingested acquisitions match those archived in XNAT",
+    )
+    _add_acquisition_arguments(verify)
+    _add_server_arguments(verify)
+    verify.set_defaults(handler=_verify, subparser=verify)
+
+    export = subparsers.add_parser(
+        "export", help="export the metadata of all scans in a project to CSV"
+    )
+    _add_server_arguments(export)
+    export.add_argument("-o", "--output", type=Path, required=True, help="CSV file")
+    export.add_argument(
+        "--scan-type",
+        choices=SCAN_TYPES.values(),
+        default=LISTMODE_SCAN_TYPE,
+        help="type of the scans to export (default %(default)s)",
+    )
+    export.set_defaults(handler=_export, subparser=export)
+
+    dry_run = subparsers.add_parser(
+        "dry-run",
+        help="print the XNAT fields of headers (as JSON lines) without connecting",
+    )
+    dry_run.add_argument(
+        "paths",
+        type=Path,
+        nargs="+",
+        help="headers (.l.hdr, .hs or .hv), or directories of them",
+    )
+    _add_header_arguments(dry_run)
+    dry_run.add_argument(
+        "--frames",
+        help="frame schedule to count events in, e.g. 6x10,4x30,60 (default the "
+        "header's time frames)",
+    )
+    dry_run.set_defaults(handler=_dry_run, subparser=dry_run)
+
+    return parser
+
+
+def configure_logging(
+    level: int = logging.INFO, log_file: Optional[Path] = None
+) -> None:
+    """Log to stderr (and log_file, if given) - only done by the command line, so
+    importing the package never adds handlers."""
+
+    handlers: list[logging.Handler] = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file))
+    logging.basicConfig(level=level, format=LOG_FORMAT, handlers=handlers)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        level = logging.DEBUG
+    elif args.quiet:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    configure_logging(level, args.log_file)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from xnat_interfile.interfile_header import get_header_value
+
+logger = logging.getLogger(__name__)
+
+# Number of values reduced at a time. Only one chunk of the file is mapped at once, so
+# memory use is bounded whatever the size of the projection data or image.
+DEFAULT_CHUNK_VALUES = 16 * 1024 * 1024
+
+# numpy type codes of interfile number formats, keyed by (number format, bytes per pixel)
+NUMBER_FORMATS = {
+    ("float", 4): "f4",
+    ("float", 8): "f8",
+    ("short float", 4): "f4",
+    ("long float", 8): "f8",
+    **{("signed integer", size): f"i{size}" for size in (1, 2, 4, 8)},
+    **{("unsigned integer", size): f"u{size}" for size in (1, 2, 4, 8)},
+}
+
+
+@dataclass
+class DataStats:
+    """Summary statistics of the values of a projection data or image file - scaled by
+    the header's image scaling factor, if any."""
+
+    n_values: int
+    minimum: float
+    maximum: float
+    sum: float
+
+
+def header_data_dtype(header: dict[str, str]) -> np.dtype:
+    """numpy type of the values of the data described by a parsed interfile header, from
+    'number format', 'number of bytes per pixel' and 'imagedata byte order'. The data is
+    big endian unless the header says otherwise (as in the interfile standard and STIR)
+    - unlike PETLINK listmode data (see listmode_stats.header_byte_order)."""
+
+    number_format = (get_header_value(header, "number format") or "float").lower()
+    bytes_per_pixel = int(get_header_value(header, "number of bytes per pixel") or "4")
+    type_code = NUMBER_FORMATS.get((number_format, bytes_per_pixel))
+    if type_code is None:
+        raise ValueError(
+            f"Unsupported number format {number_format} with {bytes_per_pixel} bytes "
+            f"per pixel"
+        )
+
+    byte_order = get_header_value(header, "imagedata byte order") or "bigendian"
+    return np.dtype((">" if byte_order.lower() == "bigendian" else "<") + type_code)
+
+
+def header_data_offset(header: dict[str, str]) -> int:
+    """Offset (bytes) of the first value in the data file, from 'data offset in bytes'
+    of the first time frame"""
+
+    return int(
+        get_header_value(header, "data offset in bytes[1]", "data offset in bytes")
+        or "0"
+    )
+
+
+def header_scaling_factor(header: dict[str, str]) -> float:
+    """Factor the stored values are multiplied by, from 'image scaling factor' of the
+    first time frame"""
+
+    return float(
+        get_header_value(header, "image scaling factor[1]", "image scaling factor")
+        or "1"
+    )
+
+
+def data_stats(
+    data_path: Path,
+    dtype: np.dtype,
+    offset: int = 0,
+    n_values: Optional[int] = None,
+    scaling_factor: float = 1.0,
+    chunk_values: int = DEFAULT_CHUNK_VALUES,
+) -> DataStats:
+    """Minimum, maximum and sum of n_values values of type dtype starting offset bytes
+    into a projection data (.s) or image (.v) file - by default, all values to the end
+    of the file.
+
+    The file is memory-mapped and reduced in vectorised chunks of chunk_values values,
+    one chunk mapped at a time, in a single sequential pass. Sums are accumulated in
+    double precision."""
+
+    if chunk_values <= 0:
+        raise ValueError(f"chunk_values must be positive, got {chunk_values}")
+    n_available = max(data_path.stat().st_size - offset, 0) // dtype.itemsize
+    if n_values is None:
+        n_values = n_available
+    if n_values > n_available:
+        raise ValueError(
+            f"{data_path} holds {n_available} values of {dtype} after {offset} bytes, "
+            f"less than the {n_values} expected"
+        )
+    if n_values == 0:
+        raise ValueError(f"No values in {data_path} after {offset} bytes")
+
+    minimum = np.inf
+    maximum = -np.inf
+    total = 0.0
+    for start in range(0, n_values, chunk_values):
+        # map one chunk at a time - pages of a whole-file map stay resident once read
+        chunk = np.memmap(
+            data_path,
+            dtype=dtype,
+            mode="r",
+            offset=offset + start * dtype.itemsize,
+            shape=(min(chunk_values, n_values - start),),
+        )
+        minimum = min(minimum, float(chunk.min()))
+        maximum = max(maximum, float(chunk.max()))
+        total += float(chunk.sum(dtype=np.float64))
+        del chunk
+
+    if scaling_factor < 0:
+        minimum, maximum = maximum, minimum
+    logger.info(
+        f"Reduced {n_values} values of {dtype} from {data_path}: minimum "
+        f"{minimum * scaling_factor:g}, maximum {maximum * scaling_factor:g}"
+    )
+    return DataStats(
+        n_values=n_values,
+        minimum=minimum * scaling_factor,
+        maximum=maximum * scaling_factor,
+        sum=total * scaling_factor,
+    )
@@ -0,0 +1,600 @@
+import hashlib
+import itertools
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any, BinaryIO, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+from xnat.exceptions import XNATResponseError
+
+from xnat_interfile.interfile_header import listmode_data_path, parse_interfile_header
+from xnat_interfile.listmode_stats import (
+    FrameSchedule,
+    header_byte_order,
+    header_frame_schedule,
+    is_petlink_32bit,
+    time_tags,
+)
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy, request_with_retry
+from xnat_interfile.upload import (
+    COMPRESSION_SUFFIXES,
+    DEFAULT_CHUNK_SIZE,
+    ChecksumError,
+    import_zstandard,
+)
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks files are cached in by a RangeCache - the smallest range fetched
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Largest range fetched in a single request - longer runs of missing blocks are split
+# into several requests, sent in parallel
+DEFAULT_RANGE_REQUEST_SIZE = 16 * 1024 * 1024
+
+# Default number of range requests sent at once
+DEFAULT_RANGE_WORKERS = 4
+
+
+def file_compression(remote_path: str) -> Optional[str]:
+    """Codec a file on the server was compressed with on upload (see
+    upload_compressed_resource_file), from the suffix of its name - None if it wasn't."""
+
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if remote_path.endswith(suffix):
+            return compression
+    return None
+
+
+def _get_file(
+    xnat_session: Any,
+    file_uri: str,
+    retry: Optional[RetryPolicy],
+    headers: Optional[dict[str, str]] = None,
+    accepted_status: Sequence[int] = (200,),
+) -> Any:
+    """Streamed response to a GET of a file, retrying transient failures of the request"""
+
+    url = f"{xnat_session.server.rstrip('/')}/{file_uri.lstrip('/')}"
+
+    def send(attempt: int, send_status: list[int]) -> Any:
+        response = xnat_session.interface.get(url, headers=headers, stream=True)
+        if response.status_code not in send_status:
+            raise XNATResponseError(
+                f"Download of {file_uri} failed (status {response.status_code}):\n"
+                f"{response.text}",
+                response=response,
+            )
+        return response
+
+    return request_with_retry(
+        send, retry, f"Download of {file_uri}", accepted_status=accepted_status
+    )
+
+
+def _decompressed(
+    chunks: Iterator[bytes], compression: Optional[str]
+) -> Iterator[bytes]:
+    if compression is None:
+        yield from chunks
+        return
+
+    decompressor = import_zstandard().ZstdDecompressor().decompressobj()
+    for chunk in chunks:
+        if data := decompressor.decompress(chunk):
+            yield data
+
+
+def _check_md5(file_uri: str, actual: str, expected: Optional[str]) -> None:
+    if expected is not None and actual != expected:
+        raise ChecksumError(
+            f"Checksum of downloaded {file_uri} ({actual}) doesn't match {expected}"
+        )
+
+
+def download_resource_file(
+    xnat_session: Any,
+    file_uri: str,
+    output_path: Path,
+    decompress: bool = True,
+    md5: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> int:
+    """Download a file from an XNAT resource (file_uri is e.g.
+    .../resources/PET_RAW/files/scan.l.zst) to output_path, streaming it in chunks of
+    chunk_size bytes. A file compressed on upload is decompressed on the fly, unless
+    decompress is False. Returns the number of bytes written.
+
+    If md5 is given (e.g. the scan's dataFile/originalMd5), the checksum of the data
+    written is checked against it, raising ChecksumError if it doesn't match. The data
+    is written to a .part file next to output_path, which is only renamed once complete.
+    """
+
+    compression = file_compression(file_uri) if decompress else None
+    part_path = output_path.with_name(f"{output_path.name}.part")
+    written_md5 = hashlib.md5()
+    n_bytes = 0
+
+    response = _get_file(xnat_session, file_uri, retry)
+    with response, open(part_path, "wb") as file:
+        for data in _decompressed(response.iter_content(chunk_size), compression):
+            written_md5.update(data)
+            n_bytes += len(data)
+            file.write(data)
+
+    try:
+        _check_md5(file_uri, written_md5.hexdigest(), md5)
+    except ChecksumError:
+        part_path.unlink()
+        raise
+    os.replace(part_path, output_path)
+    logger.info(f"Downloaded {file_uri} to {output_path} ({n_bytes} bytes)")
+    return n_bytes
+
+
+def download_resource_file_to_mmap(
+    xnat_session: Any,
+    file_uri: str,
+    size: Optional[int] = None,
+    decompress: bool = True,
+    md5: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> mmap.mmap:
+    """Download a file from an XNAT resource into an anonymous memory map (e.g. to view
+    listmode data with numpy.frombuffer, without writing it to disk), decompressing a file
+    compressed on upload on the fly unless decompress is False.
+
+    size is the number of bytes of (decompressed) data - by default, taken from the zstd
+    frame header of a compressed file, or the Content-Length of the response. If md5 is
+    given, the checksum of the data is checked against it (see download_resource_file).
+    """
+
+    compression = file_compression(file_uri) if decompress else None
+    response = _get_file(xnat_session, file_uri, retry)
+    with response:
+        chunks = response.iter_content(chunk_size)
+        first_chunk = next(chunks, b"")
+        if size is None:
+            if compression is not None:
+                size = import_zstandard().frame_content_size(first_chunk)
+            elif "Content-Length" in response.headers:
+                size = int(response.headers["Content-Length"])
+            if size is None or size < 0:
+                raise ValueError(f"Size of {file_uri} isn't known - pass size")
+
+        data_md5 = hashlib.md5()
+        # an anonymous memory map can't be empty
+        buffer = mmap.mmap(-1, max(size, 1))
+        try:
+            for data in _decompressed(
+                itertools.chain([first_chunk], chunks), compression
+            ):
+                if buffer.tell() + len(data) > size:
+                    raise ValueError(f"{file_uri} has more than {size} bytes")
+                buffer.write(data)
+                data_md5.update(data)
+            if buffer.tell() != size:
+                raise ValueError(
+                    f"{file_uri} has {buffer.tell()} bytes - expected {size}"
+                )
+            _check_md5(file_uri, data_md5.hexdigest(), md5)
+        except BaseException:
+            buffer.close()
+            raise
+
+    buffer.seek(0)
+    logger.info(f"Downloaded {file_uri} to memory ({size} bytes)")
+    return buffer
+
+
+class RangeCache:
+    """Persistent cache of byte ranges of files on XNAT servers, so only the parts of a
+    large file that are needed are downloaded - and only once, however many times they
+    are read (see open).
+
+    Each file is cached in a sparse local file of its full size in cache_dir, filled in
+    blocks of block_size bytes as they are fetched. The blocks present are recorded in an
+    SQLite database in cache_dir. A cached file is discarded when the size or MD5 of the
+    file on the server changes.
+    """
+
+    def __init__(self, cache_dir: Path, block_size: int = DEFAULT_BLOCK_SIZE):
+        if block_size <= 0:
+            raise ValueError(f"block_size must be positive, got {block_size}")
+
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            cache_dir / "ranges.sqlite", check_same_thread=False
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "key TEXT PRIMARY KEY, size INTEGER NOT NULL, md5 TEXT, "
+                "block_size INTEGER NOT NULL, name TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                "key TEXT NOT NULL, block INTEGER NOT NULL, PRIMARY KEY (key, block))"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def open(
+        self,
+        xnat_session: Any,
+        file_uri: str,
+        max_workers: int = DEFAULT_RANGE_WORKERS,
+        request_size: int = DEFAULT_RANGE_REQUEST_SIZE,
+        retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    ) -> "CachedFile":
+        """The cached copy of a file in an XNAT resource (file_uri is e.g.
+        .../resources/PET_RAW/files/scan.l), to fetch ranges of it into (see
+        CachedFile.fetch) in a with block. The size and MD5 of the file are looked up on
+        the server."""
+
+        resource_uri, name = file_uri.split("/files/", 1)
+        rows = xnat_session.get_json(f"{resource_uri}/files")["ResultSet"]["Result"]
+        row = next((row for row in rows if row["Name"] == name), None)
+        if row is None:
+            raise FileNotFoundError(f"{file_uri} not found on {xnat_session.server}")
+        size, md5 = int(row["Size"]), row.get("digest") or None
+
+        key = f"{xnat_session.server.rstrip('/')}{file_uri}"
+        path = self.cache_dir / (
+            f"{hashlib.sha1(key.encode()).hexdigest()}_{Path(name).name}"
+        )
+        with self._lock, self._connection:
+            entry = self._connection.execute(
+                "SELECT size, md5, block_size FROM files WHERE key = ?", (key,)
+            ).fetchone()
+            if entry != (size, md5, self.block_size) or not path.exists():
+                if entry is not None:
+                    logger.info(f"{file_uri} changed on the server - clearing cache")
+                self._connection.execute("DELETE FROM blocks WHERE key = ?", (key,))
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (key, size, md5, self.block_size, path.name),
+                )
+                with open(path, "wb") as file:
+                    # sparse on most filesystems - space is only used as blocks are fetched
+                    file.truncate(size)
+            fetched = {
+                block
+                for (block,) in self._connection.execute(
+                    "SELECT block FROM blocks WHERE key = ?", (key,)
+                )
+            }
+        return CachedFile(
+            self,
+            xnat_session,
+            file_uri,
+            key,
+            path,
+            size,
+            fetched,
+            max_workers,
+            request_size,
+            retry,
+        )
+
+    def record_blocks(self, key: str, blocks: Iterable[int]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO blocks VALUES (?, ?)",
+                [(key, block) for block in blocks],
+            )
+
+
+class CachedFile:
+    """A file on XNAT cached by a RangeCache, used as a context manager - the local copy
+    is opened on entry, and closed on exit (delete any numpy arrays viewing data first).
+    data is a read-only memory map of the local copy, the size of the whole file - but
+    only the ranges fetched hold its data, the rest reads as zeros."""
+
+    data: mmap.mmap
+
+    def __init__(
+        self,
+        cache: RangeCache,
+        xnat_session: Any,
+        file_uri: str,
+        key: str,
+        path: Path,
+        size: int,
+        fetched: set[int],
+        max_workers: int,
+        request_size: int,
+        retry: Optional[RetryPolicy],
+    ):
+        self.cache = cache
+        self.xnat_session = xnat_session
+        self.file_uri = file_uri
+        self.path = path
+        self.size = size
+        self.block_size = cache.block_size
+        self.max_workers = max_workers
+        self.request_size = request_size
+        self.retry = retry
+        self._key = key
+        self._fetched = fetched
+        self._file: Optional[BinaryIO] = None
+
+    def __enter__(self):
+        self._file = open(self.path, "r+b")
+        try:
+            # a memory map can't be empty
+            self.data = (
+                mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.size
+                else mmap.mmap(-1, 1)
+            )
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if hasattr(self, "data"):
+            self.data.close()
+            del self.data
+        self._file.close()
+        self._file = None
+
+    def is_cached(self, start: int, end: int) -> bool:
+        """Whether bytes start to end (exclusive) of the file are cached"""
+
+        return all(block in self._fetched for block in self._blocks(start, end))
+
+    def _blocks(self, start: int, end: int) -> range:
+        end = min(end, self.size)
+        if end <= start:
+            return range(0)
+        return range(start // self.block_size, (end - 1) // self.block_size + 1)
+
+    def fetch(self, ranges: Iterable[tuple[int, int]]) -> int:
+        """Make sure the byte ranges (start, end exclusive) of the file are cached. The
+        blocks missing from the cache are fetched with range requests, max_workers at
+        once - each for a run of consecutive blocks of up to request_size bytes. Returns
+        the number of bytes fetched."""
+
+        if self._file is None:
+            raise RuntimeError(
+                f"The cached copy of {self.file_uri} isn't open - fetch in a with block"
+            )
+        missing = sorted(
+            {block for start, end in ranges for block in self._blocks(start, end)}
+            - self._fetched
+        )
+        blocks_per_request = max(1, self.request_size // self.block_size)
+        requests: list[list[int]] = []
+        for block in missing:
+            if (
+                requests
+                and requests[-1][-1] == block - 1
+                and len(requests[-1]) < blocks_per_request
+            ):
+                requests[-1].append(block)
+            else:
+                requests.append([block])
+
+        n_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            # recorded as each completes, so a failed fetch keeps the blocks fetched
+            fetch_blocks = partial(self._fetch_blocks, self._file)
+            for blocks, n_request_bytes in pool.map(fetch_blocks, requests):
+                self._fetched.update(blocks)
+                self.cache.record_blocks(self._key, blocks)
+                n_bytes += n_request_bytes
+        if n_bytes:
+            logger.info(
+                f"Fetched {n_bytes} bytes of {self.file_uri} in {len(requests)} requests"
+            )
+        return n_bytes
+
+    def _fetch_blocks(self, file: BinaryIO, blocks: list[int]) -> tuple[list[int], int]:
+        start = blocks[0] * self.block_size
+        end = min((blocks[-1] + 1) * self.block_size, self.size)
+        response = _get_file(
+            self.xnat_session,
+            self.file_uri,
+            self.retry,
+            headers={"Range": f"bytes={start}-{end - 1}"},
+            accepted_status=(200, 206),
+        )
+        if response.status_code == 200:
+            # the server ignored the range - the whole file is cached instead
+            logger.warning(f"Range requests not supported - fetching {self.file_uri}")
+            blocks, start, end = list(self._blocks(0, self.size)), 0, self.size
+
+        position = start
+        with response:
+            for chunk in response.iter_content(DEFAULT_CHUNK_SIZE):
+                if position + len(chunk) > end:
+                    raise ValueError(
+                        f"Range {start}-{end} of {self.file_uri} has more than "
+                        f"{end - start} bytes"
+                    )
+                os.pwrite(file.fileno(), chunk, position)
+                position += len(chunk)
+        if position != end:
+            raise ValueError(
+                f"Range {start}-{end} of {self.file_uri} has {position - start} bytes - "
+                f"expected {end - start}"
+            )
+        return blocks, end - start
+
+
+@dataclass
+class ListmodeFrames:
+    """Time frames of listmode data on XNAT, fetched into a RangeCache (see
+    download_listmode_frames). header is the parsed interfile header, and ranges the
+    byte range (start, end exclusive) of each frame in data_file."""
+
+    header: dict[str, str]
+    frame_schedule: list[tuple[float, float]]
+    data_file: CachedFile
+    ranges: list[tuple[int, int]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self.data_file.close()
+
+    def frame_words(self, frame: int) -> np.ndarray:
+        """32-bit listmode words of a frame (0-based), viewing the memory map of the
+        cache - delete it before closing"""
+
+        start, end = self.ranges[frame]
+        return np.frombuffer(
+            self.data_file.data,
+            dtype=f"{header_byte_order(self.header)}u4",
+            count=(end - start) // 4,
+            offset=start,
+        )
+
+
+def _frame_ranges(
+    data_file: CachedFile, byte_order: str, frame_schedule: FrameSchedule
+) -> list[tuple[int, int]]:
+    """Byte ranges of the frames in listmode data, found by bisecting the file for the
+    time tags at the boundaries - each block probed is fetched into the cache. The events
+    of a frame run from the first time tag at or after its start (or the start of the
+    file, for a frame starting at 0) to the first at or after its end, as counted by
+    listmode_event_stats. Each block is assumed to hold a time tag (1 ms apart), as
+    any block of more than a few kB does."""
+
+    block_size = data_file.block_size
+    n_words = data_file.size // 4
+    n_blocks = -(-n_words * 4 // block_size)
+    block_tags: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+
+    def tags(block: int) -> tuple[np.ndarray, np.ndarray]:
+        if block not in block_tags:
+            start = block * block_size
+            end = min(start + block_size, n_words * 4)
+            data_file.fetch([(start, end)])
+            words = np.frombuffer(
+                data_file.data,
+                dtype=f"{byte_order}u4",
+                count=(end - start) // 4,
+                offset=start,
+            )
+            block_tags[block] = time_tags(words)
+            del words
+        return block_tags[block]
+
+    first_block = next(
+        (block for block in range(n_blocks) if tags(block)[1].size), None
+    )
+    if first_block is None:
+        raise ValueError(f"No time tags in {data_file.file_uri}")
+    first_time_ms = int(tags(first_block)[1][0])
+
+    def offset(time_ms: int) -> int:
+        """Byte offset of the first time tag at or after time_ms (from the first tag)"""
+
+        target = first_time_ms + time_ms
+        low, high = first_block, n_blocks
+        while low < high:
+            middle = (low + high) // 2
+            times = tags(middle)[1]
+            if times.size and times[-1] >= target:
+                high = middle
+            else:
+                low = middle + 1
+        if low == n_blocks:
+            return n_words * 4
+        positions, times = tags(low)
+        return low * block_size + int(positions[np.searchsorted(times, target)]) * 4
+
+    return [
+        (
+            0 if start <= 0 else offset(round(start * 1000)),
+            offset(round((start + duration) * 1000)),
+        )
+        for start, duration in frame_schedule
+    ]
+
+
+def download_listmode_frames(
+    xnat_session: Any,
+    resource_uri: str,
+    header_name: str,
+    cache: RangeCache,
+    frame_schedule: Optional[FrameSchedule] = None,
+    max_workers: int = DEFAULT_RANGE_WORKERS,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> ListmodeFrames:
+    """Download the listmode header (header_name, e.g. scan.l.hdr) from an XNAT resource
+    (e.g. .../resources/PET_RAW), and only the events in the frames of frame_schedule
+    (by default, the time frames defined in the header) from its 32-bit PETLINK data
+    (scan.l) - e.g. to reconstruct a 5 min frame without fetching a file of several GB.
+
+    The frames are fetched into cache with range requests in parallel (see
+    CachedFile.fetch), so later calls only fetch the ranges not cached yet. Data
+    compressed on upload can't be fetched in ranges. Close the returned ListmodeFrames
+    once done with it."""
+
+    with cache.open(
+        xnat_session, f"{resource_uri}/files/{header_name}", retry=retry
+    ) as header_file:
+        header_file.fetch([(0, header_file.size)])
+        header = parse_interfile_header(
+            header_file.data[: header_file.size].decode("latin-1").splitlines()
+        )
+    if not is_petlink_32bit(header):
+        raise ValueError(f"{header_name} doesn't describe 32-bit PETLINK listmode data")
+    if frame_schedule is None:
+        frame_schedule = header_frame_schedule(header)
+        if not frame_schedule:
+            raise ValueError(f"{header_name} defines no time frames - pass them")
+
+    with ExitStack() as stack:
+        data_file = stack.enter_context(
+            cache.open(
+                xnat_session,
+                f"{resource_uri}/files/{listmode_data_path(Path(header_name)).name}",
+                max_workers=max_workers,
+                retry=retry,
+            )
+        )
+        ranges = _frame_ranges(data_file, header_byte_order(header), frame_schedule)
+        data_file.fetch(ranges)
+        # closed by the returned ListmodeFrames from now on
+        stack.pop_all()
+    logger.info(
+        f"Fetched {len(ranges)} frames of {data_file.file_uri} "
+        f"({sum(end - start for start, end in ranges)} of {data_file.size} bytes)"
+    )
+    return ListmodeFrames(header, list(frame_schedule), data_file, ranges)
@@ -1,47 +1,601 @@
-from typing import Optional
-import pooch
+import hashlib
+import io
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional, Sequence
 
+import httpx
 
-def _set_up_zenodo_doi(base_url: str):
-    ZENODO = pooch.create(
-        path=Path(__file__).parents[3] / "test-data",
-        base_url=base_url,
-        registry=None,
-        retry_if_failed=5,
+from xnat_interfile.interfile_header import listmode_data_path
+
+logger = logging.getLogger(__name__)
+
+TEST_DATA_DIR = Path(__file__).parents[3] / "test-data"
+
+ZENODO_URL = "https://zenodo.org"
+
+# DOI of the Zenodo record of the NEMA image quality phantom acquisition used in tests
+NEMA_IQ_DOI = "doi:10.5281/zenodo.1304454"
+
+# Name of the cache of registries and fetched files, in the data directory
+CACHE_NAME = "datasets.sqlite"
+
+# Default number of files (or parts of a file) downloaded at the same time
+DEFAULT_MAX_WORKERS = 4
+
+# Files larger than this are downloaded in parts of this size (bytes), in parallel
+DEFAULT_PART_SIZE = 32 * 1024 * 1024
+
+# Size of the chunks (bytes) downloads are written to disk in
+_READ_SIZE = 1024 * 1024
+
+# Bytes read from the end of a zip archive in one request - the end of central directory
+# record (22 bytes, plus a comment of up to 64 KiB), which the central directory is
+# usually within too
+_TAIL_SIZE = 64 * 1024 + 22
+
+_LOCAL_FILE_HEADER = b"PK\x03\x04"
+_LOCAL_FILE_HEADER_SIZE = 30
+
+
+class _RangesNotSupported(Exception):
+    """The server returned the whole file in response to a range request"""
+
+
+@dataclass(frozen=True)
+class RegistryEntry:
+    """A file of a Zenodo record - where to download it from, its MD5 and size (bytes)"""
+
+    name: str
+    url: str
+    md5: str
+    size: int
+
+
+@dataclass(frozen=True)
+class ZipMember:
+    """A file in a zip archive, as listed in the archive's central directory"""
+
+    name: str
+    header_offset: int
+    compress_size: int
+    file_size: int
+    compress_type: int
+    crc: int
+
+
+class DatasetCache:
+    """Persistent (SQLite) cache of the registries of Zenodo records, the central
+    directories of zip archives in them, and the files already fetched - so fetching
+    files that are already present makes no requests.
+
+    Fetched files are keyed by path, size and modification time, so they are only
+    verified again (against the registry) if they change.
+    """
+
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS registry ("
+                "doi TEXT NOT NULL, name TEXT NOT NULL, url TEXT NOT NULL, "
+                "md5 TEXT NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (doi, name))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS zip_members ("
+                "archive_md5 TEXT NOT NULL, name TEXT NOT NULL, "
+                "header_offset INTEGER NOT NULL, compress_size INTEGER NOT NULL, "
+                "file_size INTEGER NOT NULL, compress_type INTEGER NOT NULL, "
+                "crc INTEGER NOT NULL, PRIMARY KEY (archive_md5, name))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS fetched_files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def registry(self, doi: str) -> dict[str, RegistryEntry]:
+        """The cached registry of a record, keyed by file name - empty if not cached"""
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT name, url, md5, size FROM registry WHERE doi = ?", (doi,)
+            ).fetchall()
+        return {row[0]: RegistryEntry(*row) for row in rows}
+
+    def store_registry(self, doi: str, registry: dict[str, RegistryEntry]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM registry WHERE doi = ?", (doi,))
+            self._connection.executemany(
+                "INSERT INTO registry VALUES (?, ?, ?, ?, ?)",
+                [
+                    (doi, entry.name, entry.url, entry.md5, entry.size)
+                    for entry in registry.values()
+                ],
+            )
+
+    def zip_members(self, archive_md5: str) -> dict[str, ZipMember]:
+        """The cached members of the zip archive with this MD5, keyed by name - empty if
+        not cached"""
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT name, header_offset, compress_size, file_size, compress_type, "
+                "crc FROM zip_members WHERE archive_md5 = ?",
+                (archive_md5,),
+            ).fetchall()
+        return {row[0]: ZipMember(*row) for row in rows}
+
+    def store_zip_members(
+        self, archive_md5: str, members: dict[str, ZipMember]
+    ) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO zip_members VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        archive_md5,
+                        member.name,
+                        member.header_offset,
+                        member.compress_size,
+                        member.file_size,
+                        member.compress_type,
+                        member.crc,
+                    )
+                    for member in members.values()
+                ],
+            )
+
+    def is_fetched(self, file_path: Path) -> bool:
+        """Whether the file was fetched (or verified), and hasn't changed since."""
+
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM fetched_files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (str(file_path.resolve()), stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        return row is not None
+
+    def record_fetched(self, file_path: Path) -> None:
+        stat = file_path.stat()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO fetched_files VALUES (?, ?, ?)",
+                (str(file_path.resolve()), stat.st_size, stat.st_mtime_ns),
+            )
+
+
+def zenodo_record_id(doi: str) -> str:
+    """Id of the Zenodo record with a DOI - e.g. 1304454 for doi:10.5281/zenodo.1304454"""
+
+    match = re.fullmatch(r"(?:doi:)?10\.5281/zenodo\.(\d+)", doi)
+    if match is None:
+        raise ValueError(f"{doi} isn't the DOI of a Zenodo record")
+    return match.group(1)
+
+
+def fetch_registry(
+    client: httpx.Client, doi: str, zenodo_url: str = ZENODO_URL
+) -> dict[str, RegistryEntry]:
+    """The files of a Zenodo record, keyed by name, from the Zenodo API"""
+
+    response = client.get(
+        f"{zenodo_url.rstrip('/')}/api/records/{zenodo_record_id(doi)}"
     )
-    ZENODO.load_registry_from_doi()
-    return ZENODO
+    response.raise_for_status()
+    return {
+        file["key"]: RegistryEntry(
+            name=file["key"],
+            url=file["links"]["self"],
+            md5=file["checksum"].removeprefix("md5:"),
+            size=file["size"],
+        )
+        for file in response.json()["files"]
+    }
+
+
+def _check_range_response(response: httpx.Response) -> None:
+    if response.status_code == 200:
+        raise _RangesNotSupported(f"{response.url} doesn't support range requests")
+    response.raise_for_status()
+
+
+def _get_range(client: httpx.Client, url: str, start: int, end: int) -> bytes:
+    """Bytes start to end (exclusive) of a remote file"""
+
+    response = client.get(url, headers={"Range": f"bytes={start}-{end - 1}"})
+    _check_range_response(response)
+    return response.content
+
+
+class _RemoteFile(io.RawIOBase):
+    """Read-only, seekable view of a remote file, reading each range with a request. The
+    tail of the file is read with the first request, so listing the members of a zip
+    archive (with zipfile) needs a single request - or two for large central directories.
+    """
+
+    def __init__(self, client: httpx.Client, url: str, size: int):
+        self.client = client
+        self.url = url
+        self.size = size
+        self._position = 0
+        self._tail_start = max(size - _TAIL_SIZE, 0)
+        self._tail = _get_range(client, url, self._tail_start, size) if size else b""
 
+    def readable(self) -> bool:
+        return True
 
-def _fetch_from_zenodo(
-    base_url: str, image_name: str, zip_file: Optional[str] = None
-) -> Path:
-    """Fetch interfile file from zenodo (if not already cached), and return the file path where
-    data is downloaded"""
+    def seekable(self) -> bool:
+        return True
 
-    ZENODO = _set_up_zenodo_doi(base_url)
+    def tell(self) -> int:
+        return self._position
 
-    if zip_file:
-        unpack = pooch.Unzip(members=[zip_file])
-        ZENODO.fetch(f"{zip_file}.zip", processor=unpack)
-        image_path = ZENODO.path / f"{zip_file}.zip.unzip" / zip_file / image_name
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(offset, 0)
+        return self._position
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        start = self._position
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        if end <= start:
+            return b""
+        if start >= self._tail_start:
+            data = self._tail[start - self._tail_start : end - self._tail_start]
+        else:
+            data = _get_range(self.client, self.url, start, end)
+        self._position = end
+        return data
+
+
+def read_zip_members(
+    client: httpx.Client, entry: RegistryEntry
+) -> dict[str, ZipMember]:
+    """The files in a remote zip archive, keyed by name - from its central directory,
+    which is read with range requests rather than downloading the archive."""
+
+    with zipfile.ZipFile(_RemoteFile(client, entry.url, entry.size)) as archive:
+        return {
+            info.filename: ZipMember(
+                name=info.filename,
+                header_offset=info.header_offset,
+                compress_size=info.compress_size,
+                file_size=info.file_size,
+                compress_type=info.compress_type,
+                crc=info.CRC,
+            )
+            for info in archive.infolist()
+            if not info.is_dir()
+        }
+
+
+def _part_path(output_path: Path) -> Path:
+    return output_path.with_name(f"{output_path.name}.part")
+
+
+def extract_zip_member(
+    client: httpx.Client, url: str, member: ZipMember, output_path: Path
+) -> None:
+    """Extract a member of a remote zip archive to output_path, streaming (and
+    decompressing) just its data with a range request. Raises zipfile.BadZipFile if the
+    CRC of the extracted data doesn't match the archive's."""
+
+    if member.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif member.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(
+            f"Can't extract {member.name} - unsupported compression type "
+            f"{member.compress_type}"
+        )
+
+    # the data starts after the member's local file header, whose length depends on the
+    # lengths of the name and extra field (which may differ from the central directory)
+    header = _get_range(
+        client,
+        url,
+        member.header_offset,
+        member.header_offset + _LOCAL_FILE_HEADER_SIZE,
+    )
+    if header[:4] != _LOCAL_FILE_HEADER:
+        raise zipfile.BadZipFile(f"Bad local file header of {member.name}")
+    name_length, extra_length = struct.unpack("<2H", header[26:30])
+    start = member.header_offset + _LOCAL_FILE_HEADER_SIZE + name_length + extra_length
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = _part_path(output_path)
+    crc = 0
+    n_bytes = 0
+    with open(part_path, "wb") as file:
+        if member.compress_size > 0:
+            with client.stream(
+                "GET",
+                url,
+                headers={"Range": f"bytes={start}-{start + member.compress_size - 1}"},
+            ) as response:
+                _check_range_response(response)
+                for chunk in response.iter_bytes(_READ_SIZE):
+                    if member.compress_type == zipfile.ZIP_DEFLATED:
+                        chunk = decompressor.decompress(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    n_bytes += len(chunk)
+                    file.write(chunk)
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+            chunk = decompressor.flush()
+            crc = zlib.crc32(chunk, crc)
+            n_bytes += len(chunk)
+            file.write(chunk)
+
+    if crc != member.crc or n_bytes != member.file_size:
+        part_path.unlink()
+        raise zipfile.BadZipFile(f"Bad CRC-32 of extracted {member.name}")
+    os.replace(part_path, output_path)
+
+
+def _download_part(
+    client: httpx.Client, url: str, part_path: Path, start: int, end: int
+) -> None:
+    with (
+        open(part_path, "r+b") as file,
+        client.stream(
+            "GET", url, headers={"Range": f"bytes={start}-{end - 1}"}
+        ) as response,
+    ):
+        _check_range_response(response)
+        file.seek(start)
+        for chunk in response.iter_bytes(_READ_SIZE):
+            file.write(chunk)
+
+
+def _download_whole(client: httpx.Client, url: str, part_path: Path) -> None:
+    with open(part_path, "wb") as file, client.stream("GET", url) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes(_READ_SIZE):
+            file.write(chunk)
+
+
+def _md5(file_path: Path) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, "rb", buffering=0) as file:
+        while chunk := file.read(_READ_SIZE):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def download_file(
+    client: httpx.Client,
+    entry: RegistryEntry,
+    output_path: Path,
+    part_size: int = DEFAULT_PART_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> None:
+    """Download a file to output_path, in parts of part_size downloaded in parallel with
+    range requests (falling back to a single request if the server doesn't support
+    them). Raises ValueError if the MD5 of the file doesn't match the registry's."""
+
+    if part_size <= 0:
+        raise ValueError(f"part_size must be positive, got {part_size}")
+
+    logger.info(f"Downloading {entry.name} ({entry.size / 1e6:.1f} MB)")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = _part_path(output_path)
+    parts = [
+        (start, min(start + part_size, entry.size))
+        for start in range(0, entry.size, part_size)
+    ]
+    if len(parts) > 1:
+        with open(part_path, "wb") as file:
+            file.truncate(entry.size)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for future in [
+                    pool.submit(_download_part, client, entry.url, part_path, *part)
+                    for part in parts
+                ]:
+                    future.result()
+        except _RangesNotSupported:
+            logger.info(
+                f"Range requests not supported - downloading {entry.name} whole"
+            )
+            _download_whole(client, entry.url, part_path)
     else:
-        image_path = Path(ZENODO.fetch(image_name))
+        _download_whole(client, entry.url, part_path)
 
-    return image_path
+    md5 = _md5(part_path)
+    if md5 != entry.md5:
+        part_path.unlink()
+        raise ValueError(
+            f"MD5 of downloaded {entry.name} ({md5}) doesn't match registry ({entry.md5})"
+        )
+    os.replace(part_path, output_path)
 
 
-def get_data() -> Path:
-    """Fetch interfile file with a single dataset, or return cached path if already present."""
+def _member_path(data_dir: Path, name: str) -> Path:
+    path = data_dir / name
+    if not path.resolve().is_relative_to(data_dir.resolve()):
+        raise ValueError(f"Zip member {name} is outside the data directory")
+    return path
 
-    test_data_dir = Path(__file__).parents[3] / "test-data"
-    image_path = test_data_dir / "NEMA_IQ" / "20170809_NEMA_60min_UCL.l.hdr"
 
-    if image_path.exists():
-        return image_path
-    return _fetch_from_zenodo(
-        "doi:10.5281/zenodo.1304454",
-        "20170809_NEMA_60min_UCL.l.hdr",
-        zip_file="NEMA_IQ",
+def _is_extracted(file_path: Path, member: ZipMember) -> bool:
+    """Whether file_path is already an extracted copy of the member"""
+
+    if not file_path.exists() or file_path.stat().st_size != member.file_size:
+        return False
+    crc = 0
+    with open(file_path, "rb", buffering=0) as file:
+        while chunk := file.read(_READ_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc == member.crc
+
+
+def _extract_downloaded_archive(
+    client: httpx.Client,
+    entry: RegistryEntry,
+    member_names: Sequence[str],
+    data_dir: Path,
+    part_size: int,
+    max_workers: int,
+) -> None:
+    """Download a whole archive and extract members from it - for servers without
+    range requests"""
+
+    archive_path = data_dir / entry.name
+    download_file(client, entry, archive_path, part_size, max_workers)
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for name in member_names:
+                archive.extract(name, data_dir)
+    finally:
+        archive_path.unlink()
+
+
+def _fetch_zip_members(
+    client: httpx.Client,
+    cache: DatasetCache,
+    entry: RegistryEntry,
+    member_names: Sequence[str],
+    data_dir: Path,
+    part_size: int,
+    max_workers: int,
+) -> None:
+    members = cache.zip_members(entry.md5)
+    if not members:
+        try:
+            members = read_zip_members(client, entry)
+        except _RangesNotSupported:
+            logger.info(f"Range requests not supported - downloading {entry.name}")
+            _extract_downloaded_archive(
+                client, entry, member_names, data_dir, part_size, max_workers
+            )
+            for name in member_names:
+                cache.record_fetched(data_dir / name)
+            return
+        cache.store_zip_members(entry.md5, members)
+
+    missing = [name for name in member_names if name not in members]
+    if missing:
+        raise FileNotFoundError(f"{entry.name} has no members {missing}")
+
+    to_extract = []
+    for name in member_names:
+        member_path = _member_path(data_dir, name)
+        if _is_extracted(member_path, members[name]):
+            cache.record_fetched(member_path)
+        else:
+            to_extract.append(name)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            name: pool.submit(
+                extract_zip_member,
+                client,
+                entry.url,
+                members[name],
+                data_dir / name,
+            )
+            for name in to_extract
+        }
+        for name, future in futures.items():
+            future.result()
+            cache.record_fetched(data_dir / name)
+            logger.info(f"Extracted {name} from {entry.name}")
+
+
+def fetch_dataset(
+    doi: str,
+    file_name: str,
+    members: Optional[Sequence[str]] = None,
+    data_dir: Path = TEST_DATA_DIR,
+    zenodo_url: str = ZENODO_URL,
+    part_size: int = DEFAULT_PART_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> list[Path]:
+    """Fetch a file of a Zenodo record (by DOI) to data_dir, unless it was already
+    fetched, and return its path. Large files are downloaded in parts, in parallel.
+
+    If members are given, file_name is a zip archive and only those members are fetched,
+    each extracted to data_dir/<member name> - streamed (in parallel) from the archive
+    on the server with range requests, so the rest of the archive isn't downloaded. Their
+    paths are returned, in the same order.
+
+    The registry of the record, the central directory of the archive and the files
+    fetched are cached in data_dir (see DatasetCache), so fetching files that are already
+    present makes no requests. Files present but not in the cache are checked against the
+    registry (MD5, or CRC-32 for members) rather than downloaded again.
+    """
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    if members is None:
+        paths = [data_dir / file_name]
+    else:
+        paths = [_member_path(data_dir, name) for name in members]
+
+    with DatasetCache(data_dir / CACHE_NAME) as cache:
+        if all(cache.is_fetched(path) for path in paths):
+            return paths
+
+        with httpx.Client(
+            follow_redirects=True,
+            timeout=httpx.Timeout(60.0),
+            transport=httpx.HTTPTransport(retries=5),
+        ) as client:
+            registry = cache.registry(doi)
+            if file_name not in registry:
+                registry = fetch_registry(client, doi, zenodo_url)
+                cache.store_registry(doi, registry)
+            if file_name not in registry:
+                raise FileNotFoundError(f"{doi} has no file {file_name}")
+            entry = registry[file_name]
+
+            if members is not None:
+                _fetch_zip_members(
+                    client, cache, entry, members, data_dir, part_size, max_workers
+                )
+            else:
+                if not (paths[0].exists() and _md5(paths[0]) == entry.md5):
+                    download_file(client, entry, paths[0], part_size, max_workers)
+                cache.record_fetched(paths[0])
+
+    return paths
+
+
+def get_data() -> Path:
+    """Fetch the interfile listmode acquisition (header and data) of the NEMA image quality
+    phantom from Zenodo, unless already fetched, and return the path of the header."""
+
+    header_name = "NEMA_IQ/20170809_NEMA_60min_UCL.l.hdr"
+    header_path, _ = fetch_dataset(
+        NEMA_IQ_DOI,
+        "NEMA_IQ.zip",
+        members=[header_name, listmode_data_path(Path(header_name)).as_posix()],
     )
+    return header_path
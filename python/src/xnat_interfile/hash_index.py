@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from xnat_interfile.upload import DEFAULT_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def file_md5(file_path: Path, chunk_size: int = DEFAULT_CHUNK_SIZE) -> str:
+    """MD5 of a file (the digest XNAT stores for resource files), read in chunks."""
+
+    md5 = hashlib.md5()
+    with open(file_path, "rb", buffering=0) as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+@dataclass
+class ArchivedFile:
+    """A file recorded as archived in XNAT - the scan and file it was archived as, and
+    the MD5 of the file as stored on the server (which differs from the local file's if
+    it was uploaded compressed)."""
+
+    scan_uri: str
+    file_uri: str
+    md5: str
+
+
+class HashIndex:
+    """Persistent (SQLite) index of the MD5 checksums of local files, and of the files
+    already archived in XNAT, used to skip uploading files that are already archived.
+
+    Local checksums are keyed by path, size and modification time, so they are only
+    re-computed if the file changes. Archived files are keyed by checksum and size, so a
+    re-export of the same acquisition under a new name is still recognised. The index
+    can't see changes on the server, so callers should check an archived file is still
+    there (see populate_datatype_fields.find_archived_scan), and forget_archived it if
+    not.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(index_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS local_files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS archived_files ("
+                "md5 TEXT NOT NULL, size INTEGER NOT NULL, scan_uri TEXT NOT NULL, "
+                "file_uri TEXT NOT NULL, remote_md5 TEXT, PRIMARY KEY (md5, size))"
+            )
+            columns = [
+                row[1]
+                for row in self._connection.execute("PRAGMA table_info(archived_files)")
+            ]
+            if "remote_md5" not in columns:
+                # index written before server checksums were recorded
+                self._connection.execute(
+                    "ALTER TABLE archived_files ADD COLUMN remote_md5 TEXT"
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def cached_md5(self, file_path: Path) -> Optional[str]:
+        """MD5 of the file if it was recorded, and the file hasn't changed since."""
+
+        stat = file_path.stat()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT md5 FROM local_files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (str(file_path.resolve()), stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def record_md5(self, file_path: Path, md5: str) -> None:
+        stat = file_path.stat()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO local_files VALUES (?, ?, ?, ?)",
+                (str(file_path.resolve()), stat.st_size, stat.st_mtime_ns, md5),
+            )
+
+    def record_archived(
+        self,
+        file_path: Path,
+        md5: str,
+        scan_uri: str,
+        file_uri: str,
+        remote_md5: Optional[str] = None,
+    ) -> None:
+        """Record that the file with this checksum was archived in the given scan, as
+        file_uri. remote_md5 is the checksum of the file stored on the server, if it
+        differs from md5 (e.g. it was compressed)."""
+
+        self.record_md5(file_path, md5)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO archived_files VALUES (?, ?, ?, ?, ?)",
+                (md5, file_path.stat().st_size, scan_uri, file_uri, remote_md5),
+            )
+
+    def forget_archived(self, file_uri: str) -> None:
+        """Remove the record of files archived as file_uri, e.g. as the scan was deleted
+        from the server."""
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM archived_files WHERE file_uri = ?", (file_uri,)
+            )
+
+    def _n_archived_with_size(self, size: int) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM archived_files WHERE size = ?", (size,)
+            ).fetchone()
+        return count
+
+    def archived_scan_uri(self, file_path: Path) -> Optional[str]:
+        """Uri of the scan the file was already archived in, or None if it wasn't."""
+
+        archived = self.archived_file(file_path)
+        return None if archived is None else archived.scan_uri
+
+    def archived_file(self, file_path: Path) -> Optional[ArchivedFile]:
+        """Where the file was already archived, or None if it wasn't.
+
+        The file is only read (to compute its checksum) if its checksum isn't already in
+        the index, and a file of exactly the same size was archived - otherwise it can't
+        be a duplicate, and its checksum is computed while it is uploaded instead.
+        """
+        size = file_path.stat().st_size
+        md5 = self.cached_md5(file_path)
+        if md5 is None:
+            if self._n_archived_with_size(size) == 0:
+                return None
+            md5 = file_md5(file_path)
+            self.record_md5(file_path, md5)
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT scan_uri, file_uri, remote_md5 FROM archived_files "
+                "WHERE md5 = ? AND size = ?",
+                (md5, size),
+            ).fetchone()
+        if row is None:
+            return None
+        scan_uri, file_uri, remote_md5 = row
+        return ArchivedFile(scan_uri, file_uri, remote_md5 or md5)
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+
+from xnat_interfile.interfile_2_xnat import (
+    CONVERTER_VERSION,
+    read_interfile_header_2_xnat,
+)
+from xnat_interfile.interfile_header import interfile_data_path
+
+if TYPE_CHECKING:
+    from xnat_interfile.listmode_stats import FrameSchedule
+
+logger = logging.getLogger(__name__)
+
+# Default maximum number of headers kept in the cache - the least recently used are evicted
+# beyond this
+DEFAULT_MAX_ENTRIES = 100_000
+
+
+def _file_identity(file_path: Path) -> tuple[int, int]:
+    stat = file_path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+class HeaderCache:
+    """Persistent (SQLite) cache of interfile headers converted to XNAT data type fields (see
+    read_interfile_header_2_xnat), so re-runs and verification don't re-parse them.
+
+    Entries are keyed by the path, size and modification time of the header - and of the
+    data file if event (or data) statistics are included. If check_hash is True, the MD5 of the
+    header is checked too, to catch changes that keep the same size and modification
+    time. At most max_entries are kept, evicting the least recently used. The whole cache
+    is cleared when CONVERTER_VERSION changes, as the stored fields may then be out of date.
+    """
+
+    def __init__(
+        self,
+        cache_path: Path,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        check_hash: bool = False,
+    ):
+        if max_entries <= 0:
+            raise ValueError(f"max_entries must be positive, got {max_entries}")
+
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.check_hash = check_hash
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                "path TEXT NOT NULL, backend TEXT NOT NULL, event_stats INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, md5 TEXT, "
+                "data_size INTEGER, data_mtime_ns INTEGER, xnat_hdr TEXT NOT NULL, "
+                "last_used REAL NOT NULL, PRIMARY KEY (path, backend, event_stats))"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS headers_last_used ON headers (last_used)"
+            )
+            row = self._connection.execute(
+                "SELECT value FROM metadata WHERE key = 'converter_version'"
+            ).fetchone()
+            if row is None or row[0] != CONVERTER_VERSION:
+                if row is not None:
+                    logger.info(
+                        f"Converter version changed from {row[0]} to "
+                        f"{CONVERTER_VERSION} - clearing header cache"
+                    )
+                self._connection.execute("DELETE FROM headers")
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO metadata VALUES ('converter_version', ?)",
+                    (CONVERTER_VERSION,),
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM headers"
+            ).fetchone()
+        return count
+
+    def _identity(
+        self, header_path: Path, event_stats: bool
+    ) -> tuple[int, int, Optional[str], Optional[int], Optional[int]]:
+        """(size, mtime_ns, md5, data size, data mtime_ns) identifying the files a cached
+        entry was converted from"""
+
+        size, mtime_ns = _file_identity(header_path)
+        md5 = None
+        if self.check_hash:
+            md5 = hashlib.md5(header_path.read_bytes()).hexdigest()
+
+        data_size, data_mtime_ns = None, None
+        if event_stats:
+            data_size, data_mtime_ns = _file_identity(interfile_data_path(header_path))
+        return size, mtime_ns, md5, data_size, data_mtime_ns
+
+    def get(
+        self, header_path: Path, backend: str = "native", event_stats: bool = False
+    ) -> Optional[dict[str, Any]]:
+        """Cached XNAT fields of the header, or None if they aren't cached, or the files
+        changed (or were removed) since they were cached."""
+
+        key = (str(header_path.resolve()), backend, int(event_stats))
+        try:
+            identity = self._identity(header_path, event_stats)
+        except FileNotFoundError:
+            return None
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT size, mtime_ns, md5, data_size, data_mtime_ns, xnat_hdr "
+                "FROM headers WHERE path = ? AND backend = ? AND event_stats = ?",
+                key,
+            ).fetchone()
+            if row is None or tuple(row[:5]) != identity:
+                return None
+
+            self._connection.execute(
+                "UPDATE headers SET last_used = ? "
+                "WHERE path = ? AND backend = ? AND event_stats = ?",
+                (time.time(), *key),
+            )
+        return json.loads(row[5])
+
+    def put(
+        self,
+        header_path: Path,
+        xnat_hdr: dict[str, Any],
+        backend: str = "native",
+        event_stats: bool = False,
+    ) -> None:
+        """Cache the XNAT fields of the header, evicting the least recently used entries
+        if the cache is full."""
+
+        identity = self._identity(header_path, event_stats)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(header_path.resolve()),
+                    backend,
+                    int(event_stats),
+                    *identity,
+                    json.dumps(xnat_hdr),
+                    time.time(),
+                ),
+            )
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM headers"
+            ).fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM headers WHERE rowid IN ("
+                    "SELECT rowid FROM headers ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+
+def cached_read_listmode_header_2_xnat(
+    interfile_listmode_file_path: Path,
+    backend: str = "native",
+    event_stats: bool = False,
+    header_cache: Optional[HeaderCache] = None,
+    frame_schedule: Optional["FrameSchedule"] = None,
+) -> dict[str, Any]:
+    """read_interfile_header_2_xnat (of a listmode, projection data or image header),
+    returning the result from header_cache if it is cached there (and caching it if not).
+    Headers read with a frame_schedule (rather than the header's own time frames) aren't
+    cached."""
+
+    if frame_schedule is not None:
+        header_cache = None
+    if header_cache is not None:
+        xnat_hdr = header_cache.get(interfile_listmode_file_path, backend, event_stats)
+        if xnat_hdr is not None:
+            logger.debug(f"Using cached header for {interfile_listmode_file_path}")
+            return xnat_hdr
+
+    xnat_hdr = read_interfile_header_2_xnat(
+        interfile_listmode_file_path,
+        backend=backend,
+        event_stats=event_stats,
+        frame_schedule=frame_schedule,
+    )
+    if header_cache is not None:
+        header_cache.put(interfile_listmode_file_path, xnat_hdr, backend, event_stats)
+    return xnat_hdr
@@ -0,0 +1,114 @@
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Status of a stage in the journal. A stage is marked as started before any request is
+# sent, so a stage left 'started' may or may not have reached the server.
+STARTED = "started"
+COMPLETED = "completed"
+
+# Stage recorded once every other stage of an acquisition has completed
+DONE_STAGE = "done"
+
+
+def acquisition_key(
+    project_name: str, subject_name: str, experiment_name: str, scan_name: str
+) -> str:
+    """Key identifying an acquisition in the journal, by where it is stored in XNAT"""
+
+    return f"{project_name}/{subject_name}/{experiment_name}/{scan_name}"
+
+
+class IngestJournal:
+    """Persistent (SQLite) record of the stages of ingest completed for each acquisition,
+    so an interrupted ingest can be re-run, skipping any stages that already completed.
+
+    Safe to share between threads. Each change is committed immediately, so the journal
+    is up to date even if the process is killed.
+    """
+
+    def __init__(self, journal_path: Path):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                "acquisition TEXT NOT NULL, "
+                "stage TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "updated REAL NOT NULL, "
+                "PRIMARY KEY (acquisition, stage))"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _set_status(self, acquisition: str, stage: str, status: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)",
+                (acquisition, stage, status, time.time()),
+            )
+
+    def status(self, acquisition: str, stage: str) -> Optional[str]:
+        """Status of a stage - STARTED, COMPLETED or None if it was never started"""
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status FROM stages WHERE acquisition = ? AND stage = ?",
+                (acquisition, stage),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def begin(self, acquisition: str, stage: str) -> None:
+        self._set_status(acquisition, stage, STARTED)
+
+    def complete(self, acquisition: str, stage: str) -> None:
+        self._set_status(acquisition, stage, COMPLETED)
+
+    def is_done(self, acquisition: str) -> bool:
+        """Whether every stage of the acquisition has completed"""
+
+        return self.status(acquisition, DONE_STAGE) == COMPLETED
+
+    def reset(self, acquisition: str) -> None:
+        """Forget all stages of an acquisition, so it is ingested from scratch"""
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM stages WHERE acquisition = ?", (acquisition,)
+            )
+
+    def for_acquisition(self, acquisition: str) -> "AcquisitionJournal":
+        return AcquisitionJournal(self, acquisition)
+
+
+class AcquisitionJournal:
+    """View of an IngestJournal for the stages of a single acquisition"""
+
+    def __init__(self, journal: IngestJournal, acquisition: str):
+        self.journal = journal
+        self.acquisition = acquisition
+
+    def status(self, stage: str) -> Optional[str]:
+        return self.journal.status(self.acquisition, stage)
+
+    def begin(self, stage: str) -> None:
+        self.journal.begin(self.acquisition, stage)
+
+    def complete(self, stage: str) -> None:
+        self.journal.complete(self.acquisition, stage)
@@ -1,74 +1,583 @@
-from typing import Any
-import stir
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional, TYPE_CHECKING
+
+from xnat_interfile.interfile_header import (
+    get_header_value,
+    get_indexed_values,
+    get_matrix_axes,
+    header_suffix,
+    interfile_data_path,
+    listmode_data_path,
+    matrix_element_count,
+    read_interfile_header,
+)
+
+if TYPE_CHECKING:
+    import stir
+
+    from xnat_interfile.data_stats import DataStats
+    from xnat_interfile.listmode_stats import FrameSchedule, ListmodeStats
+    from xnat_interfile.upload import CompressedUpload
+
+logger = logging.getLogger(__name__)
+
+# Version of the conversion from interfile headers to XNAT fields. Bump this whenever the
+# fields produced change, so cached conversions (see header_cache) are discarded.
+CONVERTER_VERSION = "4"
+
+# Scan types of listmode data, projection data (sinograms) and images
+LISTMODE_SCAN_TYPE = "interfile:petLmScanData"
+PROJECTION_SCAN_TYPE = "interfile:petProjScanData"
+IMAGE_SCAN_TYPE = "interfile:petImageScanData"
+
+# Scan type of each kind of interfile header, keyed by its suffix (see header_suffix)
+SCAN_TYPES = {
+    ".l.hdr": LISTMODE_SCAN_TYPE,
+    ".hs": PROJECTION_SCAN_TYPE,
+    ".hv": IMAGE_SCAN_TYPE,
+}
+
+# Backends available to read interfile listmode headers. "native" parses the header
+# directly in python, "stir" requires stir to be installed (via conda). "server" leaves
+# the header fields to the interfile plugin on XNAT, which fills them from the uploaded
+# header (see request_header_extraction) - only the scan type (and event statistics) are
+# set by the client. Projection data and image headers are always read natively.
+HEADER_BACKENDS = ("native", "stir", "server")
+
+# Scanner names as returned by stir.Scanner.get_name(), keyed by the (lower-case) names
+# and 'originating system' codes stir accepts for them
+SCANNER_NAMES = {
+    "siemens mmr": "Siemens mMR",
+    "mmr": "Siemens mMR",
+    "2008": "Siemens mMR",
+    "siemens mct": "Siemens mCT",
+    "mct": "Siemens mCT",
+    "1104": "Siemens mCT",
+    "siemens vision 600": "Siemens Vision 600",
+    "vision600": "Siemens Vision 600",
+    "1208": "Siemens Vision 600",
+    "ge signa pet/mr": "GE Signa PET/MR",
+    "signa pet/mr": "GE Signa PET/MR",
+    "ge signa": "GE Signa PET/MR",
+}
+
+# Radionuclide name as returned by stir.Radionuclide.get_name(), energy (keV),
+# half life (s) and branching ratio, keyed by the (lower-case) 'isotope name'
+RADIONUCLIDES = {
+    "f-18": ("^18^Fluorine", 511.0, 6586.2, 0.9686),
+    "c-11": ("^11^Carbon", 511.0, 1221.66, 0.9976),
+    "o-15": ("^15^Oxygen", 511.0, 122.24, 0.9989),
+    "n-13": ("^13^Nitrogen", 511.0, 597.9, 0.9982),
+    "ga-68": ("^68^Gallium", 511.0, 4057.74, 0.8894),
+    "rb-82": ("^82^Rubidium", 511.0, 76.38, 0.9545),
+    "zr-89": ("^89^Zirconium", 511.0, 282240.0, 0.2274),
+}
+
+# Patient position abbreviations, keyed by stir's (patient orientation, patient rotation)
+PATIENT_ORIENTATIONS = {"head_in": "HF", "feet_in": "FF"}
+PATIENT_ROTATIONS = {"supine": "S", "prone": "P", "right": "DR", "left": "DL"}
+PATIENT_POSITIONS = {
+    orientation + rotation
+    for orientation in PATIENT_ORIENTATIONS.values()
+    for rotation in PATIENT_ROTATIONS.values()
+}
+
+
+def _listmode_values_2_xnat(
+    scanner_name: str,
+    radionuclide: str,
+    energy: float,
+    half_life: float,
+    branching_ratio: float,
+    low_energy_thres: float,
+    high_energy_thres: float,
+    patient_position: str,
+    frame_start: float,
+    frame_end: float,
+) -> dict[str, Any]:
+    """Build the dictionary of XNAT data type fields from values read from a listmode header
+    by stir - the same fields as the listmode table of FIELD_TABLES sets (checked by
+    tests/test_interfile_header.py).
+
+    The table's readers can't be used here, as they read header keys, while stir returns
+    values it has already interpreted - e.g. the radionuclide's energy and half life from
+    its own database, and the frames as TimeFrameDefinitions."""
+
+    fields = {
+        "scannerInformation/name": scanner_name,
+        "radionuclideInformation/radionuclide": radionuclide,
+        "radionuclideInformation/energy": energy,
+        "radionuclideInformation/halfLife": half_life,
+        "radionuclideInformation/branchingRatio": branching_ratio,
+        "examInformation/lowEnergyThres": low_energy_thres,
+        "examInformation/highEnergyThres": high_energy_thres,
+        "examInformation/patientPosition": patient_position,
+        "frameInformation/frameStart": frame_start,
+        "frameInformation/frameEnd": frame_end,
+        "frameInformation/frameDuration": frame_end - frame_start,
+    }
+    return {
+        "scans": LISTMODE_SCAN_TYPE,
+        **{f"{LISTMODE_SCAN_TYPE}/{path}": value for path, value in fields.items()},
+    }
 
 
 def interfile_listmode_2_xnat(
-    interfile_listmode_header: stir.ListModeData,
+    interfile_listmode_header: "stir.ListModeData",
 ) -> dict[str, Any]:
     """
     This takes the interfile_listmode_header and converts it to a dictionary compatible with XNAT data types.
     """
-    # Create dictionary with parameter names and their values
-    xnat_interfile_dict: dict[str, Any] = {}
-    xnat_interfile_dict["scans"] = "interfile:petLmScanData"
+    exam_info = interfile_listmode_header.get_exam_info()
+    radionuclide = exam_info.get_radionuclide()
+    time_frames = exam_info.get_time_frame_definitions()
 
-    xnat_interfile_dict["interfile:petLmScanData/scannerInformation/name"] = str(
-        interfile_listmode_header.get_scanner().get_name()
-    )
+    pat_pos = str(exam_info.patient_position)
+    pat_pos = pat_pos.replace("<stir::PatientPosition::", "").replace(">", "")
 
-    xnat_interfile_dict[
-        "interfile:petLmScanData/radionuclideInformation/radionuclide"
-    ] = str(interfile_listmode_header.get_exam_info().get_radionuclide().get_name())
-    xnat_interfile_dict["interfile:petLmScanData/radionuclideInformation/energy"] = (
-        float(interfile_listmode_header.get_exam_info().get_radionuclide().get_energy())
-    )
-    xnat_interfile_dict["interfile:petLmScanData/radionuclideInformation/halfLife"] = (
-        float(
-            interfile_listmode_header.get_exam_info()
-            .get_radionuclide()
-            .get_branching_ratio()
-        )
+    return _listmode_values_2_xnat(
+        scanner_name=str(interfile_listmode_header.get_scanner().get_name()),
+        radionuclide=str(radionuclide.get_name()),
+        energy=float(radionuclide.get_energy()),
+        half_life=float(radionuclide.get_half_life()),
+        branching_ratio=float(radionuclide.get_branching_ratio()),
+        low_energy_thres=float(exam_info.get_low_energy_thres()),
+        high_energy_thres=float(exam_info.get_high_energy_thres()),
+        patient_position=pat_pos,
+        frame_start=float(time_frames.get_start_time()),
+        frame_end=float(time_frames.get_end_time()),
     )
-    xnat_interfile_dict[
-        "interfile:petLmScanData/radionuclideInformation/branchingRatio"
-    ] = float(
-        interfile_listmode_header.get_exam_info()
-        .get_radionuclide()
-        .get_branching_ratio()
+
+
+def _patient_position(header: dict[str, str]) -> str:
+    """Patient position abbreviation (e.g. HFS) as stir reports it. Vendor headers give the
+    abbreviation directly, interfile 3.3 headers give separate orientation and rotation."""
+
+    orientation = (get_header_value(header, "patient orientation") or "").lower()
+    rotation = (get_header_value(header, "patient rotation") or "").lower()
+
+    if orientation in PATIENT_ORIENTATIONS and rotation in PATIENT_ROTATIONS:
+        return PATIENT_ORIENTATIONS[orientation] + PATIENT_ROTATIONS[rotation]
+    if orientation.upper() in PATIENT_POSITIONS:
+        return orientation.upper()
+    return "unknown"
+
+
+def _frame_start_end(header: dict[str, str]) -> tuple[float, float]:
+    """Start of the first and end of the last time frame, as
+    stir.TimeFrameDefinitions.get_start_time() / get_end_time()"""
+
+    durations = get_indexed_values(header, "image duration (sec)")
+    starts = get_indexed_values(header, "image relative start time (sec)")
+
+    if not durations:
+        duration = get_header_value(header, "image duration (sec)")
+        if duration is None:
+            return 0.0, 0.0
+        durations = {1: duration}
+        starts = {1: get_header_value(header, "image relative start time (sec)") or "0"}
+
+    frames = sorted(durations)
+    first_start = float(starts.get(frames[0], 0))
+    last_start = float(starts.get(frames[-1], 0))
+    return first_start, last_start + float(durations[frames[-1]])
+
+
+@dataclass(frozen=True)
+class HeaderField:
+    """A data field of a scan type (path relative to the type, e.g. dataFormat/byteOrder)
+    set from the value of the first of keys present in a header, converted with convert -
+    or default if none are (None leaves the field unset)."""
+
+    path: str
+    keys: tuple[str, ...]
+    convert: Callable[[str], Any] = str
+    default: Any = None
+
+    def __call__(self, header: dict[str, str]) -> dict[str, Any]:
+        value = get_header_value(header, *self.keys)
+        return {self.path: self.default if value is None else self.convert(value)}
+
+
+@dataclass(frozen=True)
+class DerivedField:
+    """A data field of a scan type computed from the whole header by read"""
+
+    path: str
+    read: Callable[[dict[str, str]], Any]
+
+    def __call__(self, header: dict[str, str]) -> dict[str, Any]:
+        return {self.path: self.read(header)}
+
+
+# Reads fields of a scan type (keyed by path relative to the type) from a parsed header -
+# a HeaderField, DerivedField, or a function setting several related fields at once
+FieldReader = Callable[[dict[str, str]], dict[str, Any]]
+
+
+def _radionuclide_information(header: dict[str, str]) -> dict[str, Any]:
+    isotope_name = get_header_value(header, "isotope name") or "Unknown"
+    radionuclide, energy, half_life, branching_ratio = RADIONUCLIDES.get(
+        isotope_name.lower(), (isotope_name, -1.0, -1.0, -1.0)
     )
+    return {
+        "radionuclideInformation/radionuclide": radionuclide,
+        "radionuclideInformation/energy": energy,
+        "radionuclideInformation/halfLife": half_life,
+        "radionuclideInformation/branchingRatio": float(
+            get_header_value(header, "isotope branching factor") or branching_ratio
+        ),
+    }
+
+
+def _frame_information(header: dict[str, str]) -> dict[str, Any]:
+    frame_start, frame_end = _frame_start_end(header)
+    return {
+        "frameInformation/frameStart": frame_start,
+        "frameInformation/frameEnd": frame_end,
+        "frameInformation/frameDuration": frame_end - frame_start,
+    }
+
+
+def _projection_information(header: dict[str, str]) -> dict[str, Any]:
+    """Dimensions of projection data, from the labels of its matrix axes (as STIR
+    writes them) - the number of axial positions is summed over segments"""
+
+    axes = dict(get_matrix_axes(header))
+    axial_positions = axes.get("axial coordinate", [])
+    return {
+        "projectionInformation/numberOfSegments": (
+            sum(axes["segment"]) if "segment" in axes else len(axial_positions) or None
+        ),
+        "projectionInformation/numberOfViews": sum(axes.get("view", [])) or None,
+        "projectionInformation/numberOfAxialPositions": sum(axial_positions) or None,
+        "projectionInformation/numberOfTangentialPositions": (
+            sum(axes.get("tangential coordinate", [])) or None
+        ),
+    }
+
+
+# Fields every scan type gets from its header
+COMMON_FIELDS: tuple[FieldReader, ...] = (
+    HeaderField(
+        "scannerInformation/name",
+        ("originating system",),
+        lambda name: SCANNER_NAMES.get(name.lower(), name),
+        "Unknown",
+    ),
+    _radionuclide_information,
+)
+
+# How the values in projection data and image files are stored
+DATA_FORMAT_FIELDS: tuple[FieldReader, ...] = (
+    HeaderField("dataFormat/numberFormat", ("number format",), str.lower),
+    HeaderField("dataFormat/bytesPerPixel", ("number of bytes per pixel",), int),
+    # big endian unless the header says otherwise, as in STIR
+    HeaderField(
+        "dataFormat/byteOrder", ("imagedata byte order",), str.upper, "BIGENDIAN"
+    ),
+    DerivedField("dataFormat/numberOfValues", matrix_element_count),
+)
+
+# The fields of each scan type, in the order they are set - all are read from a header
+# parsed once (see read_interfile_header), so each is a dictionary lookup or two
+FIELD_TABLES: dict[str, tuple[FieldReader, ...]] = {
+    LISTMODE_SCAN_TYPE: (
+        *COMMON_FIELDS,
+        HeaderField(
+            "examInformation/lowEnergyThres",
+            (
+                "energy window lower level[1]",
+                "energy window lower level (kev)[1]",
+                "energy window lower level",
+            ),
+            float,
+            -1.0,
+        ),
+        HeaderField(
+            "examInformation/highEnergyThres",
+            (
+                "energy window upper level[1]",
+                "energy window upper level (kev)[1]",
+                "energy window upper level",
+            ),
+            float,
+            -1.0,
+        ),
+        DerivedField("examInformation/patientPosition", _patient_position),
+        _frame_information,
+    ),
+    PROJECTION_SCAN_TYPE: (
+        *COMMON_FIELDS,
+        DerivedField("examInformation/patientPosition", _patient_position),
+        _frame_information,
+        HeaderField("projectionInformation/dataType", ("pet data type",)),
+        _projection_information,
+        HeaderField(
+            "projectionInformation/binSize", ("effective central bin size (cm)",), float
+        ),
+        *DATA_FORMAT_FIELDS,
+    ),
+    IMAGE_SCAN_TYPE: (
+        *COMMON_FIELDS,
+        DerivedField("examInformation/patientPosition", _patient_position),
+        _frame_information,
+        *(
+            HeaderField(
+                f"imageInformation/matrixSize{axis}", (f"matrix size[{index}]",), int
+            )
+            for index, axis in enumerate("XYZ", start=1)
+        ),
+        *(
+            HeaderField(
+                f"imageInformation/voxelSize{axis}",
+                (f"scaling factor (mm/pixel)[{index}]",),
+                float,
+            )
+            for index, axis in enumerate("XYZ", start=1)
+        ),
+        HeaderField(
+            "imageInformation/numberOfTimeFrames", ("number of time frames",), int
+        ),
+        HeaderField("imageInformation/quantificationUnits", ("quantification units",)),
+        *DATA_FORMAT_FIELDS,
+    ),
+}
+
+
+def interfile_scan_type(interfile_header_path: Path) -> str:
+    """Scan type of an interfile header, from its suffix (see SCAN_TYPES)"""
+
+    return SCAN_TYPES[header_suffix(interfile_header_path)]
+
+
+def extract_interfile_fields(header: dict[str, str], xsi_type: str) -> dict[str, Any]:
+    """
+    Convert a parsed interfile header (see read_interfile_header) to a dictionary of the
+    fields of the scan type xsi_type (one of SCAN_TYPES), by applying the type's table of
+    FIELD_TABLES. Fields the header has no value for (and no default) are left out.
+    """
+    xnat_interfile_dict: dict[str, Any] = {"scans": xsi_type}
+    for read_fields in FIELD_TABLES[xsi_type]:
+        for path, value in read_fields(header).items():
+            if value is not None:
+                xnat_interfile_dict[f"{xsi_type}/{path}"] = value
+    return xnat_interfile_dict
+
+
+def interfile_header_2_xnat(header: dict[str, str]) -> dict[str, Any]:
+    """
+    Convert a parsed interfile listmode header (see read_interfile_header) to a dictionary
+    compatible with XNAT data types, matching the output of interfile_listmode_2_xnat
+    without needing stir.
+    """
+    return extract_interfile_fields(header, LISTMODE_SCAN_TYPE)
+
 
-    xnat_interfile_dict["interfile:petLmScanData/examInformation/lowEnergyThres"] = (
-        float(interfile_listmode_header.get_exam_info().get_low_energy_thres())
+def listmode_stats_2_xnat(stats: "ListmodeStats") -> dict[str, Any]:
+    """Convert listmode event statistics (see listmode_event_stats) to a dictionary of
+    XNAT data type fields, to merge with the header fields."""
+
+    xnat_interfile_dict: dict[str, Any] = {}
+
+    xnat_interfile_dict["interfile:petLmScanData/eventStatistics/totalPrompts"] = (
+        stats.total_prompts
     )
-    xnat_interfile_dict["interfile:petLmScanData/examInformation/highEnergyThres"] = (
-        float(interfile_listmode_header.get_exam_info().get_high_energy_thres())
+    xnat_interfile_dict["interfile:petLmScanData/eventStatistics/totalDelayeds"] = (
+        stats.total_delayeds
     )
-    pat_pos = str(interfile_listmode_header.get_exam_info().patient_position)
-    pat_pos = pat_pos.replace("<stir::PatientPosition::", "").replace(">", "")
-    xnat_interfile_dict["interfile:petLmScanData/examInformation/patientPosition"] = (
-        pat_pos
+    xnat_interfile_dict["interfile:petLmScanData/eventStatistics/totalEvents"] = (
+        stats.total_events
     )
-
-    xnat_interfile_dict["interfile:petLmScanData/frameInformation/frameStart"] = float(
-        interfile_listmode_header.get_exam_info()
-        .get_time_frame_definitions()
-        .get_start_time()
+    xnat_interfile_dict[
+        "interfile:petLmScanData/eventStatistics/acquisitionDuration"
+    ] = stats.acquisition_duration
+    xnat_interfile_dict[
+        "interfile:petLmScanData/eventStatistics/countRateBinDuration"
+    ] = stats.count_rate_bin_duration
+    xnat_interfile_dict["interfile:petLmScanData/eventStatistics/countRateCurve"] = (
+        " ".join(f"{rate:g}" for rate in stats.count_rate_curve)
     )
-    xnat_interfile_dict["interfile:petLmScanData/frameInformation/frameEnd"] = float(
-        interfile_listmode_header.get_exam_info()
-        .get_time_frame_definitions()
-        .get_end_time()
+
+    # one (repeating) frames/frame element per frame, indexed from 0 in the xpath
+    for index, frame in enumerate(stats.frames):
+        frame_xpath = f"interfile:petLmScanData/frames/frame[{index}]"
+        xnat_interfile_dict[f"{frame_xpath}/number"] = index + 1
+        xnat_interfile_dict[f"{frame_xpath}/start"] = frame.start
+        xnat_interfile_dict[f"{frame_xpath}/duration"] = frame.duration
+        xnat_interfile_dict[f"{frame_xpath}/prompts"] = frame.prompts
+        xnat_interfile_dict[f"{frame_xpath}/delayeds"] = frame.delayeds
+
+    return xnat_interfile_dict
+
+
+def compressed_upload_2_xnat(
+    upload: "CompressedUpload", xsi_type: str = LISTMODE_SCAN_TYPE
+) -> dict[str, Any]:
+    """Convert how the data file was compressed on upload (see
+    upload_compressed_resource_file) to a dictionary of the fields of scan type
+    xsi_type."""
+
+    return {
+        "scans": xsi_type,
+        f"{xsi_type}/dataFile/name": upload.remote_path,
+        f"{xsi_type}/dataFile/compression": upload.compression,
+        f"{xsi_type}/dataFile/originalSize": upload.original_size,
+        f"{xsi_type}/dataFile/originalMd5": upload.original_md5,
+        f"{xsi_type}/dataFile/storedSize": upload.size,
+    }
+
+
+def data_stats_2_xnat(stats: "DataStats", xsi_type: str) -> dict[str, Any]:
+    """Convert summary statistics of projection data or an image (see data_stats) to a
+    dictionary of the fields of scan type xsi_type, to merge with the header fields."""
+
+    return {
+        f"{xsi_type}/dataStatistics/minimum": stats.minimum,
+        f"{xsi_type}/dataStatistics/maximum": stats.maximum,
+        f"{xsi_type}/dataStatistics/sum": stats.sum,
+    }
+
+
+def read_data_stats_2_xnat(
+    interfile_header_path: Path, header: dict[str, str], xsi_type: str
+) -> dict[str, Any]:
+    """Compute summary statistics of the projection data (.s) or image (.v) next to the
+    header, and convert them to the fields of scan type xsi_type. Returns no fields
+    (with a warning) if the data is in a format that isn't supported, or has fewer values
+    than the header describes."""
+
+    # numpy is only needed to reduce the data - imported here so reading headers alone
+    # stays fast
+    from xnat_interfile.data_stats import (
+        data_stats,
+        header_data_dtype,
+        header_data_offset,
+        header_scaling_factor,
     )
-    frame_dur = float(
-        interfile_listmode_header.get_exam_info()
-        .get_time_frame_definitions()
-        .get_end_time()
-        - interfile_listmode_header.get_exam_info()
-        .get_time_frame_definitions()
-        .get_start_time()
+
+    data_path = interfile_data_path(interfile_header_path)
+    try:
+        stats = data_stats(
+            data_path,
+            header_data_dtype(header),
+            offset=header_data_offset(header),
+            n_values=matrix_element_count(header),
+            scaling_factor=header_scaling_factor(header),
+        )
+    except ValueError as error:
+        logger.warning(f"Skipping data statistics of {data_path} - {error}")
+        return {}
+    return data_stats_2_xnat(stats, xsi_type)
+
+
+def read_listmode_event_stats_2_xnat(
+    interfile_listmode_file_path: Path,
+    header: dict[str, str],
+    frame_schedule: Optional["FrameSchedule"] = None,
+) -> dict[str, Any]:
+    """Decode the listmode data (.l) next to the header and convert its event statistics
+    to XNAT data type fields. Returns no fields (with a warning) if the data isn't in a
+    format that can be decoded (32-bit PETLINK).
+
+    Events are also counted in each frame of frame_schedule - by default, the time
+    frames defined in the header."""
+
+    # numpy is only needed to decode the data - imported here so reading headers alone
+    # stays fast
+    from xnat_interfile.listmode_stats import (
+        header_byte_order,
+        header_frame_schedule,
+        is_petlink_32bit,
+        listmode_event_stats,
     )
-    xnat_interfile_dict["interfile:petLmScanData/frameInformation/frameDuration"] = (
-        frame_dur
+
+    if not is_petlink_32bit(header):
+        logger.warning(
+            f"Listmode data of {interfile_listmode_file_path} isn't 32-bit PETLINK - "
+            f"skipping event statistics"
+        )
+        return {}
+
+    if frame_schedule is None:
+        frame_schedule = header_frame_schedule(header)
+    stats = listmode_event_stats(
+        listmode_data_path(interfile_listmode_file_path),
+        byte_order=header_byte_order(header),
+        frame_schedule=frame_schedule,
     )
+    return listmode_stats_2_xnat(stats)
+
+
+def read_listmode_header_2_xnat(
+    interfile_listmode_file_path: Path,
+    backend: str = "native",
+    event_stats: bool = False,
+    frame_schedule: Optional["FrameSchedule"] = None,
+) -> dict[str, Any]:
+    """Read an interfile listmode header (.l.hdr) and convert it to a dictionary compatible with
+    XNAT data types, using the given backend - 'native' (default), 'stir' or 'server' (no
+    header fields, as the server extracts them once it is uploaded). If event_stats
+    is True, event statistics decoded from the listmode data (.l) are included too, with
+    the counts in each frame of frame_schedule (by default, the header's time frames)."""
+
+    if backend not in HEADER_BACKENDS:
+        raise ValueError(
+            f"Unknown header backend {backend} - must be one of {HEADER_BACKENDS}"
+        )
 
+    # parsing the header text is cheap, and needed to decode the data for event_stats
+    header = read_interfile_header(interfile_listmode_file_path)
+
+    if backend == "server":
+        xnat_interfile_dict: dict[str, Any] = {"scans": "interfile:petLmScanData"}
+    elif backend == "stir":
+        import stir
+
+        stir_header = stir.ListModeData.read_from_file(
+            str(interfile_listmode_file_path)
+        )
+        xnat_interfile_dict = interfile_listmode_2_xnat(stir_header)
+    else:
+        xnat_interfile_dict = interfile_header_2_xnat(header)
+
+    if event_stats:
+        xnat_interfile_dict.update(
+            read_listmode_event_stats_2_xnat(
+                interfile_listmode_file_path, header, frame_schedule
+            )
+        )
+    return xnat_interfile_dict
+
+
+def read_interfile_header_2_xnat(
+    interfile_header_path: Path,
+    backend: str = "native",
+    event_stats: bool = False,
+    frame_schedule: Optional["FrameSchedule"] = None,
+) -> dict[str, Any]:
+    """Read an interfile header of any supported kind - listmode (.l.hdr), projection
+    data (.hs) or image (.hv) - and convert it to the fields of its scan type (see
+    SCAN_TYPES). Listmode headers are read with read_listmode_header_2_xnat. Projection
+    data and image headers are always read natively, whatever the backend, and if
+    event_stats is True, the minimum, maximum and sum of their data are included."""
+
+    xsi_type = interfile_scan_type(interfile_header_path)
+    if xsi_type == LISTMODE_SCAN_TYPE:
+        return read_listmode_header_2_xnat(
+            interfile_header_path, backend, event_stats, frame_schedule
+        )
+    if backend not in HEADER_BACKENDS:
+        raise ValueError(
+            f"Unknown header backend {backend} - must be one of {HEADER_BACKENDS}"
+        )
+
+    header = read_interfile_header(interfile_header_path)
+    xnat_interfile_dict = extract_interfile_fields(header, xsi_type)
+    if event_stats:
+        xnat_interfile_dict.update(
+            read_data_stats_2_xnat(interfile_header_path, header, xsi_type)
+        )
     return xnat_interfile_dict
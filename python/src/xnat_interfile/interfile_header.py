@@ -0,0 +1,168 @@
+import re
+from pathlib import Path
+from typing import Iterable, Optional
+
+# Interfile keys that mark the end of the header - nothing after these is parsed
+END_OF_HEADER_KEYS = ("end of interfile",)
+
+# Suffixes of the interfile headers handled, and of the data file next to each - listmode
+# data (.l.hdr / .l), projection data i.e. sinograms (.hs / .s) and images (.hv / .v)
+DATA_FILE_SUFFIXES = {".l.hdr": ".l", ".hs": ".s", ".hv": ".v"}
+
+_WHITESPACE = re.compile(r"\s+")
+_INDEX_SPACING = re.compile(r"\s+\[")
+_INDEXED_KEY = re.compile(r"^(?P<name>.*?)\[(?P<index>\d+)\]$")
+
+
+def listmode_data_path(interfile_listmode_header_path: Path) -> Path:
+    """Path of the listmode data file (.l) next to an interfile listmode header (.l.hdr)"""
+
+    return interfile_listmode_header_path.with_name(
+        interfile_listmode_header_path.name.replace(".l.hdr", ".l")
+    )
+
+
+def header_suffix(interfile_header_path: Path) -> str:
+    """Suffix of an interfile header (one of DATA_FILE_SUFFIXES, e.g. '.hs') - raises
+    ValueError for files that aren't headers of a supported kind"""
+
+    for suffix in DATA_FILE_SUFFIXES:
+        if interfile_header_path.name.endswith(suffix):
+            return suffix
+    raise ValueError(
+        f"{interfile_header_path} isn't an interfile header - expected one of "
+        f"{', '.join(DATA_FILE_SUFFIXES)}"
+    )
+
+
+def is_interfile_header(path: Path) -> bool:
+    """Whether path has the suffix of a supported interfile header (see header_suffix)"""
+
+    return path.name.endswith(tuple(DATA_FILE_SUFFIXES))
+
+
+def interfile_data_path(interfile_header_path: Path) -> Path:
+    """Path of the data file next to an interfile header - e.g. scan.l for scan.l.hdr,
+    sino.s for sino.hs or image.v for image.hv"""
+
+    suffix = header_suffix(interfile_header_path)
+    return interfile_header_path.with_name(
+        interfile_header_path.name.removesuffix(suffix) + DATA_FILE_SUFFIXES[suffix]
+    )
+
+
+def standardise_interfile_key(key: str) -> str:
+    """Standardise an interfile key in the same way STIR does - keys are case-insensitive,
+    the '!' (required) and '%' (vendor) prefixes are ignored and runs of whitespace are
+    treated as a single space (or none, before an index such as '[1]')."""
+
+    key = key.strip().lstrip("!%").strip()
+    key = _INDEX_SPACING.sub("[", _WHITESPACE.sub(" ", key))
+    return key.lower()
+
+
+def parse_interfile_header(lines: Iterable[str]) -> dict[str, str]:
+    """Parse the key := value pairs of the lines of an interfile header (see
+    read_interfile_header)."""
+    header: dict[str, str] = {}
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(";"):
+            continue
+
+        key, separator, value = line.partition(":=")
+        if not separator:
+            continue
+
+        key = standardise_interfile_key(key)
+        if key in END_OF_HEADER_KEYS:
+            break
+
+        value = value.strip()
+        if value:
+            header[key] = value
+
+    return header
+
+
+def read_interfile_header(
+    interfile_header_path: Path, encoding: str = "latin-1"
+) -> dict[str, str]:
+    """Read all key := value pairs from an interfile header (.l.hdr, .hs, .hv ...) in a
+    single pass over the file, without loading any of the binary data it refers to.
+
+    Keys are standardised with standardise_interfile_key. Section headings (keys without
+    a value, e.g. '!GENERAL DATA :=') and comment lines (starting with ';') are skipped.
+    If a key appears more than once, the last value wins (as in STIR).
+    """
+
+    with open(interfile_header_path, "r", encoding=encoding, errors="replace") as f:
+        return parse_interfile_header(f)
+
+
+def get_header_value(header: dict[str, str], *keys: str) -> Optional[str]:
+    """Return the value of the first of keys present in the header. Keys are standardised
+    before lookup, so they can be given as they appear in the interfile specification."""
+
+    for key in keys:
+        value = header.get(standardise_interfile_key(key))
+        if value is not None:
+            return value
+    return None
+
+
+def get_indexed_values(header: dict[str, str], key: str) -> dict[int, str]:
+    """Return all values of an indexed key, e.g. 'image duration (sec)[1]',
+    'image duration (sec)[2]' ..., as a dict of {index: value}."""
+
+    key = standardise_interfile_key(key)
+    values = {}
+    for header_key, value in header.items():
+        match = _INDEXED_KEY.match(header_key)
+        if match and match.group("name") == key:
+            values[int(match.group("index"))] = value
+    return values
+
+
+def parse_list_value(value: str) -> list[str]:
+    """The items of an interfile list value, e.g. '{ 127, 125, 125 }' - a value that
+    isn't a list is a single item"""
+
+    return [
+        item.strip() for item in value.strip().strip("{}").split(",") if item.strip()
+    ]
+
+
+def get_matrix_axes(header: dict[str, str]) -> list[tuple[str, list[int]]]:
+    """The (label, sizes) of each axis of the data matrix, in order of 'matrix size [k]'.
+    Sizes are a list, as they vary by segment along the axial axis of projection data
+    (e.g. '!matrix size [2] := { 127, 125, 125 }'). Labels are lower-case, and empty if
+    the header doesn't give them."""
+
+    sizes = get_indexed_values(header, "matrix size")
+    labels = get_indexed_values(header, "matrix axis label")
+    return [
+        (
+            labels.get(axis, "").lower(),
+            [int(size) for size in parse_list_value(sizes[axis])],
+        )
+        for axis in sorted(sizes)
+    ]
+
+
+def matrix_element_count(header: dict[str, str]) -> Optional[int]:
+    """Number of values in the data described by a header - the product of the sizes of
+    the axes of its matrix (see get_matrix_axes), for each time frame. Sizes that vary by
+    segment are summed, and the segment axis skipped, as its size is the number of
+    sizes. None if the header gives no matrix sizes."""
+
+    axes = get_matrix_axes(header)
+    if not axes:
+        return None
+
+    count = int(get_header_value(header, "number of time frames") or 1)
+    for label, sizes in axes:
+        if label != "segment":
+            count *= sum(sizes)
+    return count
@@ -0,0 +1,64 @@
+import logging
+import threading
+
+import xnat
+
+logger = logging.getLogger(__name__)
+
+
+def subjects_uri(project_name: str) -> str:
+    return f"/data/projects/{project_name}/subjects"
+
+
+def experiments_uri(project_name: str, subject_name: str) -> str:
+    return f"{subjects_uri(project_name)}/{subject_name}/experiments"
+
+
+def label_exists(xnat_session: xnat.XNATSession, parent_uri: str, label: str) -> bool:
+    """Check if an object with the given label exists under parent_uri (e.g. a subject in
+    /data/projects/<project>/subjects) with a single HEAD request, rather than listing
+    every child of the parent."""
+
+    response = xnat_session.head(f"{parent_uri}/{label}", accepted_status=[200, 404])
+    return response.status_code == 200
+
+
+class LabelIndex:
+    """Cache of the labels of children (e.g. subjects or experiments) under XNAT parent
+    uris, shared across a batch of uploads.
+
+    The labels under each parent are fetched with one listing request the first time that
+    parent is queried, then updated incrementally as new objects are created (see add),
+    rather than re-listing for every upload. Use refresh if objects may have been created
+    elsewhere.
+    """
+
+    def __init__(self, xnat_session: xnat.XNATSession):
+        self.xnat_session = xnat_session
+        self._labels: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _fetch_labels(self, parent_uri: str) -> set[str]:
+        result = self.xnat_session.get_json(parent_uri, query={"columns": "label"})
+        labels = {row["label"] for row in result["ResultSet"]["Result"]}
+        logger.debug(f"Indexed {len(labels)} labels under {parent_uri}")
+        return labels
+
+    def refresh(self, parent_uri: str) -> None:
+        labels = self._fetch_labels(parent_uri)
+        with self._lock:
+            self._labels[parent_uri] = labels
+
+    def contains(self, parent_uri: str, label: str) -> bool:
+        with self._lock:
+            labels = self._labels.get(parent_uri)
+        if labels is None:
+            self.refresh(parent_uri)
+            with self._lock:
+                labels = self._labels[parent_uri]
+        return label in labels
+
+    def add(self, parent_uri: str, label: str) -> None:
+        with self._lock:
+            if parent_uri in self._labels:
+                self._labels[parent_uri].add(label)
@@ -0,0 +1,294 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+
+from xnat_interfile.interfile_header import get_header_value, get_indexed_values
+
+logger = logging.getLogger(__name__)
+
+# Number of 32-bit words decoded at a time. Only a few arrays of this length are held in
+# memory at once (about 50 MB at the default), whatever the size of the listmode file.
+DEFAULT_CHUNK_WORDS = 4 * 1024 * 1024
+
+# Number of bins of the coarse count rate curve stored in XNAT
+DEFAULT_COUNT_RATE_BINS = 60
+
+# PETLINK 32-bit listmode words (Siemens mMR / mCT / Vision). Bit 31 is clear for events,
+# where bit 30 is set for prompts and clear for delayeds. Tags have bit 31 set - elapsed
+# time tags have the top 3 bits 100, and the elapsed time in ms in the remaining 29 bits.
+_TAG_BIT = np.uint32(0x80000000)
+_PROMPT_BIT = np.uint32(0x40000000)
+_TAG_TYPE_MASK = np.uint32(0xE0000000)
+_TIME_TAG = np.uint32(0x80000000)
+_TIME_MASK = np.uint32(0x1FFFFFFF)
+
+_MS_PER_SECOND = 1000
+
+# Time frames to count events in - (start, duration) in s from the first time tag
+FrameSchedule = Sequence[tuple[float, float]]
+
+# A run of frames of the same duration in a frame schedule specification, e.g. 6x10
+_FRAME_RUN = re.compile(r"^(?:(?P<count>\d+)\s*[x*]\s*)?(?P<duration>[\d.]+)$")
+
+
+@dataclass
+class FrameStats:
+    """Event counts in a time frame of a listmode acquisition - start and duration (s)
+    are from the first time tag"""
+
+    start: float
+    duration: float
+    prompts: int
+    delayeds: int
+
+
+@dataclass
+class ListmodeStats:
+    """Event statistics of a listmode acquisition.
+
+    acquisition_duration is the time (s) spanned by the elapsed time tags, and
+    count_rate_curve the prompt count rate (counts/s) in consecutive bins of
+    count_rate_bin_duration seconds from the first time tag. frames holds the counts in
+    each frame of the schedule they were computed for (if any)."""
+
+    total_prompts: int
+    total_delayeds: int
+    acquisition_duration: float
+    count_rate_bin_duration: float
+    count_rate_curve: list[float]
+    frames: list[FrameStats] = field(default_factory=list)
+
+    @property
+    def total_events(self) -> int:
+        return self.total_prompts + self.total_delayeds
+
+
+def is_petlink_32bit(header: dict[str, str]) -> bool:
+    """Whether the listmode data described by a parsed interfile header (see
+    read_interfile_header) is in the 32-bit PETLINK format decoded here."""
+
+    word_bits = get_header_value(
+        header, "lm event and tag words format (bits)", "lm event and tag words format"
+    )
+    if word_bits is None:
+        return False
+    return word_bits.lower().removesuffix("-bit").strip() == "32"
+
+
+def header_byte_order(header: dict[str, str]) -> str:
+    """numpy byte order ('<' or '>') of the data, from 'imagedata byte order' (PETLINK
+    data is little endian unless the header says otherwise)."""
+
+    byte_order = get_header_value(header, "imagedata byte order") or "littleendian"
+    return ">" if byte_order.lower() == "bigendian" else "<"
+
+
+def parse_frame_schedule(specification: str) -> list[tuple[float, float]]:
+    """Frame schedule from a comma-separated list of frame durations (s), where a run of
+    frames of the same duration can be given as count x duration - e.g. 6x10,4x30,60 is
+    six 10 s frames, then four 30 s frames and a 60 s frame. Frames are consecutive from
+    the first time tag."""
+
+    schedule = []
+    start = 0.0
+    for run in specification.split(","):
+        match = _FRAME_RUN.match(run.strip())
+        if match is None:
+            raise ValueError(
+                f"Invalid frame schedule {specification} - can't parse {run}"
+            )
+        duration = float(match["duration"])
+        for _ in range(int(match["count"] or 1)):
+            schedule.append((start, duration))
+            start += duration
+    _check_frame_schedule(schedule)
+    return schedule
+
+
+def header_frame_schedule(header: dict[str, str]) -> list[tuple[float, float]]:
+    """Frame schedule given by the time frame definitions of a parsed interfile header
+    ('image duration (sec)' and 'image relative start time (sec)' of each frame) - empty
+    if it defines none."""
+
+    durations = get_indexed_values(header, "image duration (sec)")
+    starts = get_indexed_values(header, "image relative start time (sec)")
+    if not durations:
+        duration = get_header_value(header, "image duration (sec)")
+        if duration is None:
+            return []
+        durations = {1: duration}
+        starts = {1: get_header_value(header, "image relative start time (sec)") or "0"}
+
+    schedule = []
+    start = 0.0
+    for frame in sorted(durations):
+        # frames without a start time follow on from the previous frame
+        start = float(starts.get(frame, start))
+        schedule.append((start, float(durations[frame])))
+        start += float(durations[frame])
+    return schedule
+
+
+def time_tags(words: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Positions (indices into words) and elapsed times (ms) of the time tags in an array
+    of 32-bit PETLINK listmode words"""
+
+    positions = np.flatnonzero((words & _TAG_TYPE_MASK) == _TIME_TAG)
+    return positions, (words[positions] & _TIME_MASK).astype(np.int64)
+
+
+def _check_frame_schedule(frame_schedule: FrameSchedule) -> None:
+    previous_end = 0.0
+    for start, duration in frame_schedule:
+        if duration <= 0 or start < previous_end:
+            raise ValueError(
+                f"Frames must have positive durations, in order without overlapping - "
+                f"got {list(frame_schedule)}"
+            )
+        previous_end = start + duration
+
+
+def _rebin(counts_per_second: np.ndarray, n_bins: int) -> tuple[float, list[float]]:
+    """Rebin a curve of counts in 1 s bins to at most n_bins bins, returning the bin
+    duration (s) and the count rate (counts/s) in each bin."""
+
+    if counts_per_second.size == 0:
+        return 0.0, []
+
+    seconds_per_bin = -(-counts_per_second.size // n_bins)
+    n_padded = -(-counts_per_second.size // seconds_per_bin) * seconds_per_bin
+    padded = np.pad(counts_per_second, (0, n_padded - counts_per_second.size))
+    rates = padded.reshape(-1, seconds_per_bin).sum(axis=1) / seconds_per_bin
+    return float(seconds_per_bin), [round(float(rate), 1) for rate in rates]
+
+
+def listmode_event_stats(
+    listmode_data_path: Path,
+    byte_order: str = "<",
+    chunk_words: int = DEFAULT_CHUNK_WORDS,
+    count_rate_bins: int = DEFAULT_COUNT_RATE_BINS,
+    frame_schedule: Optional[FrameSchedule] = None,
+) -> ListmodeStats:
+    """Count the prompts and delayeds in a 32-bit PETLINK listmode file (.l), and compute
+    the acquisition duration and a coarse prompt count rate curve from its time tags. If
+    a frame_schedule is given, the prompts and delayeds in each of its frames are counted
+    too (see ListmodeStats.frames).
+
+    The file is memory-mapped and decoded in vectorised chunks of chunk_words words, one
+    chunk mapped at a time, so memory use is bounded and files of several GB are decoded
+    in seconds - in a single sequential pass, whatever the number of frames."""
+
+    if chunk_words <= 0:
+        raise ValueError(f"chunk_words must be positive, got {chunk_words}")
+    frame_schedule = list(frame_schedule or [])
+    _check_frame_schedule(frame_schedule)
+    frame_starts_ms = np.array(
+        [round(start * _MS_PER_SECOND) for start, _ in frame_schedule], dtype=np.int64
+    )
+    frame_ends_ms = np.array(
+        [
+            round((start + duration) * _MS_PER_SECOND)
+            for start, duration in frame_schedule
+        ],
+        dtype=np.int64,
+    )
+    frame_prompts = np.zeros(len(frame_schedule), dtype=np.int64)
+    frame_delayeds = np.zeros(len(frame_schedule), dtype=np.int64)
+
+    n_words = listmode_data_path.stat().st_size // 4
+    total_prompts = 0
+    total_delayeds = 0
+    first_time_ms = None
+    current_time_ms = 0
+    # prompts in each second since the first time tag (prompts before it count in the
+    # first second)
+    counts_per_second = np.zeros(0, dtype=np.int64)
+
+    for start in range(0, n_words, chunk_words):
+        # map one chunk at a time - pages of a whole-file map stay resident once read
+        chunk = np.array(
+            np.memmap(
+                listmode_data_path,
+                dtype=f"{byte_order}u4",
+                mode="r",
+                offset=start * 4,
+                shape=(min(chunk_words, n_words - start),),
+            )
+        )
+
+        is_prompt = (chunk & (_TAG_BIT | _PROMPT_BIT)) == _PROMPT_BIT
+        is_event = chunk < _TAG_BIT
+        n_prompts = int(np.count_nonzero(is_prompt))
+        total_prompts += n_prompts
+        total_delayeds += int(np.count_nonzero(is_event)) - n_prompts
+
+        tag_positions, tag_times = time_tags(chunk)
+        if first_time_ms is None and tag_times.size:
+            first_time_ms = int(tag_times[0])
+        del chunk
+
+        # prompts between consecutive time tags are at the time of the preceding tag (a
+        # segment is never empty - it starts with its tag, which isn't a prompt)
+        segment_starts = np.concatenate(([0], tag_positions))
+        segment_prompts = np.add.reduceat(is_prompt, segment_starts, dtype=np.int64)
+        segment_events = np.add.reduceat(is_event, segment_starts, dtype=np.int64)
+        del is_prompt, is_event
+        segment_times = np.concatenate(([current_time_ms], tag_times))
+        if tag_times.size:
+            current_time_ms = int(tag_times[-1])
+        segment_times = np.maximum(segment_times - (first_time_ms or 0), 0)
+
+        if frame_schedule:
+            # frame of each segment - the last starting at or before it, if it hasn't
+            # ended (segments in gaps between frames, or after the last, are in none)
+            frames = np.searchsorted(frame_starts_ms, segment_times, side="right") - 1
+            in_frame = (frames >= 0) & (
+                segment_times < frame_ends_ms[np.maximum(frames, 0)]
+            )
+            frames = frames[in_frame]
+            n_frames = len(frame_schedule)
+            frame_prompts += np.bincount(
+                frames, weights=segment_prompts[in_frame], minlength=n_frames
+            ).astype(np.int64)
+            frame_delayeds += np.bincount(
+                frames,
+                weights=(segment_events - segment_prompts)[in_frame],
+                minlength=n_frames,
+            ).astype(np.int64)
+
+        seconds = segment_times // _MS_PER_SECOND
+        chunk_counts = np.bincount(seconds, weights=segment_prompts).astype(np.int64)
+        if chunk_counts.size > counts_per_second.size:
+            counts_per_second = np.pad(
+                counts_per_second, (0, chunk_counts.size - counts_per_second.size)
+            )
+        counts_per_second[: chunk_counts.size] += chunk_counts
+
+    acquisition_duration = 0.0
+    if first_time_ms is not None:
+        # each time tag marks the start of a 1 ms interval
+        acquisition_duration = (current_time_ms - first_time_ms + 1) / _MS_PER_SECOND
+
+    bin_duration, count_rate_curve = _rebin(counts_per_second, count_rate_bins)
+    logger.info(
+        f"Decoded {n_words} listmode words from {listmode_data_path}: {total_prompts} "
+        f"prompts, {total_delayeds} delayeds over {acquisition_duration:.1f}s"
+    )
+
+    return ListmodeStats(
+        total_prompts=total_prompts,
+        total_delayeds=total_delayeds,
+        acquisition_duration=acquisition_duration,
+        count_rate_bin_duration=bin_duration,
+        count_rate_curve=count_rate_curve,
+        frames=[
+            FrameStats(start, duration, int(prompts), int(delayeds))
+            for (start, duration), prompts, delayeds in zip(
+                frame_schedule, frame_prompts, frame_delayeds
+            )
+        ],
+    )
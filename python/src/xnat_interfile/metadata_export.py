@@ -0,0 +1,317 @@
+import csv
+import logging
+import re
+import warnings
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+from xml.sax.saxutils import escape
+
+import numpy as np
+import xmlschema
+import xnat
+from xnat.exceptions import XNATResponseError
+
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy, request_with_retry
+
+logger = logging.getLogger(__name__)
+
+SCAN_XSI_TYPE = "interfile:petLmScanData"
+
+# Number of rows in each batch of columns yielded by iter_scan_metadata
+DEFAULT_BATCH_SIZE = 10000
+
+# Search field ids of the fields XNAT adds to every scan type, and the column each is
+# exported as
+ID_COLUMNS = {
+    "PROJECT": "project",
+    "SUBJECT_ID": "subject_id",
+    "SESSION_LABEL": "experiment_label",
+    "ID": "scan_id",
+}
+
+# XSD primitive types exported as (float) numbers - missing values become NaN
+_NUMERIC_TYPES = {"float", "double", "decimal"}
+
+# Field ids longer than this are truncated by XNAT (see test_interfile_data_fields)
+_MAX_SEARCH_FIELD_LENGTH = 75
+
+
+@dataclass(frozen=True)
+class SchemaField:
+    """A data field of a scan type, from its XSD - path is as in scan.data (e.g.
+    radionuclideInformation/halfLife), xsd_type the XSD primitive type (e.g. float)."""
+
+    path: str
+    xsd_type: str
+
+    @property
+    def numeric(self) -> bool:
+        return self.xsd_type in _NUMERIC_TYPES
+
+    def search_field(self, xsi_type: str = SCAN_XSI_TYPE) -> str:
+        """Id of the field in XNAT searches (e.g. RADIONUCLIDEINFORMATION_HALFLIFE)"""
+
+        element = xsi_type.split(":")[-1]
+        field_id = f"{element}/{self.path.replace('/', '_').upper()}"
+        return field_id[:_MAX_SEARCH_FIELD_LENGTH].removeprefix(f"{element}/")
+
+
+def schema_fields(
+    schema: Union[Path, str], xsi_type: str = SCAN_XSI_TYPE
+) -> list[SchemaField]:
+    """The data fields (leaf elements) of a scan type, from its XSD - given as a path,
+    or the text of the schema."""
+
+    with warnings.catch_warnings():
+        # the xnat base schema isn't needed to list the fields of the extension
+        warnings.simplefilter("ignore", xmlschema.XMLSchemaImportWarning)
+        xml_schema = xmlschema.XMLSchema(schema, validation="skip")
+
+    # only the elements of the scan type itself - repeating elements (e.g. frames/frame)
+    # have types of their own, so their fields aren't included
+    scan_type = xml_schema.types[xsi_type.split(":")[-1]]
+    elements: list[Any] = list(
+        scan_type.iter_components(
+            xsd_classes=(xmlschema.validators.elements.XsdElement,)
+        )
+    )
+    fields = []
+    for component in elements:
+        component_type: Any = component.type
+        if isinstance(component_type, xmlschema.validators.simple_types.XsdSimpleType):
+            xsd_type = getattr(component_type, "primitive_type").local_name
+        elif component_type.name is not None and component_type.name.endswith(
+            "anyType"
+        ):
+            xsd_type = "string"
+        else:
+            continue
+
+        # strip namespaces - {http://ptb.de/interfile}scannerInformation/...
+        path = re.sub(r"\{[^}]*\}", "", component.get_path())
+        fields.append(SchemaField(path, xsd_type))
+
+    return fields
+
+
+def server_schema_fields(
+    xnat_session: xnat.XNATSession,
+    schema_name: str = "interfile/interfile",
+    xsi_type: str = SCAN_XSI_TYPE,
+) -> list[SchemaField]:
+    """schema_fields of an interfile scan type, from the schema installed on the
+    server - so only fields the server knows about are exported."""
+
+    response = xnat_session.get(f"/xapi/schemas/{schema_name}")
+    return schema_fields(response.text, xsi_type)
+
+
+def search_xml(
+    project_name: str,
+    fields: list[SchemaField],
+    xsi_type: str = SCAN_XSI_TYPE,
+) -> str:
+    """XNAT search (xdat:search) for the ID_COLUMNS and fields of all scans of type
+    xsi_type in a project. The header of each column is its name in the export."""
+
+    columns = list(ID_COLUMNS.items()) + [
+        (field.search_field(xsi_type), field.path) for field in fields
+    ]
+    search_fields = "".join(
+        f"<xdat:search_field>"
+        f"<xdat:element_name>{xsi_type}</xdat:element_name>"
+        f"<xdat:field_ID>{escape(field_id)}</xdat:field_ID>"
+        f"<xdat:sequence>{sequence}</xdat:sequence>"
+        f"<xdat:header>{escape(header)}</xdat:header>"
+        f"</xdat:search_field>"
+        for sequence, (field_id, header) in enumerate(columns)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<xdat:search allow-diff-columns="0" secure="false" '
+        'xmlns:xdat="http://nrg.wustl.edu/security" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+        f"<xdat:root_element_name>{xsi_type}</xdat:root_element_name>"
+        f"{search_fields}"
+        '<xdat:search_where method="AND">'
+        '<xdat:criteria override_value_formatting="0">'
+        f"<xdat:schema_field>{xsi_type}/PROJECT</xdat:schema_field>"
+        "<xdat:comparison_type>=</xdat:comparison_type>"
+        f"<xdat:value>{escape(project_name)}</xdat:value>"
+        "</xdat:criteria>"
+        "</xdat:search_where>"
+        "</xdat:search>"
+    )
+
+
+def export_columns(fields: list[SchemaField]) -> list[str]:
+    """Names of the exported columns - the ID_COLUMNS, then the path of each field"""
+
+    return list(ID_COLUMNS.values()) + [field.path for field in fields]
+
+
+def iter_scan_metadata_rows(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    fields: Optional[list[SchemaField]] = None,
+    xsi_type: str = SCAN_XSI_TYPE,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> Iterator[list[str]]:
+    """Rows (lists of strings, in the order of export_columns) of the fields of every scan
+    of type xsi_type in a project, fetched with a single search request. The response
+    is streamed as CSV, so rows are yielded as they arrive rather than after the whole
+    result is read. fields default to all fields in the server's schema."""
+
+    if fields is None:
+        fields = server_schema_fields(xnat_session, xsi_type=xsi_type)
+    columns = export_columns(fields)
+    search_uri = f"{xnat_session.server.rstrip('/')}/data/search"
+    data = search_xml(project_name, fields, xsi_type)
+
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        response = xnat_session.interface.post(
+            search_uri,
+            params={"format": "csv"},
+            data=data,
+            headers={"Content-Type": "text/xml"},
+            stream=True,
+        )
+        if response.status_code not in accepted_status:
+            raise XNATResponseError(
+                f"Search of {xsi_type} in {project_name} failed (status "
+                f"{response.status_code}):\n{response.text}",
+                response=response,
+            )
+        return response
+
+    response = request_with_retry(send, retry, f"Search of {project_name}")
+    with response:
+        response.encoding = response.encoding or "utf-8"
+        lines = response.iter_lines(decode_unicode=True)
+        reader = csv.reader(line for line in lines if line)
+        header = next(reader, None)
+        if header is None:
+            return
+
+        # find columns by their header, or search field id, as XNAT may reorder them
+        indices = {name.lower(): index for index, name in enumerate(header)}
+        field_ids = list(ID_COLUMNS) + [
+            field.search_field(xsi_type) for field in fields
+        ]
+        try:
+            column_indices = [
+                indices[column.lower()]
+                if column.lower() in indices
+                else indices[field_id.lower()]
+                for column, field_id in zip(columns, field_ids)
+            ]
+        except KeyError as error:
+            raise ValueError(f"Search result has no column {error}") from None
+
+        n_rows = 0
+        for row in reader:
+            yield [row[index] for index in column_indices]
+            n_rows += 1
+    logger.info(f"Exported metadata of {n_rows} scans in {project_name}")
+
+
+def _column_arrays(
+    rows: list[list[str]], columns: list[str], numeric: list[bool]
+) -> dict[str, np.ndarray]:
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    arrays = {}
+    for column, column_values, is_numeric in zip(columns, values, numeric):
+        if is_numeric:
+            arrays[column] = np.array(
+                [float(value) if value != "" else np.nan for value in column_values],
+                dtype=np.float64,
+            )
+        else:
+            arrays[column] = np.array(column_values, dtype=object)
+    return arrays
+
+
+def iter_scan_metadata(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    fields: Optional[list[SchemaField]] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    xsi_type: str = SCAN_XSI_TYPE,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> Iterator[dict[str, np.ndarray]]:
+    """Batches of up to batch_size scans' metadata, as columns - {column: array} (see
+    export_columns). Numeric fields are float arrays (NaN where a scan has no value),
+    others are object arrays of strings. Only one batch is held in memory at a time."""
+
+    if batch_size <= 0:
+        raise ValueError(f"batch_size must be positive, got {batch_size}")
+    if fields is None:
+        fields = server_schema_fields(xnat_session, xsi_type=xsi_type)
+    columns = export_columns(fields)
+    numeric = [False] * len(ID_COLUMNS) + [field.numeric for field in fields]
+
+    rows = []
+    for row in iter_scan_metadata_rows(
+        xnat_session, project_name, fields, xsi_type, retry
+    ):
+        rows.append(row)
+        if len(rows) == batch_size:
+            yield _column_arrays(rows, columns, numeric)
+            rows = []
+    if rows:
+        yield _column_arrays(rows, columns, numeric)
+
+
+def export_scan_metadata(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    fields: Optional[list[SchemaField]] = None,
+    xsi_type: str = SCAN_XSI_TYPE,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> dict[str, np.ndarray]:
+    """The metadata of all scans of type xsi_type in a project as a table of columns -
+    {column: array}, see iter_scan_metadata. Use iter_scan_metadata (or
+    export_scan_metadata_csv) for projects too large to hold in memory."""
+
+    if fields is None:
+        fields = server_schema_fields(xnat_session, xsi_type=xsi_type)
+    batches = list(
+        iter_scan_metadata(
+            xnat_session, project_name, fields, xsi_type=xsi_type, retry=retry
+        )
+    )
+    if not batches:
+        numeric = [False] * len(ID_COLUMNS) + [field.numeric for field in fields]
+        return _column_arrays([], export_columns(fields), numeric)
+    return {
+        column: np.concatenate([batch[column] for batch in batches])
+        for column in batches[0]
+    }
+
+
+def export_scan_metadata_csv(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    output_path: Path,
+    fields: Optional[list[SchemaField]] = None,
+    xsi_type: str = SCAN_XSI_TYPE,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> int:
+    """Write the metadata of all scans of type xsi_type in a project to a CSV file, with
+    a header row of export_columns, streaming rows from the search straight to the file.
+    Returns the number of scans written."""
+
+    if fields is None:
+        fields = server_schema_fields(xnat_session, xsi_type=xsi_type)
+
+    n_rows = 0
+    with open(output_path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(export_columns(fields))
+        for row in iter_scan_metadata_rows(
+            xnat_session, project_name, fields, xsi_type, retry
+        ):
+            writer.writerow(row)
+            n_rows += 1
+    return n_rows
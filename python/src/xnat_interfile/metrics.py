@@ -0,0 +1,284 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import IO, Iterator, Optional, Protocol
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Quantiles of the stage durations reported in summaries and the Prometheus text file
+SUMMARY_QUANTILES = (0.5, 0.95)
+
+# Number of most recent durations of each stage the quantiles are computed over, and of
+# most recent timings kept in MetricsRecorder.timings - so a long-running ingest (e.g. a
+# watch folder) uses bounded memory, and summaries take bounded time
+DEFAULT_WINDOW_SIZE = 1000
+DEFAULT_MAX_TIMINGS = 10_000
+
+
+@dataclass
+class StageTiming:
+    """Time taken by one stage of ingest, e.g. 'header', 'subject', 'scan_put' or
+    'upload'. name is the object the stage acted on (subject label, file name ...), and
+    n_bytes the amount of data transferred, if any."""
+
+    stage: str
+    seconds: float
+    start_time: float
+    name: Optional[str] = None
+    n_bytes: Optional[int] = None
+
+    @property
+    def bytes_per_second(self) -> Optional[float]:
+        if self.n_bytes is None or self.seconds <= 0:
+            return None
+        return self.n_bytes / self.seconds
+
+
+@dataclass
+class _StageAggregate:
+    """Running totals of the timings of one stage, and a sliding window of its most
+    recent durations"""
+
+    window_size: int
+    count: int = 0
+    total: float = 0.0
+    n_bytes: int = 0
+    recent_seconds: deque = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.recent_seconds = deque(maxlen=self.window_size)
+
+    def add(self, timing: StageTiming) -> None:
+        self.count += 1
+        self.total += timing.seconds
+        self.n_bytes += timing.n_bytes or 0
+        self.recent_seconds.append(timing.seconds)
+
+
+class MetricsSink(Protocol):
+    """Destination for stage timings, e.g. JsonLinesSink or PrometheusTextSink. Sinks are
+    entered and closed by the with block of the MetricsRecorder they are given to."""
+
+    def __enter__(self) -> "MetricsSink": ...
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None: ...
+
+    def record(self, timing: StageTiming, recorder: "MetricsRecorder") -> None: ...
+
+    def close(self) -> None: ...
+
+
+class JsonLinesSink:
+    """Appends each stage timing to a file as a line of JSON. The file is open from
+    __enter__ to close."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file: Optional[IO[str]] = None
+
+    def __enter__(self) -> "JsonLinesSink":
+        self._file = open(self.path, "a", encoding="utf-8")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def record(self, timing: StageTiming, recorder: "MetricsRecorder") -> None:
+        if self._file is None:
+            raise RuntimeError(
+                f"{self.path} isn't open - record timings in the with block of the "
+                f"MetricsRecorder"
+            )
+        line = asdict(timing)
+        line["bytes_per_second"] = timing.bytes_per_second
+        self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PrometheusTextSink:
+    """Keeps a file in the Prometheus text exposition format up to date with a summary of
+    the stage timings (e.g. for the node exporter's textfile collector). The file is
+    rewritten at most every min_interval seconds, and on close."""
+
+    def __init__(self, path: Path, min_interval: float = 5.0):
+        self.path = path
+        self.min_interval = min_interval
+        self._last_written = 0.0
+        self._recorder: Optional[MetricsRecorder] = None
+
+    def __enter__(self) -> "PrometheusTextSink":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def record(self, timing: StageTiming, recorder: "MetricsRecorder") -> None:
+        self._recorder = recorder
+        if time.monotonic() - self._last_written >= self.min_interval:
+            self.write(recorder)
+
+    def write(self, recorder: "MetricsRecorder") -> None:
+        lines = [
+            "# HELP xnat_interfile_stage_seconds Time taken by each stage of ingest",
+            "# TYPE xnat_interfile_stage_seconds summary",
+        ]
+        bytes_lines = [
+            "# HELP xnat_interfile_stage_bytes_total Bytes transferred by each stage",
+            "# TYPE xnat_interfile_stage_bytes_total counter",
+        ]
+        for stage, summary in recorder.summary().items():
+            for quantile in SUMMARY_QUANTILES:
+                lines.append(
+                    f'xnat_interfile_stage_seconds{{stage="{stage}",'
+                    f'quantile="{quantile}"}} {summary[f"p{round(quantile * 100)}"]}'
+                )
+            lines.append(
+                f'xnat_interfile_stage_seconds_sum{{stage="{stage}"}} '
+                f"{summary['total']}"
+            )
+            lines.append(
+                f'xnat_interfile_stage_seconds_count{{stage="{stage}"}} '
+                f"{summary['count']}"
+            )
+            if summary["n_bytes"]:
+                bytes_lines.append(
+                    f'xnat_interfile_stage_bytes_total{{stage="{stage}"}} '
+                    f"{summary['n_bytes']}"
+                )
+
+        # write then rename, so a scrape never sees a partial file
+        temp_path = self.path.with_name(f".{self.path.name}.tmp")
+        temp_path.write_text("\n".join(lines + bytes_lines) + "\n", encoding="utf-8")
+        os.replace(temp_path, self.path)
+        self._last_written = time.monotonic()
+
+    def close(self) -> None:
+        if self._recorder is not None:
+            self.write(self._recorder)
+
+
+class MetricsRecorder:
+    """Collects the timing of each stage of ingest, passing each to the sinks as it is
+    recorded. Safe to share between threads.
+
+    Counts, totals and bytes of each stage cover every timing recorded, but only the
+    last window_size durations of each stage are kept for quantiles, and only the last
+    max_timings timings in timings.
+
+    Use it as a context manager when it has sinks - they are entered (e.g. JsonLinesSink
+    opens its file) on entry, and closed on exit."""
+
+    def __init__(
+        self,
+        sinks: Optional[list[MetricsSink]] = None,
+        window_size: int = DEFAULT_WINDOW_SIZE,
+        max_timings: int = DEFAULT_MAX_TIMINGS,
+    ):
+        if window_size <= 0:
+            raise ValueError(f"window_size must be positive, got {window_size}")
+        self.sinks = sinks or []
+        self.window_size = window_size
+        self.timings: deque[StageTiming] = deque(maxlen=max_timings)
+        self._stages: dict[str, _StageAggregate] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with ExitStack() as stack:
+            for sink in self.sinks:
+                stack.enter_context(sink)
+            # only closes the sinks entered so far if one fails - close() does after this
+            stack.pop_all()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for sink in self.sinks:
+                sink.close()
+
+    def record(self, timing: StageTiming) -> None:
+        with self._lock:
+            self.timings.append(timing)
+            aggregate = self._stages.get(timing.stage)
+            if aggregate is None:
+                aggregate = self._stages[timing.stage] = _StageAggregate(
+                    self.window_size
+                )
+            aggregate.add(timing)
+            for sink in self.sinks:
+                sink.record(timing, self)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Count, total, p50 and p95 of the durations (s) of each stage, and the total
+        bytes transferred, keyed by stage. Quantiles are of the last window_size
+        durations."""
+
+        summary = {}
+        for stage, aggregate in list(self._stages.items()):
+            quantiles = np.quantile(list(aggregate.recent_seconds), SUMMARY_QUANTILES)
+            summary[stage] = {
+                "count": aggregate.count,
+                "total": aggregate.total,
+                "n_bytes": aggregate.n_bytes,
+                **{
+                    f"p{round(quantile * 100)}": float(value)
+                    for quantile, value in zip(SUMMARY_QUANTILES, quantiles)
+                },
+            }
+        return summary
+
+    def log_summary(self) -> None:
+        for stage, summary in self.summary().items():
+            message = (
+                f"{stage}: {summary['count']} in {summary['total']:.2f}s, "
+                f"p50 {summary['p50']:.3f}s, p95 {summary['p95']:.3f}s"
+            )
+            if summary["n_bytes"] and summary["total"] > 0:
+                message += f", {summary['n_bytes'] / summary['total'] / 1e6:.1f} MB/s"
+            logger.info(message)
+
+
+class _StageRecord:
+    """Details of a timed stage that are only known once it has run"""
+
+    def __init__(self) -> None:
+        self.n_bytes: Optional[int] = None
+
+
+@contextmanager
+def timed_stage(
+    metrics: Optional[MetricsRecorder], stage: str, name: Optional[str] = None
+) -> Iterator[_StageRecord]:
+    """Time the body of the with block as an ingest stage, recording it in metrics (if
+    given). Set n_bytes on the yielded record to report the data transferred. Stages that
+    raise are not recorded."""
+
+    record = _StageRecord()
+    start_time = time.time()
+    start = time.perf_counter()
+    yield record
+    if metrics is not None:
+        metrics.record(
+            StageTiming(
+                stage=stage,
+                seconds=time.perf_counter() - start,
+                start_time=start_time,
+                name=name,
+                n_bytes=record.n_bytes,
+            )
+        )
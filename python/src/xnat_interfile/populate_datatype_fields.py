@@ -1,31 +1,60 @@
 import xnat
 from pathlib import Path
-from xnat_interfile.interfile_2_xnat import interfile_listmode_2_xnat
 import logging
-from typing import Any, Tuple
-import stir
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Optional, Tuple
 from xnat.exceptions import XNATResponseError
-from datetime import datetime
-
-from xnat_interfile.fetch_datasets import get_data
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),  # Console output
-        logging.FileHandler("xnat_interfile_processing.log"),  # File output
-    ],
+
+from xnat_interfile.chunked_upload import upload_resource_file_in_parts
+from xnat_interfile.hash_index import HashIndex
+from xnat_interfile.header_cache import HeaderCache, cached_read_listmode_header_2_xnat
+from xnat_interfile.interfile_2_xnat import (
+    LISTMODE_SCAN_TYPE,
+    compressed_upload_2_xnat,
+    interfile_scan_type,
+)
+from xnat_interfile.ingest_journal import (
+    COMPLETED,
+    DONE_STAGE,
+    STARTED,
+    AcquisitionJournal,
+    IngestJournal,
+    acquisition_key,
+)
+from xnat_interfile.interfile_header import interfile_data_path
+from xnat_interfile.metrics import MetricsRecorder, timed_stage
+from xnat_interfile.label_index import (
+    LabelIndex,
+    experiments_uri,
+    label_exists,
+    subjects_uri,
+)
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy, request_with_retry
+from xnat_interfile.upload import (
+    DEFAULT_CHUNK_SIZE,
+    UploadProgressCallback,
+    log_upload_progress,
+    resource_file_digests,
+    upload_compressed_resource_file,
+    upload_resource_archive,
+    upload_resource_file,
 )
 
+if TYPE_CHECKING:
+    from xnat_interfile.listmode_stats import FrameSchedule
+
 logger = logging.getLogger(__name__)
 
 
-def verify_project_exists(xnat_session: xnat.XNATSession, project_name: str) -> Any:
+def verify_project_exists(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    metrics: Optional[MetricsRecorder] = None,
+) -> Any:
     """Verify project exist on XNAT server - disconnect if project does not exist"""
     try:
-        xnat_project = xnat_session.projects[project_name]
+        with timed_stage(metrics, "project", project_name):
+            xnat_project = xnat_session.projects[project_name]
         logger.info(f"Project {xnat_project} exists")
         return xnat_project
     except KeyError:
@@ -40,41 +69,179 @@ def upload_interfile_data(
     subject_name: str,
     experiment_name: str,
     scan_name: str,
+    header_backend: str = "native",
+    label_index: Optional[LabelIndex] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = log_upload_progress,
+    journal: Optional[IngestJournal] = None,
+    hash_index: Optional[HashIndex] = None,
+    archive: bool = False,
+    event_stats: bool = False,
+    header_cache: Optional[HeaderCache] = None,
+    metrics: Optional[MetricsRecorder] = None,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    frame_schedule: Optional["FrameSchedule"] = None,
+    compression: Optional[str] = None,
+    part_size: Optional[int] = None,
 ) -> Any:
+    """Upload an interfile listmode acquisition to a new subject / experiment / scan in
+    an existing XNAT project. Projection data (.hs / .s) and images (.hv / .v) are
+    uploaded in the same way, to scans of their own types (see SCAN_TYPES).
+    header_backend selects how the listmode header is read - 'native' (default, no
+    stir needed) or 'stir' - or 'server' to only upload the files, and have the
+    interfile plugin fill the header fields (see request_header_extraction).
+    A label_index can be shared between uploads to avoid repeated existence checks on the
+    server. chunk_size and progress control the streaming upload of the files (see
+    add_scan).
+
+    If a journal is given, each stage of the upload is recorded in it. Re-running an
+    upload that was interrupted then skips the stages that completed (including files
+    that were fully uploaded) rather than failing with 'already exists'.
+
+    If a hash_index is given, and it shows the listmode data was already archived (e.g.
+    under another name), and the archived file still has the same checksum on the server
+    (see find_archived_scan), nothing is uploaded and the existing scan is returned.
+    Otherwise checksums are computed as the files are uploaded and verified against the
+    server.
+
+    If archive is True, the header and data are uploaded together in a single request
+    (see add_scan), which needs fewer round trips per acquisition.
+
+    If event_stats is True, event statistics decoded from the listmode data (prompts,
+    delayeds, duration and count rate curve) are stored in the scan fields too,
+    with the prompts and delayeds in each frame of frame_schedule (by default, the time
+    frames defined in the header) - see listmode_event_stats. For projection data and
+    images, the minimum, maximum and sum of the data are stored instead (see data_stats).
+    Either reads all of the data file before the upload starts, so is off by default.
+    If a header_cache is given, the converted header is taken from (or stored in) it.
+
+    If compression is given (e.g. 'zstd'), the listmode data is compressed as it is
+    uploaded, and how is recorded in the scan fields (see add_scan). If part_size is
+    given, the listmode data is uploaded in parts of part_size bytes, in parallel,
+    through the interfile plugin (see add_scan).
+
+    If metrics are given, the time taken by each stage (header extraction, project /
+    subject / experiment lookup, scan creation and each upload) is recorded in them.
+
+    Transient server errors (e.g. 503 or a timeout) when creating the scan and resource,
+    and uploading the files, are retried according to retry (see request_with_retry) -
+    pass None to fail on the first error."""
     logger.info(f"Interfile file path: {interfile_listmode_file_path}")
 
     if not interfile_listmode_file_path.exists():
         raise FileNotFoundError(
             f"Interfile file not found: {interfile_listmode_file_path}"
         )
+    if not interfile_data_path(interfile_listmode_file_path).exists():
+        raise FileNotFoundError(
+            f"Interfile data file not found: "
+            f"{interfile_data_path(interfile_listmode_file_path)}"
+        )
 
-    xnat_project = verify_project_exists(xnat_session, project_name)
-    xnat_subject = create_subject(xnat_session, xnat_project, subject_name)
-    experiment = add_experiment(xnat_subject, experiment_name)
+    if hash_index is not None:
+        archived_scan = find_archived_scan(
+            xnat_session, interfile_listmode_file_path, hash_index
+        )
+        if archived_scan is not None:
+            return archived_scan
+
+    acquisition_journal = None
+    if journal is not None:
+        key = acquisition_key(project_name, subject_name, experiment_name, scan_name)
+        if journal.is_done(key):
+            logger.info(f"Skipping {key} - already ingested according to journal")
+            return xnat_session.create_object(
+                f"{experiments_uri(project_name, subject_name)}/{experiment_name}"
+                f"/scans/{scan_name}"
+            )
+        acquisition_journal = journal.for_acquisition(key)
+
+    xnat_project = verify_project_exists(xnat_session, project_name, metrics)
+    xnat_subject = _resume_or_create(
+        xnat_session,
+        acquisition_journal,
+        "subject",
+        subjects_uri(project_name),
+        subject_name,
+        lambda: create_subject(
+            xnat_session, xnat_project, subject_name, label_index, metrics
+        ),
+    )
+    experiment = _resume_or_create(
+        xnat_session,
+        acquisition_journal,
+        "experiment",
+        experiments_uri(project_name, subject_name),
+        experiment_name,
+        lambda: add_experiment(xnat_subject, experiment_name, label_index, metrics),
+    )
 
     # Load interfile header and convert to XNAT format
-    header = stir.ListModeData.read_from_file(str(interfile_listmode_file_path))
-    xnat_hdr = interfile_listmode_2_xnat(header)
+    with timed_stage(metrics, "header", interfile_listmode_file_path.name):
+        xnat_hdr = cached_read_listmode_header_2_xnat(
+            interfile_listmode_file_path,
+            backend=header_backend,
+            event_stats=event_stats,
+            header_cache=header_cache,
+            frame_schedule=frame_schedule,
+        )
 
-    xnat_scan = add_scan(experiment, xnat_hdr, scan_name, interfile_listmode_file_path)
+    xnat_scan = add_scan(
+        experiment,
+        xnat_hdr,
+        scan_name,
+        interfile_listmode_file_path,
+        chunk_size=chunk_size,
+        progress=progress,
+        journal=acquisition_journal,
+        hash_index=hash_index,
+        archive=archive,
+        metrics=metrics,
+        retry=retry,
+        compression=compression,
+        part_size=part_size,
+    )
+    # the plugin only extracts listmode headers - others were read on the client
+    if (
+        header_backend == "server"
+        and interfile_scan_type(interfile_listmode_file_path) == LISTMODE_SCAN_TYPE
+    ):
+        request_header_extraction(
+            xnat_session, project_name, experiment_name, scan_name, retry
+        )
+    if acquisition_journal is not None:
+        acquisition_journal.complete(DONE_STAGE)
     return xnat_scan
 
 
 def create_subject(
-    session: xnat.XNATSession, xnat_project: Any, subject_name: str
+    session: xnat.XNATSession,
+    xnat_project: Any,
+    subject_name: str,
+    label_index: Optional[LabelIndex] = None,
+    metrics: Optional[MetricsRecorder] = None,
 ) -> Tuple[Any, str]:
-    """Create a subject."""
-    # Check if subject already exists
-    existing_subjects = list(xnat_project.subjects.values())
-    existing_subject_labels = [subj.label for subj in existing_subjects]
-
-    if subject_name in existing_subject_labels:
-        logger.error(f"Subject {subject_name} already exists")
-        raise NameError(f"Subject {subject_name} already exists.")
-
-    # Create subject using the proper XNAT object creation method
-    # As per documentation: session.classes.SubjectData(parent=project, label='new_subject_label')
-    xnat_subject = session.classes.SubjectData(parent=xnat_project, label=subject_name)
+    """Create a subject. If a label_index is given, it is used (and updated) to check if
+    the subject already exists, otherwise this is checked with a single request."""
+    with timed_stage(metrics, "subject", subject_name):
+        # Check if subject already exists
+        parent_uri = subjects_uri(xnat_project.id)
+        if label_index is not None:
+            subject_exists = label_index.contains(parent_uri, subject_name)
+        else:
+            subject_exists = label_exists(session, parent_uri, subject_name)
+
+        if subject_exists:
+            logger.error(f"Subject {subject_name} already exists")
+            raise NameError(f"Subject {subject_name} already exists.")
+
+        # Create subject using the proper XNAT object creation method
+        # As per documentation: session.classes.SubjectData(parent=project, label='new_subject_label')
+        xnat_subject = session.classes.SubjectData(
+            parent=xnat_project, label=subject_name
+        )
+        if label_index is not None:
+            label_index.add(parent_uri, subject_name)
 
     logger.info(f"Created subject: {subject_name}")
 
@@ -98,39 +265,48 @@ def add_project(xnat_session: xnat.XNATSession, project_name: str) -> None:
     logger.info(f"Created project: {project_name}")
 
 
-def add_experiment(xnat_subject: Any, experiment_name: str) -> Any:
-    """Add experiment to the XNAT subject"""
-    # Check if experiment already exists
-    existing_experiments = list(xnat_subject.experiments.values())
-    existing_experiment_labels = [exp.label for exp in existing_experiments]
-
-    if experiment_name in existing_experiment_labels:
-        logger.error(f"Experiment {experiment_name} already exists")
-        raise NameError(f"Experiment {experiment_name} already exists.")
-
-    # Create experiment using the proper XNAT object creation method
-    # session.classes.PetSessionData(parent=subject, label='new_experiment_label')
-    session = xnat_subject.xnat_session
-    experiment = session.classes.PetSessionData(
-        parent=xnat_subject, label=experiment_name
-    )
+def add_experiment(
+    xnat_subject: Any,
+    experiment_name: str,
+    label_index: Optional[LabelIndex] = None,
+    metrics: Optional[MetricsRecorder] = None,
+) -> Any:
+    """Add experiment to the XNAT subject. If a label_index is given, it is used (and
+    updated) to check if the experiment already exists, otherwise this is checked with a
+    single request."""
+    with timed_stage(metrics, "experiment", experiment_name):
+        # Check if experiment already exists
+        session = xnat_subject.xnat_session
+        parent_uri = experiments_uri(xnat_subject.project, xnat_subject.label)
+        if label_index is not None:
+            experiment_exists = label_index.contains(parent_uri, experiment_name)
+        else:
+            experiment_exists = label_exists(session, parent_uri, experiment_name)
+
+        if experiment_exists:
+            logger.error(f"Experiment {experiment_name} already exists")
+            raise NameError(f"Experiment {experiment_name} already exists.")
+
+        # Create experiment using the proper XNAT object creation method
+        # session.classes.PetSessionData(parent=subject, label='new_experiment_label')
+        experiment = session.classes.PetSessionData(
+            parent=xnat_subject, label=experiment_name
+        )
+        if label_index is not None:
+            label_index.add(parent_uri, experiment_name)
 
     logger.info(f"Created experiment: {experiment_name}")
     return experiment
 
 
-def add_scan(
-    experiment: Any, xnat_hdr: dict, scan_name: str, interfile_file_path: Path
+def create_scan(
+    experiment: Any,
+    xnat_hdr: dict,
+    scan_name: str,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
 ) -> Any:
-    """Add scan to experiment. Create scan with the xnat_hdr info. Add PET_RAW resource
-    to scan with interfile data.
-
-    Args:
-        experiment (Any): existing XNAT experiment
-        xnat_hdr (dict): dict containing all the header info to populate in the data type interfile
-        scan_name (str): custom str e.g. cart_cine_scan
-        interfile_path (Path): Path of interfile containing PET listmode data
-    """
+    """Create a scan in the experiment, with all the header info in xnat_hdr. Transient
+    failures of the PUT creating it are retried according to retry."""
     # Check if scan already exists, otherwise create it with all header data
     if scan_name in experiment.scans:
         logger.error(f"XNAT scan {scan_name} already exists")
@@ -144,60 +320,527 @@ def add_scan(
     scan_uri = f"{experiment.uri}/scans/{scan_name}"
 
     # Create the scan using PUT request with all header data as query parameters
-    response = session.put(scan_uri, query=xnat_hdr)
+    _put_scan_fields(session, scan_uri, xnat_hdr, scan_name, retry)
+    logger.info(f"Successfully created interfile scan: {scan_name}")
+
+    # Refresh the experiment to see the new scan
+    experiment.clearcache()
+
+    # Get the created scan object
+    scan = experiment.scans[scan_name]
+
+    logger.info(f"Configured interfile scan: {scan_name}")
+    return scan
+
+
+def put_scan(
+    experiment: Any,
+    xnat_hdr: dict,
+    scan_name: str,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> Any:
+    """Create a scan in the experiment, with all the header info in xnat_hdr, using as few
+    requests as possible - a HEAD to check the scan doesn't exist, and the PUT creating it.
+    Unlike create_scan, the experiment's scan listing isn't fetched (before or after).
+    Transient failures of the PUT are retried according to retry."""
 
-    if response.ok:
-        logger.info(f"Successfully created interfile scan: {scan_name}")
-        # Refresh the experiment to see the new scan
-        experiment.clearcache()
+    session = experiment.xnat_session
+    scans_uri = f"{experiment.uri}/scans"
+    if label_exists(session, scans_uri, scan_name):
+        logger.error(f"XNAT scan {scan_name} already exists")
+        raise NameError(f"XNAT scan {scan_name} already exists")
+
+    logger.info(f"Creating interfile scan {scan_name} with header data")
+    scan_uri = f"{scans_uri}/{scan_name}"
+    _put_scan_fields(session, scan_uri, xnat_hdr, scan_name, retry)
+    logger.info(f"Successfully created interfile scan: {scan_name}")
+
+    # Wrap the new scan without fetching it, if its type is known to the session
+    scan_type = xnat_hdr.get("scans")
+    if scan_type in session.XNAT_CLASS_LOOKUP:
+        return session.create_object(scan_uri, type_=scan_type, id_=scan_name)
+    return session.create_object(scan_uri)
 
-        # Get the created scan object
-        scan = experiment.scans[scan_name]
 
+def _put_scan_fields(
+    session: xnat.XNATSession,
+    scan_uri: str,
+    xnat_hdr: dict,
+    scan_name: str,
+    retry: Optional[RetryPolicy],
+) -> None:
+    """PUT the scan with the xnat_hdr fields as query parameters. This only creates the
+    scan if it doesn't exist, and sets the fields, so is safe to repeat - the 'already
+    exists' check is made once, before the first attempt."""
+
+    request_with_retry(
+        lambda attempt, accepted_status: session.put(
+            scan_uri, query=xnat_hdr, accepted_status=accepted_status
+        ),
+        retry,
+        f"Creation of interfile scan {scan_name}",
+    )
+
+
+def header_extraction_uri(
+    project_name: str, experiment_name: str, scan_name: str
+) -> str:
+    """xapi uri of the interfile plugin's header extraction of a scan"""
+
+    return (
+        f"/xapi/interfile/projects/{project_name}/experiments/{experiment_name}"
+        f"/scans/{scan_name}/header"
+    )
+
+
+def request_header_extraction(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    experiment_name: str,
+    scan_name: str,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> None:
+    """Ask the interfile plugin to fill the scan's fields from the listmode header (.l.hdr)
+    in its PET_RAW resource. The fields are extracted in the background on the server -
+    this returns as soon as the extraction is queued (see header_extraction_status)."""
+
+    request_with_retry(
+        lambda attempt, accepted_status: xnat_session.post(
+            header_extraction_uri(project_name, experiment_name, scan_name),
+            accepted_status=accepted_status,
+        ),
+        retry,
+        f"Header extraction of scan {scan_name}",
+        accepted_status=(202,),
+    )
+    logger.info(f"Queued header extraction of scan {scan_name} on the server")
+
+
+def header_extraction_status(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    experiment_name: str,
+    scan_name: str,
+) -> str:
+    """Status of the latest header extraction of a scan (see request_header_extraction) -
+    QUEUED, RUNNING, COMPLETE or FAILED"""
+
+    status = xnat_session.get_json(
+        header_extraction_uri(project_name, experiment_name, scan_name)
+    )
+    return status["status"]
+
+
+def create_resource(
+    scan: Any, label: str, retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY
+) -> Any:
+    """Create a resource in the scan (like scan.create_resource), retrying transient
+    failures according to retry. Retries accept a 409 (conflict) response, as the
+    resource may have been created by an attempt whose response was lost."""
+
+    session = scan.xnat_session
+    resource_uri = f"{scan.uri}/resources/{label}"
+
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        if attempt > 1:
+            accepted_status = accepted_status + [409]
+        return session.put(resource_uri, accepted_status=accepted_status)
+
+    request_with_retry(send, retry, f"Creation of resource {label}")
+    scan.clearcache()
+    return session.create_object(resource_uri)
+
+
+def _resume_or_create(
+    xnat_session: xnat.XNATSession,
+    journal: Optional[AcquisitionJournal],
+    stage: str,
+    parent_uri: str,
+    label: str,
+    create: Callable[[], Any],
+) -> Any:
+    """Run the create step of an ingest stage, recording it in the journal. If the journal
+    shows the stage was already started by a previous run, and the object it creates exists
+    on the server, the existing object is returned instead of raising 'already exists'."""
+
+    if (
+        journal is not None
+        and journal.status(stage) is not None
+        and label_exists(xnat_session, parent_uri, label)
+    ):
+        logger.info(f"Resuming from journal - {stage} {label} already exists")
+        xnat_object = xnat_session.create_object(f"{parent_uri}/{label}")
     else:
-        logger.error(
-            f"Failed to create interfile scan: {response.status_code} - {response.text}"
+        if journal is not None:
+            journal.begin(stage)
+        xnat_object = create()
+
+    if journal is not None:
+        journal.complete(stage)
+    return xnat_object
+
+
+def _upload_file_once(
+    scan_resource: Any,
+    file_path: Path,
+    journal: Optional[AcquisitionJournal],
+    chunk_size: int,
+    progress: Optional[UploadProgressCallback],
+    hash_index: Optional[HashIndex] = None,
+    scan_uri: Optional[str] = None,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    compression: Optional[str] = None,
+    upload_in_parts: Optional[Callable[..., str]] = None,
+    xsi_type: str = LISTMODE_SCAN_TYPE,
+) -> int:
+    """Upload a file to the resource, unless the journal shows it was already uploaded. An
+    upload that was started but not completed is overwritten - unless a hash_index is given
+    and the file on the server has the same checksum as the local file. Returns the number
+    of bytes uploaded.
+
+    With a hash_index, the checksum of the file is computed while it is uploaded, verified
+    against the server after upload, and recorded as archived in scan_uri.
+
+    If compression is given, the file is compressed as it is uploaded (see
+    upload_compressed_resource_file), and the codec, original size and checksum are set in
+    the fields of the scan (scan_uri, of type xsi_type) before the upload is recorded as
+    complete.
+
+    If upload_in_parts is given, the file is uploaded with upload_in_parts(file_path,
+    progress=..., retry=...) instead - upload_resource_file_in_parts, with the scan and
+    resource to upload to bound."""
+
+    stage = f"upload:{file_path.name}"
+    status = None if journal is None else journal.status(stage)
+    if status == COMPLETED:
+        logger.info(f"Resuming from journal - {file_path.name} already uploaded")
+        return 0
+
+    if journal is not None and status == STARTED and hash_index is not None:
+        local_md5 = hash_index.cached_md5(file_path)
+        if (
+            local_md5 is not None
+            and resource_file_digests(
+                scan_resource.xnat_session, scan_resource.uri
+            ).get(file_path.name)
+            == local_md5
+        ):
+            logger.info(f"{file_path.name} already on server with matching checksum")
+            journal.complete(stage)
+            return 0
+
+    if journal is not None:
+        journal.begin(stage)
+    if compression is not None:
+        n_bytes = _upload_compressed_file(
+            scan_resource,
+            file_path,
+            chunk_size,
+            progress,
+            overwrite=status == STARTED,
+            hash_index=hash_index,
+            scan_uri=scan_uri or scan_resource.uri.rsplit("/resources/", 1)[0],
+            retry=retry,
+            compression=compression,
+            xsi_type=xsi_type,
         )
-        raise Exception(f"Failed to create interfile scan: {response.status_code}")
+    else:
+        if upload_in_parts is None:
+            md5 = upload_resource_file(
+                scan_resource,
+                file_path,
+                file_path.name,
+                chunk_size=chunk_size,
+                progress=progress,
+                overwrite=status == STARTED,
+                checksum=hash_index is not None,
+                retry=retry,
+            )
+        else:
+            # a file left by an upload that was started is replaced by the plugin
+            md5 = upload_in_parts(file_path, progress=progress, retry=retry)
+        if hash_index is not None and md5 is not None:
+            hash_index.record_archived(
+                file_path,
+                md5,
+                scan_uri or scan_resource.uri,
+                f"{scan_resource.uri}/files/{file_path.name}",
+            )
+        n_bytes = file_path.stat().st_size
+    if journal is not None:
+        journal.complete(stage)
+    return n_bytes
+
+
+def _upload_compressed_file(
+    scan_resource: Any,
+    file_path: Path,
+    chunk_size: int,
+    progress: Optional[UploadProgressCallback],
+    overwrite: bool,
+    hash_index: Optional[HashIndex],
+    scan_uri: str,
+    retry: Optional[RetryPolicy],
+    compression: str,
+    xsi_type: str = LISTMODE_SCAN_TYPE,
+) -> int:
+    """Upload a file compressed, and set how in the fields of the scan (of type xsi_type)
+    - returns the number of (compressed) bytes uploaded"""
+
+    upload = upload_compressed_resource_file(
+        scan_resource,
+        file_path,
+        file_path.name,
+        compression,
+        chunk_size=chunk_size,
+        progress=progress,
+        overwrite=overwrite,
+        checksum=hash_index is not None,
+        retry=retry,
+    )
+    _put_scan_fields(
+        scan_resource.xnat_session,
+        scan_uri,
+        compressed_upload_2_xnat(upload, xsi_type),
+        scan_uri.rsplit("/", 1)[-1],
+        retry,
+    )
+    if hash_index is not None:
+        # recorded by the checksum of the original file, so it is recognised locally
+        hash_index.record_archived(
+            file_path,
+            upload.original_md5,
+            scan_uri,
+            f"{scan_resource.uri}/files/{upload.remote_path}",
+            remote_md5=upload.md5,
+        )
+    return upload.size
 
-    logger.info(f"Configured interfile scan: {scan_name}")
 
-    # Create resource for interfile files - create the resource first, then upload
-    scan_resource = scan.create_resource("PET_RAW")
-    scan_resource.upload(interfile_file_path, interfile_file_path.name)
-    scan_resource.upload(
-        interfile_file_path, interfile_file_path.name.replace(".l.hdr", ".l")
+def _upload_archive_once(
+    xnat_session: xnat.XNATSession,
+    resource_uri: str,
+    file_paths: list[Path],
+    archive_name: str,
+    journal: Optional[AcquisitionJournal],
+    chunk_size: int,
+    progress: Optional[UploadProgressCallback],
+    hash_index: Optional[HashIndex] = None,
+    scan_uri: Optional[str] = None,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> int:
+    """Upload files to the resource in a single zip archive, extracted on the server,
+    unless the journal shows it was already uploaded. An upload that was started but not
+    completed is overwritten. Returns the number of bytes uploaded (of the files).
+
+    With a hash_index, the checksum of each file is computed while it is uploaded, verified
+    against the server after upload, and recorded as archived in scan_uri."""
+
+    stage = f"upload:{archive_name}"
+    status = None if journal is None else journal.status(stage)
+    if status == COMPLETED:
+        logger.info(f"Resuming from journal - {archive_name} already uploaded")
+        return 0
+
+    if journal is not None:
+        journal.begin(stage)
+    md5s = upload_resource_archive(
+        xnat_session,
+        resource_uri,
+        [(file_path, file_path.name) for file_path in file_paths],
+        archive_name,
+        chunk_size=chunk_size,
+        progress=progress,
+        overwrite=status == STARTED,
+        checksum=hash_index is not None,
+        retry=retry,
     )
-    logger.info(f"Successfully created scan {scan_name} and uploaded interfile files")
-
-    return scan
+    if hash_index is not None:
+        for file_path in file_paths:
+            hash_index.record_archived(
+                file_path,
+                md5s[file_path.name],
+                scan_uri or resource_uri,
+                f"{resource_uri}/files/{file_path.name}",
+            )
+    if journal is not None:
+        journal.complete(stage)
+    return sum(file_path.stat().st_size for file_path in file_paths)
+
+
+def find_archived_scan(
+    xnat_session: xnat.XNATSession,
+    interfile_listmode_file_path: Path,
+    hash_index: HashIndex,
+) -> Optional[Any]:
+    """Return the XNAT scan the data file (e.g. .l) next to the header was already
+    archived in, according to the hash_index, or None if it wasn't.
+
+    The checksum of the archived file on the PET_RAW resource is checked against the
+    hash_index first. If the file is no longer on the server (e.g. the scan was deleted)
+    or its checksum changed (e.g. the scan was replaced), it is removed from the
+    hash_index and None is returned, so the data is uploaded again."""
+
+    data_path = interfile_data_path(interfile_listmode_file_path)
+    archived = hash_index.archived_file(data_path)
+    if archived is None:
+        return None
+
+    resource_uri, file_name = archived.file_uri.rsplit("/files/", 1)
+    try:
+        server_md5s = resource_file_digests(xnat_session, resource_uri)
+    except XNATResponseError:
+        server_md5s = {}
+    if file_name not in server_md5s or server_md5s[file_name] not in (
+        None,
+        archived.md5,
+    ):
+        logger.warning(
+            f"{data_path} was archived as {archived.file_uri}, which is no longer on "
+            f"the server with the same checksum - uploading it again"
+        )
+        hash_index.forget_archived(archived.file_uri)
+        return None
+    if server_md5s[file_name] is None:
+        logger.warning(f"No checksum available on server for {archived.file_uri}")
 
+    logger.warning(
+        f"{data_path} is already archived in {archived.scan_uri} - skipping upload"
+    )
+    return xnat_session.create_object(archived.scan_uri)
 
-def main():
-    xnat_server_address = "http://localhost"
-    user = "admin"
-    password = "admin"
-    project_name = "interfile_project"
-    time_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")[:-3]
-    subject_name = "Subj-" + time_id
-    experiment_name = "Exp-" + time_id
-    scan_name = "pet_listmode_scan"
 
-    interfile_data_path = get_data()
-    logger.info(f"Interfile data path: {interfile_data_path}")
+def add_scan(
+    experiment: Any,
+    xnat_hdr: dict,
+    scan_name: str,
+    interfile_file_path: Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = log_upload_progress,
+    journal: Optional[AcquisitionJournal] = None,
+    hash_index: Optional[HashIndex] = None,
+    archive: bool = False,
+    metrics: Optional[MetricsRecorder] = None,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    compression: Optional[str] = None,
+    part_size: Optional[int] = None,
+) -> Any:
+    """Add scan to experiment. Create scan with the xnat_hdr info. Add PET_RAW resource
+    to scan with interfile data.
 
-    # Use context manager for automatic connection cleanup
-    with xnat.connect(xnat_server_address, user=user, password=password) as session:
-        logger.info("Connected to XNAT server")
-        upload_interfile_data(
+    Args:
+        experiment (Any): existing XNAT experiment
+        xnat_hdr (dict): dict containing all the header info to populate in the data type interfile
+        scan_name (str): custom str e.g. cart_cine_scan
+        interfile_path (Path): Path of interfile header (.l.hdr, .hs or .hv) - the data
+            file (.l, .s or .v) is uploaded from the same directory
+        chunk_size (int): size of chunks (bytes) the files are streamed from disk in
+        progress (UploadProgressCallback): called with (bytes sent, total bytes, bytes/sec)
+            after each chunk is uploaded
+        journal (AcquisitionJournal): if given, each stage is recorded in the journal, and
+            stages completed by a previous run are skipped
+        hash_index (HashIndex): if given, file checksums are computed during upload,
+            verified against the server and recorded in the index
+        archive (bool): if True, the scan is created without listing the experiment's
+            scans, and the header and data are uploaded in a single zip archive that is
+            extracted on the server (creating the PET_RAW resource) - 3 requests, rather
+            than the 6+ of creating the scan and resource, and uploading each file
+        metrics (MetricsRecorder): if given, the time taken to create the scan (and
+            resource) and upload the files is recorded in it
+        retry (RetryPolicy): how transient failures of the requests creating the scan and
+            resource, and uploading the files, are retried - None to not retry
+        compression (str): if given (e.g. 'zstd'), the listmode data is compressed as it
+            is uploaded (e.g. to scan.l.zst), and the codec, original size and checksum
+            are set in the scan's dataFile fields - not supported with archive
+        part_size (int): if given, the listmode data is uploaded in parts of part_size
+            bytes, several at once, through the interfile plugin's upload API (see
+            upload_resource_file_in_parts) - for very large files, as failed parts are
+            retried on their own. Not supported with archive or compression
+    """
+    if archive and compression is not None:
+        raise ValueError("Compression isn't supported when uploading an archive")
+    if part_size is not None and (archive or compression is not None):
+        raise ValueError(
+            "Uploads in parts aren't supported with an archive or compression"
+        )
+    session = experiment.xnat_session
+    file_paths = [interfile_file_path, interfile_data_path(interfile_file_path)]
+
+    if archive:
+        with timed_stage(metrics, "scan_put", scan_name):
+            scan = _resume_or_create(
+                session,
+                journal,
+                "scan",
+                f"{experiment.uri}/scans",
+                scan_name,
+                lambda: put_scan(experiment, xnat_hdr, scan_name, retry),
+            )
+        with timed_stage(metrics, "upload", f"{scan_name}.zip") as upload_stage:
+            upload_stage.n_bytes = _upload_archive_once(
+                session,
+                f"{scan.uri}/resources/PET_RAW",
+                file_paths,
+                f"{scan_name}.zip",
+                journal,
+                chunk_size,
+                progress,
+                hash_index=hash_index,
+                scan_uri=scan.uri,
+                retry=retry,
+            )
+        logger.info(f"Successfully created scan {scan_name} and uploaded archive")
+        return scan
+
+    with timed_stage(metrics, "scan_put", scan_name):
+        scan = _resume_or_create(
             session,
-            interfile_data_path,
-            project_name,
-            subject_name,
-            experiment_name,
+            journal,
+            "scan",
+            f"{experiment.uri}/scans",
             scan_name,
+            lambda: create_scan(experiment, xnat_hdr, scan_name, retry),
         )
 
+    # Create resource for interfile files - create the resource first, then upload
+    with timed_stage(metrics, "resource", "PET_RAW"):
+        scan_resource = _resume_or_create(
+            session,
+            journal,
+            "resource",
+            f"{scan.uri}/resources",
+            "PET_RAW",
+            lambda: create_resource(scan, "PET_RAW", retry),
+        )
+    upload_in_parts = None
+    if part_size is not None:
+        upload_in_parts = partial(
+            upload_resource_file_in_parts,
+            session,
+            experiment.project,
+            experiment.id,
+            scan_name,
+            "PET_RAW",
+            part_size=part_size,
+        )
+    for file_path in file_paths:
+        with timed_stage(metrics, "upload", file_path.name) as upload_stage:
+            upload_stage.n_bytes = _upload_file_once(
+                scan_resource,
+                file_path,
+                journal,
+                chunk_size,
+                progress,
+                hash_index=hash_index,
+                scan_uri=scan.uri,
+                retry=retry,
+                # only the listmode data - the header is small, and read as text
+                compression=compression if file_path == file_paths[1] else None,
+                xsi_type=xnat_hdr.get("scans", LISTMODE_SCAN_TYPE),
+                upload_in_parts=(
+                    upload_in_parts if file_path == file_paths[1] else None
+                ),
+            )
+    logger.info(f"Successfully created scan {scan_name} and uploaded interfile files")
 
-if __name__ == "__main__":
-    main()
+    return scan
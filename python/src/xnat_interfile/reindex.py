@@ -0,0 +1,333 @@
+import logging
+import math
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+import xnat
+
+from xnat_interfile.batch_ingest import Acquisition
+from xnat_interfile.header_cache import HeaderCache, cached_read_listmode_header_2_xnat
+from xnat_interfile.ingest_journal import IngestJournal, acquisition_key
+from xnat_interfile.interfile_2_xnat import (
+    CONVERTER_VERSION,
+    read_listmode_header_2_xnat,
+)
+from xnat_interfile.label_index import experiments_uri
+from xnat_interfile.metadata_export import (
+    ID_COLUMNS,
+    SCAN_XSI_TYPE,
+    SchemaField,
+    export_columns,
+    iter_scan_metadata_rows,
+    server_schema_fields,
+)
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy, request_with_retry
+from xnat_interfile.upload import resource_file_digests
+
+logger = logging.getLogger(__name__)
+
+# Stage recorded in the journal once a scan has been reindexed. It includes the converter
+# version, so scans are reindexed again whenever the conversion changes.
+REINDEX_STAGE = f"reindex:{CONVERTER_VERSION}"
+
+# Relative tolerance when comparing numeric fields, as XNAT may store floats with less
+# precision than python formats them
+_NUMERIC_REL_TOL = 1e-6
+
+
+@dataclass
+class ArchivedScan:
+    """An interfile scan already in XNAT, with the values of its fields as stored there
+    (as strings, keyed by path e.g. radionuclideInformation/halfLife - '' if unset)."""
+
+    project_name: str
+    subject_id: str
+    experiment_name: str
+    scan_name: str
+    fields: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def uri(self) -> str:
+        return (
+            f"{experiments_uri(self.project_name, self.subject_id)}"
+            f"/{self.experiment_name}/scans/{self.scan_name}"
+        )
+
+    @property
+    def key(self) -> str:
+        return acquisition_key(
+            self.project_name, self.subject_id, self.experiment_name, self.scan_name
+        )
+
+
+@dataclass
+class ReindexResult:
+    """Outcome of reindexing a single scan - changed holds the fields that were (or, in a
+    dry run, would be) updated, keyed by xpath. skipped is True if the journal shows the
+    scan was already reindexed with the current converter version."""
+
+    scan: ArchivedScan
+    changed: dict[str, Any] = field(default_factory=dict)
+    error: Optional[BaseException] = None
+    skipped: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+ReindexProgressCallback = Callable[[ReindexResult, int, int], None]
+
+
+def log_reindex_progress(result: ReindexResult, n_completed: int, n_total: int) -> None:
+    """Default progress callback - log the outcome of each scan."""
+
+    if result.skipped:
+        logger.debug(f"[{n_completed}/{n_total}] Skipped {result.scan.uri}")
+    elif not result.ok:
+        logger.error(
+            f"[{n_completed}/{n_total}] Failed to reindex {result.scan.uri}: "
+            f"{result.error!r}"
+        )
+    elif result.changed:
+        logger.info(
+            f"[{n_completed}/{n_total}] Updated {len(result.changed)} fields of "
+            f"{result.scan.uri}"
+        )
+    else:
+        logger.debug(f"[{n_completed}/{n_total}] {result.scan.uri} is up to date")
+
+
+def iter_archived_scans(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    fields: list[SchemaField],
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> Iterator[ArchivedScan]:
+    """All interfile scans in a project, with the stored values of fields - fetched with
+    a single search (see iter_scan_metadata_rows), rather than a request per scan."""
+
+    columns = export_columns(fields)
+    for row in iter_scan_metadata_rows(
+        xnat_session, project_name, fields, SCAN_XSI_TYPE, retry
+    ):
+        values = dict(zip(columns, row))
+        yield ArchivedScan(
+            project_name=values["project"],
+            subject_id=values["subject_id"],
+            experiment_name=values["experiment_label"],
+            scan_name=values["scan_id"],
+            fields={path: values[path] for path in columns[len(ID_COLUMNS) :]},
+        )
+
+
+def _field_changed(field: SchemaField, stored: str, value: Any) -> bool:
+    if stored == "":
+        return True
+    if field.numeric:
+        try:
+            return not math.isclose(
+                float(stored), float(value), rel_tol=_NUMERIC_REL_TOL
+            )
+        except ValueError:
+            return True
+    return stored != str(value)
+
+
+def changed_fields(
+    stored: dict[str, str],
+    xnat_hdr: dict[str, Any],
+    fields: list[SchemaField],
+    xsi_type: str = SCAN_XSI_TYPE,
+) -> dict[str, Any]:
+    """Fields of xnat_hdr (keyed by xpath, as read_listmode_header_2_xnat returns them)
+    that differ from the stored values. Fields the server's schema doesn't have are left
+    out, and numeric fields are compared as numbers."""
+
+    schema_fields = {schema_field.path: schema_field for schema_field in fields}
+    changed = {}
+    for xpath, value in xnat_hdr.items():
+        path = xpath.removeprefix(f"{xsi_type}/")
+        schema_field = schema_fields.get(path)
+        if schema_field is None or path == xpath:
+            continue
+        if _field_changed(schema_field, stored.get(path, ""), value):
+            changed[xpath] = value
+    return changed
+
+
+def read_archived_header_2_xnat(
+    xnat_session: xnat.XNATSession,
+    scan_uri: str,
+    backend: str = "native",
+    resource_label: str = "PET_RAW",
+) -> dict[str, Any]:
+    """Download the interfile listmode header (.l.hdr) of an archived scan and convert
+    it to XNAT data type fields. Only the header is downloaded, so event statistics
+    (which need the listmode data) aren't included."""
+
+    resource_uri = f"{scan_uri}/resources/{resource_label}"
+    header_names = [
+        name
+        for name in resource_file_digests(xnat_session, resource_uri)
+        if name.endswith(".l.hdr")
+    ]
+    if len(header_names) != 1:
+        raise FileNotFoundError(
+            f"Expected one listmode header in {resource_uri}, found {len(header_names)}"
+        )
+
+    response = xnat_session.get(f"{resource_uri}/files/{header_names[0]}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        header_path = Path(temp_dir) / header_names[0]
+        header_path.write_bytes(response.content)
+        return read_listmode_header_2_xnat(header_path, backend=backend)
+
+
+class _Reindexer:
+    """Reindexes scans from several threads sharing one XNAT session"""
+
+    def __init__(
+        self,
+        xnat_session: xnat.XNATSession,
+        fields: list[SchemaField],
+        header_paths: dict[tuple[str, str, str], Path],
+        header_backend: str,
+        event_stats: bool,
+        header_cache: Optional[HeaderCache],
+        journal: Optional[IngestJournal],
+        dry_run: bool,
+        retry: Optional[RetryPolicy],
+    ):
+        self.xnat_session = xnat_session
+        self.fields = fields
+        self.header_paths = header_paths
+        self.header_backend = header_backend
+        self.event_stats = event_stats
+        self.header_cache = header_cache
+        self.journal = journal
+        self.dry_run = dry_run
+        self.retry = retry
+
+    def _xnat_hdr(self, scan: ArchivedScan) -> dict[str, Any]:
+        header_path = self.header_paths.get(
+            (scan.project_name, scan.experiment_name, scan.scan_name)
+        )
+        if header_path is None:
+            return read_archived_header_2_xnat(
+                self.xnat_session, scan.uri, self.header_backend
+            )
+        return cached_read_listmode_header_2_xnat(
+            header_path,
+            backend=self.header_backend,
+            event_stats=self.event_stats,
+            header_cache=self.header_cache,
+        )
+
+    def reindex(self, scan: ArchivedScan) -> ReindexResult:
+        if self.journal is not None and (
+            self.journal.status(scan.key, REINDEX_STAGE) is not None
+        ):
+            return ReindexResult(scan, skipped=True)
+
+        changed = changed_fields(scan.fields, self._xnat_hdr(scan), self.fields)
+        if self.dry_run:
+            return ReindexResult(scan, changed=changed)
+
+        if changed:
+            query = {"scans": SCAN_XSI_TYPE, **changed}
+            request_with_retry(
+                lambda attempt, accepted_status: self.xnat_session.put(
+                    scan.uri, query=query, accepted_status=accepted_status
+                ),
+                self.retry,
+                f"Update of {scan.uri}",
+            )
+        if self.journal is not None:
+            self.journal.complete(scan.key, REINDEX_STAGE)
+        return ReindexResult(scan, changed=changed)
+
+
+def reindex_scans(
+    xnat_session: xnat.XNATSession,
+    project_name: str,
+    acquisitions: Optional[list[Acquisition]] = None,
+    max_workers: int = 4,
+    header_backend: str = "native",
+    event_stats: bool = False,
+    header_cache: Optional[HeaderCache] = None,
+    journal: Optional[IngestJournal] = None,
+    dry_run: bool = False,
+    fields: Optional[list[SchemaField]] = None,
+    progress: ReindexProgressCallback = log_reindex_progress,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> list[ReindexResult]:
+    """Re-populate the fields of the interfile scans already archived in a project, e.g.
+    after fields are added to the schema or the conversion of headers is fixed, without
+    re-uploading any data.
+
+    The stored fields of all scans are fetched with a single search. Each scan's header is
+    then converted again - from the local copy if it is one of acquisitions (matched by
+    project, experiment and scan name), otherwise from the header archived in the scan's
+    PET_RAW resource - and only the fields that changed are sent to the server. Scans are
+    processed in a pool of max_workers threads sharing xnat_session, and a failure of one
+    doesn't stop the others.
+
+    event_stats only applies to local copies - archived listmode data isn't downloaded
+    to decode it. fields default to all fields in the server's schema.
+
+    If a journal is given, each scan is recorded in it once reindexed, and scans already
+    reindexed with the current CONVERTER_VERSION are skipped - so an interrupted run
+    resumes where it stopped. If dry_run is True, the changes are only computed (and
+    returned), not sent to the server or recorded in the journal.
+    """
+    if fields is None:
+        fields = server_schema_fields(xnat_session)
+    header_paths = {
+        (
+            acquisition.project_name,
+            acquisition.experiment_name,
+            acquisition.scan_name,
+        ): acquisition.header_path
+        for acquisition in acquisitions or []
+    }
+    scans = list(iter_archived_scans(xnat_session, project_name, fields, retry))
+    logger.info(f"Reindexing {len(scans)} scans in {project_name}")
+
+    reindexer = _Reindexer(
+        xnat_session,
+        fields,
+        header_paths,
+        header_backend,
+        event_stats,
+        header_cache,
+        journal,
+        dry_run,
+        retry,
+    )
+    results: dict[int, ReindexResult] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(reindexer.reindex, scan): index
+            for index, scan in enumerate(scans)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            error = future.exception()
+            if error is None:
+                result = future.result()
+            else:
+                result = ReindexResult(scans[index], error=error)
+            results[index] = result
+            progress(result, len(results), len(scans))
+
+    n_changed = sum(bool(result.changed) for result in results.values())
+    n_failed = sum(not result.ok for result in results.values())
+    logger.info(
+        f"Reindexed {len(scans)} scans in {project_name} - {n_changed} "
+        f"{'would change' if dry_run else 'changed'}, {n_failed} failed"
+    )
+    return [results[index] for index in range(len(scans))]
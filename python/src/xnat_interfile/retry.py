@@ -0,0 +1,216 @@
+import logging
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Mapping, Optional, Sequence
+
+import requests
+from xnat.exceptions import XNATResponseError
+
+logger = logging.getLogger(__name__)
+
+# Statuses of responses from a busy or overloaded server, which are worth retrying
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+
+# Errors from requests where the server may be overloaded (or restarting), rather than
+# rejecting the request
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+# Fraction of a Retry-After wait added at random, so clients told to wait the same time
+# don't all retry at once
+RETRY_AFTER_JITTER = 0.1
+
+
+class AdaptiveConcurrencyLimit:
+    """Limit on the number of uploads running at once, adapted to server load (AIMD).
+
+    Use as a context manager around each upload - it waits until fewer than limit uploads
+    are running. The limit starts at max_limit. Each success adds 1 / limit (so about 1
+    per limit successes), and each transient failure (5xx or timeout) multiplies it by
+    decrease_factor, down to min_limit. Failures within cooldown seconds of a decrease are
+    taken to be from the same burst, so don't decrease it again.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        if not 0 < min_limit <= max_limit:
+            raise ValueError(
+                f"Need 0 < min_limit <= max_limit, got {min_limit} and {max_limit}"
+            )
+        if not 0 < decrease_factor < 1:
+            raise ValueError(
+                f"decrease_factor must be between 0 and 1, got {decrease_factor}"
+            )
+
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._limit = float(max_limit)
+        self._n_running = 0
+        self._last_decrease = -math.inf
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return math.floor(self._limit)
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._n_running < self.limit)
+            self._n_running += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._n_running -= 1
+            self._condition.notify_all()
+
+    def record_success(self) -> None:
+        with self._condition:
+            previous_limit = self.limit
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if self.limit > previous_limit:
+                logger.debug(f"Increased upload concurrency to {self.limit}")
+                self._condition.notify_all()
+
+    def record_failure(self) -> None:
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+        logger.warning(
+            f"Server under load - reduced upload concurrency to {self.limit}"
+        )
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How to retry requests that fail with a transient error (TRANSIENT_STATUS, or a
+    connection error / timeout).
+
+    Up to max_attempts are made. Before each retry, the client waits for the time given by
+    the server's Retry-After header if there is one - capped at max_retry_after, plus up
+    to RETRY_AFTER_JITTER of it at random - otherwise for an exponential backoff with full
+    jitter - a random time up to base_delay * 2 ** (attempt - 1), capped at max_delay. If
+    a concurrency_limit is given, the outcome of every attempt is recorded in it.
+    """
+
+    max_attempts: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    max_retry_after: float = 120.0
+    retry_status: tuple[int, ...] = TRANSIENT_STATUS
+    concurrency_limit: Optional[AdaptiveConcurrencyLimit] = None
+
+    def __post_init__(self):
+        if self.max_attempts <= 0:
+            raise ValueError(f"max_attempts must be positive, got {self.max_attempts}")
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Time (s) to wait after the given (1-based) attempt failed"""
+
+        if retry_after is not None:
+            wait = min(retry_after, self.max_retry_after)
+            return random.uniform(wait, wait * (1 + RETRY_AFTER_JITTER))
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+    def record(self, transient_failure: bool) -> None:
+        if self.concurrency_limit is None:
+            return
+        if transient_failure:
+            self.concurrency_limit.record_failure()
+        else:
+            self.concurrency_limit.record_success()
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """Time (s) to wait given by a Retry-After header (in seconds or as an HTTP date), or
+    None if there isn't one"""
+
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring invalid Retry-After header: {value}")
+        return None
+
+
+def request_with_retry(
+    send: Callable[[int, list[int]], Any],
+    retry: Optional[RetryPolicy],
+    description: str,
+    accepted_status: Sequence[int] = (200, 201),
+) -> Any:
+    """Send a request with send(attempt, accepted_status), retrying transient failures
+    according to the retry policy (or only trying once if retry is None). send should
+    pass accepted_status on to xnat-py, and must be safe to repeat - e.g. file uploads
+    overwrite the file on later attempts, in case an earlier one reached the server.
+
+    Raises XNATResponseError if the last attempt still gets a transient status."""
+
+    if retry is None:
+        return send(1, list(accepted_status))
+
+    # transient statuses are handled here, rather than raised by xnat-py, so the
+    # Retry-After header of the response can be read
+    send_status = list(accepted_status) + list(retry.retry_status)
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_after = None
+        error: Exception
+        try:
+            response = send(attempt, send_status)
+        except TRANSIENT_ERRORS as transient_error:
+            error = transient_error
+            reason = repr(error)
+        except XNATResponseError as response_error:
+            # e.g. an HTML error page from a proxy, which xnat-py rejects whatever the status
+            if response_error.status_code not in retry.retry_status:
+                raise
+            error = response_error
+            reason = f"status {response_error.status_code}"
+        else:
+            if response.status_code not in retry.retry_status:
+                retry.record(transient_failure=False)
+                return response
+            error = XNATResponseError(
+                f"{description} failed after {attempt} attempts (status "
+                f"{response.status_code}):\n{response.text}",
+                response=response,
+            )
+            reason = f"status {response.status_code}"
+            retry_after = retry_after_seconds(response.headers)
+
+        retry.record(transient_failure=True)
+        if attempt == retry.max_attempts:
+            raise error
+
+        delay = retry.delay(attempt, retry_after)
+        logger.warning(
+            f"{description} failed ({reason}) - retrying in {delay:.1f}s "
+            f"(attempt {attempt + 1} of {retry.max_attempts})"
+        )
+        time.sleep(delay)
@@ -0,0 +1,527 @@
+import hashlib
+import logging
+import os
+import time
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterator, Optional, Union
+
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy, request_with_retry
+
+logger = logging.getLogger(__name__)
+
+# Default size of the chunks read from disk and sent to XNAT. Only one chunk is held in
+# memory at a time, whatever the size of the file.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Called after each chunk is sent with (bytes sent, total bytes, throughput in bytes/sec)
+UploadProgressCallback = Callable[[int, int, float], None]
+
+# Codecs files can be compressed with as they are uploaded, and the suffix each adds to
+# the name of the file on the server
+COMPRESSION_SUFFIXES = {"zstd": ".zst"}
+
+# Default zstd compression level - fast enough to keep up with a WAN link
+DEFAULT_ZSTD_LEVEL = 3
+
+
+class ChecksumError(Exception):
+    """The checksum of a file on the server doesn't match the local file."""
+
+
+def log_upload_progress(bytes_sent: int, total_bytes: int, throughput: float) -> None:
+    """Progress callback that logs upload progress at debug level."""
+
+    logger.debug(
+        f"Uploaded {bytes_sent}/{total_bytes} bytes ({throughput / 1e6:.1f} MB/s)"
+    )
+
+
+class FileChunkStream:
+    """Iterable request body that reads a file in fixed-size chunks, so uploads use bounded
+    memory no matter how large the file is.
+
+    The source can be a path, or any binary file object supporting read / seek / tell -
+    including an mmap.mmap. It has a length, so requests sends a Content-Length header
+    rather than using chunked transfer encoding. It can be iterated more than once (each
+    iteration starts from the beginning), so the upload can be retried.
+
+    If checksum is True, the MD5 of the data is computed in the same pass as it is read
+    for upload, and is available from md5 once the stream has been fully read.
+    """
+
+    def __init__(
+        self,
+        source: Union[Path, BinaryIO],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        progress: Optional[UploadProgressCallback] = None,
+        checksum: bool = False,
+    ):
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+        self.source = source
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.checksum = checksum
+        self._md5: Optional[Any] = None
+        self._bytes_read = 0
+
+        if isinstance(source, Path):
+            self._start = 0
+            self._size = source.stat().st_size
+        else:
+            self._start = source.tell()
+            source.seek(0, os.SEEK_END)
+            self._size = source.tell() - self._start
+            source.seek(self._start)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def md5(self) -> Optional[str]:
+        """MD5 of the data, if checksum is True and the stream has been fully read"""
+
+        if self._md5 is None or self._bytes_read < self._size:
+            return None
+        return self._md5.hexdigest()
+
+    def _read_chunks(self, file: BinaryIO) -> Iterator[bytes]:
+        file.seek(self._start)
+        bytes_sent = 0
+        start_time = time.perf_counter()
+        self._bytes_read = 0
+        self._md5 = hashlib.md5() if self.checksum else None
+
+        while bytes_sent < self._size:
+            chunk = file.read(min(self.chunk_size, self._size - bytes_sent))
+            if not chunk:
+                raise EOFError(
+                    f"File ended after {bytes_sent} of {self._size} bytes - was it "
+                    f"modified during upload?"
+                )
+            bytes_sent += len(chunk)
+            if self._md5 is not None:
+                self._md5.update(chunk)
+            self._bytes_read = bytes_sent
+            yield chunk
+
+            if self.progress is not None:
+                elapsed = time.perf_counter() - start_time
+                throughput = bytes_sent / elapsed if elapsed > 0 else 0.0
+                self.progress(bytes_sent, self._size, throughput)
+
+    def __iter__(self) -> Iterator[bytes]:
+        if isinstance(self.source, Path):
+            with open(self.source, "rb", buffering=0) as file:
+                yield from self._read_chunks(file)
+        else:
+            yield from self._read_chunks(self.source)
+
+
+def import_zstandard() -> Any:
+    """The zstandard module - an optional dependency, only needed for compression."""
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression needs the zstandard package - install xnatinterfile[zstd]"
+        ) from None
+    return zstandard
+
+
+class ZstdStream:
+    """Iterable request body streaming a file compressed with zstd on the fly - without a
+    temporary file, and holding about one chunk in memory at a time. Compression uses
+    threads worker threads (-1 for one per CPU, 0 to compress in the calling thread).
+
+    The compressed size isn't known up front, so requests sends it with chunked transfer
+    encoding. progress is called with the bytes of the file (not the compressed data)
+    read so far. Once the stream has been fully read, md5 and size are those of the
+    compressed data, original_md5 that of the file. It can be iterated more than once,
+    so the upload can be retried.
+    """
+
+    def __init__(
+        self,
+        source: Path,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        progress: Optional[UploadProgressCallback] = None,
+        level: int = DEFAULT_ZSTD_LEVEL,
+        threads: int = -1,
+    ):
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+        self.source = source
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.level = level
+        self.threads = threads
+        self.total_bytes = source.stat().st_size
+        self.md5: Optional[str] = None
+        self.original_md5: Optional[str] = None
+        self.size: Optional[int] = None
+
+    def __iter__(self) -> Iterator[bytes]:
+        zstandard = import_zstandard()
+        # the original size is written to the frame header, so it is known to readers
+        compressor = zstandard.ZstdCompressor(
+            level=self.level, threads=self.threads
+        ).compressobj(size=self.total_bytes)
+        md5 = hashlib.md5()
+        original_md5 = hashlib.md5()
+        self.md5 = self.original_md5 = self.size = None
+        bytes_read = 0
+        size = 0
+        start_time = time.perf_counter()
+
+        with open(self.source, "rb", buffering=0) as file:
+            while bytes_read < self.total_bytes:
+                chunk = file.read(min(self.chunk_size, self.total_bytes - bytes_read))
+                if not chunk:
+                    raise EOFError(
+                        f"File ended after {bytes_read} of {self.total_bytes} bytes - "
+                        f"was it modified during upload?"
+                    )
+                bytes_read += len(chunk)
+                original_md5.update(chunk)
+
+                # an empty chunk would end a chunked transfer - only send data
+                if data := compressor.compress(chunk):
+                    md5.update(data)
+                    size += len(data)
+                    yield data
+
+                if self.progress is not None:
+                    elapsed = time.perf_counter() - start_time
+                    throughput = bytes_read / elapsed if elapsed > 0 else 0.0
+                    self.progress(bytes_read, self.total_bytes, throughput)
+
+        if data := compressor.flush():
+            md5.update(data)
+            size += len(data)
+            yield data
+
+        self.md5 = md5.hexdigest()
+        self.original_md5 = original_md5.hexdigest()
+        self.size = size
+
+
+@dataclass(frozen=True)
+class CompressedUpload:
+    """A file uploaded compressed (see upload_compressed_resource_file) - its name on the
+    server, the codec, and the size (bytes) and MD5 of both the original file and the
+    compressed data stored on the server."""
+
+    remote_path: str
+    compression: str
+    original_size: int
+    original_md5: str
+    size: int
+    md5: str
+
+
+def resource_file_digests(
+    xnat_session: Any, resource_uri: str
+) -> dict[str, Optional[str]]:
+    """MD5 digests of the files in an XNAT resource, keyed by file name. Digests are None
+    if the server doesn't compute checksums."""
+
+    result = xnat_session.get_json(f"{resource_uri}/files")
+    return {
+        row["Name"]: row.get("digest") or None for row in result["ResultSet"]["Result"]
+    }
+
+
+def verify_resource_files(
+    xnat_session: Any, resource_uri: str, md5s: dict[str, str]
+) -> None:
+    """Check the checksums of files in an XNAT resource match md5s ({file name: md5}) -
+    raises ChecksumError if any don't. Only logs a warning if the server doesn't compute
+    checksums."""
+
+    server_md5s = resource_file_digests(xnat_session, resource_uri)
+    for remote_path, md5 in md5s.items():
+        _verify_md5(remote_path, server_md5s.get(remote_path), md5)
+
+
+def _verify_md5(remote_path: str, server_md5: Optional[str], md5: str) -> None:
+    if server_md5 is None:
+        logger.warning(f"No checksum available on server for {remote_path}")
+    elif server_md5 != md5:
+        raise ChecksumError(
+            f"Checksum of {remote_path} on server ({server_md5}) doesn't match local "
+            f"file ({md5})"
+        )
+    else:
+        logger.info(f"Verified checksum of {remote_path} on server")
+
+
+def upload_resource_file(
+    xnat_resource: Any,
+    source: Union[Path, BinaryIO],
+    remote_path: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = None,
+    overwrite: bool = False,
+    query: Optional[dict[str, str]] = None,
+    checksum: bool = False,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> Optional[str]:
+    """Upload a file to an XNAT resource (e.g. PET_RAW), streaming it from disk in chunks of
+    chunk_size bytes. progress is called after each chunk is sent.
+
+    If checksum is True, the MD5 of the file is computed while it is uploaded, checked
+    against the checksum on the server after upload (see verify_resource_files), and
+    returned. Otherwise None is returned.
+
+    Transient failures are retried according to retry (see request_with_retry) - the
+    file is sent again from the start, overwriting any copy a failed attempt left behind.
+    """
+
+    stream = FileChunkStream(
+        source, chunk_size=chunk_size, progress=progress, checksum=checksum
+    )
+    uri = f"{xnat_resource.uri}/files/{remote_path.lstrip('/')}"
+
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        attempt_query = dict(query or {})
+        if overwrite or attempt > 1:
+            attempt_query["overwrite"] = "true"
+        return xnat_resource.xnat_session.put(
+            uri,
+            data=stream,
+            query=attempt_query,
+            headers={"Content-Type": "application/octet-stream"},
+            accepted_status=accepted_status,
+        )
+
+    start_time = time.perf_counter()
+    request_with_retry(send, retry, f"Upload of {remote_path}")
+    elapsed = time.perf_counter() - start_time
+
+    logger.info(
+        f"Uploaded {remote_path} ({len(stream)} bytes in {elapsed:.1f}s, "
+        f"{len(stream) / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+    )
+
+    if stream.md5 is not None:
+        verify_resource_files(
+            xnat_resource.xnat_session, xnat_resource.uri, {remote_path: stream.md5}
+        )
+    return stream.md5
+
+
+class _WriteBuffer:
+    """Write-only, unseekable file object collecting the bytes written to it, so zipfile
+    streams an archive (using data descriptors) rather than seeking back to patch headers."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStream:
+    """Iterable request body streaming a zip archive of files, built on the fly as it is
+    sent - without a temporary file, and holding about one chunk in memory at a time.
+
+    files are (path, name in archive) pairs. Files are stored uncompressed. The size of the
+    archive isn't known up front, so requests sends it with chunked transfer encoding.
+    If checksum is True, the MD5 of each file is computed as it is read, and is available
+    from md5s (keyed by name in archive) once the stream has been fully read.
+    """
+
+    def __init__(
+        self,
+        files: list[tuple[Path, str]],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        progress: Optional[UploadProgressCallback] = None,
+        checksum: bool = False,
+    ):
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+        self.files = files
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.checksum = checksum
+        self.md5s: dict[str, str] = {}
+        self.total_bytes = sum(path.stat().st_size for path, _ in files)
+
+    def __iter__(self) -> Iterator[bytes]:
+        buffer = _WriteBuffer()
+        bytes_sent = 0
+        start_time = time.perf_counter()
+        self.md5s = {}
+
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+            for path, name in self.files:
+                md5 = hashlib.md5() if self.checksum else None
+                info = zipfile.ZipInfo.from_file(path, name)
+                with (
+                    open(path, "rb", buffering=0) as source,
+                    archive.open(info, "w", force_zip64=True) as member,
+                ):
+                    while chunk := source.read(self.chunk_size):
+                        member.write(chunk)
+                        if md5 is not None:
+                            md5.update(chunk)
+                        bytes_sent += len(chunk)
+
+                        # an empty chunk would end a chunked transfer - only send data
+                        if data := buffer.take():
+                            yield data
+
+                        if self.progress is not None:
+                            elapsed = time.perf_counter() - start_time
+                            throughput = bytes_sent / elapsed if elapsed > 0 else 0.0
+                            self.progress(bytes_sent, self.total_bytes, throughput)
+
+                if md5 is not None:
+                    self.md5s[name] = md5.hexdigest()
+
+        if data := buffer.take():
+            yield data
+
+
+def upload_resource_archive(
+    xnat_session: Any,
+    resource_uri: str,
+    files: list[tuple[Path, str]],
+    archive_name: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = None,
+    overwrite: bool = False,
+    checksum: bool = False,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+) -> dict[str, str]:
+    """Upload several files to an XNAT resource in a single request, as a zip archive
+    streamed on the fly (see ZipStream) and extracted on the server. The resource is
+    created if it doesn't exist.
+
+    If checksum is True, the MD5 of each file is computed as it is uploaded, checked
+    against the server after upload, and returned as {file name: md5}.
+
+    Transient failures are retried according to retry, overwriting any files a failed
+    attempt left behind (as for upload_resource_file).
+    """
+
+    stream = ZipStream(
+        files, chunk_size=chunk_size, progress=progress, checksum=checksum
+    )
+
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        query = {"extract": "true"}
+        if overwrite or attempt > 1:
+            query["overwrite"] = "true"
+        return xnat_session.put(
+            f"{resource_uri}/files/{archive_name}",
+            data=stream,
+            query=query,
+            headers={"Content-Type": "application/zip"},
+            accepted_status=accepted_status,
+        )
+
+    start_time = time.perf_counter()
+    request_with_retry(send, retry, f"Upload of {archive_name}")
+    elapsed = time.perf_counter() - start_time
+
+    logger.info(
+        f"Uploaded {len(files)} files as {archive_name} ({stream.total_bytes} bytes in "
+        f"{elapsed:.1f}s, {stream.total_bytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+    )
+
+    if checksum:
+        verify_resource_files(xnat_session, resource_uri, stream.md5s)
+    return stream.md5s
+
+
+def upload_compressed_resource_file(
+    xnat_resource: Any,
+    source: Path,
+    remote_path: str,
+    compression: str = "zstd",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[UploadProgressCallback] = None,
+    overwrite: bool = False,
+    checksum: bool = False,
+    retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+    level: int = DEFAULT_ZSTD_LEVEL,
+    threads: int = -1,
+) -> CompressedUpload:
+    """Upload a file to an XNAT resource compressed with the given codec (only 'zstd' is
+    supported), as remote_path plus the codec's suffix (e.g. scan.l.zst). The file is
+    compressed as it is streamed from disk (see ZstdStream), with no temporary file.
+
+    If checksum is True, the MD5 of the compressed data is checked against the checksum
+    on the server after upload. Transient failures are retried according to retry,
+    compressing the file again (as for upload_resource_file)."""
+
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(
+            f"Unknown compression {compression} - must be one of "
+            f"{tuple(COMPRESSION_SUFFIXES)}"
+        )
+    import_zstandard()
+
+    stream = ZstdStream(
+        source, chunk_size=chunk_size, progress=progress, level=level, threads=threads
+    )
+    remote_path = f"{remote_path.lstrip('/')}{COMPRESSION_SUFFIXES[compression]}"
+    uri = f"{xnat_resource.uri}/files/{remote_path}"
+
+    def send(attempt: int, accepted_status: list[int]) -> Any:
+        query = {"overwrite": "true"} if overwrite or attempt > 1 else {}
+        return xnat_resource.xnat_session.put(
+            uri,
+            data=stream,
+            query=query,
+            headers={"Content-Type": "application/zstd"},
+            accepted_status=accepted_status,
+        )
+
+    start_time = time.perf_counter()
+    request_with_retry(send, retry, f"Upload of {remote_path}")
+    elapsed = time.perf_counter() - start_time
+    if stream.md5 is None or stream.original_md5 is None or stream.size is None:
+        raise RuntimeError(
+            f"Upload of {remote_path} finished before all of {source} was compressed "
+            f"and sent, so its size and checksum are unknown"
+        )
+
+    logger.info(
+        f"Uploaded {remote_path} ({stream.total_bytes} bytes compressed to "
+        f"{stream.size} ({stream.size / max(stream.total_bytes, 1):.0%}) in "
+        f"{elapsed:.1f}s, {stream.total_bytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+    )
+
+    if checksum:
+        verify_resource_files(
+            xnat_resource.xnat_session, xnat_resource.uri, {remote_path: stream.md5}
+        )
+    return CompressedUpload(
+        remote_path=remote_path,
+        compression=compression,
+        original_size=stream.total_bytes,
+        original_md5=stream.original_md5,
+        size=stream.size,
+        md5=stream.md5,
+    )
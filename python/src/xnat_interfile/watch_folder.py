@@ -0,0 +1,418 @@
+import ctypes
+import logging
+import os
+import re
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Protocol
+
+import xnat
+
+from xnat_interfile.batch_ingest import (
+    DEFAULT_ACQUISITION_PATTERN,
+    INGEST_ERRORS,
+    Acquisition,
+    IngestResult,
+    ProgressCallback,
+    _BatchUploader,
+    log_progress,
+    match_acquisition,
+)
+from xnat_interfile.hash_index import HashIndex
+from xnat_interfile.header_cache import HeaderCache, cached_read_listmode_header_2_xnat
+from xnat_interfile.ingest_journal import IngestJournal
+from xnat_interfile.interfile_header import DATA_FILE_SUFFIXES, is_interfile_header
+from xnat_interfile.metrics import MetricsRecorder
+from xnat_interfile.retry import DEFAULT_RETRY_POLICY, RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+# Time (s) both files of an acquisition must be unchanged (in size and modification time)
+# before it is ingested - so files still being written (or copied) aren't uploaded
+DEFAULT_SETTLE_TIME = 2.0
+
+# Time (s) between checks for new files (when polling) and of the files waiting to settle
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Directories modified within this time (ns) are listed again at the next poll, even if
+# their modification time hasn't changed - filesystems with coarse timestamps may not
+# change it for entries added within the same tick
+_MTIME_SLACK_NS = 2_000_000_000
+
+# inotify event flags (see inotify(7))
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+# struct inotify_event - wd, mask, cookie and length of the name that follows
+_INOTIFY_EVENT = struct.Struct("iIII")
+_INOTIFY_READ_SIZE = 64 * 1024
+
+
+def _libc() -> Optional[ctypes.CDLL]:
+    if not sys.platform.startswith("linux"):
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def inotify_available() -> bool:
+    """Whether new files can be detected with inotify (linux only), rather than polling"""
+
+    return _libc() is not None
+
+
+class _Watcher(Protocol):
+    def changed_paths(self, timeout: float) -> list[Path]: ...
+
+    def close(self) -> None: ...
+
+
+class _InotifyWatcher:
+    """Reports files created, written or moved into a directory tree, as inotify events
+    arrive. New subdirectories are watched as they appear. Note inotify doesn't see
+    changes made by other hosts on network filesystems - poll those instead."""
+
+    def __init__(self, root_dir: Path):
+        libc = _libc()
+        if libc is None:
+            raise OSError("inotify isn't available on this platform")
+        self._libc = libc
+        self._root_dir = root_dir
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "Failed to initialise inotify")
+        self._directories: dict[int, Path] = {}
+        self._watch_tree(root_dir)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _watch_tree(self, directory: Path) -> list[Path]:
+        """Watch directory and all directories under it, returning the files in them"""
+
+        watch = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), _WATCH_MASK
+        )
+        if watch < 0:
+            errno = ctypes.get_errno()
+            raise OSError(
+                errno,
+                f"Failed to watch {directory} - {os.strerror(errno)} (if out of "
+                f"watches, raise fs.inotify.max_user_watches, or poll instead)",
+            )
+        self._directories[watch] = directory
+
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                files.extend(self._watch_tree(Path(entry.path)))
+            else:
+                files.append(Path(entry.path))
+        return files
+
+    def changed_paths(self, timeout: float) -> list[Path]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = b""
+        while True:
+            try:
+                data += os.read(self._fd, _INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+
+        paths: list[Path] = []
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & _IN_Q_OVERFLOW:
+                logger.warning("inotify events were lost - rescanning the watched tree")
+                paths.extend(self._root_dir.rglob("*"))
+            elif mask & _IN_IGNORED:
+                self._directories.pop(watch, None)
+            elif watch in self._directories:
+                path = self._directories[watch] / name
+                if not mask & _IN_ISDIR:
+                    paths.append(path)
+                else:
+                    try:
+                        # files may have been added before the new directory was watched
+                        paths.extend(self._watch_tree(path))
+                    except FileNotFoundError:
+                        pass
+        return paths
+
+
+class _PollingWatcher:
+    """Reports the files in directories of a tree whose modification time changed since
+    the last poll. Only the directories are checked at each poll - the files in a
+    directory are only listed when it changes."""
+
+    def __init__(self, root_dir: Path):
+        self._mtimes: dict[Path, int] = {}
+        self._list(root_dir)
+
+    def close(self) -> None:
+        pass
+
+    def _list(self, directory: Path) -> list[Path]:
+        """Files in directory, and in any subdirectories not seen before"""
+
+        self._mtimes[directory] = directory.stat().st_mtime_ns
+        files = []
+        for entry in os.scandir(directory):
+            path = Path(entry.path)
+            if not entry.is_dir(follow_symlinks=False):
+                files.append(path)
+            elif path not in self._mtimes:
+                files.extend(self._list(path))
+        return files
+
+    def changed_paths(self, timeout: float) -> list[Path]:
+        time.sleep(timeout)
+        paths = []
+        for directory, mtime in list(self._mtimes.items()):
+            try:
+                new_mtime = directory.stat().st_mtime_ns
+                if new_mtime != mtime or time.time_ns() - new_mtime < _MTIME_SLACK_NS:
+                    paths.extend(self._list(directory))
+            except FileNotFoundError:
+                del self._mtimes[directory]
+        return paths
+
+
+@dataclass
+class _PendingAcquisition:
+    """An acquisition waiting for its files to settle - identity is the (size, mtime) of
+    the header and data when last checked, which they have been since the (monotonic)
+    time since"""
+
+    acquisition: Acquisition
+    identity: Optional[tuple[int, ...]] = None
+    since: float = 0.0
+
+
+def _acquisition_identity(acquisition: Acquisition) -> tuple[int, ...]:
+    header_stat = acquisition.header_path.stat()
+    data_stat = acquisition.data_path.stat()
+    return (
+        header_stat.st_size,
+        header_stat.st_mtime_ns,
+        data_stat.st_size,
+        data_stat.st_mtime_ns,
+    )
+
+
+class WatchFolderIngest:
+    """Long-running ingest of acquisitions dropped into a directory tree (e.g. exported by
+    scanners onto a shared filesystem).
+
+    New and changed files are detected with inotify where available (use_inotify=None),
+    otherwise by polling directory modification times every poll_interval seconds. Once
+    both the header (e.g. .l.hdr) and data (.l) of an acquisition exist and have been unchanged
+    for settle_time seconds, it is queued for upload in a pool of max_workers threads
+    sharing xnat_session. Where it belongs in XNAT is given by its path (see
+    find_acquisitions), and subjects / experiments are created the first time they are
+    seen and re-used by later scans.
+
+    Progress is kept in the journal, so after a restart acquisitions that were fully
+    ingested are skipped, and those that were interrupted resume from the first incomplete
+    stage. Acquisitions already in the tree when the ingest starts are picked up too. An
+    acquisition that fails is retried when its files change, or at the next start.
+
+    Note inotify doesn't see files written by other hosts to network filesystems (e.g.
+    NFS) - pass use_inotify=False to poll those.
+
+    The remaining arguments are as for ingest_acquisitions.
+    """
+
+    def __init__(
+        self,
+        xnat_session: xnat.XNATSession,
+        root_dir: Path,
+        project_name: str,
+        journal: IngestJournal,
+        pattern: str = DEFAULT_ACQUISITION_PATTERN,
+        max_workers: int = 4,
+        settle_time: float = DEFAULT_SETTLE_TIME,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        use_inotify: Optional[bool] = None,
+        header_backend: str = "native",
+        event_stats: bool = False,
+        header_cache: Optional[HeaderCache] = None,
+        hash_index: Optional[HashIndex] = None,
+        archive: bool = False,
+        metrics: Optional[MetricsRecorder] = None,
+        retry: Optional[RetryPolicy] = DEFAULT_RETRY_POLICY,
+        progress: ProgressCallback = log_progress,
+        compression: Optional[str] = None,
+    ):
+        if use_inotify is None:
+            use_inotify = inotify_available()
+
+        self.root_dir = root_dir
+        self.project_name = project_name
+        self.journal = journal
+        self.regex = re.compile(pattern)
+        self.max_workers = max_workers
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.header_backend = header_backend
+        self.event_stats = event_stats
+        self.header_cache = header_cache
+        self.progress = progress
+        self._uploader = _BatchUploader(
+            xnat_session,
+            journal,
+            hash_index,
+            archive,
+            metrics,
+            retry,
+            compression,
+            extract_header_on_server=header_backend == "server",
+        )
+        self._stop = threading.Event()
+        self._pending: dict[Path, _PendingAcquisition] = {}
+        self._running: dict[Future[IngestResult], _PendingAcquisition] = {}
+        # identity of the files of acquisitions when they were last ingested (or failed),
+        # and headers that don't match pattern
+        self._finished: dict[Path, tuple[int, ...]] = {}
+        self._ignored: set[Path] = set()
+        self._n_queued = 0
+        self._n_completed = 0
+
+    def stop(self) -> None:
+        """Stop run - uploads in progress are finished, queued uploads are cancelled (and
+        picked up again at the next start)"""
+
+        self._stop.set()
+
+    def run(self) -> None:
+        """Watch for and ingest acquisitions, until stop is called"""
+
+        watcher: _Watcher
+        if self.use_inotify:
+            watcher = _InotifyWatcher(self.root_dir)
+        else:
+            watcher = _PollingWatcher(self.root_dir)
+        logger.info(
+            f"Watching {self.root_dir} for acquisitions "
+            f"({'inotify' if self.use_inotify else 'polling'})"
+        )
+
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # acquisitions added while not running - the watcher reports later changes
+            for suffix in DATA_FILE_SUFFIXES:
+                for header_path in self.root_dir.rglob(f"*{suffix}"):
+                    self._found(header_path)
+
+            while not self._stop.is_set():
+                for path in watcher.changed_paths(self.poll_interval):
+                    self._found(path)
+                self._submit_settled(pool)
+                self._finish_completed()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            watcher.close()
+            self._finish_completed()
+            logger.info(f"Stopped watching {self.root_dir}")
+
+    def _found(self, path: Path) -> None:
+        """Consider a new or changed file - queue its acquisition to wait for its files to
+        settle, unless it is already queued or ingested"""
+
+        for header_suffix, data_suffix in DATA_FILE_SUFFIXES.items():
+            if path.name.endswith(data_suffix):
+                path = path.with_name(
+                    path.name.removesuffix(data_suffix) + header_suffix
+                )
+                break
+        if not is_interfile_header(path) or path in self._pending:
+            return
+        if path in self._ignored or any(
+            pending.acquisition.header_path == path
+            for pending in self._running.values()
+        ):
+            return
+
+        acquisition = match_acquisition(
+            self.root_dir, path, self.project_name, self.regex
+        )
+        if acquisition is None:
+            self._ignored.add(path)
+        elif not self.journal.is_done(acquisition.key):
+            self._pending[path] = _PendingAcquisition(acquisition)
+
+    def _submit_settled(self, pool: ThreadPoolExecutor) -> None:
+        now = time.monotonic()
+        for header_path, pending in list(self._pending.items()):
+            try:
+                identity = _acquisition_identity(pending.acquisition)
+            except FileNotFoundError:
+                # the data isn't there yet - or the header was removed
+                if not header_path.exists():
+                    del self._pending[header_path]
+                continue
+
+            if identity != pending.identity:
+                pending.identity = identity
+                pending.since = now
+                continue
+            if now - pending.since < self.settle_time:
+                continue
+
+            del self._pending[header_path]
+            if self._finished.get(header_path) == identity:
+                continue
+            self._n_queued += 1
+            self._running[pool.submit(self._ingest, pending.acquisition)] = pending
+
+    def _ingest(self, acquisition: Acquisition) -> IngestResult:
+        try:
+            xnat_hdr = cached_read_listmode_header_2_xnat(
+                acquisition.header_path,
+                backend=self.header_backend,
+                event_stats=self.event_stats,
+                header_cache=self.header_cache,
+            )
+            return self._uploader.upload(acquisition, xnat_hdr)
+        except (*INGEST_ERRORS, sqlite3.Error) as error:
+            return IngestResult(acquisition, error=error)
+        except Exception as error:
+            # the watcher keeps running, so log where it came from
+            logger.exception(f"Unexpected error ingesting {acquisition.header_path}")
+            return IngestResult(acquisition, error=error)
+
+    def _finish_completed(self) -> None:
+        for future in [future for future in self._running if future.done()]:
+            pending = self._running.pop(future)
+            if future.cancelled():
+                continue
+
+            result = future.result()
+            if pending.identity is not None:
+                self._finished[pending.acquisition.header_path] = pending.identity
+            self._n_completed += 1
+            self.progress(result, self._n_completed, self._n_queued)
@@ -5,6 +5,7 @@ import xnat4tests
 import re
 import os
 
+from tests.fake_xnat import FakeXNATServer
 from tests.utils import delete_data, XnatConnection
 from xnat_interfile.fetch_datasets import get_data
 
@@ -38,6 +39,20 @@ def interfile_file_path():
     return interfile_file_path
 
 
+@pytest.fixture
+def fake_xnat():
+    """In-process fake XNAT server (see tests.fake_xnat), with an empty interfile_project"""
+
+    with FakeXNATServer(project_names=("interfile_project",)) as server:
+        yield server
+
+
+@pytest.fixture
+def fake_xnat_session(fake_xnat):
+    with fake_xnat.connect() as session:
+        yield session
+
+
 @pytest.fixture
 def remove_test_data(xnat_connection):
     yield
@@ -0,0 +1,1039 @@
+"""In-process stand-in for the XNAT REST API, so the ingest path (project / subject /
+experiment / scan creation and resource uploads) can be tested and benchmarked in seconds,
+without the xnat4tests Docker container.
+
+Only the endpoints used by xnat_interfile (and by xnat.connect to build its data model)
+are modelled, keeping projects, subjects, experiments, scans, resources and file digests
+in memory. Latency and errors can be injected to exercise retries and measure the cost
+of round trips."""
+
+import csv
+import hashlib
+import http.server
+import io
+import json
+import random
+import re
+import threading
+import tempfile
+import time
+import traceback
+import uuid
+import zipfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any, Optional
+from urllib.parse import parse_qsl, urlsplit
+from xml.etree import ElementTree
+
+import xnat
+
+from xnat_interfile.chunked_upload import parts_md5
+from xnat_interfile.interfile_2_xnat import interfile_header_2_xnat
+from xnat_interfile.interfile_header import parse_interfile_header
+
+INTERFILE_XSD_PATH = (
+    Path(__file__).parents[2]
+    / "src"
+    / "main"
+    / "resources"
+    / "schemas"
+    / "interfile"
+    / "interfile.xsd"
+)
+
+# Minimal core XNAT schema - just the types (and fields) xnat-py needs to build classes
+# for the objects created during ingest. The full xnat.xsd is only available from a
+# running XNAT.
+CORE_XSD = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema targetNamespace="http://nrg.wustl.edu/xnat" xmlns:xnat="http://nrg.wustl.edu/xnat"
+    xmlns:xs="http://www.w3.org/2001/XMLSchema" elementFormDefault="qualified"
+    attributeFormDefault="unqualified">
+  <xs:element name="Project" type="xnat:projectData"/>
+  <xs:element name="Subject" type="xnat:subjectData"/>
+  <xs:element name="PETSession" type="xnat:petSessionData"/>
+  <xs:element name="PETScan" type="xnat:petScanData"/>
+  <xs:element name="Resource" type="xnat:resourceCatalog"/>
+  <xs:complexType name="projectData">
+    <xs:sequence>
+      <xs:element name="name" type="xs:string" minOccurs="0"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+  </xs:complexType>
+  <xs:complexType name="subjectData">
+    <xs:sequence>
+      <xs:element name="group" type="xs:string" minOccurs="0"/>
+      <xs:element name="experiments" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="experiment" type="xnat:subjectAssessorData" minOccurs="0"
+                maxOccurs="unbounded"/>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+    <xs:attribute name="label" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="experimentData">
+    <xs:sequence>
+      <xs:element name="date" type="xs:date" minOccurs="0"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+    <xs:attribute name="label" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="subjectAssessorData">
+    <xs:complexContent>
+      <xs:extension base="xnat:experimentData">
+        <xs:sequence>
+          <xs:element name="subject_ID" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="imageSessionData">
+    <xs:complexContent>
+      <xs:extension base="xnat:subjectAssessorData">
+        <xs:sequence>
+          <xs:element name="modality" type="xs:string" minOccurs="0"/>
+          <xs:element name="scans" minOccurs="0">
+            <xs:complexType>
+              <xs:sequence>
+                <xs:element name="scan" type="xnat:imageScanData" minOccurs="0"
+                    maxOccurs="unbounded"/>
+              </xs:sequence>
+            </xs:complexType>
+          </xs:element>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="petSessionData">
+    <xs:complexContent>
+      <xs:extension base="xnat:imageSessionData">
+        <xs:sequence>
+          <xs:element name="tracer" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="imageScanData">
+    <xs:sequence>
+      <xs:element name="note" type="xs:string" minOccurs="0"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+    <xs:attribute name="type" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+    <xs:attribute name="image_session_ID" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="petScanData">
+    <xs:complexContent>
+      <xs:extension base="xnat:imageScanData"/>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="abstractResource">
+    <xs:attribute name="label" type="xs:string"/>
+    <xs:attribute name="file_count" type="xs:integer"/>
+  </xs:complexType>
+  <xs:complexType name="resourceCatalog">
+    <xs:complexContent>
+      <xs:extension base="xnat:abstractResource">
+        <xs:attribute name="URI" type="xs:string" use="required"/>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+</xs:schema>
+"""
+
+JSESSION_ID = "FAKEJSESSIONID"
+XNAT_VERSION = "1.8.10"
+
+# Request bodies (uploads) larger than this are spooled to disk rather than held in memory
+_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+_READ_SIZE = 1024 * 1024
+
+# Contents of uploaded files up to this size (e.g. headers) are kept, so they can be
+# downloaded again
+_KEEP_MAX_SIZE = 64 * 1024
+
+
+@dataclass
+class FakeResource:
+    id: str
+    label: str
+    # md5 and size of each file, keyed by name
+    files: dict[str, tuple[str, int]] = field(default_factory=dict)
+    # contents of the files no larger than _KEEP_MAX_SIZE, keyed by name
+    contents: dict[str, bytes] = field(default_factory=dict)
+
+
+@dataclass
+class FakeScan:
+    id: str
+    xsi_type: str
+    fields: dict[str, str] = field(default_factory=dict)
+    resources: dict[str, FakeResource] = field(default_factory=dict)
+    # status of the interfile plugin's header extraction, once requested
+    header_extraction: Optional[str] = None
+
+
+@dataclass
+class FakeChunkedUpload:
+    """Upload in parts through the interfile plugin's upload API - the parts received
+    are kept, keyed by number"""
+
+    scan: FakeScan
+    resource: str
+    name: str
+    size: int
+    part_size: int
+    parts: dict[int, bytes] = field(default_factory=dict)
+
+    @property
+    def n_parts(self) -> int:
+        return -(-self.size // self.part_size)
+
+    def part_length(self, part: int) -> int:
+        return min(self.part_size, self.size - (part - 1) * self.part_size)
+
+    def status(self, upload_id: str) -> dict[str, Any]:
+        return {
+            "uploadId": upload_id,
+            "name": self.name,
+            "size": self.size,
+            "partSize": self.part_size,
+            "numberOfParts": self.n_parts,
+            "missingParts": [
+                part for part in range(1, self.n_parts + 1) if part not in self.parts
+            ],
+        }
+
+
+@dataclass
+class FakeExperiment:
+    id: str
+    label: str
+    xsi_type: str
+    scans: dict[str, FakeScan] = field(default_factory=dict)
+
+
+@dataclass
+class FakeSubject:
+    id: str
+    label: str
+    experiments: dict[str, FakeExperiment] = field(default_factory=dict)
+
+
+@dataclass
+class FakeProject:
+    id: str
+    subjects: dict[str, FakeSubject] = field(default_factory=dict)
+
+
+# Name of the collection of children of each type of object, as it appears in uris
+_COLLECTIONS = {
+    FakeProject: "subjects",
+    FakeSubject: "experiments",
+    FakeExperiment: "scans",
+    FakeScan: "resources",
+}
+
+
+class _NotFound(Exception):
+    pass
+
+
+def _find(children: dict[str, Any], id_or_label: str) -> Any:
+    """Child with the given ID, or label - XNAT accepts either in uris"""
+
+    if id_or_label in children:
+        return children[id_or_label]
+    for child in children.values():
+        if getattr(child, "label", None) == id_or_label:
+            return child
+    raise _NotFound(id_or_label)
+
+
+def _digest(file: IO[bytes]) -> tuple[str, int, Optional[bytes]]:
+    """md5, size and (if no larger than _KEEP_MAX_SIZE) contents of a file"""
+
+    md5 = hashlib.md5()
+    size = 0
+    contents = bytearray()
+    while chunk := file.read(_READ_SIZE):
+        md5.update(chunk)
+        size += len(chunk)
+        if size <= _KEEP_MAX_SIZE:
+            contents += chunk
+    return md5.hexdigest(), size, bytes(contents) if size <= _KEEP_MAX_SIZE else None
+
+
+def _item(
+    xsi_type: str, data_fields: dict[str, Any], children: Optional[list] = None
+) -> dict[str, Any]:
+    return {
+        "meta": {"xsi:type": xsi_type, "isHistory": False},
+        "data_fields": data_fields,
+        "children": children or [],
+    }
+
+
+def _result_set(rows: list[dict[str, Any]]) -> dict[str, Any]:
+    return {"ResultSet": {"Result": rows, "totalRecords": str(len(rows))}}
+
+
+class FakeXNATState:
+    """In-memory store of the objects on the fake server. Access is guarded by lock."""
+
+    def __init__(self, project_names: tuple[str, ...] = ()):
+        self.projects: dict[str, FakeProject] = {
+            name: FakeProject(name) for name in project_names
+        }
+        self.uploads: dict[str, FakeChunkedUpload] = {}
+        self.lock = threading.Lock()
+        self._next_id = 1
+
+    def new_id(self, prefix: str) -> str:
+        """New accession number, e.g. FAKE_S00001 for a subject"""
+
+        object_id = f"FAKE_{prefix}{self._next_id:05d}"
+        self._next_id += 1
+        return object_id
+
+
+class _FakeXNATRequestHandler(http.server.BaseHTTPRequestHandler):
+    # keep connections alive between requests, as XNAT (behind tomcat) does
+    protocol_version = "HTTP/1.1"
+    server: "_FakeXNATHTTPServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self) -> None:
+        url = urlsplit(self.path)
+        self.query = dict(parse_qsl(url.query, keep_blank_values=True))
+        parts = [part for part in url.path.split("/") if part]
+        if parts[:2] == ["data", "archive"]:
+            parts = ["data"] + parts[2:]
+        self.parts = parts
+        fake = self.server.fake
+
+        # the body is read (and uploaded files hashed) before injecting latency or errors,
+        # as the client has sent it all by then
+        self.file_digests: Optional[dict[str, tuple[str, int, Optional[bytes]]]] = None
+        with self._read_body() as body:
+            keep_body = self.command == "POST" or parts[:3] == [
+                "xapi",
+                "interfile",
+                "uploads",
+            ]
+            self.body = body.read() if keep_body else b""
+            if self.command == "PUT" and len(parts) >= 2 and parts[-2] == "files":
+                try:
+                    self.file_digests = self._file_digests(body)
+                except zipfile.BadZipFile as error:
+                    self._send(400, f"Invalid archive: {error}")
+                    return
+
+        fake.record_request(self.command, url.path)
+        if fake.latency:
+            time.sleep(fake.latency)
+        injected_error = fake.injected_error(self.command, url.path)
+        if injected_error is not None:
+            status, retry_after = injected_error
+            headers = {} if retry_after is None else {"Retry-After": str(retry_after)}
+            self._send(status, f"Injected error {status}", headers)
+            return
+
+        self.response_headers: dict[str, str] = {}
+        try:
+            with fake.state.lock:
+                status, response = getattr(self, f"_{self.command.lower()}")()
+        except (_NotFound, KeyError) as error:
+            status, response = 404, f"Not found: {error}"
+        except Exception:
+            status, response = 500, traceback.format_exc()
+        self._send(status, response, self.response_headers)
+
+    def _read_body(self) -> IO[bytes]:
+        body = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while (size := int(self.rfile.readline().split(b";")[0], 16)) > 0:
+                self._copy_body(size, body)
+                self.rfile.readline()
+            self.rfile.readline()
+        else:
+            self._copy_body(int(self.headers.get("Content-Length", 0)), body)
+        body.seek(0)
+        return body
+
+    def _copy_body(self, size: int, body: IO[bytes]) -> None:
+        remaining = size
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, _READ_SIZE))
+            if not chunk:
+                break
+            body.write(chunk)
+            remaining -= len(chunk)
+        self.server.fake.add_bytes_received(size - remaining)
+
+    def _file_digests(
+        self, body: IO[bytes]
+    ) -> dict[str, tuple[str, int, Optional[bytes]]]:
+        """md5, size and contents (see _digest) of each file uploaded, keyed by name -
+        archives are extracted if the query has extract=true"""
+
+        if self.query.get("extract", "").lower() != "true":
+            return {self.parts[-1]: _digest(body)}
+
+        digests = {}
+        with zipfile.ZipFile(body) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        digests[info.filename] = _digest(member)
+        return digests
+
+    def _send(
+        self, status: int, response: Any, headers: Optional[dict[str, str]] = None
+    ) -> None:
+        if isinstance(response, (dict, list)):
+            data = json.dumps(response).encode()
+            content_type = "application/json"
+        elif isinstance(response, bytes):
+            data = response
+            content_type = "application/octet-stream"
+        else:
+            data = str(response).encode()
+            content_type = (
+                "text/csv" if self.query.get("format") == "csv" else "text/plain"
+            )
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if self.parts == ["data", "services", "auth"]:
+            self.send_header("Set-Cookie", f"JSESSIONID={JSESSION_ID}; Path=/")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _resolve(self, parts: list[str]) -> list[Any]:
+        """Objects along a data/projects/... path, e.g. [project, subject] for
+        data/projects/P/subjects/S"""
+
+        if len(parts) < 3 or len(parts) % 2 == 0 or parts[:2] != ["data", "projects"]:
+            raise _NotFound("/".join(parts))
+
+        objects = [self.server.fake.state.projects[parts[2]]]
+        for collection, id_or_label in zip(parts[3::2], parts[4::2]):
+            parent = objects[-1]
+            if _COLLECTIONS.get(type(parent)) != collection:
+                raise _NotFound("/".join(parts))
+            objects.append(_find(getattr(parent, collection), id_or_label))
+        return objects
+
+    def _base_uri(self, depth: int) -> str:
+        return "/" + "/".join(self.parts[:depth])
+
+    # --- GET / HEAD -----------------------------------------------------------------
+
+    def _get(self) -> tuple[int, Any]:
+        parts = self.parts
+        path = "/".join(parts)
+        fake = self.server.fake
+
+        if not parts:
+            return 200, "Fake XNAT"
+        if path == "data/auth":
+            return 200, "User 'admin' is logged in"
+        if path == "data/JSESSION":
+            return 200, JSESSION_ID
+        if path == "data/version":
+            return 200, XNAT_VERSION
+        if path == "xapi/schemas":
+            return 200, list(fake.schemas)
+        if parts[:2] == ["xapi", "schemas"]:
+            return 200, fake.schemas["/".join(parts[2:])]
+        if parts[:2] == ["xapi", "interfile"] and parts[-1] == "header":
+            scan = self._interfile_scan()
+            if scan.header_extraction is None:
+                raise _NotFound(path)
+            return 200, {"status": scan.header_extraction, "message": None}
+        if parts[:3] == ["xapi", "interfile", "uploads"] and len(parts) == 4:
+            return 200, fake.state.uploads[parts[3]].status(parts[3])
+        if path == "data/search/elements":
+            # no display fields to add to the data model
+            return 200, _result_set([])
+        if path == "data/projects":
+            return 200, _result_set(
+                [
+                    {
+                        "ID": project.id,
+                        "name": project.id,
+                        "URI": f"/data/projects/{project.id}",
+                    }
+                    for project in fake.state.projects.values()
+                ]
+            )
+
+        if len(parts) >= 2 and parts[-2] == "files":
+            resource = self._resolve(parts[:-2])[-1]
+            if parts[-1] not in resource.files:
+                raise _NotFound(path)
+            if parts[-1] not in resource.contents:
+                return (
+                    501,
+                    "Contents of large files aren't kept by the fake XNAT server",
+                )
+            return self._file_range(resource.contents[parts[-1]])
+        if parts[-1] == "files":
+            return 200, self._files_listing(self._resolve(parts[:-1])[-1])
+        if len(parts) % 2 == 0:
+            return 200, self._listing(self._resolve(parts[:-1]), parts[-1])
+        return 200, {"items": [self._object_item(self._resolve(parts))]}
+
+    def _file_range(self, contents: bytes) -> tuple[int, Any]:
+        """Response to a GET of a file - only the range requested by a Range header of
+        a single range (bytes=start-end), if there is one"""
+
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match is None:
+            return 200, contents
+        start = int(match[1])
+        end = min(int(match[2] or len(contents) - 1), len(contents) - 1)
+        if start > end:
+            self.response_headers["Content-Range"] = f"bytes */{len(contents)}"
+            return 416, b""
+        self.response_headers["Content-Range"] = f"bytes {start}-{end}/{len(contents)}"
+        return 206, contents[start : end + 1]
+
+    def _head(self) -> tuple[int, Any]:
+        return self._get()
+
+    def _object_item(self, objects: list[Any]) -> dict[str, Any]:
+        obj = objects[-1]
+        project = objects[0]
+        if isinstance(obj, FakeProject):
+            return _item("xnat:projectData", {"ID": obj.id, "name": obj.id})
+        if isinstance(obj, FakeSubject):
+            experiments = [
+                self._object_item(objects + [experiment])
+                for experiment in obj.experiments.values()
+            ]
+            return _item(
+                "xnat:subjectData",
+                {"ID": obj.id, "label": obj.label, "project": project.id},
+                [{"field": "experiments/experiment", "items": experiments}]
+                if experiments
+                else [],
+            )
+        if isinstance(obj, FakeExperiment):
+            scans = [self._object_item(objects + [scan]) for scan in obj.scans.values()]
+            return _item(
+                obj.xsi_type,
+                {
+                    "ID": obj.id,
+                    "label": obj.label,
+                    "project": project.id,
+                    "subject_ID": objects[1].id,
+                },
+                [{"field": "scans/scan", "items": scans}] if scans else [],
+            )
+        if isinstance(obj, FakeScan):
+            return _item(
+                obj.xsi_type,
+                {
+                    "ID": obj.id,
+                    "project": project.id,
+                    "image_session_ID": objects[2].id,
+                    **obj.fields,
+                },
+            )
+        return _item(
+            "xnat:resourceCatalog",
+            {
+                "xnat_abstractresource_id": obj.id,
+                "label": obj.label,
+                "file_count": len(obj.files),
+            },
+        )
+
+    def _listing(self, objects: list[Any], collection: str) -> dict[str, Any]:
+        parent = objects[-1]
+        project = objects[0]
+        base_uri = self._base_uri(len(self.parts))
+        if isinstance(parent, FakeProject) and collection == "experiments":
+            # all experiments in the project, across subjects
+            return _result_set(
+                [
+                    {
+                        "ID": experiment.id,
+                        "label": experiment.label,
+                        "project": project.id,
+                        "xsiType": experiment.xsi_type,
+                        "URI": f"/data/projects/{project.id}/subjects/{subject.id}"
+                        f"/experiments/{experiment.id}",
+                    }
+                    for subject in parent.subjects.values()
+                    for experiment in subject.experiments.values()
+                ]
+            )
+        if _COLLECTIONS.get(type(parent)) != collection:
+            raise _NotFound(collection)
+
+        rows = []
+        for child in getattr(parent, collection).values():
+            if isinstance(child, FakeResource):
+                rows.append(
+                    {
+                        "xnat_abstractresource_id": child.id,
+                        "label": child.label,
+                        "file_count": str(len(child.files)),
+                    }
+                )
+                continue
+            row = {
+                "ID": child.id,
+                "project": project.id,
+                "URI": f"{base_uri}/{child.id}",
+            }
+            if isinstance(child, FakeScan):
+                row["xsiType"] = child.xsi_type
+            else:
+                row["label"] = child.label
+            if isinstance(child, FakeExperiment):
+                row["xsiType"] = child.xsi_type
+            rows.append(row)
+        return _result_set(rows)
+
+    def _files_listing(self, parent: Any) -> dict[str, Any]:
+        """Files in a resource, or in all resources of a scan"""
+
+        if isinstance(parent, FakeResource):
+            resources = {parent.label: (parent, self._base_uri(len(self.parts) - 1))}
+        elif isinstance(parent, FakeScan):
+            scan_uri = self._base_uri(len(self.parts) - 1)
+            resources = {
+                label: (resource, f"{scan_uri}/resources/{label}")
+                for label, resource in parent.resources.items()
+            }
+        else:
+            raise _NotFound("files")
+
+        return _result_set(
+            [
+                {
+                    "Name": name,
+                    "Size": str(size),
+                    "URI": f"{resource_uri}/files/{name}",
+                    "digest": md5,
+                    "collection": label,
+                    "cat_ID": resource.id,
+                }
+                for label, (resource, resource_uri) in resources.items()
+                for name, (md5, size) in resource.files.items()
+            ]
+        )
+
+    # --- PUT --------------------------------------------------------------------------
+
+    def _put(self) -> tuple[int, Any]:
+        parts = self.parts
+        state = self.server.fake.state
+
+        if parts == ["data", "services", "auth"]:
+            return 200, JSESSION_ID
+        if parts[:3] == ["xapi", "interfile", "uploads"] and len(parts) == 6:
+            return self._put_part()
+        if self.file_digests is not None:
+            return self._put_files()
+        if len(parts) == 3 and parts[:2] == ["data", "projects"]:
+            state.projects.setdefault(parts[2], FakeProject(parts[2]))
+            return 200, parts[2]
+
+        parent = self._resolve(parts[:-2])[-1]
+        collection, id_or_label = parts[-2:]
+        if _COLLECTIONS.get(type(parent)) != collection:
+            raise _NotFound("/".join(parts))
+        children = getattr(parent, collection)
+        try:
+            child = _find(children, id_or_label)
+        except _NotFound:
+            child = self._new_child(parent, id_or_label)
+            children[id_or_label if isinstance(parent, FakeScan) else child.id] = child
+
+        if isinstance(child, FakeScan):
+            child.fields.update(self._query_fields(child.xsi_type))
+        return 200, child.id
+
+    def _new_child(self, parent: Any, id_or_label: str) -> Any:
+        state = self.server.fake.state
+        if isinstance(parent, FakeProject):
+            return FakeSubject(state.new_id("S"), id_or_label)
+        if isinstance(parent, FakeSubject):
+            xsi_type = self.query.get("xsiType", "xnat:petSessionData")
+            return FakeExperiment(state.new_id("E"), id_or_label, xsi_type)
+        if isinstance(parent, FakeExperiment):
+            # the interfile ingest passes the scan type as 'scans', xnat-py as 'xsiType'
+            xsi_type = self.query.get("xsiType") or self.query.get(
+                "scans", "xnat:imageScanData"
+            )
+            return FakeScan(id_or_label, xsi_type)
+        return FakeResource(state.new_id("R"), id_or_label)
+
+    def _query_fields(self, xsi_type: str) -> dict[str, str]:
+        """Data fields set by the query of a PUT. xpaths (e.g.
+        interfile:petLmScanData/scannerInformation/name) are stored as the field names XNAT
+        returns (scannerInformation/name)."""
+
+        return {
+            name.removeprefix(f"{xsi_type}/"): value
+            for name, value in self.query.items()
+            if name not in ("xsiType", "scans", "req_format", "format")
+        }
+
+    def _put_files(self) -> tuple[int, Any]:
+        assert self.file_digests is not None
+        scan = self._resolve(self.parts[:-4])[-1]
+        if not isinstance(scan, FakeScan) or self.parts[-4] != "resources":
+            raise _NotFound("/".join(self.parts))
+
+        label = self.parts[-3]
+        resource = scan.resources.get(label)
+        if resource is None:
+            resource = scan.resources[label] = self._new_child(scan, label)
+
+        existing = sorted(set(self.file_digests) & set(resource.files))
+        if existing and self.query.get("overwrite", "").lower() != "true":
+            return 409, f"Files already exist in {label}: {', '.join(existing)}"
+        for name, (md5, size, contents) in self.file_digests.items():
+            resource.files[name] = (md5, size)
+            if contents is None:
+                resource.contents.pop(name, None)
+            else:
+                resource.contents[name] = contents
+        return 200, ""
+
+    def _put_part(self) -> tuple[int, Any]:
+        """Stand-in for the interfile plugin's upload of a part of a file"""
+
+        upload = self.server.fake.state.uploads[self.parts[3]]
+        part = int(self.parts[5])
+        if not 1 <= part <= upload.n_parts or len(self.body) != upload.part_length(
+            part
+        ):
+            return 400, ""
+        upload.parts[part] = self.body
+        return 200, {"part": part, "md5": hashlib.md5(self.body).hexdigest()}
+
+    # --- POST -----------------------------------------------------------------------
+
+    def _post(self) -> tuple[int, Any]:
+        if self.parts[:2] == ["xapi", "interfile"] and self.parts[-1] == "header":
+            return self._extract_header()
+        if self.parts[:2] == ["xapi", "interfile"] and self.parts[-1] == "uploads":
+            return self._start_upload()
+        if (
+            self.parts[:3] == ["xapi", "interfile", "uploads"]
+            and self.parts[-1] == "complete"
+        ):
+            return self._complete_upload()
+        if self.parts != ["data", "search"]:
+            raise _NotFound("/".join(self.parts))
+        return self._search()
+
+    def _interfile_scan(self) -> FakeScan:
+        """Scan of an xapi/interfile/projects/P/experiments/E/scans/S/... path (e.g.
+        .../header) - the experiment is found by label or ID across the project's
+        subjects"""
+
+        if len(self.parts) < 9 or self.parts[6] != "scans":
+            raise _NotFound("/".join(self.parts))
+        project = self.server.fake.state.projects[self.parts[3]]
+        for subject in project.subjects.values():
+            try:
+                experiment = _find(subject.experiments, self.parts[5])
+            except _NotFound:
+                continue
+            return _find(experiment.scans, self.parts[7])
+        raise _NotFound(self.parts[5])
+
+    def _extract_header(self) -> tuple[int, Any]:
+        """Stand-in for the interfile plugin's header extraction - the scan's fields are
+        filled from the header in its PET_RAW resource straight away, rather than in the
+        background"""
+
+        scan = self._interfile_scan()
+        if scan.xsi_type != "interfile:petLmScanData":
+            return 400, ""
+        resource = scan.resources.get("PET_RAW")
+        header_names = [
+            name
+            for name in (resource.contents if resource is not None else {})
+            if name.endswith(".l.hdr")
+        ]
+        if resource is None or not header_names:
+            raise _NotFound("header")
+
+        header_text = resource.contents[header_names[0]].decode("latin-1")
+        xnat_hdr = interfile_header_2_xnat(
+            parse_interfile_header(header_text.splitlines())
+        )
+        scan.fields.update(
+            {
+                name.removeprefix(f"{scan.xsi_type}/"): str(value)
+                for name, value in xnat_hdr.items()
+                if name != "scans"
+            }
+        )
+        scan.header_extraction = "COMPLETE"
+        return 202, {"status": "QUEUED", "message": None}
+
+    def _start_upload(self) -> tuple[int, Any]:
+        """Stand-in for the interfile plugin's start of an upload in parts, to
+        xapi/interfile/projects/P/experiments/E/scans/S/resources/R/uploads"""
+
+        scan = self._interfile_scan()
+        request = json.loads(self.body)
+        if not scan.xsi_type.startswith("interfile:") or request["partSize"] <= 0:
+            return 400, ""
+        upload_id = str(uuid.uuid4())
+        upload = FakeChunkedUpload(
+            scan, self.parts[9], request["name"], request["size"], request["partSize"]
+        )
+        self.server.fake.state.uploads[upload_id] = upload
+        return 201, upload.status(upload_id)
+
+    def _complete_upload(self) -> tuple[int, Any]:
+        """Stand-in for the interfile plugin's completion of an upload - the parts are
+        joined and added to the scan's resource (created if needed)"""
+
+        upload_id = self.parts[3]
+        uploads = self.server.fake.state.uploads
+        upload = uploads[upload_id]
+        if upload.status(upload_id)["missingParts"]:
+            return 409, ""
+        data = b"".join(upload.parts[part] for part in range(1, upload.n_parts + 1))
+        md5, size, contents = _digest(io.BytesIO(data))
+        upload_parts_md5 = parts_md5(
+            [
+                hashlib.md5(upload.parts[part]).hexdigest()
+                for part in range(1, upload.n_parts + 1)
+            ]
+        )
+        if self.query.get("partsMd5", upload_parts_md5) != upload_parts_md5:
+            return (
+                400,
+                f"MD5 of parts of upload {upload_id} ({upload_parts_md5}) doesn't match",
+            )
+
+        resource = upload.scan.resources.get(upload.resource)
+        if resource is None:
+            resource = upload.scan.resources[upload.resource] = self._new_child(
+                upload.scan, upload.resource
+            )
+        resource.files[upload.name] = (md5, size)
+        if contents is None:
+            resource.contents.pop(upload.name, None)
+        else:
+            resource.contents[upload.name] = contents
+        del uploads[upload_id]
+        return 200, {"name": upload.name, "size": size, "partsMd5": upload_parts_md5}
+
+    def _search(self) -> tuple[int, Any]:
+        """Run an xdat:search of scans in a project - only the root element, search
+        fields and a PROJECT criterion are supported"""
+
+        ns = {"xdat": "http://nrg.wustl.edu/security"}
+        search = ElementTree.fromstring(self.body)
+        xsi_type = search.findtext("xdat:root_element_name", namespaces=ns)
+        columns = [
+            (
+                search_field.findtext("xdat:field_ID", default="", namespaces=ns),
+                search_field.findtext("xdat:header", default="", namespaces=ns),
+            )
+            for search_field in search.iterfind("xdat:search_field", namespaces=ns)
+        ]
+        project_name = search.findtext(
+            "xdat:search_where/xdat:criteria/xdat:value", default="", namespaces=ns
+        )
+
+        project = self.server.fake.state.projects[project_name]
+        rows = []
+        for subject in project.subjects.values():
+            for experiment in subject.experiments.values():
+                for scan in experiment.scans.values():
+                    if scan.xsi_type != xsi_type:
+                        continue
+                    values = {
+                        "PROJECT": project.id,
+                        "SUBJECT_ID": subject.id,
+                        "SESSION_LABEL": experiment.label,
+                        "ID": scan.id,
+                    }
+                    for path, value in scan.fields.items():
+                        values[path.replace("/", "_").upper()[:61]] = value
+                    rows.append([values.get(field_id, "") for field_id, _ in columns])
+
+        headers = [header for _, header in columns]
+        if self.query.get("format") != "csv":
+            return 200, _result_set([dict(zip(headers, row)) for row in rows])
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(headers)
+        writer.writerows(rows)
+        return 200, output.getvalue()
+
+    # --- DELETE -----------------------------------------------------------------------
+
+    def _delete(self) -> tuple[int, Any]:
+        parts = self.parts
+        if parts == ["data", "JSESSION"]:
+            return 200, ""
+        if parts[:3] == ["xapi", "interfile", "uploads"] and len(parts) == 4:
+            del self.server.fake.state.uploads[parts[3]]
+            return 200, ""
+
+        if len(parts) >= 2 and parts[-2] == "files":
+            resource = self._resolve(parts[:-2])[-1]
+            del resource.files[parts[-1]]
+            resource.contents.pop(parts[-1], None)
+            return 200, ""
+
+        parent = self._resolve(parts[:-2])[-1]
+        if _COLLECTIONS.get(type(parent)) != parts[-2]:
+            raise _NotFound("/".join(parts))
+        children = getattr(parent, parts[-2])
+        child = _find(children, parts[-1])
+        del children[next(key for key, value in children.items() if value is child)]
+        return 200, ""
+
+
+class _FakeXNATHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    fake: "FakeXNATServer"
+
+
+class FakeXNATServer:
+    """Fake XNAT server, run in a background thread. Use as a context manager - url gives
+    the address to connect to, or use connect to get an xnat-py session.
+
+    latency (s) is added to every request, and error_rate is the fraction of requests
+    (chosen at random, reproducibly from seed) that fail with a 503. Specific failures can
+    be injected with fail_next. Every request is recorded in requests, as (method, path).
+    """
+
+    def __init__(
+        self,
+        project_names: tuple[str, ...] = (),
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.state = FakeXNATState(project_names)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.schemas = {
+            "xnat": CORE_XSD,
+            "interfile/interfile": INTERFILE_XSD_PATH.read_text(),
+        }
+        self.requests: list[tuple[str, str]] = []
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._failures: list[tuple[str, re.Pattern, int, Optional[int]]] = []
+        self._lock = threading.Lock()
+
+        self.server = _FakeXNATHTTPServer(("127.0.0.1", 0), _FakeXNATRequestHandler)
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{str(host)}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connect(self, **kwargs) -> xnat.XNATSession:
+        """Connect to the server with xnat-py - kwargs are passed to xnat.connect"""
+
+        return xnat.connect(self.url, user="admin", password="admin", **kwargs)
+
+    def fail_next(
+        self,
+        method: str,
+        path_pattern: str,
+        status: int = 503,
+        times: int = 1,
+        retry_after: Optional[int] = None,
+    ) -> None:
+        """Fail the next `times` requests with the given method, and a path matching the
+        regular expression path_pattern, with status (and a Retry-After header, if
+        retry_after is given)"""
+
+        failure = (method, re.compile(path_pattern), status, retry_after)
+        with self._lock:
+            self._failures.extend([failure] * times)
+
+    def record_request(self, method: str, path: str) -> None:
+        with self._lock:
+            self.requests.append((method, path))
+
+    def add_bytes_received(self, n_bytes: int) -> None:
+        with self._lock:
+            self.bytes_received += n_bytes
+
+    def injected_error(
+        self, method: str, path: str
+    ) -> Optional[tuple[int, Optional[int]]]:
+        """(status, retry after) of the error to respond to a request with, or None to
+        handle it"""
+
+        with self._lock:
+            for index, failure in enumerate(self._failures):
+                fail_method, pattern, status, retry_after = failure
+                if fail_method == method and pattern.search(path):
+                    del self._failures[index]
+                    return status, retry_after
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 503, None
+        return None
+
+    def request_count(
+        self, method: Optional[str] = None, path_pattern: str = ""
+    ) -> int:
+        """Number of requests received with the given method (any if None), and a path
+        matching the regular expression path_pattern"""
+
+        with self._lock:
+            return sum(
+                1
+                for request_method, path in self.requests
+                if method in (None, request_method) and re.search(path_pattern, path)
+            )
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+
+import pytest
+from xnat.exceptions import XNATResponseError
+
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.async_ingest import (
+    AsyncXNATClient,
+    ingest_acquisitions_async,
+    upload_interfile_data_async,
+)
+from xnat_interfile.batch_ingest import Acquisition
+from xnat_interfile.metrics import MetricsRecorder
+from xnat_interfile.retry import RetryPolicy
+
+PROJECT = "interfile_project"
+
+
+def md5(path):
+    return hashlib.md5(path.read_bytes()).hexdigest()
+
+
+def server_scan(server, subject_name, experiment_name, scan_name):
+    project = server.state.projects[PROJECT]
+    subject = next(s for s in project.subjects.values() if s.label == subject_name)
+    experiment = next(
+        e for e in subject.experiments.values() if e.label == experiment_name
+    )
+    return experiment.scans[scan_name]
+
+
+def upload(server, *args, **kwargs):
+    async def run():
+        async with AsyncXNATClient(
+            server.url, user="admin", password="admin"
+        ) as client:
+            return await upload_interfile_data_async(client, *args, **kwargs)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_upload_async(tmp_path, fake_xnat, archive):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+    scan_uri = upload(
+        fake_xnat,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        archive=archive,
+        event_stats=True,
+    )
+
+    assert scan_uri.endswith("/experiments/experiment/scans/scan")
+    scan = server_scan(fake_xnat, "subject", "experiment", "scan")
+    assert scan.xsi_type == "interfile:petLmScanData"
+    assert scan.fields["scannerInformation/name"] == "Siemens mMR"
+    assert scan.fields["eventStatistics/totalPrompts"] == "10000"
+    files = scan.resources["PET_RAW"].files
+    assert {name: file_md5 for name, (file_md5, _) in files.items()} == {
+        "scan.l.hdr": md5(header_path),
+        "scan.l": md5(tmp_path / "scan.l"),
+    }
+
+
+@pytest.mark.parametrize(
+    "names, message",
+    [
+        (("subject", "experiment2", "scan"), "Subject subject already exists"),
+        (("other", "experiment", "scan"), None),
+    ],
+)
+def test_upload_async_already_exists(tmp_path, fake_xnat, names, message):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    upload(fake_xnat, header_path, PROJECT, "subject", "experiment", "scan")
+
+    if message is None:
+        upload(fake_xnat, header_path, PROJECT, *names)
+    else:
+        with pytest.raises(NameError, match=message):
+            upload(fake_xnat, header_path, PROJECT, *names)
+
+
+def test_upload_async_missing_project(tmp_path, fake_xnat):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+    with pytest.raises(NameError, match="Project missing not available"):
+        upload(fake_xnat, header_path, "missing", "subject", "experiment", "scan")
+
+
+def test_ingest_acquisitions_async(tmp_path, fake_xnat):
+    """Scans sharing a subject / experiment (new or existing) re-use it, an existing scan
+    fails without stopping the batch, and no more requests are in flight than the client
+    allows."""
+
+    acquisitions = [
+        Acquisition(
+            write_listmode_acquisition(tmp_path / f"scan{index}.l.hdr", seed=index),
+            PROJECT,
+            f"subject{index % 2}",
+            "experiment",
+            f"scan{index}",
+        )
+        for index in range(6)
+    ]
+    upload(
+        fake_xnat,
+        acquisitions[0].header_path,
+        PROJECT,
+        "subject0",
+        "experiment",
+        "scan0",
+    )
+    metrics = MetricsRecorder()
+    fake_xnat.latency = 0.01
+    in_flight = []
+
+    async def run():
+        async with AsyncXNATClient(
+            fake_xnat.url, max_connections=3, max_uploads=1
+        ) as client:
+            # wrap the pooled client's send, to count the requests in flight at once
+            send = client._client.send
+            n_in_flight = 0
+
+            async def counting_send(*args, **kwargs):
+                nonlocal n_in_flight
+                n_in_flight += 1
+                in_flight.append(n_in_flight)
+                try:
+                    return await send(*args, **kwargs)
+                finally:
+                    n_in_flight -= 1
+
+            client._client.send = counting_send
+            return await ingest_acquisitions_async(
+                client,
+                acquisitions,
+                max_header_workers=2,
+                max_pending=4,
+                metrics=metrics,
+            )
+
+    results = asyncio.run(run())
+
+    assert [result.ok for result in results] == [False] + [True] * 5
+    assert isinstance(results[0].error, NameError)
+    assert len(fake_xnat.state.projects[PROJECT].subjects) == 2
+    for result in results[1:]:
+        acquisition = result.acquisition
+        scan = server_scan(
+            fake_xnat, acquisition.subject_name, "experiment", acquisition.scan_name
+        )
+        assert set(scan.resources["PET_RAW"].files) == {
+            acquisition.header_path.name,
+            acquisition.data_path.name,
+        }
+    assert 1 < max(in_flight) <= 3
+    assert metrics.summary()["upload"]["count"] == 10
+
+
+def test_ingest_acquisitions_async_server_error(tmp_path, fake_xnat):
+    acquisitions = [
+        Acquisition(
+            write_listmode_acquisition(tmp_path / "scan.l.hdr"),
+            PROJECT,
+            "subject",
+            "experiment",
+            "scan",
+        )
+    ]
+    fake_xnat.fail_next("PUT", r"/files/scan\.l$", status=503)
+
+    async def run():
+        async with AsyncXNATClient(fake_xnat.url, retry=None) as client:
+            return await ingest_acquisitions_async(
+                client, acquisitions, max_header_workers=1
+            )
+
+    (result,) = asyncio.run(run())
+
+    assert isinstance(result.error, XNATResponseError)
+    assert result.error.status_code == 503
+
+
+def test_upload_async_retries_transient_errors(tmp_path, fake_xnat):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    fake_xnat.fail_next("PUT", r"/scans/scan$", status=503)
+    fake_xnat.fail_next("PUT", r"/resources/PET_RAW$", status=502)
+    fake_xnat.fail_next("PUT", r"/files/scan\.l$", status=503, times=2)
+
+    async def run():
+        async with AsyncXNATClient(
+            fake_xnat.url, retry=RetryPolicy(base_delay=0.01)
+        ) as client:
+            return await upload_interfile_data_async(
+                client, header_path, PROJECT, "subject", "experiment", "scan"
+            )
+
+    asyncio.run(run())
+
+    scan = server_scan(fake_xnat, "subject", "experiment", "scan")
+    assert set(scan.resources["PET_RAW"].files) == {"scan.l.hdr", "scan.l"}
+    assert fake_xnat.request_count("PUT", r"/files/scan\.l$") == 3
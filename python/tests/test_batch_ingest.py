@@ -0,0 +1,73 @@
+from xnat_interfile.batch_ingest import (
+    Acquisition,
+    find_acquisitions,
+    ingest_acquisitions,
+)
+
+
+def make_acquisition(root_dir, relative_header_path, with_data=True):
+    header_path = root_dir / relative_header_path
+    header_path.parent.mkdir(parents=True, exist_ok=True)
+    header_path.write_text("!INTERFILE:=\n")
+    if with_data:
+        header_path.with_name(header_path.name.replace(".l.hdr", ".l")).touch()
+    return header_path
+
+
+def test_find_acquisitions(tmp_path):
+    make_acquisition(tmp_path, "subj1/exp1/scan1.l.hdr")
+    make_acquisition(tmp_path, "subj1/exp1/scan2.l.hdr")
+    make_acquisition(tmp_path, "subj2/exp2/scan1.l.hdr", with_data=False)
+    make_acquisition(tmp_path, "not_matching.l.hdr")
+
+    acquisitions = find_acquisitions(tmp_path, "interfile_project")
+
+    assert [(a.subject_name, a.experiment_name, a.scan_name) for a in acquisitions] == [
+        ("subj1", "exp1", "scan1"),
+        ("subj1", "exp1", "scan2"),
+    ]
+    assert all(a.project_name == "interfile_project" for a in acquisitions)
+    assert acquisitions[0].data_path == tmp_path / "subj1" / "exp1" / "scan1.l"
+
+
+def test_find_acquisitions_custom_pattern(tmp_path):
+    make_acquisition(tmp_path, "projA/subj1_exp1_scan1.l.hdr")
+
+    acquisitions = find_acquisitions(
+        tmp_path,
+        "interfile_project",
+        pattern=r"(?P<project>\w+)/(?P<subject>[^_]+)_(?P<experiment>[^_]+)_(?P<scan>[^_]+)\.l\.hdr",
+    )
+
+    assert acquisitions == [
+        Acquisition(
+            header_path=tmp_path / "projA" / "subj1_exp1_scan1.l.hdr",
+            project_name="projA",
+            subject_name="subj1",
+            experiment_name="exp1",
+            scan_name="scan1",
+        )
+    ]
+
+
+def test_ingest_reports_failures(tmp_path):
+    """A failure to read a header is reported for that acquisition, without uploading."""
+
+    acquisition = Acquisition(
+        tmp_path / "missing.l.hdr", "project", "subject", "experiment", "scan"
+    )
+    reported = []
+
+    results = ingest_acquisitions(
+        None,
+        [acquisition],
+        max_header_workers=1,
+        progress=lambda result, n_completed, n_total: reported.append(
+            (result, n_completed, n_total)
+        ),
+    )
+
+    assert len(results) == 1
+    assert not results[0].ok
+    assert isinstance(results[0].error, FileNotFoundError)
+    assert reported == [(results[0], 1, 1)]
@@ -0,0 +1,40 @@
+import json
+
+from benchmarks.run_benchmarks import BenchmarkConfig, run_benchmarks
+
+
+def test_run_benchmarks(tmp_path):
+    """Run a tiny version of every benchmark, so the suite doesn't break unnoticed"""
+
+    config = BenchmarkConfig(
+        data_size_mb=0.1,
+        ingest_data_size_mb=0.01,
+        n_headers=5,
+        n_objects=3,
+        n_acquisitions=2,
+        max_workers=2,
+        latency=0.0,
+        repeats=1,
+    )
+    output_path = tmp_path / "results.json"
+
+    run_benchmarks(config, output_path, work_dir=tmp_path)
+
+    report = json.loads(output_path.read_text())
+    assert report["config"]["n_headers"] == 5
+    assert "commit" in report["environment"]
+    names = {result["name"] for result in report["results"]}
+    assert {
+        "header_2_xnat_native",
+        "listmode_event_stats",
+        "label_lookup_shared_index",
+        "scan_put",
+        "upload_pet_raw_archive",
+    } <= names
+    ingest_workers = [
+        result["params"]["n_workers"]
+        for result in report["results"]
+        if result["name"] == "concurrent_ingest"
+    ]
+    assert ingest_workers == [1, 2]
+    assert all(result["median_seconds"] > 0 for result in report["results"])
@@ -0,0 +1,184 @@
+import hashlib
+
+import pytest
+from xnat.exceptions import XNATResponseError
+
+from tests.test_async_ingest import server_scan
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.chunked_upload import (
+    abort_chunked_upload,
+    chunked_upload_status,
+    parts_md5,
+    upload_resource_file_in_parts,
+)
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+from xnat_interfile.retry import RetryPolicy
+
+PROJECT = "interfile_project"
+
+PART_SIZE = 4096
+
+FAST_RETRY = RetryPolicy(base_delay=0.01)
+
+
+@pytest.fixture
+def header_path(tmp_path):
+    return write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+
+@pytest.fixture
+def scan(fake_xnat, fake_xnat_session, header_path):
+    upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        event_stats=False,
+    )
+    return server_scan(fake_xnat, "subject", "experiment", "scan")
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    data_path = tmp_path / "extra.l"
+    data_path.write_bytes(bytes(range(256)) * 100 + b"end")
+    return data_path
+
+
+def _upload(fake_xnat_session, data_path, **kwargs):
+    return upload_resource_file_in_parts(
+        fake_xnat_session,
+        PROJECT,
+        "experiment",
+        "scan",
+        "EXTRA",
+        data_path,
+        part_size=PART_SIZE,
+        retry=FAST_RETRY,
+        **kwargs,
+    )
+
+
+def test_upload_interfile_data_in_parts(fake_xnat, fake_xnat_session, header_path):
+    data = header_path.with_name("scan.l").read_bytes()
+    progress = []
+    upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        event_stats=False,
+        part_size=PART_SIZE,
+        progress=lambda sent, total, throughput: progress.append((sent, total)),
+    )
+
+    files = (
+        server_scan(fake_xnat, "subject", "experiment", "scan")
+        .resources["PET_RAW"]
+        .files
+    )
+    assert files["scan.l"] == (hashlib.md5(data).hexdigest(), len(data))
+    assert set(files) == {"scan.l.hdr", "scan.l"}
+    n_parts = -(-len(data) // PART_SIZE)
+    assert n_parts > 1
+    assert fake_xnat.request_count("PUT", r"/xapi/interfile/uploads/.*/parts/") == (
+        n_parts
+    )
+    assert max(progress) == (len(data), len(data))
+    assert not fake_xnat.state.uploads
+
+
+def test_part_size_not_supported_with_archive(fake_xnat_session, header_path):
+    with pytest.raises(ValueError, match="parts"):
+        upload_interfile_data(
+            fake_xnat_session,
+            header_path,
+            PROJECT,
+            "subject",
+            "experiment",
+            "scan",
+            archive=True,
+            part_size=PART_SIZE,
+        )
+
+
+def test_failed_part_retried(fake_xnat, fake_xnat_session, scan, data_path):
+    fake_xnat.fail_next("PUT", r"/parts/3$", times=2)
+
+    md5 = _upload(fake_xnat_session, data_path, max_workers=2)
+
+    data = data_path.read_bytes()
+    assert md5 == hashlib.md5(data).hexdigest()
+    assert scan.resources["EXTRA"].files["extra.l"] == (md5, len(data))
+    assert scan.resources["EXTRA"].contents["extra.l"] == data
+    assert fake_xnat.request_count("PUT", r"/parts/3$") == 3
+    assert fake_xnat.request_count("PUT", r"/parts/1$") == 1
+
+
+def test_resume_upload(fake_xnat, fake_xnat_session, scan, data_path):
+    fake_xnat.fail_next("PUT", r"/parts/2$", status=400)
+    with pytest.raises(XNATResponseError):
+        _upload(fake_xnat_session, data_path, max_workers=1)
+    assert "EXTRA" not in scan.resources
+    (upload_id,) = fake_xnat.state.uploads
+    assert 2 in chunked_upload_status(fake_xnat_session, upload_id)["missingParts"]
+
+    with pytest.raises(ValueError, match="parts of"):
+        upload_resource_file_in_parts(
+            fake_xnat_session,
+            PROJECT,
+            "experiment",
+            "scan",
+            "EXTRA",
+            data_path,
+            part_size=PART_SIZE * 2,
+            upload_id=upload_id,
+        )
+
+    n_puts = fake_xnat.request_count("PUT", r"/parts/")
+    md5 = _upload(fake_xnat_session, data_path, upload_id=upload_id)
+
+    data = data_path.read_bytes()
+    assert scan.resources["EXTRA"].files["extra.l"] == (md5, len(data))
+    # only the parts the server didn't receive are sent again
+    assert fake_xnat.request_count("PUT", r"/parts/1$") == 1
+    assert fake_xnat.request_count("PUT", r"/parts/2$") == 2
+    assert fake_xnat.request_count("PUT", r"/parts/") - n_puts < -(
+        -len(data) // PART_SIZE
+    )
+
+
+def test_abort_upload(fake_xnat, fake_xnat_session, scan, data_path):
+    fake_xnat.fail_next("PUT", r"/parts/1$", status=400)
+    with pytest.raises(XNATResponseError):
+        _upload(fake_xnat_session, data_path, max_workers=1)
+    (upload_id,) = fake_xnat.state.uploads
+
+    abort_chunked_upload(fake_xnat_session, upload_id)
+
+    assert not fake_xnat.state.uploads
+
+
+def test_upload_empty_file(fake_xnat_session, scan, tmp_path):
+    empty_path = tmp_path / "empty.l"
+    empty_path.write_bytes(b"")
+
+    md5 = upload_resource_file_in_parts(
+        fake_xnat_session, PROJECT, "experiment", "scan", "EXTRA", empty_path
+    )
+
+    assert scan.resources["EXTRA"].files["empty.l"] == (md5, 0)
+
+
+def test_parts_md5():
+    part_md5s = [hashlib.md5(b"a").hexdigest(), hashlib.md5(b"b").hexdigest()]
+
+    assert parts_md5(part_md5s) == (
+        hashlib.md5(hashlib.md5(b"a").digest() + hashlib.md5(b"b").digest()).hexdigest()
+        + "-2"
+    )
+    assert parts_md5([]) == hashlib.md5(b"").hexdigest() + "-0"
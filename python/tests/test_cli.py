@@ -0,0 +1,105 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.cli import main
+
+PROJECT = "interfile_project"
+
+
+@pytest.fixture
+def exports(tmp_path):
+    root_dir = tmp_path / "exports"
+    for index in range(2):
+        write_listmode_acquisition(
+            root_dir / f"subject{index}" / "experiment" / "scan.l.hdr", seed=index
+        )
+    return root_dir
+
+
+@pytest.fixture
+def server_args(fake_xnat, monkeypatch):
+    monkeypatch.setenv("XNAT_PASSWORD", "admin")
+    return ["--server", fake_xnat.url, "--user", "admin", "--project", PROJECT]
+
+
+def test_startup_imports(exports):
+    """--help and dry runs mustn't import xnat (or stir), or numpy for headers alone"""
+
+    script = (
+        "import sys\n"
+        "from xnat_interfile.cli import main\n"
+        f"main(['-q', 'dry-run', {str(exports)!r}])\n"
+        "try:\n"
+        "    main(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print([name for name in ('xnat', 'stir', 'numpy') if name in sys.modules])\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+
+    assert result.stdout.splitlines()[-1] == "[]"
+
+
+def test_dry_run(exports, capsys):
+    assert main(["dry-run", str(exports), "--event-stats", "--frames", "2x0.5"]) == 0
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [line["header"] for line in lines] == [
+        str(exports / f"subject{index}" / "experiment" / "scan.l.hdr")
+        for index in range(2)
+    ]
+    fields = lines[0]["fields"]
+    assert fields["scans"] == "interfile:petLmScanData"
+    assert fields["interfile:petLmScanData/eventStatistics/totalPrompts"] == 10000
+    assert "interfile:petLmScanData/frames/frame[1]/prompts" in fields
+
+
+def test_ingest_verify_export(tmp_path, exports, server_args, capsys):
+    assert main(["ingest", str(exports), *server_args]) == 0
+
+    capsys.readouterr()
+    assert main(["verify", str(exports), *server_args]) == 0
+    assert capsys.readouterr().out.splitlines() == [
+        f"ok\t{PROJECT}/subject{index}/experiment/scan" for index in range(2)
+    ]
+
+    output_path = tmp_path / "metadata.csv"
+    assert main(["export", *server_args, "--output", str(output_path)]) == 0
+    with open(output_path, newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert [row["experiment_label"] for row in rows] == ["experiment"] * 2
+
+
+def test_verify_reports_missing_and_changed_files(exports, server_args, capsys):
+    header_path = exports / "subject0" / "experiment" / "scan.l.hdr"
+    args = ["--subject", "subject0", "--experiment", "experiment", "--scan", "scan"]
+    assert main(["ingest", str(header_path), *server_args, *args]) == 0
+
+    with open(header_path.with_name("scan.l"), "ab") as file:
+        file.write(b"\0" * 4)
+    capsys.readouterr()
+    assert main(["verify", str(exports), *server_args]) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        f"mismatch\t{PROJECT}/subject0/experiment/scan\tscan.l",
+        f"missing\t{PROJECT}/subject1/experiment/scan\tscan.l.hdr\tscan.l",
+    ]
+
+
+def test_single_header_needs_labels(exports, server_args):
+    header_path = exports / "subject0" / "experiment" / "scan.l.hdr"
+
+    with pytest.raises(SystemExit) as error:
+        main(["ingest", str(header_path), *server_args, "--subject", "subject0"])
+    assert error.value.code == 2
@@ -0,0 +1,149 @@
+import hashlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from tests.test_async_ingest import server_scan
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.download import (
+    download_resource_file,
+    download_resource_file_to_mmap,
+)
+from xnat_interfile.label_index import experiments_uri
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+from xnat_interfile.upload import (
+    ChecksumError,
+    ZstdStream,
+    upload_compressed_resource_file,
+)
+
+zstandard = pytest.importorskip("zstandard")
+
+PROJECT = "interfile_project"
+
+RESOURCE_URI = (
+    f"{experiments_uri(PROJECT, 'subject')}/experiment/scans/scan/resources/PET_RAW"
+)
+
+
+@pytest.fixture
+def header_path(tmp_path):
+    return write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+
+@pytest.fixture
+def data(header_path):
+    return header_path.with_name("scan.l").read_bytes()
+
+
+@pytest.fixture
+def compressed_scan(fake_xnat, fake_xnat_session, header_path):
+    upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        event_stats=False,
+        compression="zstd",
+    )
+    return server_scan(fake_xnat, "subject", "experiment", "scan")
+
+
+@pytest.mark.parametrize("threads", [0, 2])
+def test_zstd_stream(tmp_path, threads):
+    data_path = tmp_path / "scan.l"
+    data = np.random.default_rng(0).integers(0, 4, 100_000, np.uint8).tobytes()
+    data_path.write_bytes(data)
+    progress = []
+    stream = ZstdStream(
+        data_path,
+        chunk_size=30_000,
+        progress=lambda sent, total, throughput: progress.append((sent, total)),
+        threads=threads,
+    )
+
+    compressed = b"".join(stream)
+
+    assert zstandard.ZstdDecompressor().decompress(compressed) == data
+    assert len(compressed) < len(data) / 2
+    assert stream.size == len(compressed)
+    assert stream.md5 == hashlib.md5(compressed).hexdigest()
+    assert stream.original_md5 == hashlib.md5(data).hexdigest()
+    assert progress[-1] == (100_000, 100_000)
+    # can be re-iterated, e.g. to retry an upload
+    assert zstandard.ZstdDecompressor().decompress(b"".join(stream)) == data
+
+
+def test_upload_compressed(data, compressed_scan):
+    files = compressed_scan.resources["PET_RAW"].files
+    assert set(files) == {"scan.l.hdr", "scan.l.zst"}
+    md5, size = files["scan.l.zst"]
+    assert size < len(data)
+
+    assert compressed_scan.fields["dataFile/name"] == "scan.l.zst"
+    assert compressed_scan.fields["dataFile/compression"] == "zstd"
+    assert compressed_scan.fields["dataFile/originalSize"] == str(len(data))
+    assert compressed_scan.fields["dataFile/originalMd5"] == (
+        hashlib.md5(data).hexdigest()
+    )
+    assert compressed_scan.fields["dataFile/storedSize"] == str(size)
+
+
+def test_upload_compressed_archive_not_supported(fake_xnat_session, header_path):
+    with pytest.raises(ValueError, match="Compression"):
+        upload_interfile_data(
+            fake_xnat_session,
+            header_path,
+            PROJECT,
+            "subject",
+            "experiment",
+            "scan",
+            archive=True,
+            compression="zstd",
+        )
+
+
+def test_upload_compressed_not_read(header_path):
+    # a session that reports success without sending the data
+    session = SimpleNamespace(put=lambda uri, data, **kwargs: None)
+    resource = SimpleNamespace(uri=RESOURCE_URI, xnat_session=session)
+
+    with pytest.raises(RuntimeError, match="scan.l.zst"):
+        upload_compressed_resource_file(
+            resource, header_path.with_name("scan.l"), "scan.l", retry=None
+        )
+
+
+def test_download_decompressed(tmp_path, fake_xnat_session, data, compressed_scan):
+    file_uri = f"{RESOURCE_URI}/files/scan.l.zst"
+    md5 = compressed_scan.fields["dataFile/originalMd5"]
+
+    output_path = tmp_path / "downloaded.l"
+    n_bytes = download_resource_file(
+        fake_xnat_session, file_uri, output_path, md5=md5, chunk_size=1000
+    )
+    assert n_bytes == len(data)
+    assert output_path.read_bytes() == data
+
+    with download_resource_file_to_mmap(fake_xnat_session, file_uri, md5=md5) as buffer:
+        assert len(buffer) == len(data)
+        assert buffer[:] == data
+
+    # without decompressing - the file as stored
+    download_resource_file(fake_xnat_session, file_uri, output_path, decompress=False)
+    assert zstandard.ZstdDecompressor().decompress(output_path.read_bytes()) == data
+
+
+def test_download_checks_md5(tmp_path, fake_xnat_session, compressed_scan):
+    file_uri = f"{RESOURCE_URI}/files/scan.l.zst"
+    output_path = tmp_path / "downloaded.l"
+
+    with pytest.raises(ChecksumError):
+        download_resource_file(fake_xnat_session, file_uri, output_path, md5="0")
+    assert list(tmp_path.glob("downloaded*")) == []
+
+    with pytest.raises(ChecksumError):
+        download_resource_file_to_mmap(fake_xnat_session, file_uri, md5="0")
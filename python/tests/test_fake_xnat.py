@@ -0,0 +1,158 @@
+import hashlib
+import time
+
+import pytest
+from xnat.exceptions import XNATResponseError
+
+from tests.fake_xnat import FakeXNATServer
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.batch_ingest import Acquisition, ingest_acquisitions
+from xnat_interfile.ingest_journal import IngestJournal
+from xnat_interfile.label_index import label_exists
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+
+PROJECT = "interfile_project"
+
+
+def md5(path):
+    return hashlib.md5(path.read_bytes()).hexdigest()
+
+
+def server_files(server, subject_name, experiment_name, scan_name):
+    """{file name: md5} of the PET_RAW resource of a scan on the fake server"""
+
+    project = server.state.projects[PROJECT]
+    subject = next(s for s in project.subjects.values() if s.label == subject_name)
+    experiment = next(
+        e for e in subject.experiments.values() if e.label == experiment_name
+    )
+    resource = experiment.scans[scan_name].resources["PET_RAW"]
+    return {name: file_md5 for name, (file_md5, _) in resource.files.items()}
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_upload_to_fake_xnat(tmp_path, fake_xnat, fake_xnat_session, archive):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+    scan = upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        archive=archive,
+        event_stats=True,
+    )
+
+    assert scan.uri.endswith("/scans/scan")
+    assert server_files(fake_xnat, "subject", "experiment", "scan") == {
+        "scan.l.hdr": md5(header_path),
+        "scan.l": md5(tmp_path / "scan.l"),
+    }
+    experiment = (
+        fake_xnat_session.projects[PROJECT]
+        .subjects["subject"]
+        .experiments["experiment"]
+    )
+    scan_data = experiment.scans["scan"].data
+    assert scan_data["scannerInformation/name"] == "Siemens mMR"
+    assert scan_data["eventStatistics/totalPrompts"] == "10000"
+
+
+def test_archive_upload_needs_fewer_requests(tmp_path, fake_xnat, fake_xnat_session):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+    n_requests = []
+    for index, archive in enumerate([False, True]):
+        before = fake_xnat.request_count()
+        upload_interfile_data(
+            fake_xnat_session,
+            header_path,
+            PROJECT,
+            f"subject{index}",
+            "experiment",
+            "scan",
+            archive=archive,
+        )
+        n_requests.append(fake_xnat.request_count() - before)
+
+    assert n_requests[1] < n_requests[0]
+    assert fake_xnat.request_count("PUT", r"/files/scan\.zip$") == 1
+
+
+def test_existing_subject_raises(tmp_path, fake_xnat_session):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    upload_interfile_data(
+        fake_xnat_session, header_path, PROJECT, "subject", "experiment1", "scan"
+    )
+
+    with pytest.raises(NameError, match="Subject subject already exists"):
+        upload_interfile_data(
+            fake_xnat_session, header_path, PROJECT, "subject", "experiment2", "scan"
+        )
+
+
+def test_journal_resumes_after_injected_error(tmp_path, fake_xnat, fake_xnat_session):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    journal = IngestJournal(tmp_path / "journal.sqlite")
+    args = (fake_xnat_session, header_path, PROJECT, "subject", "experiment", "scan")
+
+    fake_xnat.fail_next("PUT", r"/files/scan\.l$", status=503)
+    with pytest.raises(XNATResponseError):
+        upload_interfile_data(*args, journal=journal, retry=None)
+
+    upload_interfile_data(*args, journal=journal)
+
+    assert len(fake_xnat.state.projects[PROJECT].subjects) == 1
+    assert set(server_files(fake_xnat, "subject", "experiment", "scan")) == {
+        "scan.l.hdr",
+        "scan.l",
+    }
+
+
+def test_injected_latency(fake_xnat, fake_xnat_session):
+    subjects_uri = f"/data/projects/{PROJECT}/subjects"
+    fake_xnat.latency = 0.05
+
+    start = time.perf_counter()
+    assert not label_exists(fake_xnat_session, subjects_uri, "subject")
+    assert time.perf_counter() - start >= 0.05
+
+
+@pytest.mark.slow
+def test_batch_ingest_with_latency_and_errors(tmp_path):
+    """Ingest a batch with realistic latency and occasional server errors - each
+    acquisition is either fully uploaded, or reported as failed with the server error."""
+
+    acquisitions = [
+        Acquisition(
+            write_listmode_acquisition(tmp_path / f"scan{index}.l.hdr", seed=index),
+            PROJECT,
+            f"subject{index}",
+            "experiment",
+            "scan",
+        )
+        for index in range(20)
+    ]
+
+    with FakeXNATServer(project_names=(PROJECT,), latency=0.01, seed=1) as server:
+        with server.connect() as session:
+            server.error_rate = 0.02
+            results = ingest_acquisitions(
+                session, acquisitions, max_header_workers=2, max_upload_workers=4
+            )
+
+    assert any(result.ok for result in results)
+    for result in results:
+        if result.ok:
+            assert set(
+                server_files(
+                    server, result.acquisition.subject_name, "experiment", "scan"
+                )
+            ) == {
+                result.acquisition.header_path.name,
+                result.acquisition.data_path.name,
+            }
+        else:
+            assert isinstance(result.error, XNATResponseError)
@@ -0,0 +1,185 @@
+import hashlib
+import io
+import json
+import re
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from xnat_interfile.fetch_datasets import CACHE_NAME, fetch_dataset
+
+DOI = "doi:10.5281/zenodo.1234"
+
+
+class FakeZenodo:
+    """Local HTTP stand-in for Zenodo - serves the record API of DOI, and its files with
+    (optional) support for range requests. Requests are recorded as (path, range)."""
+
+    def __init__(self, files: dict[str, bytes], ranges: bool = True):
+        self.files = files
+        self.ranges = ranges
+        self.requests: list[tuple[str, str | None]] = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def file_requests(self, name: str) -> list[str | None]:
+        return [range_ for path, range_ in self.requests if path == f"/files/{name}"]
+
+    def _record(self) -> dict:
+        return {
+            "files": [
+                {
+                    "key": name,
+                    "size": len(content),
+                    "checksum": f"md5:{hashlib.md5(content).hexdigest()}",
+                    "links": {"self": f"{self.url}/files/{name}"},
+                }
+                for name, content in self.files.items()
+            ]
+        }
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        zenodo = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, headers: dict = {}):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                range_ = self.headers.get("Range")
+                zenodo.requests.append((self.path, range_))
+                if self.path == "/api/records/1234":
+                    return self._send(200, json.dumps(zenodo._record()).encode())
+
+                content = zenodo.files.get(self.path.removeprefix("/files/"))
+                if content is None:
+                    return self._send(404, b"")
+                match = re.fullmatch(r"bytes=(\d+)-(\d+)", range_ or "")
+                if match is None or not zenodo.ranges:
+                    return self._send(200, content)
+                start, end = int(match[1]), min(int(match[2]), len(content) - 1)
+                self._send(
+                    206,
+                    content[start : end + 1],
+                    {"Content-Range": f"bytes {start}-{end}/{len(content)}"},
+                )
+
+        return Handler
+
+
+def zip_archive(members: dict[str, tuple[bytes, int]]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, (content, compress_type) in members.items():
+            archive.writestr(name, content, compress_type=compress_type)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def members():
+    rng = np.random.default_rng(0)
+    return {
+        "data/scan.l.hdr": (b"!INTERFILE:=\n" * 100, zipfile.ZIP_DEFLATED),
+        "data/scan.l": (
+            rng.integers(0, 4, 500_000, np.uint8).tobytes(),
+            zipfile.ZIP_DEFLATED,
+        ),
+        "data/stored.txt": (b"stored", zipfile.ZIP_STORED),
+        "other/large.bin": (rng.bytes(1_000_000), zipfile.ZIP_STORED),
+    }
+
+
+@pytest.mark.parametrize("ranges", [True, False], ids=["ranges", "no_ranges"])
+def test_fetch_zip_members(tmp_path, members, ranges):
+    names = ["data/scan.l.hdr", "data/scan.l", "data/stored.txt"]
+    archive = zip_archive(members)
+
+    with FakeZenodo({"data.zip": archive}, ranges=ranges) as zenodo:
+        paths = fetch_dataset(
+            DOI, "data.zip", names, data_dir=tmp_path, zenodo_url=zenodo.url
+        )
+        assert paths == [tmp_path / name for name in names]
+        assert [path.read_bytes() for path in paths] == [
+            members[name][0] for name in names
+        ]
+        assert not (tmp_path / "other").exists()
+        assert not (tmp_path / "data.zip").exists()
+
+        if ranges:
+            # the central directory, then a local header and the data of each member -
+            # the large member isn't downloaded
+            requested = zenodo.file_requests("data.zip")
+            assert len(requested) == 1 + 2 * len(names)
+            assert all(range_ is not None for range_ in requested)
+
+        # already fetched - no requests at all
+        n_requests = len(zenodo.requests)
+        assert (
+            fetch_dataset(
+                DOI, "data.zip", names, data_dir=tmp_path, zenodo_url=zenodo.url
+            )
+            == paths
+        )
+        assert len(zenodo.requests) == n_requests
+
+
+def test_fetch_file_in_parallel_parts(tmp_path):
+    content = np.random.default_rng(0).bytes(1_000_000)
+
+    with FakeZenodo({"scan.l": content}) as zenodo:
+        (path,) = fetch_dataset(
+            DOI, "scan.l", data_dir=tmp_path, zenodo_url=zenodo.url, part_size=100_000
+        )
+        assert path.read_bytes() == content
+        assert len(zenodo.file_requests("scan.l")) == 10
+
+        n_requests = len(zenodo.requests)
+        fetch_dataset(DOI, "scan.l", data_dir=tmp_path, zenodo_url=zenodo.url)
+        assert len(zenodo.requests) == n_requests
+
+
+def test_fetch_verifies_files_present(tmp_path, members):
+    """Files already present, but not in the cache, are checked rather than downloaded"""
+
+    names = ["data/scan.l.hdr", "data/scan.l"]
+    with FakeZenodo({"data.zip": zip_archive(members)}) as zenodo:
+        fetch_dataset(DOI, "data.zip", names, data_dir=tmp_path, zenodo_url=zenodo.url)
+        (tmp_path / CACHE_NAME).unlink()
+        (tmp_path / "data/scan.l.hdr").write_bytes(b"changed")
+        zenodo.requests.clear()
+
+        fetch_dataset(DOI, "data.zip", names, data_dir=tmp_path, zenodo_url=zenodo.url)
+
+        assert (tmp_path / "data/scan.l.hdr").read_bytes() == members[names[0]][0]
+        # the registry, central directory, and the changed member's header and data
+        assert len(zenodo.requests) == 4
+
+
+def test_fetch_checks_md5(tmp_path):
+    with FakeZenodo({"scan.l": b"data"}) as zenodo:
+        record = zenodo._record()
+        record["files"][0]["checksum"] = "md5:0"
+        zenodo._record = lambda: record  # type: ignore[method-assign]
+
+        with pytest.raises(ValueError, match="doesn't match registry"):
+            fetch_dataset(DOI, "scan.l", data_dir=tmp_path, zenodo_url=zenodo.url)
+        assert list(tmp_path.glob("scan.l*")) == []
@@ -0,0 +1,109 @@
+import hashlib
+
+import pytest
+
+from tests.test_async_ingest import server_scan
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.hash_index import HashIndex, file_md5
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+
+PROJECT = "interfile_project"
+
+
+def test_file_md5(tmp_path):
+    data_file = tmp_path / "test.l"
+    data_file.write_bytes(b"listmode" * 1000)
+
+    assert (
+        file_md5(data_file, chunk_size=100)
+        == hashlib.md5(b"listmode" * 1000).hexdigest()
+    )
+
+
+def test_cached_md5_invalidated_on_change(tmp_path):
+    data_file = tmp_path / "test.l"
+    data_file.write_bytes(b"listmode")
+
+    with HashIndex(tmp_path / "hash_index.sqlite") as hash_index:
+        hash_index.record_md5(data_file, file_md5(data_file))
+        assert hash_index.cached_md5(data_file) == file_md5(data_file)
+
+        data_file.write_bytes(b"modified listmode")
+        assert hash_index.cached_md5(data_file) is None
+
+
+def test_renamed_copy_is_recognised_as_archived(tmp_path):
+    data_file = tmp_path / "test.l"
+    data_file.write_bytes(b"listmode")
+    renamed_copy = tmp_path / "re_export.l"
+    renamed_copy.write_bytes(b"listmode")
+    different_file = tmp_path / "other.l"
+    different_file.write_bytes(b"listmodf")
+
+    with HashIndex(tmp_path / "hash_index.sqlite") as hash_index:
+        assert hash_index.archived_scan_uri(data_file) is None
+
+        scan_uri = "/data/experiments/XNAT_E00001/scans/scan"
+        hash_index.record_archived(
+            data_file,
+            file_md5(data_file),
+            scan_uri,
+            f"{scan_uri}/resources/PET_RAW/files/test.l",
+        )
+
+        assert hash_index.archived_scan_uri(renamed_copy) == scan_uri
+        assert hash_index.archived_scan_uri(different_file) is None
+
+
+def test_files_of_new_size_are_not_read(tmp_path):
+    """A file can't be a duplicate if no archived file has the same size, so its
+    checksum is left to be computed during upload."""
+
+    data_file = tmp_path / "test.l"
+    data_file.write_bytes(b"listmode")
+
+    with HashIndex(tmp_path / "hash_index.sqlite") as hash_index:
+        assert hash_index.archived_scan_uri(data_file) is None
+        assert hash_index.cached_md5(data_file) is None
+
+
+@pytest.mark.parametrize("compression", [None, "zstd"])
+def test_archived_file_is_checked_on_server(
+    tmp_path, fake_xnat, fake_xnat_session, compression
+):
+    """A file recorded in the index is only skipped while it is still on the server with
+    the same checksum (of the compressed data, if compressed) - once the scan is deleted,
+    it is uploaded again."""
+
+    if compression is not None:
+        pytest.importorskip("zstandard")
+
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    copy_path = write_listmode_acquisition(tmp_path / "copy" / "scan.l.hdr")
+
+    with HashIndex(tmp_path / "hash_index.sqlite") as hash_index:
+
+        def upload(path, subject_name):
+            return upload_interfile_data(
+                fake_xnat_session,
+                path,
+                PROJECT,
+                subject_name,
+                "experiment",
+                "scan",
+                hash_index=hash_index,
+                compression=compression,
+            )
+
+        scan = upload(header_path, "subject")
+        assert upload(copy_path, "copy").uri == scan.uri
+        with pytest.raises(StopIteration):
+            server_scan(fake_xnat, "copy", "experiment", "scan")
+
+        fake_xnat_session.delete(scan.uri)
+        copy_uri = upload(copy_path, "copy_2").uri
+
+        copy_scan = server_scan(fake_xnat, "copy_2", "experiment", "scan")
+        data_name = "scan.l" if compression is None else "scan.l.zst"
+        assert set(copy_scan.resources["PET_RAW"].files) == {"scan.l.hdr", data_name}
+        assert hash_index.archived_scan_uri(tmp_path / "scan.l") == copy_uri
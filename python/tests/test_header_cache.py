@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from xnat_interfile import header_cache as header_cache_module
+from xnat_interfile.header_cache import HeaderCache, cached_read_listmode_header_2_xnat
+from xnat_interfile.interfile_2_xnat import read_interfile_header_2_xnat
+
+HEADER = "!INTERFILE:=\n!originating system:=2008\nisotope name:=F-18\n"
+
+
+@pytest.fixture
+def header_path(tmp_path):
+    header_path = tmp_path / "test.l.hdr"
+    header_path.write_text(HEADER)
+    return header_path
+
+
+@pytest.fixture
+def count_reads(monkeypatch):
+    """Count the headers actually read (rather than taken from the cache)"""
+
+    reads = []
+
+    def read(path, **kwargs):
+        reads.append(path)
+        return read_interfile_header_2_xnat(path, **kwargs)
+
+    monkeypatch.setattr(header_cache_module, "read_interfile_header_2_xnat", read)
+    return reads
+
+
+def test_cached_header_is_reused(tmp_path, header_path, count_reads):
+    with HeaderCache(tmp_path / "cache.sqlite") as cache:
+        first = cached_read_listmode_header_2_xnat(header_path, header_cache=cache)
+        second = cached_read_listmode_header_2_xnat(header_path, header_cache=cache)
+
+    # persists between runs
+    with HeaderCache(tmp_path / "cache.sqlite") as cache:
+        third = cached_read_listmode_header_2_xnat(header_path, header_cache=cache)
+
+    assert first == second == third == read_interfile_header_2_xnat(header_path)
+    assert count_reads == [header_path]
+
+
+def test_changed_header_is_reread(tmp_path, header_path, count_reads):
+    with HeaderCache(tmp_path / "cache.sqlite") as cache:
+        cached_read_listmode_header_2_xnat(header_path, header_cache=cache)
+        header_path.write_text(HEADER.replace("F-18", "C-11"))
+        xnat_hdr = cached_read_listmode_header_2_xnat(header_path, header_cache=cache)
+
+    radionuclide_key = "interfile:petLmScanData/radionuclideInformation/radionuclide"
+    assert xnat_hdr[radionuclide_key] == "^11^Carbon"
+    assert len(count_reads) == 2
+
+
+def test_check_hash(tmp_path, header_path):
+    # a change that keeps the same size and modification time
+    with HeaderCache(tmp_path / "cache.sqlite", check_hash=True) as cache:
+        cache.put(header_path, {"field": 1})
+        stat = header_path.stat()
+        header_path.write_text(HEADER.replace("F-18", "C-11"))
+        os.utime(header_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        assert cache.get(header_path) is None
+
+
+def test_converter_version_change_clears_cache(tmp_path, header_path, monkeypatch):
+    with HeaderCache(tmp_path / "cache.sqlite") as cache:
+        cache.put(header_path, {"field": 1})
+        assert cache.get(header_path) == {"field": 1}
+
+    monkeypatch.setattr(header_cache_module, "CONVERTER_VERSION", "test")
+    with HeaderCache(tmp_path / "cache.sqlite") as cache:
+        assert len(cache) == 0
+        assert cache.get(header_path) is None
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    header_paths = []
+    for i in range(3):
+        header_paths.append(tmp_path / f"test{i}.l.hdr")
+        header_paths[-1].write_text(HEADER)
+
+    with HeaderCache(tmp_path / "cache.sqlite", max_entries=2) as cache:
+        cache.put(header_paths[0], {"field": 0})
+        cache.put(header_paths[1], {"field": 1})
+        assert cache.get(header_paths[0]) is not None
+
+        cache.put(header_paths[2], {"field": 2})
+
+        assert len(cache) == 2
+        assert cache.get(header_paths[0]) is not None
+        assert cache.get(header_paths[1]) is None
+        assert cache.get(header_paths[2]) is not None
+
+
+def test_event_stats_are_keyed_by_data_file(tmp_path, header_path):
+    data_path = tmp_path / "test.l"
+    data_path.write_bytes(bytes(8))
+
+    with HeaderCache(tmp_path / "cache.sqlite") as cache:
+        cache.put(header_path, {"field": 1}, event_stats=True)
+        assert cache.get(header_path, event_stats=False) is None
+        assert cache.get(header_path, event_stats=True) == {"field": 1}
+
+        data_path.write_bytes(bytes(16))
+        assert cache.get(header_path, event_stats=True) is None
+
+        data_path.unlink()
+        assert cache.get(header_path, event_stats=True) is None
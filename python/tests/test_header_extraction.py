@@ -0,0 +1,91 @@
+import pytest
+from xnat.exceptions import XNATResponseError
+
+from tests.test_async_ingest import server_scan
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.batch_ingest import find_acquisitions, ingest_acquisitions
+from xnat_interfile.interfile_2_xnat import read_listmode_header_2_xnat
+from xnat_interfile.populate_datatype_fields import (
+    header_extraction_status,
+    request_header_extraction,
+    upload_interfile_data,
+)
+
+PROJECT = "interfile_project"
+
+
+def header_fields(header_path):
+    """Header fields as the fake server stores them"""
+
+    xnat_hdr = read_listmode_header_2_xnat(header_path)
+    return {
+        name.removeprefix("interfile:petLmScanData/"): str(value)
+        for name, value in xnat_hdr.items()
+        if name != "scans"
+    }
+
+
+def test_read_server_backend(tmp_path):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+    assert read_listmode_header_2_xnat(header_path, backend="server") == {
+        "scans": "interfile:petLmScanData"
+    }
+    fields = read_listmode_header_2_xnat(header_path, "server", event_stats=True)
+    assert "interfile:petLmScanData/scannerInformation/name" not in fields
+    assert fields["interfile:petLmScanData/eventStatistics/totalPrompts"] == 10000
+
+
+def test_upload_with_server_extraction(tmp_path, fake_xnat, fake_xnat_session):
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+
+    upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        header_backend="server",
+        event_stats=False,
+    )
+
+    scan = server_scan(fake_xnat, "subject", "experiment", "scan")
+    assert scan.fields == header_fields(header_path)
+    assert (
+        header_extraction_status(fake_xnat_session, PROJECT, "experiment", "scan")
+        == "COMPLETE"
+    )
+
+
+def test_ingest_with_server_extraction(tmp_path, fake_xnat, fake_xnat_session):
+    # experiment labels are unique within an XNAT project
+    for index in range(2):
+        write_listmode_acquisition(
+            tmp_path / f"subject{index}" / f"experiment{index}" / "scan.l.hdr",
+            seed=index,
+        )
+    acquisitions = find_acquisitions(tmp_path, PROJECT)
+
+    results = ingest_acquisitions(
+        fake_xnat_session,
+        acquisitions,
+        max_header_workers=1,
+        header_backend="server",
+        event_stats=True,
+    )
+
+    assert all(result.ok for result in results)
+    for acquisition in acquisitions:
+        scan = server_scan(
+            fake_xnat, acquisition.subject_name, acquisition.experiment_name, "scan"
+        )
+        assert scan.fields.items() >= header_fields(acquisition.header_path).items()
+        assert "eventStatistics/totalPrompts" in scan.fields
+
+
+def test_server_extraction_needs_header(fake_xnat_session):
+    with pytest.raises(XNATResponseError):
+        request_header_extraction(
+            fake_xnat_session, PROJECT, "experiment", "scan", retry=None
+        )
@@ -0,0 +1,47 @@
+from xnat_interfile.batch_ingest import Acquisition, ingest_acquisitions
+from xnat_interfile.ingest_journal import (
+    COMPLETED,
+    DONE_STAGE,
+    STARTED,
+    IngestJournal,
+    acquisition_key,
+)
+
+
+def test_journal_persists_between_runs(tmp_path):
+    journal_path = tmp_path / "ingest_journal.sqlite"
+    key = acquisition_key("project", "subject", "experiment", "scan")
+
+    with IngestJournal(journal_path) as journal:
+        acquisition_journal = journal.for_acquisition(key)
+        acquisition_journal.begin("subject")
+        acquisition_journal.complete("subject")
+        acquisition_journal.begin("upload:test.l")
+
+    # e.g. re-opened after the process was killed part way through an upload
+    with IngestJournal(journal_path) as journal:
+        assert journal.status(key, "subject") == COMPLETED
+        assert journal.status(key, "upload:test.l") == STARTED
+        assert journal.status(key, "scan") is None
+        assert not journal.is_done(key)
+
+        journal.complete(key, DONE_STAGE)
+        assert journal.is_done(key)
+
+        journal.reset(key)
+        assert journal.status(key, "subject") is None
+
+
+def test_ingest_skips_done_acquisitions(tmp_path):
+    acquisition = Acquisition(
+        tmp_path / "scan.l.hdr", "project", "subject", "experiment", "scan"
+    )
+
+    with IngestJournal(tmp_path / "ingest_journal.sqlite") as journal:
+        journal.complete(acquisition.key, DONE_STAGE)
+        results = ingest_acquisitions(
+            None, [acquisition], progress=lambda *args: None, journal=journal
+        )
+
+    assert results[0].ok
+    assert results[0].skipped
@@ -0,0 +1,158 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+from xnat_interfile.interfile_2_xnat import (
+    LISTMODE_SCAN_TYPE,
+    _listmode_values_2_xnat,
+    extract_interfile_fields,
+    interfile_header_2_xnat,
+    read_listmode_header_2_xnat,
+)
+from xnat_interfile.interfile_header import (
+    get_indexed_values,
+    read_interfile_header,
+    standardise_interfile_key,
+)
+
+LISTMODE_HEADER = """!INTERFILE:=
+%comment:=SMS-MI header
+!originating system:=2008
+!GENERAL DATA:=
+!name of data file:=test.l
+; a comment line := with a separator
+!GENERAL IMAGE DATA:=
+isotope name:=F-18
+isotope branching factor:=0.97
+%patient orientation:=HFS
+!energy window lower level [1]:=430
+!energy window upper level[1] :=610
+number of time frames:=2
+image relative start time (sec)[1]:=0
+image duration (sec)[1]:=1800
+image relative start time (sec)[2]:=1800
+image duration (sec)[2]:=1800
+!END OF INTERFILE:=
+isotope name:=C-11
+"""
+
+
+# A Siemens mMR listmode header, and the fields the plugin's java extractor must set for
+# it (see ListmodeHeaderFieldsTest)
+PLUGIN_HEADER_PATH = (
+    Path(__file__).parents[2]
+    / "src"
+    / "test"
+    / "resources"
+    / "org"
+    / "nrg"
+    / "xnat"
+    / "interfile"
+    / "header"
+    / "mmr.l.hdr"
+)
+
+
+@pytest.fixture
+def listmode_header_path(tmp_path):
+    header_path = tmp_path / "test.l.hdr"
+    header_path.write_text(LISTMODE_HEADER)
+    return header_path
+
+
+@pytest.mark.parametrize(
+    "key,expected",
+    [
+        ("!INTERFILE", "interfile"),
+        ("%patient   orientation ", "patient orientation"),
+        ("!Energy Window Lower Level [1]", "energy window lower level[1]"),
+    ],
+)
+def test_standardise_interfile_key(key, expected):
+    assert standardise_interfile_key(key) == expected
+
+
+def test_read_interfile_header(listmode_header_path):
+    header = read_interfile_header(listmode_header_path)
+
+    assert header["originating system"] == "2008"
+    assert header["name of data file"] == "test.l"
+    assert header["energy window upper level[1]"] == "610"
+
+    # section headings, comments and anything after the end of the header are ignored
+    assert "general data" not in header
+    assert "a comment line" not in header
+    assert header["isotope name"] == "F-18"
+
+    assert get_indexed_values(header, "image duration (sec)") == {
+        1: "1800",
+        2: "1800",
+    }
+
+
+def test_interfile_header_2_xnat(listmode_header_path):
+    xnat_hdr = interfile_header_2_xnat(read_interfile_header(listmode_header_path))
+
+    assert xnat_hdr["scans"] == "interfile:petLmScanData"
+    assert xnat_hdr["interfile:petLmScanData/scannerInformation/name"] == "Siemens mMR"
+    assert (
+        xnat_hdr["interfile:petLmScanData/radionuclideInformation/radionuclide"]
+        == "^18^Fluorine"
+    )
+    assert (
+        xnat_hdr["interfile:petLmScanData/radionuclideInformation/halfLife"] == 6586.2
+    )
+    assert (
+        xnat_hdr["interfile:petLmScanData/radionuclideInformation/branchingRatio"]
+        == 0.97
+    )
+    assert xnat_hdr["interfile:petLmScanData/examInformation/lowEnergyThres"] == 430
+    assert xnat_hdr["interfile:petLmScanData/examInformation/highEnergyThres"] == 610
+    assert xnat_hdr["interfile:petLmScanData/examInformation/patientPosition"] == "HFS"
+    assert xnat_hdr["interfile:petLmScanData/frameInformation/frameStart"] == 0
+    assert xnat_hdr["interfile:petLmScanData/frameInformation/frameEnd"] == 3600
+    assert xnat_hdr["interfile:petLmScanData/frameInformation/frameDuration"] == 3600
+
+
+def test_stir_values_have_the_table_fields(listmode_header_path):
+    """The stir backend sets its fields without FIELD_TABLES, so check they don't drift."""
+    header = read_interfile_header(listmode_header_path)
+    stir_hdr = _listmode_values_2_xnat("", "", 0, 0, 0, 0, 0, "", 0, 0)
+
+    assert (
+        stir_hdr.keys() == extract_interfile_fields(header, LISTMODE_SCAN_TYPE).keys()
+    )
+
+
+def test_native_fields_match_plugin():
+    """The plugin's java header extractor is checked against the same expected fields."""
+    expected_fields = {}
+    for line in (
+        PLUGIN_HEADER_PATH.with_name("mmr.l.hdr.fields").read_text().splitlines()
+    ):
+        if line and not line.startswith("#"):
+            path, value = line.split("=", 1)
+            expected_fields[f"{LISTMODE_SCAN_TYPE}/{path}"] = value
+
+    xnat_hdr = read_listmode_header_2_xnat(PLUGIN_HEADER_PATH, backend="native")
+
+    assert xnat_hdr.pop("scans") == LISTMODE_SCAN_TYPE
+    assert xnat_hdr.keys() == expected_fields.keys()
+    for name, value in xnat_hdr.items():
+        expected = expected_fields[name]
+        assert value == (expected if isinstance(value, str) else float(expected)), name
+
+
+def test_unknown_header_backend(listmode_header_path):
+    with pytest.raises(ValueError):
+        read_listmode_header_2_xnat(listmode_header_path, backend="unknown")
+
+
+@pytest.mark.skipif(importlib.util.find_spec("stir") is None, reason="requires stir")
+def test_native_and_stir_headers_match(interfile_file_path):
+    """The native header parser must give identical output to stir on real-world data."""
+
+    assert read_listmode_header_2_xnat(
+        interfile_file_path, backend="native"
+    ) == read_listmode_header_2_xnat(interfile_file_path, backend="stir")
@@ -0,0 +1,259 @@
+import logging
+
+import numpy as np
+import pytest
+
+from tests.fake_xnat import INTERFILE_XSD_PATH
+from tests.test_async_ingest import server_scan
+from tests.utils import write_interfile_data, write_listmode_acquisition
+from xnat_interfile.batch_ingest import find_acquisitions, ingest_acquisitions
+from xnat_interfile.data_stats import data_stats, header_data_dtype
+from xnat_interfile.interfile_2_xnat import (
+    IMAGE_SCAN_TYPE,
+    PROJECTION_SCAN_TYPE,
+    SCAN_TYPES,
+    extract_interfile_fields,
+    read_interfile_header_2_xnat,
+)
+from xnat_interfile.interfile_header import (
+    interfile_data_path,
+    matrix_element_count,
+    parse_interfile_header,
+)
+from xnat_interfile.metadata_export import schema_fields
+
+PROJECT = "interfile_project"
+
+# A STIR projection data header - 3 segments, with 5, 4 and 4 axial positions
+PROJECTION_HEADER = """!INTERFILE :=
+!imaging modality := PT
+name of data file := sino.s
+originating system := Siemens mMR
+!GENERAL IMAGE DATA :=
+!type of data := PET
+imagedata byte order := LITTLEENDIAN
+isotope name := F-18
+!PET STUDY (General) :=
+!PET data type := Emission
+!number format := float
+!number of bytes per pixel := 4
+number of dimensions := 4
+matrix axis label [4] := segment
+!matrix size [4] := 3
+matrix axis label [3] := view
+!matrix size [3] := 6
+matrix axis label [2] := axial coordinate
+!matrix size [2] := { 4, 5, 4 }
+matrix axis label [1] := tangential coordinate
+!matrix size [1] := 7
+effective central bin size (cm) := 0.208
+number of time frames := 1
+image duration (sec)[1] := 600
+image relative start time (sec)[1] := 60
+!END OF INTERFILE :=
+"""
+
+# A STIR image header - big endian 16-bit integers, scaled by 0.5
+IMAGE_HEADER = """!INTERFILE :=
+!imaging modality := PT
+name of data file := image.v
+!GENERAL IMAGE DATA :=
+imagedata byte order := BIGENDIAN
+isotope name := Ga-68
+patient orientation := head_in
+patient rotation := supine
+!PET data type := Image
+!number format := signed integer
+!number of bytes per pixel := 2
+number of dimensions := 3
+matrix axis label [1] := x
+!matrix size [1] := 8
+scaling factor (mm/pixel) [1] := 2.08626
+matrix axis label [2] := y
+!matrix size [2] := 6
+scaling factor (mm/pixel) [2] := 2.08626
+matrix axis label [3] := z
+!matrix size [3] := 4
+scaling factor (mm/pixel) [3] := 2.03125
+number of time frames := 1
+image scaling factor[1] := 0.5
+data offset in bytes[1] := 0
+quantification units := 1
+!END OF INTERFILE :=
+"""
+
+# arithmetic gives native byte order, so set the stored byte order afterwards
+PROJECTION_VALUES = (np.arange(6 * 13 * 7) - 100).astype("<f4")
+IMAGE_VALUES = (np.arange(8 * 6 * 4) * 3 - 50).astype(">i2")
+
+
+@pytest.fixture
+def projection_header_path(tmp_path):
+    return write_interfile_data(
+        tmp_path / "sino.hs", PROJECTION_HEADER, PROJECTION_VALUES
+    )
+
+
+@pytest.fixture
+def image_header_path(tmp_path):
+    return write_interfile_data(tmp_path / "image.hv", IMAGE_HEADER, IMAGE_VALUES)
+
+
+def test_projection_fields(projection_header_path):
+    xnat_hdr = read_interfile_header_2_xnat(projection_header_path, event_stats=True)
+
+    fields = {
+        name.removeprefix(f"{PROJECTION_SCAN_TYPE}/"): value
+        for name, value in xnat_hdr.items()
+    }
+    assert fields == {
+        "scans": PROJECTION_SCAN_TYPE,
+        "scannerInformation/name": "Siemens mMR",
+        "radionuclideInformation/radionuclide": "^18^Fluorine",
+        "radionuclideInformation/energy": 511.0,
+        "radionuclideInformation/halfLife": 6586.2,
+        "radionuclideInformation/branchingRatio": 0.9686,
+        "examInformation/patientPosition": "unknown",
+        "frameInformation/frameStart": 60.0,
+        "frameInformation/frameEnd": 660.0,
+        "frameInformation/frameDuration": 600.0,
+        "projectionInformation/dataType": "Emission",
+        "projectionInformation/numberOfSegments": 3,
+        "projectionInformation/numberOfViews": 6,
+        "projectionInformation/numberOfAxialPositions": 13,
+        "projectionInformation/numberOfTangentialPositions": 7,
+        "projectionInformation/binSize": 0.208,
+        "dataFormat/numberFormat": "float",
+        "dataFormat/bytesPerPixel": 4,
+        "dataFormat/byteOrder": "LITTLEENDIAN",
+        "dataFormat/numberOfValues": PROJECTION_VALUES.size,
+        "dataStatistics/minimum": -100.0,
+        "dataStatistics/maximum": float(PROJECTION_VALUES.max()),
+        "dataStatistics/sum": float(PROJECTION_VALUES.sum(dtype=np.float64)),
+    }
+
+
+def test_image_fields(image_header_path):
+    xnat_hdr = read_interfile_header_2_xnat(
+        image_header_path, backend="server", event_stats=True
+    )
+
+    assert xnat_hdr["scans"] == IMAGE_SCAN_TYPE
+    fields = {
+        name.removeprefix(f"{IMAGE_SCAN_TYPE}/"): value
+        for name, value in xnat_hdr.items()
+    }
+    assert fields["radionuclideInformation/radionuclide"] == "^68^Gallium"
+    assert fields["examInformation/patientPosition"] == "HFS"
+    assert [fields[f"imageInformation/matrixSize{axis}"] for axis in "XYZ"] == [8, 6, 4]
+    assert fields["imageInformation/voxelSizeZ"] == 2.03125
+    assert fields["imageInformation/quantificationUnits"] == "1"
+    assert fields["dataFormat/byteOrder"] == "BIGENDIAN"
+    # stored values scaled by the image scaling factor
+    assert fields["dataStatistics/minimum"] == -25.0
+    assert fields["dataStatistics/maximum"] == IMAGE_VALUES.max() * 0.5
+    assert fields["dataStatistics/sum"] == IMAGE_VALUES.sum() * 0.5
+
+
+@pytest.mark.parametrize("header_suffix", SCAN_TYPES)
+def test_fields_are_in_schema(tmp_path, header_suffix):
+    header_text = {".hs": PROJECTION_HEADER, ".hv": IMAGE_HEADER}.get(header_suffix)
+    if header_text is None:
+        header_text = write_listmode_acquisition(tmp_path / "lm.l.hdr").read_text()
+    header = parse_interfile_header(header_text.splitlines())
+    xsi_type = SCAN_TYPES[header_suffix]
+
+    paths = {
+        name.removeprefix(f"{xsi_type}/")
+        for name in extract_interfile_fields(header, xsi_type)
+        if name != "scans"
+    }
+
+    schema_paths = {field.path for field in schema_fields(INTERFILE_XSD_PATH, xsi_type)}
+    assert paths <= schema_paths
+    if header_suffix != ".l.hdr":
+        assert {"dataStatistics/minimum", "dataStatistics/sum"} <= schema_paths
+
+
+def test_data_stats_in_chunks(tmp_path):
+    values = np.random.default_rng(0).normal(size=10_001).astype(">f8")
+    data_path = tmp_path / "image.v"
+    data_path.write_bytes(b"\0" * 16 + values.tobytes())
+
+    stats = data_stats(
+        data_path, values.dtype, offset=16, chunk_values=1000, scaling_factor=-2.0
+    )
+
+    assert stats.n_values == values.size
+    assert stats.minimum == values.max() * -2.0
+    assert stats.maximum == values.min() * -2.0
+    assert stats.sum == pytest.approx(values.sum() * -2.0)
+
+    with pytest.raises(ValueError, match="less than"):
+        data_stats(data_path, values.dtype, offset=16, n_values=values.size + 1)
+
+
+def test_truncated_data_skips_stats(image_header_path, caplog):
+    data_path = interfile_data_path(image_header_path)
+    data_path.write_bytes(data_path.read_bytes()[:-2])
+
+    with caplog.at_level(logging.WARNING):
+        xnat_hdr = read_interfile_header_2_xnat(image_header_path, event_stats=True)
+
+    assert f"{IMAGE_SCAN_TYPE}/imageInformation/matrixSizeX" in xnat_hdr
+    assert not any("dataStatistics" in name for name in xnat_hdr)
+    assert "Skipping data statistics" in caplog.text
+
+
+def test_header_data_dtype():
+    header = parse_interfile_header(IMAGE_HEADER.splitlines())
+    assert header_data_dtype(header) == np.dtype(">i2")
+    assert matrix_element_count(header) == IMAGE_VALUES.size
+
+    # big endian floats unless the header says otherwise
+    assert header_data_dtype({}) == np.dtype(">f4")
+    with pytest.raises(ValueError, match="Unsupported number format"):
+        header_data_dtype({"number format": "bit"})
+
+
+def test_ingest_all_types(fake_xnat, fake_xnat_session, tmp_path):
+    root_dir = tmp_path / "exports"
+    write_listmode_acquisition(root_dir / "subject" / "experiment" / "listmode.l.hdr")
+    write_interfile_data(
+        root_dir / "subject" / "experiment" / "sino.hs",
+        PROJECTION_HEADER,
+        PROJECTION_VALUES,
+    )
+    write_interfile_data(
+        root_dir / "subject" / "experiment" / "image.hv", IMAGE_HEADER, IMAGE_VALUES
+    )
+
+    acquisitions = find_acquisitions(root_dir, PROJECT)
+    assert [acquisition.scan_name for acquisition in acquisitions] == [
+        "image",
+        "listmode",
+        "sino",
+    ]
+    results = ingest_acquisitions(
+        fake_xnat_session,
+        acquisitions,
+        max_header_workers=1,
+        header_backend="server",
+        event_stats=True,
+    )
+
+    assert all(result.ok for result in results)
+    for scan_name, xsi_type, data_name in [
+        ("sino", PROJECTION_SCAN_TYPE, "sino.s"),
+        ("image", IMAGE_SCAN_TYPE, "image.v"),
+    ]:
+        scan = server_scan(fake_xnat, "subject", "experiment", scan_name)
+        assert scan.xsi_type == xsi_type
+        assert set(scan.resources["PET_RAW"].files) == {
+            f"{scan_name}.{'hs' if scan_name == 'sino' else 'hv'}",
+            data_name,
+        }
+        assert "dataStatistics/sum" in scan.fields
+        assert scan.header_extraction is None
+    # the plugin only extracts listmode headers
+    assert fake_xnat.request_count("POST", r"/header$") == 1
@@ -0,0 +1,52 @@
+import pytest
+
+from xnat_interfile.label_index import LabelIndex, label_exists, subjects_uri
+
+
+class ListingSession:
+    """Minimal stand-in for the parts of xnat.XNATSession used for label lookups, which
+    counts the requests made."""
+
+    def __init__(self, labels):
+        self.labels = set(labels)
+        self.n_requests = 0
+
+    def head(self, path, accepted_status=None):
+        self.n_requests += 1
+        label = path.rsplit("/", 1)[-1]
+        return type(
+            "Response", (), {"status_code": 200 if label in self.labels else 404}
+        )
+
+    def get_json(self, uri, query=None):
+        self.n_requests += 1
+        return {"ResultSet": {"Result": [{"label": label} for label in self.labels]}}
+
+
+@pytest.mark.parametrize("n_subjects", [1, 10_000])
+def test_label_exists_single_request(n_subjects):
+    session = ListingSession(f"subject_{i}" for i in range(n_subjects))
+    parent_uri = subjects_uri("interfile_project")
+
+    assert label_exists(session, parent_uri, "subject_0")
+    assert not label_exists(session, parent_uri, "new_subject")
+    assert session.n_requests == 2
+
+
+def test_label_index_is_reused_and_updated():
+    session = ListingSession(["subject_0", "subject_1"])
+    label_index = LabelIndex(session)
+    parent_uri = subjects_uri("interfile_project")
+
+    assert label_index.contains(parent_uri, "subject_0")
+    assert not label_index.contains(parent_uri, "new_subject")
+
+    label_index.add(parent_uri, "new_subject")
+    assert label_index.contains(parent_uri, "new_subject")
+
+    # only the initial listing hits the server
+    assert session.n_requests == 1
+
+    label_index.refresh(parent_uri)
+    assert not label_index.contains(parent_uri, "new_subject")
+    assert session.n_requests == 2
@@ -0,0 +1,252 @@
+import resource
+
+import numpy as np
+import pytest
+
+from xnat_interfile.interfile_2_xnat import read_listmode_header_2_xnat
+from xnat_interfile.listmode_stats import (
+    FrameStats,
+    header_frame_schedule,
+    is_petlink_32bit,
+    listmode_event_stats,
+    parse_frame_schedule,
+)
+
+TIME_TAG = 0x80000000
+PROMPT = 0x40000000
+# a tag that isn't a time tag (e.g. a gantry motion tag)
+OTHER_TAG = 0xC0000000
+
+
+def make_listmode_words(n_ms, seed=0):
+    """Random 32-bit PETLINK listmode words - a time tag each ms followed by a random
+    mix of prompts, delayeds and other tags."""
+
+    rng = np.random.default_rng(seed)
+    words = []
+    for time_ms in range(n_ms):
+        words.append(TIME_TAG | time_ms)
+        n_events = int(rng.integers(0, 20))
+        events = rng.integers(0, PROMPT, size=n_events, dtype=np.uint32)
+        events |= np.where(rng.random(n_events) < 0.8, PROMPT, 0).astype(np.uint32)
+        events[rng.random(n_events) < 0.05] = OTHER_TAG
+        words.extend(int(event) for event in events)
+    return np.array(words, dtype=np.uint32)
+
+
+def python_event_stats(words):
+    """Reference per-event decoder"""
+
+    prompts, delayeds, times, counts_per_second = 0, 0, [], {}
+    for word in words.tolist():
+        if word & TIME_TAG == 0:
+            if word & PROMPT:
+                prompts += 1
+                second = times[-1] // 1000 if times else 0
+                counts_per_second[second] = counts_per_second.get(second, 0) + 1
+            else:
+                delayeds += 1
+        elif word & 0xE0000000 == TIME_TAG:
+            times.append(word & 0x1FFFFFFF)
+    return prompts, delayeds, times, counts_per_second
+
+
+@pytest.mark.parametrize("chunk_words", [7, 1000, 1024**2])
+def test_listmode_event_stats(tmp_path, chunk_words):
+    words = make_listmode_words(n_ms=5500)
+    data_path = tmp_path / "test.l"
+    words.astype("<u4").tofile(data_path)
+
+    stats = listmode_event_stats(data_path, chunk_words=chunk_words, count_rate_bins=3)
+    prompts, delayeds, times, counts_per_second = python_event_stats(words)
+
+    assert stats.total_prompts == prompts
+    assert stats.total_delayeds == delayeds
+    assert stats.total_events == prompts + delayeds
+    assert stats.acquisition_duration == pytest.approx(5.5)
+
+    # 6 seconds of data in 3 bins of 2s
+    assert stats.count_rate_bin_duration == 2.0
+    expected_curve = [
+        (counts_per_second.get(second, 0) + counts_per_second.get(second + 1, 0)) / 2
+        for second in (0, 2, 4)
+    ]
+    assert stats.count_rate_curve == pytest.approx(expected_curve, abs=0.05)
+
+
+def test_listmode_event_stats_big_endian(tmp_path):
+    words = make_listmode_words(n_ms=100)
+    data_path = tmp_path / "test.l"
+    words.astype(">u4").tofile(data_path)
+
+    stats = listmode_event_stats(data_path, byte_order=">")
+    assert stats.total_prompts == python_event_stats(words)[0]
+
+
+def test_listmode_event_stats_empty_file(tmp_path):
+    data_path = tmp_path / "test.l"
+    data_path.touch()
+
+    stats = listmode_event_stats(data_path)
+    assert stats.total_events == 0
+    assert stats.acquisition_duration == 0.0
+    assert stats.count_rate_curve == []
+
+
+def python_frame_counts(words, frame_schedule):
+    """Reference per-event count of the prompts and delayeds in each frame"""
+
+    counts = [[0, 0] for _ in frame_schedule]
+    time_ms = 0
+    for word in words.tolist():
+        if word & 0xE0000000 == TIME_TAG:
+            time_ms = word & 0x1FFFFFFF
+        elif word & TIME_TAG == 0:
+            for frame, (start, duration) in enumerate(frame_schedule):
+                if start * 1000 <= time_ms < (start + duration) * 1000:
+                    counts[frame][0 if word & PROMPT else 1] += 1
+    return counts
+
+
+@pytest.mark.parametrize("chunk_words", [7, 1000, 1024**2])
+def test_listmode_frame_counts(tmp_path, chunk_words):
+    words = make_listmode_words(n_ms=5500)
+    data_path = tmp_path / "test.l"
+    words.astype("<u4").tofile(data_path)
+    # a gap between the 2nd and 3rd frames, and the last running past the data
+    frame_schedule = [(0.0, 0.5), (0.5, 1.5), (2.5, 0.25), (4.0, 10.0)]
+
+    stats = listmode_event_stats(
+        data_path, chunk_words=chunk_words, frame_schedule=frame_schedule
+    )
+
+    assert [
+        [frame.prompts, frame.delayeds] for frame in stats.frames
+    ] == python_frame_counts(words, frame_schedule)
+    assert stats.frames[1] == FrameStats(
+        0.5, 1.5, stats.frames[1].prompts, stats.frames[1].delayeds
+    )
+    assert listmode_event_stats(data_path).frames == []
+
+
+def test_invalid_frame_schedule(tmp_path):
+    data_path = tmp_path / "test.l"
+    data_path.touch()
+
+    with pytest.raises(ValueError, match="without overlapping"):
+        listmode_event_stats(data_path, frame_schedule=[(0.0, 10.0), (5.0, 10.0)])
+
+
+def test_parse_frame_schedule():
+    assert parse_frame_schedule("2x10, 1*30,5") == [
+        (0.0, 10.0),
+        (10.0, 10.0),
+        (20.0, 30.0),
+        (50.0, 5.0),
+    ]
+    with pytest.raises(ValueError, match="can't parse"):
+        parse_frame_schedule("10,x")
+    with pytest.raises(ValueError):
+        parse_frame_schedule("0")
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        (
+            {
+                "image duration (sec)[1]": "60",
+                "image relative start time (sec)[1]": "0",
+                "image duration (sec)[2]": "120",
+                "image relative start time (sec)[2]": "60",
+            },
+            [(0.0, 60.0), (60.0, 120.0)],
+        ),
+        (
+            {"image duration (sec)[1]": "10", "image duration (sec)[2]": "20"},
+            [(0.0, 10.0), (10.0, 20.0)],
+        ),
+        ({"image duration (sec)": "600"}, [(0.0, 600.0)]),
+        ({}, []),
+    ],
+)
+def test_header_frame_schedule(header, expected):
+    assert header_frame_schedule(header) == expected
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ({"lm event and tag words format (bits)": "32"}, True),
+        ({"lm event and tag words format": "32-bit"}, True),
+        ({"lm event and tag words format (bits)": "64"}, False),
+        ({}, False),
+    ],
+)
+def test_is_petlink_32bit(header, expected):
+    assert is_petlink_32bit(header) == expected
+
+
+def test_read_listmode_header_with_event_stats(tmp_path):
+    header_path = tmp_path / "test.l.hdr"
+    header_path.write_text(
+        "!INTERFILE:=\n%LM event and tag words format (bits):=32\n!END OF INTERFILE:=\n"
+    )
+    words = make_listmode_words(n_ms=2000)
+    words.astype("<u4").tofile(tmp_path / "test.l")
+
+    xnat_hdr = read_listmode_header_2_xnat(header_path, event_stats=True)
+
+    prefix = "interfile:petLmScanData/eventStatistics"
+    assert xnat_hdr[f"{prefix}/totalPrompts"] == python_event_stats(words)[0]
+    assert xnat_hdr[f"{prefix}/acquisitionDuration"] == pytest.approx(2.0)
+    assert len(xnat_hdr[f"{prefix}/countRateCurve"].split()) == 2
+
+    assert f"{prefix}/totalPrompts" not in read_listmode_header_2_xnat(header_path)
+
+
+def test_read_listmode_header_with_frames(tmp_path):
+    header_path = tmp_path / "test.l.hdr"
+    header_path.write_text(
+        "!INTERFILE:=\n%LM event and tag words format (bits):=32\n"
+        "image duration (sec)[1]:=1\nimage duration (sec)[2]:=1\n!END OF INTERFILE:=\n"
+    )
+    words = make_listmode_words(n_ms=2000)
+    words.astype("<u4").tofile(tmp_path / "test.l")
+
+    xnat_hdr = read_listmode_header_2_xnat(header_path, event_stats=True)
+
+    prefix = "interfile:petLmScanData/frames/frame"
+    (first, second) = python_frame_counts(words, [(0.0, 1.0), (1.0, 1.0)])
+    assert xnat_hdr[f"{prefix}[0]/number"] == 1
+    assert xnat_hdr[f"{prefix}[0]/prompts"] == first[0]
+    assert xnat_hdr[f"{prefix}[1]/start"] == 1.0
+    assert xnat_hdr[f"{prefix}[1]/delayeds"] == second[1]
+    assert f"{prefix}[2]/start" not in xnat_hdr
+
+    # a frame schedule replaces the header's frames
+    xnat_hdr = read_listmode_header_2_xnat(
+        header_path, event_stats=True, frame_schedule=[(0.0, 2.0)]
+    )
+    assert xnat_hdr[f"{prefix}[0]/prompts"] == first[0] + second[0]
+    assert f"{prefix}[1]/start" not in xnat_hdr
+
+
+@pytest.mark.slow
+def test_listmode_event_stats_memory_is_bounded(tmp_path):
+    """Decode a (sparse) multi-GB file, and check peak memory use stays well below the
+    file size."""
+
+    file_size = 2 * 1024**3
+    data_path = tmp_path / "large.l"
+    with open(data_path, "wb") as f:
+        f.truncate(file_size)
+
+    # ru_maxrss is in kB on linux
+    peak_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    stats = listmode_event_stats(data_path)
+    peak_rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    # all-zero words are delayeds
+    assert stats.total_delayeds == file_size // 4
+    assert peak_rss_after - peak_rss_before < 256 * 1024**2
@@ -0,0 +1,126 @@
+import csv
+from xml.etree import ElementTree
+
+import numpy as np
+import pytest
+
+from tests.fake_xnat import INTERFILE_XSD_PATH
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.metadata_export import (
+    SchemaField,
+    export_scan_metadata,
+    export_scan_metadata_csv,
+    iter_scan_metadata,
+    schema_fields,
+    search_xml,
+)
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+
+PROJECT = "interfile_project"
+
+
+@pytest.fixture
+def archived_scans(tmp_path, fake_xnat_session):
+    """Three scans in two subjects - the last without event statistics"""
+
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    for subject_name, experiment_name, event_stats in [
+        ("subject1", "experiment1", True),
+        ("subject2", "experiment2", True),
+        ("subject3", "experiment3", False),
+    ]:
+        upload_interfile_data(
+            fake_xnat_session,
+            header_path,
+            PROJECT,
+            subject_name,
+            experiment_name,
+            "scan",
+            event_stats=event_stats,
+        )
+
+
+def test_schema_fields():
+    fields = schema_fields(INTERFILE_XSD_PATH)
+
+    assert SchemaField("scannerInformation/name", "string") in fields
+    assert SchemaField("radionuclideInformation/halfLife", "float") in fields
+    assert SchemaField("eventStatistics/totalPrompts", "decimal") in fields
+    assert SchemaField("eventStatistics/countRateCurve", "string") in fields
+    assert all("/" in field.path for field in fields)
+
+    half_life = SchemaField("radionuclideInformation/halfLife", "float")
+    assert half_life.search_field() == "RADIONUCLIDEINFORMATION_HALFLIFE"
+    assert half_life.numeric
+
+
+def test_search_xml():
+    fields = [SchemaField("scannerInformation/name", "string")]
+    ns = {"xdat": "http://nrg.wustl.edu/security"}
+
+    search = ElementTree.fromstring(search_xml("a&b", fields))
+
+    assert search.findtext("xdat:root_element_name", namespaces=ns) == (
+        "interfile:petLmScanData"
+    )
+    assert [
+        element.text for element in search.iterfind(".//xdat:field_ID", namespaces=ns)
+    ] == ["PROJECT", "SUBJECT_ID", "SESSION_LABEL", "ID", "SCANNERINFORMATION_NAME"]
+    assert search.findtext(".//xdat:value", namespaces=ns) == "a&b"
+
+
+@pytest.mark.usefixtures("archived_scans")
+def test_export_scan_metadata(fake_xnat, fake_xnat_session):
+    before = fake_xnat.request_count("POST")
+
+    table = export_scan_metadata(fake_xnat_session, PROJECT)
+
+    assert fake_xnat.request_count("POST", "/data/search") - before == 1
+    assert list(table["experiment_label"]) == [
+        "experiment1",
+        "experiment2",
+        "experiment3",
+    ]
+    assert list(table["scan_id"]) == ["scan"] * 3
+    assert list(table["scannerInformation/name"]) == ["Siemens mMR"] * 3
+    assert table["radionuclideInformation/energy"].dtype == np.float64
+    np.testing.assert_array_equal(
+        table["eventStatistics/totalPrompts"], [10000, 10000, np.nan]
+    )
+
+
+@pytest.mark.usefixtures("archived_scans")
+def test_iter_scan_metadata_batches(fake_xnat_session):
+    fields = [SchemaField("frameInformation/frameDuration", "float")]
+
+    batches = list(iter_scan_metadata(fake_xnat_session, PROJECT, fields, batch_size=2))
+
+    assert [len(batch["scan_id"]) for batch in batches] == [2, 1]
+    assert list(batches[0]) == [
+        "project",
+        "subject_id",
+        "experiment_label",
+        "scan_id",
+        "frameInformation/frameDuration",
+    ]
+
+
+def test_export_empty_project(fake_xnat_session):
+    table = export_scan_metadata(fake_xnat_session, PROJECT)
+
+    assert len(table["scan_id"]) == 0
+    assert "radionuclideInformation/halfLife" in table
+
+
+@pytest.mark.usefixtures("archived_scans")
+def test_export_scan_metadata_csv(tmp_path, fake_xnat_session):
+    output_path = tmp_path / "metadata.csv"
+
+    n_scans = export_scan_metadata_csv(fake_xnat_session, PROJECT, output_path)
+
+    with open(output_path, newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert n_scans == len(rows) == 3
+    assert rows[0]["project"] == PROJECT
+    assert rows[0]["examInformation/patientPosition"] == "unknown"
+    assert rows[2]["eventStatistics/totalPrompts"] == ""
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from xnat_interfile.metrics import (
+    JsonLinesSink,
+    MetricsRecorder,
+    PrometheusTextSink,
+    StageTiming,
+    timed_stage,
+)
+
+
+def record_timings(metrics):
+    for seconds in range(1, 101):
+        metrics.record(StageTiming("subject", seconds / 100, 0.0, name=f"s{seconds}"))
+    metrics.record(StageTiming("upload", 2.0, 0.0, name="test.l", n_bytes=4_000_000))
+
+
+def test_timed_stage():
+    metrics = MetricsRecorder()
+
+    with timed_stage(metrics, "upload", "test.l") as stage:
+        stage.n_bytes = 1024
+    with pytest.raises(ValueError):
+        with timed_stage(metrics, "scan_put", "scan"):
+            raise ValueError("failed")
+    # no metrics to record in
+    with timed_stage(None, "header"):
+        pass
+
+    assert [timing.stage for timing in metrics.timings] == ["upload"]
+    assert metrics.timings[0].name == "test.l"
+    assert metrics.timings[0].n_bytes == 1024
+    assert metrics.timings[0].bytes_per_second > 0
+
+
+def test_summary():
+    metrics = MetricsRecorder()
+    record_timings(metrics)
+
+    summary = metrics.summary()
+
+    assert summary["subject"]["count"] == 100
+    assert summary["subject"]["p50"] == pytest.approx(0.505)
+    assert summary["subject"]["p95"] == pytest.approx(0.9505)
+    assert summary["upload"]["n_bytes"] == 4_000_000
+
+
+def test_summary_window():
+    """Quantiles are of the most recent durations only, but counts and totals cover
+    every timing"""
+
+    metrics = MetricsRecorder(window_size=10, max_timings=5)
+    record_timings(metrics)
+
+    summary = metrics.summary()
+
+    assert summary["subject"]["count"] == 100
+    assert summary["subject"]["total"] == pytest.approx(50.5)
+    assert summary["subject"]["p50"] == pytest.approx(0.955)
+    assert len(metrics.timings) == 5
+    assert metrics.timings[-1].stage == "upload"
+
+
+def test_json_lines_sink(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    with MetricsRecorder([JsonLinesSink(path)]) as metrics:
+        record_timings(metrics)
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 101
+    assert lines[-1]["stage"] == "upload"
+    assert lines[-1]["bytes_per_second"] == 2_000_000
+
+
+def test_json_lines_sink_needs_with_block(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    metrics = MetricsRecorder([JsonLinesSink(path)])
+
+    with pytest.raises(RuntimeError, match="with block"):
+        record_timings(metrics)
+
+    with metrics:
+        pass
+    with pytest.raises(RuntimeError, match="with block"):
+        record_timings(metrics)
+
+
+def test_prometheus_text_sink(tmp_path):
+    path = tmp_path / "metrics.prom"
+    with MetricsRecorder([PrometheusTextSink(path, min_interval=60)]) as metrics:
+        record_timings(metrics)
+
+    text = path.read_text()
+    assert 'xnat_interfile_stage_seconds{stage="subject",quantile="0.95"}' in text
+    assert 'xnat_interfile_stage_seconds_count{stage="subject"} 100' in text
+    assert 'xnat_interfile_stage_bytes_total{stage="upload"} 4000000' in text
+    assert list(tmp_path.iterdir()) == [path]
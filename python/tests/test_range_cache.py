@@ -0,0 +1,138 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+from tests.test_async_ingest import server_scan
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.download import RangeCache, download_listmode_frames
+from xnat_interfile.label_index import experiments_uri
+from xnat_interfile.listmode_stats import listmode_event_stats
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+from xnat_interfile.retry import RetryPolicy
+
+PROJECT = "interfile_project"
+
+RESOURCE_URI = (
+    f"{experiments_uri(PROJECT, 'subject')}/experiment/scans/scan/resources/PET_RAW"
+)
+
+# each ms of the synthetic acquisition is a time tag and 10 prompts
+BYTES_PER_MS = 44
+
+DATA_PATTERN = r"/files/scan\.l$"
+
+
+@pytest.fixture
+def header_path(fake_xnat_session, tmp_path):
+    header_path = write_listmode_acquisition(tmp_path / "data" / "scan.l.hdr")
+    upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        event_stats=False,
+    )
+    return header_path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with RangeCache(tmp_path / "cache", block_size=1024) as cache:
+        yield cache
+
+
+def test_download_listmode_frames(fake_xnat, fake_xnat_session, header_path, cache):
+    data = header_path.with_name("scan.l").read_bytes()
+    frame_schedule = [(0.2, 0.1), (0.5, 0.05)]
+
+    with download_listmode_frames(
+        fake_xnat_session, RESOURCE_URI, "scan.l.hdr", cache, frame_schedule
+    ) as frames:
+        assert frames.ranges == [
+            (200 * BYTES_PER_MS, 300 * BYTES_PER_MS),
+            (500 * BYTES_PER_MS, 550 * BYTES_PER_MS),
+        ]
+        for frame, (start, end) in enumerate(frames.ranges):
+            words = frames.frame_words(frame)
+            assert words.tobytes() == data[start:end]
+            del words
+        assert not frames.data_file.is_cached(0, len(data))
+        assert not frames.data_file.is_cached(400 * BYTES_PER_MS, 450 * BYTES_PER_MS)
+
+    # the same events as are counted in each frame on ingest
+    stats = listmode_event_stats(
+        header_path.with_name("scan.l"), frame_schedule=frame_schedule
+    )
+    assert [frame.prompts for frame in stats.frames] == [1000, 500]
+
+    # fetched from the cache the second time
+    n_requests = fake_xnat.request_count("GET", DATA_PATTERN)
+    with download_listmode_frames(
+        fake_xnat_session, RESOURCE_URI, "scan.l.hdr", cache, frame_schedule
+    ) as frames:
+        assert frames.frame_words(1)[0] == 0x80000000 | 500
+    assert fake_xnat.request_count("GET", DATA_PATTERN) == n_requests
+
+
+def test_download_header_frames(fake_xnat_session, header_path, cache):
+    data = header_path.with_name("scan.l").read_bytes()
+
+    with download_listmode_frames(
+        fake_xnat_session, RESOURCE_URI, "scan.l.hdr", cache
+    ) as frames:
+        assert frames.frame_schedule == [(0.0, 1.0)]
+        assert frames.ranges == [(0, len(data))]
+        assert frames.data_file.data[:] == data
+
+
+def test_failed_range_retried(fake_xnat, fake_xnat_session, header_path, tmp_path):
+    data = header_path.with_name("scan.l").read_bytes()
+    fake_xnat.fail_next("GET", DATA_PATTERN, times=2)
+
+    with (
+        RangeCache(tmp_path / "cache", block_size=1024) as cache,
+        cache.open(
+            fake_xnat_session,
+            f"{RESOURCE_URI}/files/scan.l",
+            retry=RetryPolicy(base_delay=0.01),
+        ) as data_file,
+    ):
+        assert data_file.fetch([(1000, 5000), (10_000, 10_004)]) == 6 * 1024
+        assert data_file.data[1000:5000] == data[1000:5000]
+        assert data_file.data[10_000:10_004] == data[10_000:10_004]
+        assert data_file.fetch([(2000, 3000)]) == 0
+
+
+def test_cache_cleared_when_file_changes(
+    fake_xnat, fake_xnat_session, header_path, cache
+):
+    file_uri = f"{RESOURCE_URI}/files/scan.l"
+    with cache.open(fake_xnat_session, file_uri) as data_file:
+        data_file.fetch([(0, 1024)])
+
+    changed = np.arange(11_000, dtype="<u4").tobytes()
+    with fake_xnat.state.lock:
+        resource = server_scan(fake_xnat, "subject", "experiment", "scan").resources[
+            "PET_RAW"
+        ]
+        resource.files["scan.l"] = (hashlib.md5(changed).hexdigest(), len(changed))
+        resource.contents["scan.l"] = changed
+
+    with cache.open(fake_xnat_session, file_uri) as data_file:
+        assert not data_file.is_cached(0, 1024)
+        data_file.fetch([(0, 1024)])
+        assert data_file.data[:1024] == changed[:1024]
+
+
+def test_cached_file_open_in_with_block(fake_xnat_session, header_path, cache):
+    data_file = cache.open(fake_xnat_session, f"{RESOURCE_URI}/files/scan.l")
+    with pytest.raises(RuntimeError, match="with block"):
+        data_file.fetch([(0, 1024)])
+
+    with data_file:
+        assert data_file.fetch([(0, 1024)]) == 1024
+    with pytest.raises(RuntimeError, match="with block"):
+        data_file.fetch([(0, 2048)])
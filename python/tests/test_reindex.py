@@ -0,0 +1,128 @@
+import pytest
+
+from tests.test_async_ingest import server_scan
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.batch_ingest import Acquisition
+from xnat_interfile.ingest_journal import IngestJournal
+from xnat_interfile.metadata_export import SchemaField
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+from xnat_interfile.reindex import changed_fields, reindex_scans
+
+PROJECT = "interfile_project"
+
+HALF_LIFE = "radionuclideInformation/halfLife"
+TOTAL_PROMPTS = "eventStatistics/totalPrompts"
+
+
+@pytest.fixture
+def acquisitions(tmp_path, fake_xnat, fake_xnat_session):
+    """Three archived scans with stale fields, as left by an older converter - halfLife
+    holds the branching ratio, and the first scan has no energy"""
+
+    acquisitions = []
+    for index in range(3):
+        acquisition = Acquisition(
+            write_listmode_acquisition(tmp_path / f"scan{index}.l.hdr", seed=index),
+            PROJECT,
+            f"subject{index}",
+            f"experiment{index}",
+            "scan",
+        )
+        upload_interfile_data(
+            fake_xnat_session,
+            acquisition.header_path,
+            *acquisition.key.split("/"),
+            event_stats=False,
+        )
+        acquisitions.append(acquisition)
+
+    for index in range(3):
+        scan = server_scan(fake_xnat, f"subject{index}", f"experiment{index}", "scan")
+        scan.fields[HALF_LIFE] = "0.9686"
+    del scan_fields(fake_xnat, 0)["radionuclideInformation/energy"]
+    return acquisitions
+
+
+def scan_fields(server, index):
+    return server_scan(server, f"subject{index}", f"experiment{index}", "scan").fields
+
+
+def test_changed_fields():
+    fields = [
+        SchemaField("radionuclideInformation/energy", "float"),
+        SchemaField("scannerInformation/name", "string"),
+    ]
+    stored = {"radionuclideInformation/energy": "511", "scannerInformation/name": ""}
+    xnat_hdr = {
+        "scans": "interfile:petLmScanData",
+        "interfile:petLmScanData/radionuclideInformation/energy": 511.0,
+        "interfile:petLmScanData/scannerInformation/name": "Siemens mMR",
+        "interfile:petLmScanData/notInSchema": "value",
+    }
+
+    assert changed_fields(stored, xnat_hdr, fields) == {
+        "interfile:petLmScanData/scannerInformation/name": "Siemens mMR"
+    }
+
+
+@pytest.mark.usefixtures("acquisitions")
+def test_reindex_from_archive(fake_xnat, fake_xnat_session):
+    before = fake_xnat.request_count("PUT")
+
+    results = reindex_scans(fake_xnat_session, PROJECT)
+
+    assert [result.ok for result in results] == [True] * 3
+    assert [sorted(result.changed) for result in results] == [
+        [
+            "interfile:petLmScanData/radionuclideInformation/energy",
+            "interfile:petLmScanData/radionuclideInformation/halfLife",
+        ],
+        ["interfile:petLmScanData/radionuclideInformation/halfLife"],
+        ["interfile:petLmScanData/radionuclideInformation/halfLife"],
+    ]
+    assert fake_xnat.request_count("PUT") - before == 3
+    for index in range(3):
+        assert scan_fields(fake_xnat, index)[HALF_LIFE] == "6586.2"
+    assert scan_fields(fake_xnat, 0)["radionuclideInformation/energy"] == "511.0"
+    # event statistics can't be decoded from the archive, so are left unset
+    assert TOTAL_PROMPTS not in scan_fields(fake_xnat, 0)
+
+
+@pytest.mark.usefixtures("acquisitions")
+def test_reindex_dry_run(fake_xnat, fake_xnat_session):
+    before = fake_xnat.request_count("PUT")
+
+    results = reindex_scans(fake_xnat_session, PROJECT, dry_run=True)
+
+    assert all(result.changed for result in results)
+    assert fake_xnat.request_count("PUT") == before
+    assert scan_fields(fake_xnat, 0)[HALF_LIFE] == "0.9686"
+
+
+def test_reindex_from_local_copies(fake_xnat, fake_xnat_session, acquisitions):
+    results = reindex_scans(
+        fake_xnat_session, PROJECT, acquisitions=acquisitions, event_stats=True
+    )
+
+    assert [result.ok for result in results] == [True] * 3
+    # the archived headers aren't downloaded
+    assert fake_xnat.request_count("GET", r"/files/scan0\.l\.hdr$") == 0
+    assert scan_fields(fake_xnat, 0)[TOTAL_PROMPTS] == "10000"
+    assert scan_fields(fake_xnat, 2)[HALF_LIFE] == "6586.2"
+
+
+@pytest.mark.usefixtures("acquisitions")
+def test_reindex_resumes_from_journal(tmp_path, fake_xnat, fake_xnat_session):
+    fake_xnat.fail_next("GET", r"/experiment1/scans/scan/resources/PET_RAW/files/")
+
+    with IngestJournal(tmp_path / "journal.sqlite") as journal:
+        results = reindex_scans(fake_xnat_session, PROJECT, journal=journal, retry=None)
+        assert [result.ok for result in results] == [True, False, True]
+
+        before = fake_xnat.request_count("PUT")
+        results = reindex_scans(fake_xnat_session, PROJECT, journal=journal)
+
+    assert [result.skipped for result in results] == [True, False, True]
+    assert results[1].ok
+    assert fake_xnat.request_count("PUT") - before == 1
+    assert scan_fields(fake_xnat, 1)[HALF_LIFE] == "6586.2"
@@ -0,0 +1,228 @@
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+import requests
+from xnat.exceptions import XNATResponseError
+
+from tests.test_fake_xnat import server_files
+from tests.utils import write_listmode_acquisition
+from xnat_interfile import retry as retry_module
+from xnat_interfile.batch_ingest import Acquisition, ingest_acquisitions
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+from xnat_interfile.retry import (
+    AdaptiveConcurrencyLimit,
+    RetryPolicy,
+    request_with_retry,
+    retry_after_seconds,
+)
+
+PROJECT = "interfile_project"
+
+FAST_RETRY = RetryPolicy(base_delay=0.01)
+
+
+def response(status_code, headers=None):
+    return SimpleNamespace(
+        status_code=status_code,
+        headers=headers or {},
+        text=f"status {status_code}",
+        url="/data/test",
+    )
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the delays between retries, rather than waiting for them"""
+
+    delays = []
+    monkeypatch.setattr(retry_module.time, "sleep", delays.append)
+    return delays
+
+
+def sender(outcomes):
+    """send function for request_with_retry, returning (or raising) each of outcomes in
+    turn, and recording the attempts and accepted statuses it's called with"""
+
+    calls = []
+
+    def send(attempt, accepted_status):
+        calls.append((attempt, accepted_status))
+        outcome = outcomes[len(calls) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return send, calls
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({}, None),
+        ({"Retry-After": "3"}, 3.0),
+        ({"Retry-After": "-1"}, 0.0),
+        ({"Retry-After": formatdate(time.time() - 60, usegmt=True)}, 0.0),
+        ({"Retry-After": "soon"}, None),
+    ],
+)
+def test_retry_after_seconds(headers, expected):
+    assert retry_after_seconds(headers) == expected
+
+
+def test_retry_after_date():
+    retry_after = retry_after_seconds(
+        {"Retry-After": formatdate(time.time() + 60, usegmt=True)}
+    )
+    assert 55 < retry_after <= 60
+
+
+def test_backoff_delay():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+
+    for attempt, max_delay in [(1, 1.0), (2, 2.0), (3, 4.0), (4, 5.0), (10, 5.0)]:
+        delays = [policy.delay(attempt) for _ in range(100)]
+        assert all(0 <= delay <= max_delay for delay in delays)
+        # jittered, rather than all the same
+        assert len(set(delays)) > 1
+    assert 42.0 <= policy.delay(10, retry_after=42.0) <= 46.2
+
+
+def test_retry_after_delay_is_capped():
+    policy = RetryPolicy(max_retry_after=60.0)
+
+    delays = [policy.delay(1, retry_after=3600.0) for _ in range(100)]
+    assert all(60.0 <= delay <= 66.0 for delay in delays)
+    # jittered, so clients told to wait the same time don't all retry at once
+    assert len(set(delays)) > 1
+
+
+def test_retry_transient_status(sleeps):
+    send, calls = sender(
+        [
+            response(503, {"Retry-After": "2"}),
+            requests.ConnectionError("reset"),
+            response(200),
+        ]
+    )
+
+    assert request_with_retry(send, FAST_RETRY, "Test").status_code == 200
+    assert [attempt for attempt, _ in calls] == [1, 2, 3]
+    assert 503 in calls[0][1]
+    assert 2.0 <= sleeps[0] <= 2.2
+    assert len(sleeps) == 2
+
+
+def test_retry_gives_up(sleeps):
+    send, calls = sender([response(503)] * 3)
+
+    with pytest.raises(XNATResponseError, match="failed after 3 attempts") as error:
+        request_with_retry(send, RetryPolicy(max_attempts=3), "Test")
+
+    assert error.value.status_code == 503
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_no_retry_of_other_errors(sleeps):
+    not_found = XNATResponseError("Not found", response=response(404))
+    send, calls = sender([not_found])
+
+    with pytest.raises(XNATResponseError):
+        request_with_retry(send, FAST_RETRY, "Test")
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_retry_disabled():
+    send, calls = sender([response(200)])
+
+    request_with_retry(send, None, "Test", accepted_status=[200])
+    # transient statuses are left to xnat-py to reject
+    assert calls == [(1, [200])]
+
+
+def test_adaptive_concurrency_limit():
+    limit = AdaptiveConcurrencyLimit(max_limit=8, cooldown=0.0)
+
+    limit.record_failure()
+    assert limit.limit == 4
+    for _ in range(3):
+        limit.record_failure()
+    assert limit.limit == 1
+
+    # additive increase - about limit successes to increase the limit by one
+    limit.record_success()
+    assert limit.limit == 2
+    for _ in range(3):
+        limit.record_success()
+    assert limit.limit == 3
+    for _ in range(100):
+        limit.record_success()
+    assert limit.limit == 8
+
+
+def test_adaptive_concurrency_limit_cooldown():
+    limit = AdaptiveConcurrencyLimit(max_limit=8, cooldown=60.0)
+
+    for _ in range(5):
+        limit.record_failure()
+    assert limit.limit == 4
+
+
+def test_upload_retries_transient_errors(tmp_path, fake_xnat, fake_xnat_session):
+    """Transient failures of the scan PUT, resource creation and file uploads are retried,
+    and the retried upload overwrites the file"""
+
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    fake_xnat.fail_next("PUT", r"/scans/scan$", status=503, retry_after=1)
+    fake_xnat.fail_next("PUT", r"/resources/PET_RAW$", status=502)
+    fake_xnat.fail_next("PUT", r"/files/scan\.l$", status=503, times=2)
+
+    start = time.perf_counter()
+    upload_interfile_data(
+        fake_xnat_session,
+        header_path,
+        PROJECT,
+        "subject",
+        "experiment",
+        "scan",
+        retry=FAST_RETRY,
+    )
+
+    assert time.perf_counter() - start >= 1.0
+    assert set(server_files(fake_xnat, "subject", "experiment", "scan")) == {
+        "scan.l.hdr",
+        "scan.l",
+    }
+    assert fake_xnat.request_count("PUT", r"/files/scan\.l$") == 3
+
+
+def test_batch_ingest_adapts_to_errors(tmp_path, fake_xnat, fake_xnat_session, caplog):
+    acquisitions = [
+        Acquisition(
+            write_listmode_acquisition(tmp_path / f"scan{index}.l.hdr", seed=index),
+            PROJECT,
+            f"subject{index}",
+            f"experiment{index}",
+            "scan",
+        )
+        for index in range(8)
+    ]
+    concurrency_limit = AdaptiveConcurrencyLimit(max_limit=4, cooldown=0.0)
+    fake_xnat.fail_next("PUT", r"/files/", status=503, times=4)
+
+    results = ingest_acquisitions(
+        fake_xnat_session,
+        acquisitions,
+        max_header_workers=2,
+        max_upload_workers=4,
+        retry=RetryPolicy(base_delay=0.01, concurrency_limit=concurrency_limit),
+    )
+
+    assert [result.error for result in results] == [None] * 8
+    assert fake_xnat.request_count("PUT", r"/files/") == 8 * 2 + 4
+    # cut while uploads were failing, then grew back
+    assert "reduced upload concurrency to 1" in caplog.text
+    assert concurrency_limit.limit == 4
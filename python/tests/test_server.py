@@ -1,60 +1,20 @@
 import xnat
-from pathlib import Path
-import xmlschema
+from xml.etree import ElementTree
 import pytest
 import stir
 import subprocess
 
-from xnat_interfile.interfile_2_xnat import interfile_listmode_2_xnat
+from tests.fake_xnat import INTERFILE_XSD_PATH
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.interfile_2_xnat import (
+    SCAN_TYPES,
+    interfile_listmode_2_xnat,
+    read_listmode_header_2_xnat,
+)
+from xnat_interfile.metadata_export import schema_fields
 from xnat_interfile.populate_datatype_fields import upload_interfile_data, add_project
 
 
-@pytest.fixture
-def interfile_schema_fields():
-    """Read data fields from the plugin's interfile schema file - interfile.xsd - and convert to xnat style."""
-
-    interfile_schema_file = (
-        Path(__file__).parents[2]
-        / "src"
-        / "main"
-        / "resources"
-        / "schemas"
-        / "interfile"
-        / "interfile.xsd"
-    )
-    interfile_schema = xmlschema.XMLSchema(interfile_schema_file, validation="skip")
-
-    # we only want the 'leaves' of the xml tree - not intermediate elements
-    components = [
-        component
-        for component in interfile_schema.iter_components(
-            xsd_classes=(xmlschema.validators.elements.XsdElement,)
-        )
-    ]
-    filtered_components = []
-    for component in components:
-        if isinstance(component.type, xmlschema.validators.simple_types.XsdSimpleType):
-            filtered_components.append(component)
-        elif (component.type.name is not None) and (
-            component.type.name.endswith("anyType")
-        ):
-            filtered_components.append(component)
-
-    # get full path to each component in xnat style (i.e. _ separated + uppercase)
-    component_paths = []
-    for component in filtered_components:
-        path = component.get_path().replace("{http://ptb.de/interfile}", "")
-        path = f"petLmScanData/{path.replace('/', '_').upper()}"
-
-        # paths over 75 characters in xnat seem to be truncated
-        if len(path) > 75:
-            path = path[:75]
-
-        component_paths.append(path)
-
-    return component_paths
-
-
 def verify_headers_match(interfile_file_path, scan):
     """Check headers from a given interfile file match those in an xnat scan object"""
 
@@ -80,22 +40,28 @@ def test_interfilePlugin_installed(xnat_connection, plugin_version):
 
 
 @pytest.mark.filterwarnings("ignore:Import of namespace")
-def test_interfile_data_fields(xnat_connection, interfile_schema_fields):
+@pytest.mark.parametrize("xsi_type", SCAN_TYPES.values())
+def test_interfile_data_fields(xnat_connection, xsi_type):
     """Confirm that all data fields defined in the interfile schema file - interfile.xsd - are registered in xnat"""
 
     # get interfile data types from xnat session
     inspector = xnat.inspect.Inspect(xnat_connection.session)
-    assert "interfile:petLmScanData" in inspector.datatypes()
-    xnat_data_fields = inspector.datafields("petLmScanData")
-
-    # get expected data types from plugin's interfile schema (+ added types relating to xnat project / session info)
-    additional_xnat_fields = [
-        "petLmScanData/SESSION_LABEL",
-        "petLmScanData/SUBJECT_ID",
-        "petLmScanData/PROJECT",
-        "petLmScanData/ID",
+    assert xsi_type in inspector.datatypes()
+    element = xsi_type.split(":")[-1]
+    xnat_data_fields = inspector.datafields(element)
+
+    # get expected data types from plugin's interfile schema, in xnat style (i.e. _
+    # separated + uppercase, and truncated like xnat) + added types relating to xnat
+    # project / session info
+    expected_data_fields = [
+        f"{element}/{field.search_field(xsi_type)}"
+        for field in schema_fields(INTERFILE_XSD_PATH, xsi_type)
+    ] + [
+        f"{element}/SESSION_LABEL",
+        f"{element}/SUBJECT_ID",
+        f"{element}/PROJECT",
+        f"{element}/ID",
     ]
-    expected_data_fields = interfile_schema_fields + additional_xnat_fields
 
     assert sorted(xnat_data_fields) == sorted(expected_data_fields)
 
@@ -140,6 +106,63 @@ def test_upload_of_data(xnat_connection, interfile_file_path):
     verify_headers_match(interfile_file_path, xnat_experiment.scans[0])
 
 
+@pytest.mark.usefixtures("remove_test_data")
+def test_upload_of_frames(xnat_connection, tmp_path):
+    """Upload a multi-frame acquisition, and check XNAT stores a frames/frame row per
+    frame, in order - they are written with 0-based xpath indices (frames/frame[0]...)."""
+
+    xnat_session = xnat_connection.session
+    project_name = "interfile_project"
+    add_project(xnat_session, project_name)
+
+    header_path = write_listmode_acquisition(
+        tmp_path / "frames.l.hdr",
+        n_ms=3000,
+        header_text=(
+            "!INTERFILE:=\n"
+            "originating system:=2008\n"
+            "isotope name:=F-18\n"
+            "%LM event and tag words format (bits):=32\n"
+            "image duration (sec)[1]:=1\n"
+            "image duration (sec)[2]:=0.5\n"
+            "image duration (sec)[3]:=1.5\n"
+            "!END OF INTERFILE:=\n"
+        ),
+    )
+    scan = upload_interfile_data(
+        xnat_session,
+        header_path,
+        project_name,
+        "interfile_subject",
+        "interfile_experiment",
+        "interfile_scan",
+        event_stats=True,
+    )
+
+    xnat_hdr = read_listmode_header_2_xnat(header_path, event_stats=True)
+    prefix = "interfile:petLmScanData/frames/frame"
+    expected_frames = [
+        tuple(
+            str(xnat_hdr[f"{prefix}[{index}]/{name}"])
+            for name in ("number", "prompts", "delayeds")
+        )
+        for index in range(3)
+    ]
+
+    ns = {"interfile": "http://ptb.de/interfile"}
+    scan_xml = ElementTree.fromstring(xnat_session.get(scan.uri, format="xml").content)
+    frames = scan_xml.findall("interfile:frames/interfile:frame", ns)
+    assert [
+        tuple(
+            frame.findtext(f"interfile:{name}", namespaces=ns)
+            for name in ("number", "prompts", "delayeds")
+        )
+        for frame in frames
+    ] == expected_frames
+    start = frames[1].findtext("interfile:start", namespaces=ns)
+    assert float(start) == pytest.approx(1.0)
+
+
 @pytest.mark.usefixtures("remove_test_data")
 def test_interfile_data_modification(xnat_connection, interfile_file_path):
     xnat_session = xnat_connection.session
@@ -0,0 +1,135 @@
+import hashlib
+import io
+import mmap
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from tests.utils import write_listmode_acquisition
+from xnat_interfile.upload import FileChunkStream, ZipStream
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    data_file = tmp_path / "test.l"
+    data_file.write_bytes(bytes(range(256)) * 40)
+    return data_file
+
+
+def test_file_chunk_stream(data_file):
+    progress = []
+    stream = FileChunkStream(
+        data_file,
+        chunk_size=4096,
+        progress=lambda sent, total, throughput: progress.append((sent, total)),
+    )
+
+    assert len(stream) == 10240
+    assert [len(chunk) for chunk in stream] == [4096, 4096, 2048]
+    assert progress == [(4096, 10240), (8192, 10240), (10240, 10240)]
+
+    # can be re-iterated, e.g. to retry an upload
+    assert b"".join(stream) == data_file.read_bytes()
+
+
+def test_file_chunk_stream_checksum(data_file):
+    stream = FileChunkStream(data_file, chunk_size=4096, checksum=True)
+    assert stream.md5 is None
+
+    assert b"".join(stream) == data_file.read_bytes()
+    assert stream.md5 == hashlib.md5(data_file.read_bytes()).hexdigest()
+
+
+def test_file_chunk_stream_from_mmap(data_file):
+    with (
+        open(data_file, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+    ):
+        stream = FileChunkStream(m, chunk_size=3000)
+
+        assert len(stream) == 10240
+        assert b"".join(stream) == data_file.read_bytes()
+
+
+def test_file_chunk_stream_invalid_chunk_size(data_file):
+    with pytest.raises(ValueError):
+        FileChunkStream(data_file, chunk_size=0)
+
+
+# ingests an acquisition with upload_interfile_data, then prints the peak RSS of the
+# process (ru_maxrss is in kB on linux)
+UPLOAD_SCRIPT = """
+import resource
+import sys
+from pathlib import Path
+
+import xnat
+
+from xnat_interfile.populate_datatype_fields import upload_interfile_data
+
+url, project, header_path = sys.argv[1:]
+with xnat.connect(url, user="admin", password="admin") as session:
+    upload_interfile_data(
+        session, Path(header_path), project, "subject", "experiment", "scan"
+    )
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+"""
+
+
+@pytest.mark.slow
+def test_upload_memory_is_bounded(tmp_path, fake_xnat):
+    """Ingest an acquisition with (sparse) multi-GB listmode data to the fake server from
+    another process, and check the peak memory use of that process stays well below the
+    size of the data."""
+
+    header_path = write_listmode_acquisition(tmp_path / "scan.l.hdr")
+    file_size = 3 * 1024**3
+    with open(tmp_path / "scan.l", "wb") as f:
+        f.truncate(file_size)
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            UPLOAD_SCRIPT,
+            fake_xnat.url,
+            "interfile_project",
+            str(header_path),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+
+    assert fake_xnat.bytes_received > file_size
+    peak_rss = int(result.stdout.splitlines()[-1])
+    assert peak_rss < 256 * 1024**2
+
+
+def test_zip_stream(data_file, tmp_path):
+    header_file = tmp_path / "test.l.hdr"
+    header_file.write_text("!INTERFILE :=\n!END OF INTERFILE :=\n")
+    files = [(header_file, header_file.name), (data_file, data_file.name)]
+
+    progress = []
+    stream = ZipStream(
+        files,
+        chunk_size=4096,
+        progress=lambda sent, total, throughput: progress.append(sent),
+        checksum=True,
+    )
+    chunks = list(stream)
+
+    # an empty chunk would end a chunked transfer early
+    assert all(chunks)
+    assert progress[-1] == stream.total_bytes
+
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.testzip() is None
+        for path, name in files:
+            assert archive.read(name) == path.read_bytes()
+            assert stream.md5s[name] == hashlib.md5(path.read_bytes()).hexdigest()
@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+
+import pytest
+
+from tests.test_fake_xnat import server_files
+from tests.utils import write_listmode_acquisition
+from xnat_interfile import watch_folder as watch_folder_module
+from xnat_interfile.ingest_journal import IngestJournal
+from xnat_interfile.watch_folder import WatchFolderIngest, inotify_available
+
+PROJECT = "interfile_project"
+
+WATCH_MODES = [
+    pytest.param(
+        True,
+        id="inotify",
+        marks=pytest.mark.skipif(
+            not inotify_available(), reason="requires inotify (linux)"
+        ),
+    ),
+    pytest.param(False, id="polling"),
+]
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(0.02)
+
+
+class RunningIngest:
+    """Run a WatchFolderIngest in a background thread, recording the results"""
+
+    def __init__(self, session, root_dir, journal, use_inotify):
+        self.results = []
+        self.ingest = WatchFolderIngest(
+            session,
+            root_dir,
+            PROJECT,
+            journal,
+            settle_time=0.3,
+            poll_interval=0.05,
+            use_inotify=use_inotify,
+            progress=lambda result, n_completed, n_total: self.results.append(result),
+        )
+        self.thread = threading.Thread(target=self.ingest.run)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.ingest.stop()
+        self.thread.join(timeout=10)
+
+
+@pytest.fixture
+def journal(tmp_path):
+    with IngestJournal(tmp_path / "journal.sqlite") as journal:
+        yield journal
+
+
+@pytest.mark.parametrize("use_inotify", WATCH_MODES)
+def test_watch_folder_ingest(
+    tmp_path, fake_xnat, fake_xnat_session, journal, use_inotify
+):
+    root_dir = tmp_path / "exports"
+    # already there when the ingest starts
+    write_listmode_acquisition(root_dir / "subject" / "experiment" / "scan1.l.hdr")
+
+    with RunningIngest(fake_xnat_session, root_dir, journal, use_inotify) as running:
+        wait_for(lambda: len(running.results) == 1)
+        # a new subject directory, and a new scan in an existing experiment
+        write_listmode_acquisition(
+            root_dir / "subject2" / "experiment2" / "scan.l.hdr", seed=1
+        )
+        write_listmode_acquisition(
+            root_dir / "subject" / "experiment" / "scan2.l.hdr", seed=2
+        )
+        (root_dir / "subject" / "notes.txt").write_text("not an acquisition")
+        wait_for(lambda: len(running.results) == 3)
+
+    assert [result.error for result in running.results] == [None] * 3
+    assert set(server_files(fake_xnat, "subject", "experiment", "scan2")) == {
+        "scan2.l.hdr",
+        "scan2.l",
+    }
+    assert set(server_files(fake_xnat, "subject2", "experiment2", "scan")) == {
+        "scan.l.hdr",
+        "scan.l",
+    }
+
+
+@pytest.mark.parametrize("use_inotify", WATCH_MODES)
+def test_watch_folder_waits_for_complete_files(
+    tmp_path, fake_xnat, fake_xnat_session, journal, use_inotify
+):
+    root_dir = tmp_path / "exports"
+    root_dir.mkdir()
+    header_path = root_dir / "subject" / "experiment" / "scan.l.hdr"
+    data_path = header_path.with_name("scan.l")
+
+    with RunningIngest(fake_xnat_session, root_dir, journal, use_inotify) as running:
+        # the header arrives first, then the data is written in pieces
+        header_path.parent.mkdir(parents=True)
+        header_path.write_text(
+            "!INTERFILE:=\n%LM event and tag words format (bits):=32\n"
+        )
+        time.sleep(0.5)
+        with open(data_path, "wb") as file:
+            for _ in range(10):
+                file.write(b"\0" * 4096)
+                file.flush()
+                time.sleep(0.1)
+        assert running.results == []
+
+        wait_for(lambda: len(running.results) == 1)
+
+    assert running.results[0].ok
+    scan = server_files(fake_xnat, "subject", "experiment", "scan")
+    assert scan["scan.l"] == hashlib.md5(data_path.read_bytes()).hexdigest()
+
+
+def test_watch_folder_resumes_after_restart(
+    tmp_path, fake_xnat, fake_xnat_session, journal
+):
+    root_dir = tmp_path / "exports"
+    write_listmode_acquisition(root_dir / "subject" / "experiment" / "scan1.l.hdr")
+
+    with RunningIngest(fake_xnat_session, root_dir, journal, False) as running:
+        wait_for(lambda: len(running.results) == 1)
+    n_puts = fake_xnat.request_count("PUT")
+
+    # added while the ingest wasn't running
+    write_listmode_acquisition(
+        root_dir / "subject" / "experiment" / "scan2.l.hdr", seed=1
+    )
+    with RunningIngest(fake_xnat_session, root_dir, journal, False) as running:
+        wait_for(lambda: len(running.results) == 1)
+        time.sleep(0.5)
+
+    assert [result.acquisition.scan_name for result in running.results] == ["scan2"]
+    assert running.results[0].ok
+    # scan1 isn't uploaded again - only scan2's scan, resource and files
+    assert fake_xnat.request_count("PUT") - n_puts == 4
+
+
+def test_watch_folder_logs_unexpected_errors(
+    tmp_path, fake_xnat_session, journal, monkeypatch, caplog
+):
+    def read_header(*args, **kwargs):
+        raise KeyError("bug")
+
+    monkeypatch.setattr(
+        watch_folder_module, "cached_read_listmode_header_2_xnat", read_header
+    )
+    root_dir = tmp_path / "exports"
+    write_listmode_acquisition(root_dir / "subject" / "experiment" / "scan.l.hdr")
+
+    with RunningIngest(fake_xnat_session, root_dir, journal, False) as running:
+        wait_for(lambda: len(running.results) == 1)
+
+    assert isinstance(running.results[0].error, KeyError)
+    [record] = [r for r in caplog.records if "Unexpected error" in r.getMessage()]
+    assert record.exc_info is not None
@@ -1,8 +1,14 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
 import xnat4tests
 import xnat
 import requests
 import time
 
+from xnat_interfile.interfile_header import interfile_data_path
+
 
 class XnatConnection:
     """Handle connection to the xnat4tests xnat.
@@ -54,3 +60,50 @@ def delete_data(session: xnat.XNATSession) -> None:
                 query={"removeFiles": "True"},
             )
         project.subjects.clearcache()
+
+
+def write_listmode_acquisition(
+    header_path: Path,
+    n_ms: int = 1000,
+    events_per_ms: int = 10,
+    seed: int = 0,
+    header_text: Optional[str] = None,
+) -> Path:
+    """Write a synthetic interfile listmode acquisition - a header (.l.hdr) and 32-bit
+    PETLINK data (.l) with a time tag each ms, each followed by events_per_ms random
+    prompts. The data is 4 * n_ms * (events_per_ms + 1) bytes. header_text replaces the
+    default (minimal) header. Returns header_path."""
+
+    header_path.parent.mkdir(parents=True, exist_ok=True)
+    if header_text is None:
+        header_text = (
+            "!INTERFILE:=\n"
+            "originating system:=2008\n"
+            "isotope name:=F-18\n"
+            "%LM event and tag words format (bits):=32\n"
+            f"image duration (sec)[1]:={n_ms / 1000}\n"
+            "!END OF INTERFILE:=\n"
+        )
+    header_path.write_text(header_text)
+
+    rng = np.random.default_rng(seed)
+    words = np.empty((n_ms, events_per_ms + 1), dtype="<u4")
+    words[:, 0] = 0x80000000 | np.arange(n_ms, dtype=np.uint32)
+    words[:, 1:] = 0x40000000 | rng.integers(
+        0, 0x40000000, size=(n_ms, events_per_ms), dtype=np.uint32
+    )
+    words.tofile(header_path.with_name(header_path.name.removesuffix(".hdr")))
+    return header_path
+
+
+def write_interfile_data(
+    header_path: Path, header_text: str, values: np.ndarray
+) -> Path:
+    """Write a synthetic interfile header (e.g. .hs or .hv) and the data file next to it
+    (.s or .v), holding values as they are stored (with their dtype's byte order).
+    Returns header_path."""
+
+    header_path.parent.mkdir(parents=True, exist_ok=True)
+    header_path.write_text(header_text)
+    values.tofile(interfile_data_path(header_path))
+    return header_path
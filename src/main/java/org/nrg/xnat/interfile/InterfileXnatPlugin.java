@@ -11,7 +11,9 @@ package org.nrg.xnat.interfile;
 
 import org.nrg.framework.annotations.XnatDataModel;
 import org.nrg.framework.annotations.XnatPlugin;
+import org.nrg.xdat.bean.InterfilePetimagescandataBean;
 import org.nrg.xdat.bean.InterfilePetlmscandataBean;
+import org.nrg.xdat.bean.InterfilePetprojscandataBean;
 import org.springframework.context.annotation.Bean;
 import org.springframework.context.annotation.ComponentScan;
 
@@ -25,6 +27,19 @@ import org.springframework.context.annotation.ComponentScan;
       plural = "PET listmode data",
       code = "INTERFILELM"
     ),
+    @XnatDataModel(
+      value = InterfilePetprojscandataBean.SCHEMA_ELEMENT_NAME,
+      singular = "PET projection data",
+      plural = "PET projection data",
+      code = "INTERFILEPROJ"
+    ),
+    @XnatDataModel(
+      value = InterfilePetimagescandataBean.SCHEMA_ELEMENT_NAME,
+      singular = "PET image",
+      plural = "PET images",
+      code = "INTERFILEIMG"
+    ),
   }
 )
+@ComponentScan({"org.nrg.xnat.interfile.rest", "org.nrg.xnat.interfile.services"})
 public class InterfileXnatPlugin {}
@@ -0,0 +1,155 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.header;
+
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.util.Collections;
+import java.util.LinkedHashMap;
+import java.util.Locale;
+import java.util.Map;
+import java.util.Set;
+import java.util.SortedMap;
+import java.util.TreeMap;
+import java.util.regex.Matcher;
+import java.util.regex.Pattern;
+
+/**
+ * The key := value pairs of an interfile header (.l.hdr, .hs, .hv ...), read in
+ * a single pass over the file without loading any of the binary data it refers
+ * to. This matches read_interfile_header in the python package.
+ *
+ * Keys are standardised with {@link #standardiseKey(String)}. Section headings
+ * (keys without a value, e.g. '!GENERAL DATA :=') and comment lines (starting
+ * with ';') are skipped. If a key appears more than once, the last value wins
+ * (as in STIR).
+ */
+public class InterfileHeader {
+  /** Interfile keys ending the header - nothing after these is parsed */
+  public static final Set<String> END_OF_HEADER_KEYS = Collections.singleton(
+    "end of interfile"
+  );
+
+  private static final Pattern WHITESPACE = Pattern.compile("\\s+");
+  private static final Pattern INDEX_SPACING = Pattern.compile("\\s+\\[");
+  private static final Pattern INDEXED_KEY = Pattern.compile(
+    "^(.*?)\\[(\\d+)]$"
+  );
+
+  private final Map<String, String> values;
+
+  public InterfileHeader(final Map<String, String> values) {
+    this.values = Collections.unmodifiableMap(new LinkedHashMap<>(values));
+  }
+
+  public static InterfileHeader read(final Path headerPath)
+    throws IOException {
+    // latin-1 maps every byte to a character, so vendor headers never fail to
+    // decode
+    try (
+      final BufferedReader reader = Files.newBufferedReader(
+        headerPath,
+        StandardCharsets.ISO_8859_1
+      )
+    ) {
+      return read(reader);
+    }
+  }
+
+  public static InterfileHeader read(final BufferedReader reader)
+    throws IOException {
+    final Map<String, String> values = new LinkedHashMap<>();
+    String line;
+    while ((line = reader.readLine()) != null) {
+      line = line.trim();
+      if (line.isEmpty() || line.startsWith(";")) {
+        continue;
+      }
+
+      final int separator = line.indexOf(":=");
+      if (separator < 0) {
+        continue;
+      }
+
+      final String key = standardiseKey(line.substring(0, separator));
+      if (END_OF_HEADER_KEYS.contains(key)) {
+        break;
+      }
+
+      final String value = line.substring(separator + 2).trim();
+      if (!value.isEmpty()) {
+        values.put(key, value);
+      }
+    }
+    return new InterfileHeader(values);
+  }
+
+  /**
+   * Standardise an interfile key in the same way STIR does - keys are
+   * case-insensitive, the '!' (required) and '%' (vendor) prefixes are ignored
+   * and runs of whitespace are treated as a single space (or none, before an
+   * index such as '[1]').
+   */
+  public static String standardiseKey(final String key) {
+    final String trimmed = key.trim();
+    int start = 0;
+    while (
+      start < trimmed.length() &&
+      (trimmed.charAt(start) == '!' || trimmed.charAt(start) == '%')
+    ) {
+      start++;
+    }
+    final String collapsed = WHITESPACE
+      .matcher(trimmed.substring(start).trim())
+      .replaceAll(" ");
+    return INDEX_SPACING
+      .matcher(collapsed)
+      .replaceAll("[")
+      .toLowerCase(Locale.ROOT);
+  }
+
+  /**
+   * The value of the first of keys present in the header, or null if none are.
+   * Keys are standardised before lookup, so they can be given as they appear in
+   * the interfile specification.
+   */
+  public String get(final String... keys) {
+    for (final String key : keys) {
+      final String value = values.get(standardiseKey(key));
+      if (value != null) {
+        return value;
+      }
+    }
+    return null;
+  }
+
+  /**
+   * All values of an indexed key, e.g. 'image duration (sec)[1]', 'image
+   * duration (sec)[2]' ..., keyed by index.
+   */
+  public SortedMap<Integer, String> getIndexed(final String key) {
+    final String name = standardiseKey(key);
+    final SortedMap<Integer, String> indexed = new TreeMap<>();
+    for (final Map.Entry<String, String> entry : values.entrySet()) {
+      final Matcher matcher = INDEXED_KEY.matcher(entry.getKey());
+      if (matcher.matches() && matcher.group(1).equals(name)) {
+        indexed.put(Integer.parseInt(matcher.group(2)), entry.getValue());
+      }
+    }
+    return indexed;
+  }
+
+  public Map<String, String> getValues() {
+    return values;
+  }
+}
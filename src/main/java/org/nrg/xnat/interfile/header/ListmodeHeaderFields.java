@@ -0,0 +1,276 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.header;
+
+import java.util.Collections;
+import java.util.HashMap;
+import java.util.HashSet;
+import java.util.LinkedHashMap;
+import java.util.Locale;
+import java.util.Map;
+import java.util.Set;
+import java.util.SortedMap;
+import java.util.TreeMap;
+
+/**
+ * Converts an interfile listmode header to the fields of the
+ * interfile:petLmScanData datatype, keyed by xpath. This is a port of
+ * interfile_header_2_xnat in the python package (the 'native' header backend) -
+ * both must give the same fields for the same header, so keep them in step.
+ */
+public final class ListmodeHeaderFields {
+  public static final String SCAN_TYPE = "interfile:petLmScanData";
+
+  /**
+   * Scanner names as returned by stir.Scanner.get_name(), keyed by the
+   * (lower-case) names and 'originating system' codes stir accepts for them
+   */
+  private static final Map<String, String> SCANNER_NAMES = new HashMap<>();
+
+  /** Radionuclides known to stir, keyed by the (lower-case) 'isotope name' */
+  private static final Map<String, Radionuclide> RADIONUCLIDES =
+    new HashMap<>();
+
+  /** Patient position abbreviations, by stir's orientation and rotation */
+  private static final Map<String, String> PATIENT_ORIENTATIONS =
+    new HashMap<>();
+  private static final Map<String, String> PATIENT_ROTATIONS = new HashMap<>();
+  private static final Set<String> PATIENT_POSITIONS = new HashSet<>();
+
+  static {
+    SCANNER_NAMES.put("siemens mmr", "Siemens mMR");
+    SCANNER_NAMES.put("mmr", "Siemens mMR");
+    SCANNER_NAMES.put("2008", "Siemens mMR");
+    SCANNER_NAMES.put("siemens mct", "Siemens mCT");
+    SCANNER_NAMES.put("mct", "Siemens mCT");
+    SCANNER_NAMES.put("1104", "Siemens mCT");
+    SCANNER_NAMES.put("siemens vision 600", "Siemens Vision 600");
+    SCANNER_NAMES.put("vision600", "Siemens Vision 600");
+    SCANNER_NAMES.put("1208", "Siemens Vision 600");
+    SCANNER_NAMES.put("ge signa pet/mr", "GE Signa PET/MR");
+    SCANNER_NAMES.put("signa pet/mr", "GE Signa PET/MR");
+    SCANNER_NAMES.put("ge signa", "GE Signa PET/MR");
+
+    RADIONUCLIDES.put(
+      "f-18",
+      new Radionuclide("^18^Fluorine", 511.0, 6586.2, 0.9686)
+    );
+    RADIONUCLIDES.put(
+      "c-11",
+      new Radionuclide("^11^Carbon", 511.0, 1221.66, 0.9976)
+    );
+    RADIONUCLIDES.put(
+      "o-15",
+      new Radionuclide("^15^Oxygen", 511.0, 122.24, 0.9989)
+    );
+    RADIONUCLIDES.put(
+      "n-13",
+      new Radionuclide("^13^Nitrogen", 511.0, 597.9, 0.9982)
+    );
+    RADIONUCLIDES.put(
+      "ga-68",
+      new Radionuclide("^68^Gallium", 511.0, 4057.74, 0.8894)
+    );
+    RADIONUCLIDES.put(
+      "rb-82",
+      new Radionuclide("^82^Rubidium", 511.0, 76.38, 0.9545)
+    );
+    RADIONUCLIDES.put(
+      "zr-89",
+      new Radionuclide("^89^Zirconium", 511.0, 282240.0, 0.2274)
+    );
+
+    PATIENT_ORIENTATIONS.put("head_in", "HF");
+    PATIENT_ORIENTATIONS.put("feet_in", "FF");
+    PATIENT_ROTATIONS.put("supine", "S");
+    PATIENT_ROTATIONS.put("prone", "P");
+    PATIENT_ROTATIONS.put("right", "DR");
+    PATIENT_ROTATIONS.put("left", "DL");
+    for (final String orientation : PATIENT_ORIENTATIONS.values()) {
+      for (final String rotation : PATIENT_ROTATIONS.values()) {
+        PATIENT_POSITIONS.add(orientation + rotation);
+      }
+    }
+  }
+
+  private ListmodeHeaderFields() {}
+
+  /**
+   * The interfile:petLmScanData fields for a listmode header, keyed by xpath
+   * (e.g. interfile:petLmScanData/scannerInformation/name) in the order the
+   * python package sets them.
+   *
+   * @throws NumberFormatException if a numeric header value isn't a number
+   */
+  public static Map<String, Object> fromHeader(final InterfileHeader header) {
+    final String originatingSystem = valueOr(
+      header.get("originating system"),
+      "Unknown"
+    );
+    final String scannerName = SCANNER_NAMES.getOrDefault(
+      originatingSystem.toLowerCase(Locale.ROOT),
+      originatingSystem
+    );
+
+    final String isotopeName = valueOr(header.get("isotope name"), "Unknown");
+    final Radionuclide radionuclide = RADIONUCLIDES.getOrDefault(
+      isotopeName.toLowerCase(Locale.ROOT),
+      new Radionuclide(isotopeName, -1.0, -1.0, -1.0)
+    );
+    final double branchingRatio = parseDouble(
+      header.get("isotope branching factor"),
+      radionuclide.branchingRatio
+    );
+
+    final double lowEnergyThres = parseDouble(
+      header.get(
+        "energy window lower level[1]",
+        "energy window lower level (kev)[1]",
+        "energy window lower level"
+      ),
+      -1.0
+    );
+    final double highEnergyThres = parseDouble(
+      header.get(
+        "energy window upper level[1]",
+        "energy window upper level (kev)[1]",
+        "energy window upper level"
+      ),
+      -1.0
+    );
+    final double[] frameStartEnd = frameStartEnd(header);
+
+    final Map<String, Object> fields = new LinkedHashMap<>();
+    fields.put(SCAN_TYPE + "/scannerInformation/name", scannerName);
+    fields.put(
+      SCAN_TYPE + "/radionuclideInformation/radionuclide",
+      radionuclide.name
+    );
+    fields.put(
+      SCAN_TYPE + "/radionuclideInformation/energy",
+      radionuclide.energy
+    );
+    fields.put(
+      SCAN_TYPE + "/radionuclideInformation/halfLife",
+      radionuclide.halfLife
+    );
+    fields.put(
+      SCAN_TYPE + "/radionuclideInformation/branchingRatio",
+      branchingRatio
+    );
+    fields.put(SCAN_TYPE + "/examInformation/lowEnergyThres", lowEnergyThres);
+    fields.put(SCAN_TYPE + "/examInformation/highEnergyThres", highEnergyThres);
+    fields.put(
+      SCAN_TYPE + "/examInformation/patientPosition",
+      patientPosition(header)
+    );
+    fields.put(SCAN_TYPE + "/frameInformation/frameStart", frameStartEnd[0]);
+    fields.put(SCAN_TYPE + "/frameInformation/frameEnd", frameStartEnd[1]);
+    fields.put(
+      SCAN_TYPE + "/frameInformation/frameDuration",
+      frameStartEnd[1] - frameStartEnd[0]
+    );
+    return fields;
+  }
+
+  /**
+   * Patient position abbreviation (e.g. HFS) as stir reports it. Vendor headers
+   * give the abbreviation directly, interfile 3.3 headers give separate
+   * orientation and rotation.
+   */
+  static String patientPosition(final InterfileHeader header) {
+    final String orientation = valueOr(header.get("patient orientation"), "")
+      .toLowerCase(Locale.ROOT);
+    final String rotation = valueOr(header.get("patient rotation"), "")
+      .toLowerCase(Locale.ROOT);
+
+    if (
+      PATIENT_ORIENTATIONS.containsKey(orientation) &&
+      PATIENT_ROTATIONS.containsKey(rotation)
+    ) {
+      return (
+        PATIENT_ORIENTATIONS.get(orientation) + PATIENT_ROTATIONS.get(rotation)
+      );
+    }
+    if (PATIENT_POSITIONS.contains(orientation.toUpperCase(Locale.ROOT))) {
+      return orientation.toUpperCase(Locale.ROOT);
+    }
+    return "unknown";
+  }
+
+  /**
+   * Start of the first and end of the last time frame, as
+   * stir.TimeFrameDefinitions.get_start_time() / get_end_time()
+   */
+  static double[] frameStartEnd(final InterfileHeader header) {
+    SortedMap<Integer, String> durations = header.getIndexed(
+      "image duration (sec)"
+    );
+    SortedMap<Integer, String> starts = header.getIndexed(
+      "image relative start time (sec)"
+    );
+
+    if (durations.isEmpty()) {
+      final String duration = header.get("image duration (sec)");
+      if (duration == null) {
+        return new double[] { 0.0, 0.0 };
+      }
+      durations = new TreeMap<>(Collections.singletonMap(1, duration));
+      starts =
+        new TreeMap<>(
+          Collections.singletonMap(
+            1,
+            valueOr(header.get("image relative start time (sec)"), "0")
+          )
+        );
+    }
+
+    final double firstStart = Double.parseDouble(
+      starts.getOrDefault(durations.firstKey(), "0")
+    );
+    final double lastStart = Double.parseDouble(
+      starts.getOrDefault(durations.lastKey(), "0")
+    );
+    return new double[] {
+      firstStart,
+      lastStart + Double.parseDouble(durations.get(durations.lastKey())),
+    };
+  }
+
+  private static String valueOr(final String value, final String defaultValue) {
+    return value != null ? value : defaultValue;
+  }
+
+  private static double parseDouble(
+    final String value,
+    final double defaultValue
+  ) {
+    return value != null ? Double.parseDouble(value) : defaultValue;
+  }
+
+  private static final class Radionuclide {
+    private final String name;
+    private final double energy;
+    private final double halfLife;
+    private final double branchingRatio;
+
+    private Radionuclide(
+      final String name,
+      final double energy,
+      final double halfLife,
+      final double branchingRatio
+    ) {
+      this.name = name;
+      this.energy = energy;
+      this.halfLife = halfLife;
+      this.branchingRatio = branchingRatio;
+    }
+  }
+}
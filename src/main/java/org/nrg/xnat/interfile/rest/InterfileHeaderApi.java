@@ -0,0 +1,151 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.rest;
+
+import static org.nrg.xdat.security.helpers.AccessLevel.Edit;
+import static org.nrg.xdat.security.helpers.AccessLevel.Read;
+import static org.springframework.http.MediaType.APPLICATION_JSON_VALUE;
+import static org.springframework.web.bind.annotation.RequestMethod.GET;
+import static org.springframework.web.bind.annotation.RequestMethod.POST;
+
+import io.swagger.annotations.Api;
+import io.swagger.annotations.ApiOperation;
+import io.swagger.annotations.ApiResponse;
+import io.swagger.annotations.ApiResponses;
+import lombok.extern.slf4j.Slf4j;
+import org.nrg.framework.annotations.XapiRestController;
+import org.nrg.xapi.exceptions.NotFoundException;
+import org.nrg.xapi.rest.AbstractXapiRestController;
+import org.nrg.xapi.rest.ProjectId;
+import org.nrg.xapi.rest.XapiRequestMapping;
+import org.nrg.xdat.security.services.RoleHolder;
+import org.nrg.xdat.security.services.UserManagementServiceI;
+import org.nrg.xnat.interfile.services.InterfileHeaderExtractionService;
+import org.nrg.xnat.interfile.services.InterfileHeaderExtractionService.ExtractionStatus;
+import org.springframework.beans.factory.annotation.Autowired;
+import org.springframework.http.HttpStatus;
+import org.springframework.http.ResponseEntity;
+import org.springframework.web.bind.annotation.PathVariable;
+import org.springframework.web.bind.annotation.RequestMapping;
+
+@Api("Interfile header API")
+@XapiRestController
+@RequestMapping(value = "/interfile")
+@Slf4j
+public class InterfileHeaderApi extends AbstractXapiRestController {
+  private static final String HEADER_PATH =
+    "/projects/{project}/experiments/{experiment}/scans/{scan}/header";
+
+  private final InterfileHeaderExtractionService extractionService;
+
+  @Autowired
+  public InterfileHeaderApi(
+    final InterfileHeaderExtractionService extractionService,
+    final UserManagementServiceI userManagementService,
+    final RoleHolder roleHolder
+  ) {
+    super(userManagementService, roleHolder);
+    this.extractionService = extractionService;
+  }
+
+  @ApiOperation(
+    value = "Fills the fields of an interfile listmode scan from the header " +
+    "(.l.hdr) in its PET_RAW resource.",
+    notes = "The fields are extracted in the background - the response is " +
+    "sent as soon as the extraction is queued.",
+    response = ExtractionStatus.class
+  )
+  @ApiResponses(
+    {
+      @ApiResponse(code = 202, message = "Header extraction queued."),
+      @ApiResponse(
+        code = 400,
+        message = "The scan isn't an interfile:petLmScanData scan."
+      ),
+      @ApiResponse(
+        code = 401,
+        message = "Must be authenticated to access the XNAT REST API."
+      ),
+      @ApiResponse(
+        code = 403,
+        message = "Must have edit access to the project."
+      ),
+      @ApiResponse(
+        code = 404,
+        message = "The experiment, scan or header doesn't exist."
+      ),
+    }
+  )
+  @XapiRequestMapping(
+    value = HEADER_PATH,
+    method = POST,
+    produces = APPLICATION_JSON_VALUE,
+    restrictTo = Edit
+  )
+  public ResponseEntity<ExtractionStatus> extractHeader(
+    @PathVariable @ProjectId final String project,
+    @PathVariable final String experiment,
+    @PathVariable final String scan
+  ) throws NotFoundException {
+    try {
+      return new ResponseEntity<>(
+        extractionService.submit(getSessionUser(), project, experiment, scan),
+        HttpStatus.ACCEPTED
+      );
+    } catch (IllegalArgumentException e) {
+      log.warn(
+        "Can't extract interfile header of scan {} of {}: {}",
+        scan,
+        experiment,
+        e.getMessage()
+      );
+      return new ResponseEntity<>(HttpStatus.BAD_REQUEST);
+    }
+  }
+
+  @ApiOperation(
+    value = "Status of the latest header extraction of an interfile listmode " +
+    "scan.",
+    response = ExtractionStatus.class
+  )
+  @ApiResponses(
+    {
+      @ApiResponse(code = 200, message = "Header extraction status."),
+      @ApiResponse(
+        code = 401,
+        message = "Must be authenticated to access the XNAT REST API."
+      ),
+      @ApiResponse(
+        code = 403,
+        message = "Must have read access to the project."
+      ),
+      @ApiResponse(
+        code = 404,
+        message = "No header extraction was queued for the scan."
+      ),
+    }
+  )
+  @XapiRequestMapping(
+    value = HEADER_PATH,
+    method = GET,
+    produces = APPLICATION_JSON_VALUE,
+    restrictTo = Read
+  )
+  public ResponseEntity<ExtractionStatus> getExtractionStatus(
+    @PathVariable @ProjectId final String project,
+    @PathVariable final String experiment,
+    @PathVariable final String scan
+  ) throws NotFoundException {
+    return new ResponseEntity<>(
+      extractionService.getStatus(getSessionUser(), project, experiment, scan),
+      HttpStatus.OK
+    );
+  }
+}
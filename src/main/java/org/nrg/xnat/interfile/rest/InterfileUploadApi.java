@@ -0,0 +1,308 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.rest;
+
+import static org.nrg.xdat.security.helpers.AccessLevel.Authenticated;
+import static org.nrg.xdat.security.helpers.AccessLevel.Edit;
+import static org.springframework.http.MediaType.APPLICATION_JSON_VALUE;
+import static org.springframework.http.MediaType.APPLICATION_OCTET_STREAM_VALUE;
+import static org.springframework.web.bind.annotation.RequestMethod.DELETE;
+import static org.springframework.web.bind.annotation.RequestMethod.GET;
+import static org.springframework.web.bind.annotation.RequestMethod.POST;
+import static org.springframework.web.bind.annotation.RequestMethod.PUT;
+
+import io.swagger.annotations.Api;
+import io.swagger.annotations.ApiOperation;
+import io.swagger.annotations.ApiResponse;
+import io.swagger.annotations.ApiResponses;
+import java.io.IOException;
+import java.util.LinkedHashMap;
+import java.util.Map;
+import javax.servlet.http.HttpServletRequest;
+import lombok.Data;
+import lombok.extern.slf4j.Slf4j;
+import org.nrg.framework.annotations.XapiRestController;
+import org.nrg.xapi.exceptions.NotFoundException;
+import org.nrg.xapi.rest.AbstractXapiRestController;
+import org.nrg.xapi.rest.ProjectId;
+import org.nrg.xapi.rest.XapiRequestMapping;
+import org.nrg.xdat.security.services.RoleHolder;
+import org.nrg.xdat.security.services.UserManagementServiceI;
+import org.nrg.xnat.interfile.services.InterfileChunkedUploadService;
+import org.nrg.xnat.interfile.upload.ChunkedUpload;
+import org.nrg.xnat.interfile.upload.ChunkedUploadStore.ChecksumMismatchException;
+import org.springframework.beans.factory.annotation.Autowired;
+import org.springframework.http.HttpStatus;
+import org.springframework.http.ResponseEntity;
+import org.springframework.web.bind.annotation.PathVariable;
+import org.springframework.web.bind.annotation.RequestBody;
+import org.springframework.web.bind.annotation.RequestMapping;
+import org.springframework.web.bind.annotation.RequestParam;
+
+/**
+ * Uploads of (very large) files to the resources of interfile scans in parts,
+ * which can be sent in parallel and retried individually: start the upload, PUT
+ * each part, then complete it with the MD5 of the part MD5s (see
+ * {@link org.nrg.xnat.interfile.upload.ChunkedUploadStore#partsMd5}).
+ */
+@Api("Interfile upload API")
+@XapiRestController
+@RequestMapping(value = "/interfile")
+@Slf4j
+public class InterfileUploadApi extends AbstractXapiRestController {
+  private final InterfileChunkedUploadService uploadService;
+
+  @Data
+  public static class UploadRequest {
+    private String name;
+    private long size;
+    private long partSize;
+  }
+
+  @Autowired
+  public InterfileUploadApi(
+    final InterfileChunkedUploadService uploadService,
+    final UserManagementServiceI userManagementService,
+    final RoleHolder roleHolder
+  ) {
+    super(userManagementService, roleHolder);
+    this.uploadService = uploadService;
+  }
+
+  @ApiOperation(
+    value = "Starts an upload of a file in parts to a resource of an " +
+    "interfile scan.",
+    notes = "The body gives the name and size of the file, and the size of " +
+    "the parts (all but the last).",
+    response = Map.class
+  )
+  @ApiResponses(
+    {
+      @ApiResponse(code = 201, message = "Upload started."),
+      @ApiResponse(
+        code = 400,
+        message = "Invalid file name or sizes, or the scan isn't an " +
+        "interfile scan."
+      ),
+      @ApiResponse(
+        code = 403,
+        message = "Must have edit access to the project."
+      ),
+      @ApiResponse(
+        code = 404,
+        message = "The experiment or scan doesn't exist."
+      ),
+    }
+  )
+  @XapiRequestMapping(
+    value = "/projects/{project}/experiments/{experiment}/scans/{scan}" +
+    "/resources/{resource}/uploads",
+    method = POST,
+    consumes = APPLICATION_JSON_VALUE,
+    produces = APPLICATION_JSON_VALUE,
+    restrictTo = Edit
+  )
+  public ResponseEntity<Map<String, Object>> createUpload(
+    @PathVariable @ProjectId final String project,
+    @PathVariable final String experiment,
+    @PathVariable final String scan,
+    @PathVariable final String resource,
+    @RequestBody final UploadRequest request
+  ) throws NotFoundException, IOException {
+    try {
+      final ChunkedUpload upload = uploadService.create(
+        getSessionUser(),
+        project,
+        experiment,
+        scan,
+        resource,
+        request.getName(),
+        request.getSize(),
+        request.getPartSize()
+      );
+      return new ResponseEntity<>(uploadStatus(upload), HttpStatus.CREATED);
+    } catch (IllegalArgumentException e) {
+      log.warn(
+        "Can't start upload to scan {} of {}: {}",
+        scan,
+        experiment,
+        e.getMessage()
+      );
+      return new ResponseEntity<>(HttpStatus.BAD_REQUEST);
+    }
+  }
+
+  @ApiOperation(
+    value = "Status of an upload, including the parts not received yet.",
+    response = Map.class
+  )
+  @ApiResponses(
+    {
+      @ApiResponse(code = 200, message = "Upload status."),
+      @ApiResponse(
+        code = 404,
+        message = "No such upload, or it was started by another user."
+      ),
+    }
+  )
+  @XapiRequestMapping(
+    value = "/uploads/{uploadId}",
+    method = GET,
+    produces = APPLICATION_JSON_VALUE,
+    restrictTo = Authenticated
+  )
+  public ResponseEntity<Map<String, Object>> getUpload(
+    @PathVariable final String uploadId
+  ) throws NotFoundException, IOException {
+    return new ResponseEntity<>(
+      uploadStatus(uploadService.get(getSessionUser(), uploadId)),
+      HttpStatus.OK
+    );
+  }
+
+  @ApiOperation(
+    value = "Uploads a part of a file, replacing it if it was already sent.",
+    notes = "Parts are numbered from 1. The response gives the MD5 of the " +
+    "part received.",
+    response = Map.class
+  )
+  @ApiResponses(
+    {
+      @ApiResponse(code = 200, message = "Part received."),
+      @ApiResponse(
+        code = 400,
+        message = "No such part, or the body doesn't hold exactly the bytes " +
+        "of the part."
+      ),
+      @ApiResponse(
+        code = 404,
+        message = "No such upload, or it was started by another user."
+      ),
+    }
+  )
+  @XapiRequestMapping(
+    value = "/uploads/{uploadId}/parts/{part}",
+    method = PUT,
+    consumes = APPLICATION_OCTET_STREAM_VALUE,
+    produces = APPLICATION_JSON_VALUE,
+    restrictTo = Authenticated
+  )
+  public ResponseEntity<Map<String, Object>> putPart(
+    @PathVariable final String uploadId,
+    @PathVariable final int part,
+    final HttpServletRequest request
+  ) throws NotFoundException, IOException {
+    try {
+      final String md5 = uploadService.putPart(
+        getSessionUser(),
+        uploadId,
+        part,
+        request.getInputStream()
+      );
+      final Map<String, Object> response = new LinkedHashMap<>();
+      response.put("part", part);
+      response.put("md5", md5);
+      return new ResponseEntity<>(response, HttpStatus.OK);
+    } catch (IllegalArgumentException e) {
+      log.warn(
+        "Rejected part {} of upload {}: {}",
+        part,
+        uploadId,
+        e.getMessage()
+      );
+      return new ResponseEntity<>(HttpStatus.BAD_REQUEST);
+    }
+  }
+
+  @ApiOperation(
+    value = "Completes an upload, adding the file to the scan's resource.",
+    notes = "If partsMd5 is given, the MD5 of the concatenated (binary) MD5s " +
+    "of the parts received, followed by '-' and the number of parts, must " +
+    "match it. The file itself isn't read again.",
+    response = Map.class
+  )
+  @ApiResponses(
+    {
+      @ApiResponse(code = 200, message = "File added to the resource."),
+      @ApiResponse(
+        code = 400,
+        message = "The MD5 of the part MD5s doesn't match partsMd5."
+      ),
+      @ApiResponse(
+        code = 404,
+        message = "No such upload, or it was started by another user."
+      ),
+      @ApiResponse(code = 409, message = "Parts of the file are missing."),
+    }
+  )
+  @XapiRequestMapping(
+    value = "/uploads/{uploadId}/complete",
+    method = POST,
+    produces = APPLICATION_JSON_VALUE,
+    restrictTo = Authenticated
+  )
+  public ResponseEntity<Map<String, Object>> completeUpload(
+    @PathVariable final String uploadId,
+    @RequestParam(required = false) final String partsMd5
+  ) throws NotFoundException, IOException {
+    final ChunkedUpload upload = uploadService.get(getSessionUser(), uploadId);
+    try {
+      final String uploadMd5 = uploadService.complete(
+        getSessionUser(),
+        uploadId,
+        partsMd5
+      );
+      final Map<String, Object> response = new LinkedHashMap<>();
+      response.put("name", upload.getFileName());
+      response.put("size", upload.getSize());
+      response.put("partsMd5", uploadMd5);
+      return new ResponseEntity<>(response, HttpStatus.OK);
+    } catch (IllegalStateException | ChecksumMismatchException e) {
+      log.warn("Can't complete upload {}: {}", uploadId, e.getMessage());
+      return new ResponseEntity<>(
+        e instanceof ChecksumMismatchException
+          ? HttpStatus.BAD_REQUEST
+          : HttpStatus.CONFLICT
+      );
+    }
+  }
+
+  @ApiOperation(value = "Deletes an upload, and any parts received.")
+  @ApiResponses(
+    {
+      @ApiResponse(code = 200, message = "Upload deleted."),
+      @ApiResponse(
+        code = 404,
+        message = "No such upload, or it was started by another user."
+      ),
+    }
+  )
+  @XapiRequestMapping(
+    value = "/uploads/{uploadId}",
+    method = DELETE,
+    restrictTo = Authenticated
+  )
+  public ResponseEntity<Void> deleteUpload(@PathVariable final String uploadId)
+    throws NotFoundException, IOException {
+    uploadService.delete(getSessionUser(), uploadId);
+    return new ResponseEntity<>(HttpStatus.OK);
+  }
+
+  private Map<String, Object> uploadStatus(final ChunkedUpload upload) {
+    final Map<String, Object> status = new LinkedHashMap<>();
+    status.put("uploadId", upload.getUploadId());
+    status.put("name", upload.getFileName());
+    status.put("size", upload.getSize());
+    status.put("partSize", upload.getPartSize());
+    status.put("numberOfParts", upload.getNumberOfParts());
+    status.put("missingParts", uploadService.getMissingParts(upload));
+    return status;
+  }
+}
@@ -0,0 +1,293 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.services;
+
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.time.Duration;
+import java.util.Collections;
+import java.util.List;
+import java.util.NoSuchElementException;
+import java.util.concurrent.Executors;
+import java.util.concurrent.ScheduledExecutorService;
+import java.util.concurrent.TimeUnit;
+import javax.annotation.PreDestroy;
+import lombok.extern.slf4j.Slf4j;
+import org.nrg.xapi.exceptions.NotFoundException;
+import org.nrg.xdat.model.XnatAbstractresourceI;
+import org.nrg.xdat.om.XnatImagescandata;
+import org.nrg.xdat.om.XnatImagesessiondata;
+import org.nrg.xdat.om.XnatResourcecatalog;
+import org.nrg.xdat.preferences.SiteConfigPreferences;
+import org.nrg.xft.security.UserI;
+import org.nrg.xnat.interfile.upload.ChunkedUpload;
+import org.nrg.xnat.interfile.upload.ChunkedUploadStore;
+import org.nrg.xnat.interfile.upload.ChunkedUploadStore.ChecksumMismatchException;
+import org.nrg.xnat.services.archive.CatalogService;
+import org.springframework.beans.factory.annotation.Autowired;
+import org.springframework.stereotype.Service;
+
+/**
+ * Uploads of files to the resources of interfile scans in parts (see
+ * {@link ChunkedUploadStore}), staged under the XNAT cache directory. Once
+ * complete, the file is added to the resource - which is created if it doesn't
+ * exist yet. Uploads that nothing has been sent to for {@link #UPLOAD_EXPIRY}
+ * are deleted, checked every {@link #EXPIRY_CHECK_INTERVAL}.
+ */
+@Service
+@Slf4j
+public class InterfileChunkedUploadService {
+  public static final Duration UPLOAD_EXPIRY = Duration.ofDays(1);
+  public static final Duration EXPIRY_CHECK_INTERVAL = Duration.ofHours(1);
+
+  private final CatalogService catalogService;
+  private final ChunkedUploadStore store;
+  private final ScheduledExecutorService expiryExecutor;
+
+  @Autowired
+  public InterfileChunkedUploadService(
+    final CatalogService catalogService,
+    final SiteConfigPreferences preferences
+  ) {
+    this.catalogService = catalogService;
+    this.store =
+      new ChunkedUploadStore(
+        Paths.get(preferences.getCachePath(), "interfile-uploads")
+      );
+    expiryExecutor =
+      Executors.newSingleThreadScheduledExecutor(
+        runnable -> {
+          final Thread thread = new Thread(runnable, "interfile-upload-expiry");
+          thread.setDaemon(true);
+          return thread;
+        }
+      );
+    // also run soon after startup, for uploads abandoned before a restart
+    expiryExecutor.scheduleWithFixedDelay(
+      this::deleteExpiredUploads,
+      1,
+      EXPIRY_CHECK_INTERVAL.toMinutes(),
+      TimeUnit.MINUTES
+    );
+  }
+
+  @PreDestroy
+  public void shutdown() {
+    expiryExecutor.shutdown();
+  }
+
+  private void deleteExpiredUploads() {
+    try {
+      final int deleted = store.deleteExpired(UPLOAD_EXPIRY);
+      if (deleted > 0) {
+        log.info(
+          "Deleted {} interfile uploads unused for over {}",
+          deleted,
+          UPLOAD_EXPIRY
+        );
+      }
+    } catch (Exception e) {
+      // an exception would stop the scheduled task from running again
+      log.error("Failed to delete expired interfile uploads", e);
+    }
+  }
+
+  /**
+   * Start an upload of a file to a resource of an interfile scan.
+   *
+   * @param experiment the label or ID of the experiment in project
+   * @throws NotFoundException        if the experiment or scan doesn't exist
+   * @throws IllegalArgumentException if the scan isn't an interfile scan type,
+   *                                  or the file name or sizes are invalid
+   */
+  public ChunkedUpload create(
+    final UserI user,
+    final String project,
+    final String experiment,
+    final String scanId,
+    final String resource,
+    final String fileName,
+    final long size,
+    final long partSize
+  ) throws NotFoundException, IOException {
+    final XnatImagesessiondata session = InterfileScans.findSession(
+      user,
+      project,
+      experiment
+    );
+    InterfileScans.findInterfileScan(session, scanId);
+    return store.create(
+      user.getUsername(),
+      session.getId(),
+      scanId,
+      resource,
+      fileName,
+      size,
+      partSize
+    );
+  }
+
+  /**
+   * @throws NotFoundException if there's no such upload, or it was started by
+   *                           another user
+   */
+  public ChunkedUpload get(final UserI user, final String uploadId)
+    throws NotFoundException, IOException {
+    final ChunkedUpload upload;
+    try {
+      upload = store.get(uploadId);
+    } catch (NoSuchElementException e) {
+      throw new NotFoundException(e.getMessage());
+    }
+    if (!upload.getOwner().equals(user.getUsername())) {
+      throw new NotFoundException("No upload " + uploadId);
+    }
+    return upload;
+  }
+
+  public List<Integer> getMissingParts(final ChunkedUpload upload) {
+    return store.getMissingParts(upload);
+  }
+
+  /**
+   * @return the MD5 (hex) of the part
+   * @see ChunkedUploadStore#putPart
+   */
+  public String putPart(
+    final UserI user,
+    final String uploadId,
+    final int part,
+    final InputStream data
+  ) throws NotFoundException, IOException {
+    return store.putPart(get(user, uploadId), part, data);
+  }
+
+  /**
+   * Check the upload is complete (and the MD5 of its part MD5s matches
+   * partsMd5, if given), add the file to the scan's resource, and delete the
+   * upload.
+   *
+   * @return the MD5 of the part MD5s of the file (see
+   *         {@link ChunkedUploadStore#partsMd5})
+   * @throws IllegalStateException     if parts are missing
+   * @throws ChecksumMismatchException if the MD5 of the part MD5s doesn't match
+   *                                   partsMd5 - the upload is kept, so it can
+   *                                   be deleted or parts sent again
+   */
+  public String complete(
+    final UserI user,
+    final String uploadId,
+    final String partsMd5
+  ) throws NotFoundException, IOException, ChecksumMismatchException {
+    final ChunkedUpload upload = get(user, uploadId);
+    final String uploadMd5 = store.complete(upload, partsMd5);
+    final File file = store.getCompletedFile(upload).toFile();
+
+    final XnatImagesessiondata session =
+      XnatImagesessiondata.getXnatImagesessiondatasById(
+        upload.getExperimentId(),
+        user,
+        false
+      );
+    if (session == null) {
+      throw new NotFoundException(
+        "Experiment " + upload.getExperimentId() + " no longer exists"
+      );
+    }
+    final XnatImagescandata scan = InterfileScans.findInterfileScan(
+      session,
+      upload.getScanId()
+    );
+    final String scanUri =
+      "/archive/experiments/" + session.getId() + "/scans/" + scan.getId();
+    try {
+      final XnatResourcecatalog existing = findResource(
+        scan,
+        upload.getResource()
+      );
+      if (existing == null) {
+        catalogService.insertResources(
+          user,
+          scanUri,
+          Collections.singletonList(file),
+          false,
+          upload.getResource(),
+          null,
+          null,
+          null
+        );
+      } else {
+        final Path directory = existing
+          .getCatalogFile(session.getArchiveRootPath())
+          .getParentFile()
+          .toPath();
+        Files.move(
+          file.toPath(),
+          directory.resolve(upload.getFileName()),
+          StandardCopyOption.REPLACE_EXISTING
+        );
+        catalogService.refreshResourceCatalog(
+          user,
+          scanUri + "/resources/" + existing.getXnatAbstractresourceId(),
+          CatalogService.Operation.Append,
+          CatalogService.Operation.Checksum,
+          CatalogService.Operation.PopulateStats
+        );
+      }
+    } catch (IOException e) {
+      throw e;
+    } catch (Exception e) {
+      throw new IOException(
+        "Failed to add " +
+        upload.getFileName() +
+        " to resource " +
+        upload.getResource() +
+        " of scan " +
+        scan.getId(),
+        e
+      );
+    }
+
+    store.delete(uploadId);
+    log.info(
+      "Added {} to resource {} of scan {} of {}",
+      upload.getFileName(),
+      upload.getResource(),
+      scan.getId(),
+      session.getId()
+    );
+    return uploadMd5;
+  }
+
+  public void delete(final UserI user, final String uploadId)
+    throws NotFoundException, IOException {
+    store.delete(get(user, uploadId).getUploadId());
+  }
+
+  private static XnatResourcecatalog findResource(
+    final XnatImagescandata scan,
+    final String label
+  ) {
+    for (final XnatAbstractresourceI resource : scan.getFile()) {
+      if (
+        label.equals(resource.getLabel()) &&
+        resource instanceof XnatResourcecatalog
+      ) {
+        return (XnatResourcecatalog) resource;
+      }
+    }
+    return null;
+  }
+}
@@ -0,0 +1,250 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.services;
+
+import java.io.File;
+import java.util.Collections;
+import java.util.LinkedHashMap;
+import java.util.Map;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.atomic.AtomicInteger;
+import javax.annotation.PreDestroy;
+import lombok.Value;
+import lombok.extern.slf4j.Slf4j;
+import org.nrg.xapi.exceptions.NotFoundException;
+import org.nrg.xdat.model.XnatAbstractresourceI;
+import org.nrg.xdat.om.InterfilePetlmscandata;
+import org.nrg.xdat.om.XnatAbstractresource;
+import org.nrg.xdat.om.XnatImagescandata;
+import org.nrg.xdat.om.XnatImagesessiondata;
+import org.nrg.xft.event.EventUtils;
+import org.nrg.xft.security.UserI;
+import org.nrg.xft.utils.SaveItemHelper;
+import org.nrg.xnat.interfile.header.InterfileHeader;
+import org.nrg.xnat.interfile.header.ListmodeHeaderFields;
+import org.springframework.stereotype.Service;
+
+/**
+ * Fills the fields of interfile:petLmScanData scans from the listmode header
+ * (.l.hdr) uploaded to their PET_RAW resource, so clients only need to upload
+ * the files. Headers are read in a small pool of background threads. The status
+ * of the latest extraction of each scan is kept in memory, for the last
+ * {@link #MAX_STATUSES} scans extracted.
+ */
+@Service
+@Slf4j
+public class InterfileHeaderExtractionService {
+  public static final String RESOURCE_LABEL = "PET_RAW";
+  public static final String HEADER_SUFFIX = ".l.hdr";
+
+  public static final int MAX_STATUSES = 10000;
+
+  private static final int EXTRACTION_THREADS = 2;
+
+  public enum Status {
+    QUEUED,
+    RUNNING,
+    COMPLETE,
+    FAILED,
+  }
+
+  @Value
+  public static class ExtractionStatus {
+    Status status;
+    String message;
+  }
+
+  private final Map<String, ExtractionStatus> statuses = boundedMap(
+    MAX_STATUSES
+  );
+  private final ExecutorService executor;
+
+  public InterfileHeaderExtractionService() {
+    final AtomicInteger threadNumber = new AtomicInteger();
+    executor =
+      Executors.newFixedThreadPool(
+        EXTRACTION_THREADS,
+        runnable -> {
+          final Thread thread = new Thread(
+            runnable,
+            "interfile-header-" + threadNumber.incrementAndGet()
+          );
+          thread.setDaemon(true);
+          return thread;
+        }
+      );
+  }
+
+  @PreDestroy
+  public void shutdown() {
+    executor.shutdown();
+  }
+
+  /**
+   * Queue extraction of the header fields of a scan. The scan and its header
+   * are looked up straight away, so a missing scan or header fails the request,
+   * rather than the extraction.
+   *
+   * @param experiment the label or ID of the experiment in project
+   * @throws NotFoundException        if the experiment, scan or header doesn't
+   *                                  exist
+   * @throws IllegalArgumentException if the scan isn't interfile:petLmScanData
+   */
+  public ExtractionStatus submit(
+    final UserI user,
+    final String project,
+    final String experiment,
+    final String scanId
+  ) throws NotFoundException {
+    final XnatImagesessiondata session = InterfileScans.findSession(
+      user,
+      project,
+      experiment
+    );
+    // projection data and image headers are read by the client
+    final XnatImagescandata scan = InterfileScans.findInterfileScan(
+      session,
+      scanId,
+      Collections.singletonList(InterfilePetlmscandata.SCHEMA_ELEMENT_NAME)
+    );
+    final File headerFile = findHeaderFile(session, scan);
+    final String key = statusKey(session, scanId);
+
+    final ExtractionStatus queued = new ExtractionStatus(Status.QUEUED, null);
+    statuses.put(key, queued);
+    executor.submit(() -> extract(user, scan, headerFile, key));
+    log.info(
+      "Queued extraction of interfile header {} for scan {} of {}",
+      headerFile.getName(),
+      scanId,
+      session.getId()
+    );
+    return queued;
+  }
+
+  /**
+   * Status of the latest extraction of the header fields of a scan.
+   *
+   * @throws NotFoundException if the experiment or scan doesn't exist, or no
+   *                           extraction was queued for it since the server
+   *                           started (or its status was dropped, as
+   *                           {@link #MAX_STATUSES} scans were extracted
+   *                           since)
+   */
+  public ExtractionStatus getStatus(
+    final UserI user,
+    final String project,
+    final String experiment,
+    final String scanId
+  ) throws NotFoundException {
+    final XnatImagesessiondata session = InterfileScans.findSession(
+      user,
+      project,
+      experiment
+    );
+    final ExtractionStatus status = statuses.get(statusKey(session, scanId));
+    if (status == null) {
+      throw new NotFoundException(
+        "No header extraction queued for scan " + scanId + " of " + experiment
+      );
+    }
+    return status;
+  }
+
+  private void extract(
+    final UserI user,
+    final XnatImagescandata scan,
+    final File headerFile,
+    final String key
+  ) {
+    statuses.put(key, new ExtractionStatus(Status.RUNNING, null));
+    try {
+      final Map<String, Object> fields = ListmodeHeaderFields.fromHeader(
+        InterfileHeader.read(headerFile.toPath())
+      );
+      for (final Map.Entry<String, Object> field : fields.entrySet()) {
+        scan.setProperty(field.getKey(), field.getValue());
+      }
+      SaveItemHelper.authorizedSave(
+        scan,
+        user,
+        false,
+        false,
+        EventUtils.DEFAULT_EVENT(user, "Extracted interfile header fields")
+      );
+      statuses.put(key, new ExtractionStatus(Status.COMPLETE, null));
+      log.info(
+        "Extracted {} fields from interfile header {}",
+        fields.size(),
+        headerFile
+      );
+    } catch (Exception e) {
+      statuses.put(key, new ExtractionStatus(Status.FAILED, e.getMessage()));
+      log.error(
+        "Failed to extract fields from interfile header {}",
+        headerFile,
+        e
+      );
+    }
+  }
+
+  private static File findHeaderFile(
+    final XnatImagesessiondata session,
+    final XnatImagescandata scan
+  ) throws NotFoundException {
+    final String rootPath = session.getArchiveRootPath();
+    for (final XnatAbstractresourceI resource : scan.getFile()) {
+      if (
+        !RESOURCE_LABEL.equals(resource.getLabel()) ||
+        !(resource instanceof XnatAbstractresource)
+      ) {
+        continue;
+      }
+      for (final File file : (
+        (XnatAbstractresource) resource
+      ).getCorrespondingFiles(rootPath)) {
+        if (file.getName().endsWith(HEADER_SUFFIX)) {
+          return file;
+        }
+      }
+    }
+    throw new NotFoundException(
+      "No " +
+      HEADER_SUFFIX +
+      " file in the " +
+      RESOURCE_LABEL +
+      " resource of scan " +
+      scan.getId()
+    );
+  }
+
+  /**
+   * Thread-safe map holding at most maxEntries entries - beyond that, the least
+   * recently updated (or read) entry is dropped.
+   */
+  static <K, V> Map<K, V> boundedMap(final int maxEntries) {
+    return Collections.synchronizedMap(
+      new LinkedHashMap<K, V>(16, 0.75f, true) {
+        @Override
+        protected boolean removeEldestEntry(final Map.Entry<K, V> eldest) {
+          return size() > maxEntries;
+        }
+      }
+    );
+  }
+
+  private static String statusKey(
+    final XnatImagesessiondata session,
+    final String scanId
+  ) {
+    return session.getId() + "/" + scanId;
+  }
+}
@@ -0,0 +1,105 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.services;
+
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.List;
+import org.nrg.xapi.exceptions.NotFoundException;
+import org.nrg.xdat.model.XnatImagescandataI;
+import org.nrg.xdat.om.InterfilePetimagescandata;
+import org.nrg.xdat.om.InterfilePetlmscandata;
+import org.nrg.xdat.om.InterfilePetprojscandata;
+import org.nrg.xdat.om.XnatExperimentdata;
+import org.nrg.xdat.om.XnatImagescandata;
+import org.nrg.xdat.om.XnatImagesessiondata;
+import org.nrg.xft.security.UserI;
+
+/**
+ * Lookups of the sessions and interfile scans the plugin's xapi endpoints act
+ * on - these address experiments by project and label (or ID), as the python
+ * client does.
+ */
+final class InterfileScans {
+  /** The interfile scan types - listmode data, projection data and images */
+  static final List<String> SCAN_TYPES = Collections.unmodifiableList(
+    Arrays.asList(
+      InterfilePetlmscandata.SCHEMA_ELEMENT_NAME,
+      InterfilePetprojscandata.SCHEMA_ELEMENT_NAME,
+      InterfilePetimagescandata.SCHEMA_ELEMENT_NAME
+    )
+  );
+
+  private InterfileScans() {}
+
+  /**
+   * @param experiment the label or ID of the experiment in project
+   * @throws NotFoundException if there's no such image session in the project
+   */
+  static XnatImagesessiondata findSession(
+    final UserI user,
+    final String project,
+    final String experiment
+  ) throws NotFoundException {
+    XnatExperimentdata found = XnatExperimentdata.GetExptByProjectIdentifier(
+      project,
+      experiment,
+      user,
+      false
+    );
+    if (found == null) {
+      found =
+        XnatExperimentdata.getXnatExperimentdatasById(experiment, user, false);
+    }
+    if (
+      !(found instanceof XnatImagesessiondata) || !found.hasProject(project)
+    ) {
+      throw new NotFoundException(
+        "No image session " + experiment + " in project " + project
+      );
+    }
+    return (XnatImagesessiondata) found;
+  }
+
+  /**
+   * @throws NotFoundException        if the session has no such scan
+   * @throws IllegalArgumentException if the scan isn't one of the interfile
+   *                                  scan types
+   */
+  static XnatImagescandata findInterfileScan(
+    final XnatImagesessiondata session,
+    final String scanId
+  ) throws NotFoundException {
+    return findInterfileScan(session, scanId, SCAN_TYPES);
+  }
+
+  /**
+   * @throws NotFoundException        if the session has no such scan
+   * @throws IllegalArgumentException if the scan isn't one of scanTypes
+   */
+  static XnatImagescandata findInterfileScan(
+    final XnatImagesessiondata session,
+    final String scanId,
+    final List<String> scanTypes
+  ) throws NotFoundException {
+    final XnatImagescandataI scan = session.getScanById(scanId);
+    if (scan == null) {
+      throw new NotFoundException(
+        "No scan " + scanId + " in " + session.getLabel()
+      );
+    }
+    if (!scanTypes.contains(((XnatImagescandata) scan).getXSIType())) {
+      throw new IllegalArgumentException(
+        "Scan " + scanId + " isn't " + String.join(" or ", scanTypes)
+      );
+    }
+    return (XnatImagescandata) scan;
+  }
+}
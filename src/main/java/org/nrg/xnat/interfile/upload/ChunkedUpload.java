@@ -0,0 +1,46 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.upload;
+
+import com.fasterxml.jackson.annotation.JsonIgnore;
+import lombok.Value;
+
+/**
+ * A file being uploaded in parts (see {@link ChunkedUploadStore}). Parts are
+ * numbered from 1, and all but the last are partSize bytes.
+ */
+@Value
+public class ChunkedUpload {
+  String uploadId;
+
+  /** Username of the user that started the upload - only they can add parts */
+  @JsonIgnore
+  String owner;
+
+  /**
+   * IDs of the experiment and scan, and label of the resource, the file is
+   * added to once complete
+   */
+  String experimentId;
+  String scanId;
+  String resource;
+  String fileName;
+  long size;
+  long partSize;
+
+  public int getNumberOfParts() {
+    return (int) ((size + partSize - 1) / partSize);
+  }
+
+  /** Number of bytes in a part */
+  public long getPartLength(final int part) {
+    return Math.min(partSize, size - (part - 1) * partSize);
+  }
+}
@@ -0,0 +1,478 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.upload;
+
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.RandomAccessFile;
+import java.io.Reader;
+import java.io.Writer;
+import java.math.BigInteger;
+import java.nio.ByteBuffer;
+import java.nio.channels.FileChannel;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.DirectoryStream;
+import java.nio.file.Files;
+import java.nio.file.NoSuchFileException;
+import java.nio.file.Path;
+import java.nio.file.StandardCopyOption;
+import java.nio.file.StandardOpenOption;
+import java.nio.file.attribute.FileTime;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
+import java.time.Duration;
+import java.time.Instant;
+import java.util.ArrayList;
+import java.util.Comparator;
+import java.util.List;
+import java.util.NoSuchElementException;
+import java.util.Properties;
+import java.util.UUID;
+import java.util.stream.Collectors;
+import java.util.stream.Stream;
+import lombok.extern.slf4j.Slf4j;
+
+/**
+ * Staging area for files uploaded in parts, so a very large file can be sent
+ * over several connections at once, and a failed part re-sent on its own. Each
+ * upload is a directory under root holding the file, allocated at its full size
+ * when the upload is created. Each part is written straight to its offset in
+ * the file, and hashed as it is written, so the file is never read back - the
+ * parts are never copied into place, and completing the upload checks the
+ * {@link #partsMd5 MD5 of the part MD5s} rather than the MD5 of the file.
+ *
+ * A part is only recorded as received (with its MD5) once all of it has been
+ * written, so a part whose request failed part way through is simply sent
+ * again. Parts can arrive in any order, and from several threads at once.
+ * Uploads that are abandoned (neither completed nor deleted) are removed by
+ * {@link #deleteExpired}.
+ */
+@Slf4j
+public class ChunkedUploadStore {
+  /** Most parts an upload may have - 10,000 parts of 64 MiB is over 600 GiB */
+  public static final int MAX_PARTS = 10000;
+
+  private static final String METADATA_FILE = "upload.properties";
+  private static final String DATA_FILE = "data";
+  private static final String PARTS_DIR = "parts";
+  private static final String COMPLETE_DIR = "complete";
+  private static final int BUFFER_SIZE = 1024 * 1024;
+
+  /** The checksum of an uploaded file doesn't match the one the client gave */
+  public static class ChecksumMismatchException extends Exception {
+    public ChecksumMismatchException(final String message) {
+      super(message);
+    }
+  }
+
+  private final Path root;
+
+  public ChunkedUploadStore(final Path root) {
+    this.root = root;
+  }
+
+  /**
+   * Start an upload of size bytes, to be sent in parts of partSize bytes.
+   *
+   * @throws IllegalArgumentException if the file name isn't a plain file name,
+   *                                  or the sizes would give more than
+   *                                  MAX_PARTS parts
+   */
+  public ChunkedUpload create(
+    final String owner,
+    final String experimentId,
+    final String scanId,
+    final String resource,
+    final String fileName,
+    final long size,
+    final long partSize
+  ) throws IOException {
+    if (
+      fileName.isEmpty() ||
+      fileName.contains("/") ||
+      fileName.contains("\\") ||
+      fileName.startsWith(".")
+    ) {
+      throw new IllegalArgumentException("Invalid file name " + fileName);
+    }
+    if (size < 0 || partSize <= 0) {
+      throw new IllegalArgumentException(
+        "Invalid size " + size + " or part size " + partSize
+      );
+    }
+    final ChunkedUpload upload = new ChunkedUpload(
+      UUID.randomUUID().toString(),
+      owner,
+      experimentId,
+      scanId,
+      resource,
+      fileName,
+      size,
+      partSize
+    );
+    if (upload.getNumberOfParts() > MAX_PARTS) {
+      throw new IllegalArgumentException(
+        "An upload can't have more than " +
+        MAX_PARTS +
+        " parts - use larger parts"
+      );
+    }
+
+    final Path directory = root.resolve(upload.getUploadId());
+    Files.createDirectories(directory.resolve(PARTS_DIR));
+    try (
+      final RandomAccessFile file = new RandomAccessFile(
+        directory.resolve(DATA_FILE).toFile(),
+        "rw"
+      )
+    ) {
+      // sparse on most filesystems - space is only used as parts are written
+      file.setLength(size);
+    }
+
+    final Properties metadata = new Properties();
+    metadata.setProperty("owner", owner);
+    metadata.setProperty("experimentId", experimentId);
+    metadata.setProperty("scanId", scanId);
+    metadata.setProperty("resource", resource);
+    metadata.setProperty("fileName", fileName);
+    metadata.setProperty("size", Long.toString(size));
+    metadata.setProperty("partSize", Long.toString(partSize));
+    try (
+      final Writer writer = Files.newBufferedWriter(
+        directory.resolve(METADATA_FILE),
+        StandardCharsets.UTF_8
+      )
+    ) {
+      metadata.store(writer, null);
+    }
+    log.info(
+      "Started upload {} of {} ({} bytes in {} parts)",
+      upload.getUploadId(),
+      fileName,
+      size,
+      upload.getNumberOfParts()
+    );
+    return upload;
+  }
+
+  /**
+   * @throws NoSuchElementException if there's no upload with the ID
+   */
+  public ChunkedUpload get(final String uploadId) throws IOException {
+    final Properties metadata = new Properties();
+    try (
+      final Reader reader = Files.newBufferedReader(
+        directory(uploadId).resolve(METADATA_FILE),
+        StandardCharsets.UTF_8
+      )
+    ) {
+      metadata.load(reader);
+    } catch (NoSuchFileException e) {
+      throw new NoSuchElementException("No upload " + uploadId);
+    }
+    return new ChunkedUpload(
+      uploadId,
+      metadata.getProperty("owner"),
+      metadata.getProperty("experimentId"),
+      metadata.getProperty("scanId"),
+      metadata.getProperty("resource"),
+      metadata.getProperty("fileName"),
+      Long.parseLong(metadata.getProperty("size")),
+      Long.parseLong(metadata.getProperty("partSize"))
+    );
+  }
+
+  /**
+   * Write a part of the file, replacing it if it was already sent.
+   *
+   * @return the MD5 (hex) of the part, so the client can check it arrived
+   *         intact
+   * @throws IllegalArgumentException if there's no such part, or data doesn't
+   *                                  hold exactly the number of bytes in the
+   *                                  part
+   */
+  public String putPart(
+    final ChunkedUpload upload,
+    final int part,
+    final InputStream data
+  ) throws IOException {
+    if (part < 1 || part > upload.getNumberOfParts()) {
+      throw new IllegalArgumentException(
+        "Upload " + upload.getUploadId() + " has no part " + part
+      );
+    }
+    final Path directory = directory(upload.getUploadId());
+    final Path marker = partMarker(directory, part);
+    // a part being sent again isn't complete until all of it has been written
+    // again
+    Files.deleteIfExists(marker);
+
+    final long length = upload.getPartLength(part);
+    final MessageDigest md5 = md5();
+    final byte[] buffer = new byte[BUFFER_SIZE];
+    long written = 0;
+    try (
+      final FileChannel channel = FileChannel.open(
+        directory.resolve(DATA_FILE),
+        StandardOpenOption.WRITE
+      )
+    ) {
+      long position = (part - 1) * upload.getPartSize();
+      final int maxRead = (int) Math.min(buffer.length, length + 1);
+      int read;
+      // reads one byte beyond the part, to tell if the body is too long
+      while ((read = data.read(buffer, 0, maxRead)) > 0) {
+        written += read;
+        if (written > length) {
+          break;
+        }
+        md5.update(buffer, 0, read);
+        final ByteBuffer chunk = ByteBuffer.wrap(buffer, 0, read);
+        while (chunk.hasRemaining()) {
+          position += channel.write(chunk, position);
+        }
+      }
+    }
+    if (written != length) {
+      throw new IllegalArgumentException(
+        "Part " +
+        part +
+        " must be " +
+        length +
+        " bytes, got " +
+        (written > length ? "more" : Long.toString(written))
+      );
+    }
+
+    final String partMd5 = hex(md5.digest());
+    final Path temporary = directory.resolve(PARTS_DIR).resolve(part + ".tmp");
+    Files.write(temporary, partMd5.getBytes(StandardCharsets.US_ASCII));
+    Files.move(
+      temporary,
+      marker,
+      StandardCopyOption.ATOMIC_MOVE,
+      StandardCopyOption.REPLACE_EXISTING
+    );
+    return partMd5;
+  }
+
+  /** Numbers of the parts that haven't been (completely) received yet */
+  public List<Integer> getMissingParts(final ChunkedUpload upload) {
+    final Path directory = directory(upload.getUploadId());
+    final List<Integer> missing = new ArrayList<>();
+    for (int part = 1; part <= upload.getNumberOfParts(); part++) {
+      if (!Files.exists(partMarker(directory, part))) {
+        missing.add(part);
+      }
+    }
+    return missing;
+  }
+
+  /**
+   * Check all parts were received, and the {@link #partsMd5 MD5 of their MD5s}
+   * matches partsMd5 (if given), then move the file to a directory of its own
+   * in the upload, under its file name. Only the part MD5s recorded as the
+   * parts were written are read, so this takes the same time whatever the size
+   * of the file.
+   *
+   * @return the MD5 of the part MD5s of the file, which is then at
+   *         {@link #getCompletedFile} - delete the upload once it has been
+   *         archived
+   * @throws IllegalStateException     if parts are missing
+   * @throws ChecksumMismatchException if the MD5 of the part MD5s doesn't match
+   *                                   partsMd5
+   */
+  public String complete(final ChunkedUpload upload, final String partsMd5)
+    throws IOException, ChecksumMismatchException {
+    final List<Integer> missing = getMissingParts(upload);
+    if (!missing.isEmpty()) {
+      throw new IllegalStateException(
+        "Upload " +
+        upload.getUploadId() +
+        " is missing " +
+        missing.size() +
+        " parts, starting with part " +
+        missing.get(0)
+      );
+    }
+
+    final Path directory = directory(upload.getUploadId());
+    final List<String> partMd5s = new ArrayList<>();
+    for (int part = 1; part <= upload.getNumberOfParts(); part++) {
+      partMd5s.add(
+        new String(
+          Files.readAllBytes(partMarker(directory, part)),
+          StandardCharsets.US_ASCII
+        )
+      );
+    }
+    final String uploadMd5 = partsMd5(partMd5s);
+    if (partsMd5 != null && !partsMd5.equalsIgnoreCase(uploadMd5)) {
+      throw new ChecksumMismatchException(
+        "MD5 of the parts of upload " +
+        upload.getUploadId() +
+        " (" +
+        uploadMd5 +
+        ") doesn't match " +
+        partsMd5
+      );
+    }
+
+    final Path complete = getCompletedFile(upload);
+    Files.createDirectories(complete.getParent());
+    Files.move(
+      directory.resolve(DATA_FILE),
+      complete,
+      StandardCopyOption.ATOMIC_MOVE
+    );
+    log.info(
+      "Completed upload {} of {} (MD5 of parts {})",
+      upload.getUploadId(),
+      upload.getFileName(),
+      uploadMd5
+    );
+    return uploadMd5;
+  }
+
+  /**
+   * Checksum of a file uploaded in parts, from the MD5s (hex) of its parts in
+   * order - the MD5 (hex) of the concatenated (binary) part MD5s, then '-' and
+   * the number of parts, as the ETag of an S3 multipart upload.
+   */
+  public static String partsMd5(final List<String> partMd5s) {
+    final MessageDigest md5 = md5();
+    for (final String partMd5 : partMd5s) {
+      md5.update(unhex(partMd5));
+    }
+    return hex(md5.digest()) + "-" + partMd5s.size();
+  }
+
+  /** Path of the file of a completed upload, under its file name */
+  public Path getCompletedFile(final ChunkedUpload upload) {
+    return directory(upload.getUploadId())
+      .resolve(COMPLETE_DIR)
+      .resolve(upload.getFileName());
+  }
+
+  /** Delete an upload, and any parts received */
+  public void delete(final String uploadId) throws IOException {
+    final Path directory = directory(uploadId);
+    if (!Files.exists(directory)) {
+      return;
+    }
+    final List<Path> paths;
+    try (final Stream<Path> walk = Files.walk(directory)) {
+      // files before the directories holding them
+      paths =
+        walk.sorted(Comparator.reverseOrder()).collect(Collectors.toList());
+    }
+    for (final Path path : paths) {
+      Files.delete(path);
+    }
+  }
+
+  /**
+   * Delete the uploads nothing has been written to for longer than maxIdle, so
+   * the space allocated to abandoned uploads is freed.
+   *
+   * @return the number of uploads deleted
+   */
+  public int deleteExpired(final Duration maxIdle) throws IOException {
+    final Instant cutoff = Instant.now().minus(maxIdle);
+    int deleted = 0;
+    for (final String uploadId : getUploadIds()) {
+      try {
+        final Instant lastModified = getLastModified(root.resolve(uploadId));
+        if (lastModified.isBefore(cutoff)) {
+          delete(uploadId);
+          deleted++;
+          log.info(
+            "Deleted upload {}, unused since {}",
+            uploadId,
+            lastModified
+          );
+        }
+      } catch (NoSuchElementException | IOException e) {
+        // not an upload, or completed or deleted meanwhile
+        log.warn("Failed to check for expiry of upload {}", uploadId, e);
+      }
+    }
+    return deleted;
+  }
+
+  /** IDs of all uploads in the store, e.g. to clean up abandoned uploads */
+  public List<String> getUploadIds() throws IOException {
+    final List<String> uploadIds = new ArrayList<>();
+    if (!Files.isDirectory(root)) {
+      return uploadIds;
+    }
+    try (
+      final DirectoryStream<Path> directories = Files.newDirectoryStream(
+        root,
+        Files::isDirectory
+      )
+    ) {
+      for (final Path directory : directories) {
+        uploadIds.add(directory.getFileName().toString());
+      }
+    }
+    return uploadIds;
+  }
+
+  private Path directory(final String uploadId) {
+    try {
+      // upload IDs are UUIDs - anything else can't name a directory in the
+      // store
+      return root.resolve(UUID.fromString(uploadId).toString());
+    } catch (IllegalArgumentException e) {
+      throw new NoSuchElementException("No upload " + uploadId);
+    }
+  }
+
+  /** Latest modification time of the directory of an upload, or its files */
+  private static Instant getLastModified(final Path directory)
+    throws IOException {
+    FileTime lastModified = Files.getLastModifiedTime(directory);
+    try (final Stream<Path> walk = Files.walk(directory)) {
+      for (final Path path : (Iterable<Path>) walk::iterator) {
+        final FileTime modified = Files.getLastModifiedTime(path);
+        if (modified.compareTo(lastModified) > 0) {
+          lastModified = modified;
+        }
+      }
+    }
+    return lastModified.toInstant();
+  }
+
+  private static Path partMarker(final Path directory, final int part) {
+    return directory.resolve(PARTS_DIR).resolve(Integer.toString(part));
+  }
+
+  private static MessageDigest md5() {
+    try {
+      return MessageDigest.getInstance("MD5");
+    } catch (NoSuchAlgorithmException e) {
+      throw new IllegalStateException("MD5 isn't available", e);
+    }
+  }
+
+  private static String hex(final byte[] digest) {
+    return String.format("%032x", new BigInteger(1, digest));
+  }
+
+  private static byte[] unhex(final String hex) {
+    final byte[] bytes = new byte[hex.length() / 2];
+    for (int i = 0; i < bytes.length; i++) {
+      bytes[i] = (byte) Integer.parseInt(hex.substring(2 * i, 2 * i + 2), 16);
+    }
+    return bytes;
+  }
+}
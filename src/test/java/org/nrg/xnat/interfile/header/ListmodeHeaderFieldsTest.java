@@ -0,0 +1,152 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.header;
+
+import static org.assertj.core.api.Assertions.assertThat;
+import static org.assertj.core.api.Assertions.entry;
+import static org.nrg.xnat.interfile.header.ListmodeHeaderFields.SCAN_TYPE;
+
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.StringReader;
+import java.nio.charset.StandardCharsets;
+import java.util.LinkedHashMap;
+import java.util.Map;
+import java.util.Properties;
+import org.junit.jupiter.api.Test;
+
+class ListmodeHeaderFieldsTest {
+  private static BufferedReader resourceReader(final String name) {
+    return new BufferedReader(
+      new InputStreamReader(
+        ListmodeHeaderFieldsTest.class.getResourceAsStream(name),
+        StandardCharsets.ISO_8859_1
+      )
+    );
+  }
+
+  private static InterfileHeader readResource(final String name)
+    throws IOException {
+    try (final BufferedReader reader = resourceReader(name)) {
+      return InterfileHeader.read(reader);
+    }
+  }
+
+  @Test
+  void standardisesKeys() {
+    assertThat(InterfileHeader.standardiseKey("!INTERFILE"))
+      .isEqualTo("interfile");
+    assertThat(InterfileHeader.standardiseKey("%patient   orientation "))
+      .isEqualTo("patient orientation");
+    assertThat(
+      InterfileHeader.standardiseKey("!Energy Window Lower Level [1]")
+    )
+      .isEqualTo("energy window lower level[1]");
+  }
+
+  @Test
+  void readsHeader() throws IOException {
+    final InterfileHeader header = readResource("test.l.hdr");
+
+    assertThat(header.get("originating system")).isEqualTo("2008");
+    assertThat(header.get("!name of data file")).isEqualTo("test.l");
+    assertThat(header.get("energy window upper level [1]")).isEqualTo("610");
+
+    // section headings, comments and anything after the end of the header are
+    // ignored
+    assertThat(header.getValues())
+      .doesNotContainKeys("general data", "a comment line");
+    assertThat(header.get("isotope name")).isEqualTo("F-18");
+
+    assertThat(header.getIndexed("image duration (sec)"))
+      .containsExactly(entry(1, "1800"), entry(2, "1800"));
+  }
+
+  @Test
+  void convertsListmodeHeader() throws IOException {
+    final Map<String, Object> fields = ListmodeHeaderFields.fromHeader(
+      readResource("test.l.hdr")
+    );
+
+    assertThat(fields)
+      .containsEntry(SCAN_TYPE + "/scannerInformation/name", "Siemens mMR")
+      .containsEntry(
+        SCAN_TYPE + "/radionuclideInformation/radionuclide",
+        "^18^Fluorine"
+      )
+      .containsEntry(SCAN_TYPE + "/radionuclideInformation/halfLife", 6586.2)
+      .containsEntry(
+        SCAN_TYPE + "/radionuclideInformation/branchingRatio",
+        0.97
+      )
+      .containsEntry(SCAN_TYPE + "/examInformation/lowEnergyThres", 430.0)
+      .containsEntry(SCAN_TYPE + "/examInformation/highEnergyThres", 610.0)
+      .containsEntry(SCAN_TYPE + "/examInformation/patientPosition", "HFS")
+      .containsEntry(SCAN_TYPE + "/frameInformation/frameStart", 0.0)
+      .containsEntry(SCAN_TYPE + "/frameInformation/frameEnd", 3600.0)
+      .containsEntry(SCAN_TYPE + "/frameInformation/frameDuration", 3600.0);
+  }
+
+  @Test
+  void convertsInterfile33Header() throws IOException {
+    final InterfileHeader header = InterfileHeader.read(
+      new BufferedReader(
+        new StringReader(
+          "!INTERFILE:=\n" +
+          "originating system:=Unknown scanner\n" +
+          "isotope name:=I-124\n" +
+          "patient orientation:=head_in\n" +
+          "patient rotation:=prone\n" +
+          "image duration (sec):=600\n"
+        )
+      )
+    );
+    final Map<String, Object> fields = ListmodeHeaderFields.fromHeader(header);
+
+    assertThat(fields)
+      .containsEntry(SCAN_TYPE + "/scannerInformation/name", "Unknown scanner")
+      .containsEntry(
+        SCAN_TYPE + "/radionuclideInformation/radionuclide",
+        "I-124"
+      )
+      .containsEntry(SCAN_TYPE + "/radionuclideInformation/halfLife", -1.0)
+      .containsEntry(SCAN_TYPE + "/examInformation/lowEnergyThres", -1.0)
+      .containsEntry(SCAN_TYPE + "/examInformation/patientPosition", "HFP")
+      .containsEntry(SCAN_TYPE + "/frameInformation/frameDuration", 600.0);
+  }
+
+  /**
+   * mmr.l.hdr.fields holds every field the python package's native header
+   * backend sets for mmr.l.hdr (checked by test_native_fields_match_plugin), so
+   * both extractors must agree on all of them.
+   */
+  @Test
+  void matchesPythonNativeBackend() throws IOException {
+    final Properties expected = new Properties();
+    try (final BufferedReader reader = resourceReader("mmr.l.hdr.fields")) {
+      expected.load(reader);
+    }
+    final Map<String, Object> expectedFields = new LinkedHashMap<>();
+    final Map<String, Object> fields = ListmodeHeaderFields.fromHeader(
+      readResource("mmr.l.hdr")
+    );
+    for (final String path : expected.stringPropertyNames()) {
+      final String name = SCAN_TYPE + "/" + path;
+      final String value = expected.getProperty(path);
+      expectedFields.put(
+        name,
+        fields.get(name) instanceof Double ? Double.valueOf(value) : value
+      );
+    }
+
+    assertThat(fields).containsExactlyInAnyOrderEntriesOf(expectedFields);
+  }
+}
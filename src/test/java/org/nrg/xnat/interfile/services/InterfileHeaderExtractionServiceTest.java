@@ -0,0 +1,32 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.services;
+
+import static org.assertj.core.api.Assertions.assertThat;
+
+import java.util.Map;
+import org.junit.jupiter.api.Test;
+
+class InterfileHeaderExtractionServiceTest {
+  @Test
+  void boundedMapDropsLeastRecentlyUsedEntries() {
+    final Map<String, String> statuses =
+      InterfileHeaderExtractionService.boundedMap(3);
+    statuses.put("E1/1", "COMPLETE");
+    statuses.put("E1/2", "COMPLETE");
+    statuses.put("E1/3", "RUNNING");
+    // an update makes an entry the most recent
+    statuses.put("E1/1", "FAILED");
+    statuses.put("E1/4", "QUEUED");
+
+    assertThat(statuses).hasSize(3).containsOnlyKeys("E1/1", "E1/3", "E1/4");
+    assertThat(statuses.get("E1/1")).isEqualTo("FAILED");
+  }
+}
@@ -0,0 +1,250 @@
+/*
+ * xnat-interfile-plugin:
+ * XNAT http://www.xnat.org
+ * Copyright (c) 2022, Physikalisch-Technische Bundesanstalt
+ * All Rights Reserved
+ *
+ * Released under Apache 2.0
+ */
+
+package org.nrg.xnat.interfile.upload;
+
+import static org.assertj.core.api.Assertions.assertThat;
+import static org.assertj.core.api.Assertions.assertThatThrownBy;
+
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.math.BigInteger;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.attribute.FileTime;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
+import java.time.Duration;
+import java.time.Instant;
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.NoSuchElementException;
+import java.util.Random;
+import java.util.stream.Stream;
+import org.junit.jupiter.api.BeforeEach;
+import org.junit.jupiter.api.Test;
+import org.junit.jupiter.api.io.TempDir;
+
+class ChunkedUploadStoreTest {
+  private static final int PART_SIZE = 1000;
+
+  @TempDir
+  Path root;
+
+  private ChunkedUploadStore store;
+  private byte[] content;
+
+  @BeforeEach
+  void setUp() {
+    store = new ChunkedUploadStore(root);
+    content = new byte[3 * PART_SIZE + 123];
+    new Random(0).nextBytes(content);
+  }
+
+  private ChunkedUpload create() throws IOException {
+    return store.create(
+      "admin",
+      "XNAT_E00001",
+      "1",
+      "PET_RAW",
+      "test.l",
+      content.length,
+      PART_SIZE
+    );
+  }
+
+  private byte[] partOf(final int part) {
+    final int start = (part - 1) * PART_SIZE;
+    return Arrays.copyOfRange(
+      content,
+      start,
+      Math.min(start + PART_SIZE, content.length)
+    );
+  }
+
+  private String putPart(final ChunkedUpload upload, final int part)
+    throws IOException {
+    return store.putPart(upload, part, new ByteArrayInputStream(partOf(part)));
+  }
+
+  private static byte[] digest(final byte[] data)
+    throws NoSuchAlgorithmException {
+    return MessageDigest.getInstance("MD5").digest(data);
+  }
+
+  private static String md5(final byte[] data)
+    throws NoSuchAlgorithmException {
+    return String.format("%032x", new BigInteger(1, digest(data)));
+  }
+
+  /** MD5 of the concatenated MD5s of the four parts of the content */
+  private String contentPartsMd5() throws NoSuchAlgorithmException {
+    final ByteArrayOutputStream partDigests = new ByteArrayOutputStream();
+    for (int part = 1; part <= 4; part++) {
+      final byte[] partDigest = digest(partOf(part));
+      partDigests.write(partDigest, 0, partDigest.length);
+    }
+    return md5(partDigests.toByteArray()) + "-4";
+  }
+
+  @Test
+  void reassemblesPartsInAnyOrder() throws Exception {
+    final ChunkedUpload upload = create();
+    assertThat(upload.getNumberOfParts()).isEqualTo(4);
+    assertThat(upload.getPartLength(4)).isEqualTo(123);
+
+    for (final int part : new int[] { 3, 1, 4, 2 }) {
+      assertThat(putPart(upload, part)).isEqualTo(md5(partOf(part)));
+    }
+    assertThat(store.getMissingParts(upload)).isEmpty();
+
+    assertThat(store.complete(upload, contentPartsMd5()))
+      .isEqualTo(contentPartsMd5());
+    assertThat(store.getCompletedFile(upload).getFileName().toString())
+      .isEqualTo("test.l");
+    assertThat(Files.readAllBytes(store.getCompletedFile(upload)))
+      .isEqualTo(content);
+  }
+
+  @Test
+  void partsMd5OfNoParts() throws Exception {
+    assertThat(ChunkedUploadStore.partsMd5(Collections.emptyList()))
+      .isEqualTo(md5(new byte[0]) + "-0");
+  }
+
+  @Test
+  void readsUploadBack() throws IOException {
+    final ChunkedUpload upload = create();
+    assertThat(store.get(upload.getUploadId())).isEqualTo(upload);
+    assertThat(store.getUploadIds()).containsExactly(upload.getUploadId());
+  }
+
+  @Test
+  void reportsMissingParts() throws IOException {
+    final ChunkedUpload upload = create();
+    putPart(upload, 2);
+    assertThat(store.getMissingParts(upload)).containsExactly(1, 3, 4);
+    assertThatThrownBy(() -> store.complete(upload, null))
+      .isInstanceOf(IllegalStateException.class);
+  }
+
+  @Test
+  void rejectsPartsOfTheWrongSize() throws IOException {
+    final ChunkedUpload upload = create();
+    assertThatThrownBy(
+        () ->
+          store.putPart(
+            upload,
+            1,
+            new ByteArrayInputStream(new byte[PART_SIZE - 1])
+          )
+      )
+      .isInstanceOf(IllegalArgumentException.class);
+    assertThatThrownBy(
+        () ->
+          store.putPart(
+            upload,
+            4,
+            new ByteArrayInputStream(new byte[PART_SIZE])
+          )
+      )
+      .isInstanceOf(IllegalArgumentException.class);
+    assertThatThrownBy(
+        () -> store.putPart(upload, 5, new ByteArrayInputStream(new byte[0]))
+      )
+      .isInstanceOf(IllegalArgumentException.class);
+    assertThat(store.getMissingParts(upload)).containsExactly(1, 2, 3, 4);
+  }
+
+  @Test
+  void replacesPartSentAgain() throws Exception {
+    final ChunkedUpload upload = create();
+    store.putPart(upload, 1, new ByteArrayInputStream(new byte[PART_SIZE]));
+    for (int part = 1; part <= 4; part++) {
+      putPart(upload, part);
+    }
+    assertThat(store.complete(upload, null)).isEqualTo(contentPartsMd5());
+    assertThat(Files.readAllBytes(store.getCompletedFile(upload)))
+      .isEqualTo(content);
+  }
+
+  @Test
+  void rejectsChecksumMismatch() throws Exception {
+    final ChunkedUpload upload = create();
+    for (int part = 1; part <= 4; part++) {
+      putPart(upload, part);
+    }
+    // the MD5 of the whole file isn't the MD5 of the part MD5s
+    assertThatThrownBy(() -> store.complete(upload, md5(content)))
+      .isInstanceOf(ChunkedUploadStore.ChecksumMismatchException.class);
+    assertThat(store.getCompletedFile(upload)).doesNotExist();
+  }
+
+  @Test
+  void deletesUpload() throws IOException {
+    final ChunkedUpload upload = create();
+    putPart(upload, 1);
+    store.delete(upload.getUploadId());
+    assertThat(store.getUploadIds()).isEmpty();
+    assertThatThrownBy(() -> store.get(upload.getUploadId()))
+      .isInstanceOf(NoSuchElementException.class);
+  }
+
+  @Test
+  void deletesExpiredUploads() throws IOException {
+    final ChunkedUpload abandoned = create();
+    putPart(abandoned, 1);
+    final ChunkedUpload active = create();
+    final FileTime twoDaysAgo = FileTime.from(
+      Instant.now().minus(Duration.ofDays(2))
+    );
+    final Path uploadDirectory = root.resolve(abandoned.getUploadId());
+    try (final Stream<Path> walk = Files.walk(uploadDirectory)) {
+      for (final Path path : (Iterable<Path>) walk::iterator) {
+        Files.setLastModifiedTime(path, twoDaysAgo);
+      }
+    }
+
+    assertThat(store.deleteExpired(Duration.ofDays(1))).isEqualTo(1);
+    assertThat(store.getUploadIds()).containsExactly(active.getUploadId());
+  }
+
+  @Test
+  void rejectsInvalidUploads() {
+    assertThatThrownBy(() -> store.get("../etc"))
+      .isInstanceOf(NoSuchElementException.class);
+    assertThatThrownBy(
+        () ->
+          store.create(
+            "admin",
+            "XNAT_E00001",
+            "1",
+            "PET_RAW",
+            "../test.l",
+            10,
+            10
+          )
+      )
+      .isInstanceOf(IllegalArgumentException.class);
+    assertThatThrownBy(
+        () ->
+          store.create(
+            "admin",
+            "XNAT_E00001",
+            "1",
+            "PET_RAW",
+            "test.l",
+            10L * ChunkedUploadStore.MAX_PARTS + 1,
+            10
+          )
+      )
+      .isInstanceOf(IllegalArgumentException.class);
+  }
+}